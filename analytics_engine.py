@@ -0,0 +1,275 @@
+"""
+AnalyticsEngine class for computing the analytics dashboard in a single database round-trip
+"""
+import copy
+import logging
+import threading
+import time
+from collections import OrderedDict
+from datetime import date, datetime, timedelta
+from typing import Any, Dict, Optional, Tuple
+
+from db_manager import DatabaseManager
+from analytics_rollups import POSITIVE_TAG, get_rollups
+from config import ANALYTICS_CACHE_TTL, ANALYTICS_CACHE_SIZE
+
+logger = logging.getLogger(__name__)
+
+# One statement: the additive sections (feedback counts, tags, latency, tokens, costs)
+# are summed from the hourly rollups, so they read O(hours) rows; only the distinct
+# query count and the recent interactions still touch votes, through the timestamp index.
+DASHBOARD_SQL = """
+WITH v AS (
+    SELECT vote_id, user_query, feedback_tags, comment, timestamp
+    FROM votes
+    WHERE (%(start)s::timestamptz IS NULL OR timestamp >= %(start)s::timestamptz)
+      AND (%(end)s::timestamptz IS NULL OR timestamp < %(end)s::timestamptz)
+),
+vote_totals AS (
+    SELECT COALESCE(SUM(vote_count), 0) AS total_feedback,
+           COALESCE(SUM(positive_count), 0) AS positive_feedback,
+           (SELECT COUNT(DISTINCT user_query) FROM v) AS total_queries
+    FROM feedback_rollup_hourly
+    WHERE (%(start)s::timestamptz IS NULL OR bucket >= %(start)s::timestamptz)
+      AND (%(end)s::timestamptz IS NULL OR bucket < %(end)s::timestamptz)
+),
+tags AS (
+    SELECT tag, SUM(count) AS count
+    FROM feedback_tag_rollup_hourly
+    WHERE (%(start)s::timestamptz IS NULL OR bucket >= %(start)s::timestamptz)
+      AND (%(end)s::timestamptz IS NULL OR bucket < %(end)s::timestamptz)
+    GROUP BY tag
+),
+recent AS (
+    SELECT vote_id, user_query, feedback_tags, comment, timestamp,
+           CASE WHEN %(positive_tag)s = ANY(feedback_tags) THEN 'Positive' ELSE 'Negative' END AS feedback_status
+    FROM v
+    ORDER BY timestamp DESC
+    LIMIT %(recent_limit)s
+),
+q AS (
+    SELECT *
+    FROM rag_query_rollup_hourly
+    WHERE (%(start)s::timestamptz IS NULL OR bucket >= %(start)s::timestamptz)
+      AND (%(end)s::timestamptz IS NULL OR bucket < %(end)s::timestamptz)
+),
+query_totals AS (
+    SELECT COALESCE(SUM(interactions), 0) AS interactions,
+           SUM(latency_ms_sum)::float / NULLIF(SUM(latency_count), 0) AS avg_latency_ms,
+           MIN(latency_ms_min) AS min_latency_ms,
+           MAX(latency_ms_max) AS max_latency_ms,
+           COALESCE(SUM(total_tokens), 0) AS total_tokens,
+           SUM(total_tokens)::float / NULLIF(SUM(token_count), 0) AS avg_tokens
+    FROM q
+),
+daily AS (
+    SELECT bucket::date AS date,
+           SUM(interactions) AS interaction_count,
+           SUM(latency_ms_sum)::float / NULLIF(SUM(latency_count), 0) AS avg_latency_ms,
+           SUM(total_tokens) AS daily_tokens
+    FROM q
+    GROUP BY bucket::date
+),
+costs AS (
+    SELECT model, SUM(calls) AS calls, SUM(total_tokens) AS total_tokens, SUM(total_cost) AS total_cost
+    FROM helpee_cost_rollup_hourly
+    WHERE (%(start)s::timestamptz IS NULL OR bucket >= %(start)s::timestamptz)
+      AND (%(end)s::timestamptz IS NULL OR bucket < %(end)s::timestamptz)
+    GROUP BY model
+)
+SELECT json_build_object(
+    'vote_totals', (SELECT row_to_json(vote_totals) FROM vote_totals),
+    'tags', COALESCE((SELECT json_agg(t ORDER BY t.count DESC) FROM tags t), '[]'::json),
+    'recent', COALESCE((SELECT json_agg(r ORDER BY r.timestamp DESC) FROM recent r), '[]'::json),
+    'query_totals', (SELECT row_to_json(query_totals) FROM query_totals),
+    'daily', COALESCE((SELECT json_agg(d ORDER BY d.date) FROM daily d), '[]'::json),
+    'costs', COALESCE((SELECT json_agg(c ORDER BY c.total_cost DESC) FROM costs c), '[]'::json)
+) AS data
+"""
+
+
+def _as_date(value) -> Optional[date]:
+    if value in (None, ""):
+        return None
+    if isinstance(value, datetime):
+        return value.date()
+    if isinstance(value, date):
+        return value
+    return datetime.strptime(str(value)[:10], "%Y-%m-%d").date()
+
+
+def date_bounds(start_date=None, end_date=None) -> Tuple[Optional[date], Optional[date]]:
+    """
+    Convert dashboard date parameters to a half-open [start, end) range.
+
+    Both ends are whole days and end_date is inclusive, so '2024-05-01'..'2024-05-01'
+    covers that entire day.
+    """
+    start = _as_date(start_date)
+    end = _as_date(end_date)
+    return start, (end + timedelta(days=1)) if end else None
+
+
+def _seconds(ms) -> Optional[float]:
+    return round(float(ms) / 1000.0, 2) if ms is not None else None
+
+
+class AnalyticsEngine:
+    """
+    Computes every analytics dashboard section from one SQL statement.
+
+    This class is responsible for:
+    - Bringing the analytics rollups up to date, then running DASHBOARD_SQL on one pooled connection
+    - Shaping the result into the structure the dashboard and exports expect
+    - Reporting real latency and token usage recorded in rag_queries
+    - Reusing a computed payload for a short TTL so polling dashboards stay cheap
+      (an LRU bounded by date range count; callers get their own copy)
+    """
+
+    def __init__(self, cache_ttl: int = ANALYTICS_CACHE_TTL, recent_limit: int = 5,
+                 max_entries: int = ANALYTICS_CACHE_SIZE):
+        """
+        Initialize the engine.
+
+        Args:
+            cache_ttl: Seconds a payload for the same date range is reused (0 disables)
+            recent_limit: Number of recent interactions to include
+            max_entries: Date ranges whose payload is kept (0 disables caching)
+        """
+        self.cache_ttl = cache_ttl if max_entries > 0 else 0
+        self.recent_limit = recent_limit
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._cache: "OrderedDict[Tuple, Tuple[float, Dict[str, Any]]]" = OrderedDict()
+        self._schema_ready = False
+
+    def get_dashboard_data(self, start_date=None, end_date=None) -> Dict[str, Any]:
+        """
+        Get all analytics metrics for the date range.
+
+        Args:
+            start_date: First day to include (date, datetime or 'YYYY-MM-DD'), or None
+            end_date: Last day to include (inclusive), or None
+
+        Returns:
+            Dict with feedback_summary, tag_distribution, time_metrics, query_analytics,
+            response_time_metrics, token_usage_metrics and cost_metrics
+        """
+        start, end = date_bounds(start_date, end_date)
+        key = (start, end)
+        if self.cache_ttl:
+            with self._lock:
+                cached = self._cached(key)
+            if cached is not None:
+                return copy.deepcopy(cached)
+
+        raw = self._query(start, end)
+        data = self._shape(raw)
+        if self.cache_ttl:
+            with self._lock:
+                self._store(key, copy.deepcopy(data))
+        return data
+
+    # ───────────── payload cache ─────────────
+    def _cached(self, key: Tuple) -> Optional[Dict[str, Any]]:
+        entry = self._cache.get(key)
+        if entry is None:
+            return None
+        if time.monotonic() - entry[0] >= self.cache_ttl:
+            del self._cache[key]
+            return None
+        self._cache.move_to_end(key)
+        return entry[1]
+
+    def _store(self, key: Tuple, data: Dict[str, Any]) -> None:
+        now = time.monotonic()
+        self._cache[key] = (now, data)
+        self._cache.move_to_end(key)
+        for expired in [k for k, (stored_at, _) in self._cache.items() if now - stored_at >= self.cache_ttl]:
+            del self._cache[expired]
+        while len(self._cache) > self.max_entries:
+            self._cache.popitem(last=False)
+
+    def invalidate(self) -> None:
+        """Forget cached payloads."""
+        with self._lock:
+            self._cache.clear()
+
+    def _query(self, start: Optional[date], end: Optional[date]) -> Dict[str, Any]:
+        rollups = get_rollups()
+        rollups.refresh_if_stale()
+        conn = DatabaseManager.get_connection()
+        try:
+            with conn.cursor() as cursor:
+                if not self._schema_ready:
+                    # The rollup tables (and rag_queries) are created lazily; make sure they exist
+                    rollups.ensure_schema(cursor)
+                    conn.commit()
+                    self._schema_ready = True
+                cursor.execute(DASHBOARD_SQL, {
+                    "start": start,
+                    "end": end,
+                    "positive_tag": POSITIVE_TAG,
+                    "recent_limit": self.recent_limit,
+                })
+                row = cursor.fetchone()
+            conn.rollback()
+            return row[0] if row else {}
+        finally:
+            conn.close()
+
+    @staticmethod
+    def _shape(raw: Dict[str, Any]) -> Dict[str, Any]:
+        votes = raw.get("vote_totals") or {}
+        queries = raw.get("query_totals") or {}
+        total_feedback = votes.get("total_feedback", 0) or 0
+        positive_feedback = votes.get("positive_feedback", 0) or 0
+        interactions = queries.get("interactions", 0) or 0
+        daily = raw.get("daily") or []
+        recent = raw.get("recent") or []
+
+        avg_tokens = queries.get("avg_tokens")
+        return {
+            "feedback_summary": {
+                "total_feedback": total_feedback,
+                "positive_feedback": positive_feedback,
+                "negative_feedback": total_feedback - positive_feedback,
+                "recent_feedback": recent,
+            },
+            "tag_distribution": raw.get("tags") or [],
+            "time_metrics": [
+                {
+                    "date": d["date"],
+                    "interaction_count": d["interaction_count"],
+                    "response_time": _seconds(d.get("avg_latency_ms")),
+                    "daily_tokens": d.get("daily_tokens", 0),
+                }
+                for d in daily
+            ],
+            "query_analytics": {
+                "total_queries": votes.get("total_queries", 0) or 0,
+                "total_interactions": interactions,
+                "queries_with_feedback": total_feedback,
+                "successful_queries": positive_feedback,
+                "recent_queries": recent,
+            },
+            "response_time_metrics": {
+                "avg_response_time": _seconds(queries.get("avg_latency_ms")),
+                "min_response_time": _seconds(queries.get("min_latency_ms")),
+                "max_response_time": _seconds(queries.get("max_latency_ms")),
+            },
+            "token_usage_metrics": {
+                "total_tokens": queries.get("total_tokens", 0) or 0,
+                "avg_tokens_per_query": round(avg_tokens) if avg_tokens is not None else None,
+                "daily_usage": [{"date": d["date"], "daily_tokens": d.get("daily_tokens", 0)} for d in daily],
+            },
+            "cost_metrics": raw.get("costs") or [],
+        }
+
+
+_engine = AnalyticsEngine()
+
+
+def get_analytics_engine() -> AnalyticsEngine:
+    """Return the process-wide analytics engine."""
+    return _engine
@@ -0,0 +1,490 @@
+"""
+AnalyticsRollups class for maintaining hourly/daily aggregates of feedback, cost and usage data
+"""
+import logging
+import threading
+import time
+from datetime import date
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
+
+from db_manager import DatabaseManager
+from config import ANALYTICS_ROLLUP_REFRESH_INTERVAL, ANALYTICS_ROLLUP_SETTLE_SECONDS
+
+logger = logging.getLogger(__name__)
+
+POSITIVE_TAG = 'Looks Good / Accurate & Clear'
+
+ROLLUP_SCHEMA_SQL = """
+CREATE TABLE IF NOT EXISTS analytics_rollup_state (
+    source TEXT PRIMARY KEY,
+    last_id BIGINT NOT NULL DEFAULT 0,
+    refreshed_at TIMESTAMPTZ
+);
+CREATE TABLE IF NOT EXISTS feedback_rollup_hourly (
+    bucket TIMESTAMPTZ PRIMARY KEY,
+    vote_count INTEGER NOT NULL DEFAULT 0,
+    positive_count INTEGER NOT NULL DEFAULT 0,
+    query_count INTEGER NOT NULL DEFAULT 0,
+    positive_query_count INTEGER NOT NULL DEFAULT 0,
+    query_length_sum BIGINT NOT NULL DEFAULT 0,
+    positive_query_length_sum BIGINT NOT NULL DEFAULT 0
+);
+ALTER TABLE feedback_rollup_hourly
+    ADD COLUMN IF NOT EXISTS query_count INTEGER NOT NULL DEFAULT 0,
+    ADD COLUMN IF NOT EXISTS positive_query_count INTEGER NOT NULL DEFAULT 0;
+CREATE TABLE IF NOT EXISTS feedback_length_rollup_daily (
+    day DATE NOT NULL,
+    length INTEGER NOT NULL,
+    count INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (day, length)
+);
+CREATE TABLE IF NOT EXISTS feedback_tag_rollup_hourly (
+    bucket TIMESTAMPTZ NOT NULL,
+    tag TEXT NOT NULL,
+    count INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (bucket, tag)
+);
+CREATE TABLE IF NOT EXISTS feedback_word_rollup_daily (
+    day DATE NOT NULL,
+    word TEXT NOT NULL,
+    count INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (day, word)
+);
+CREATE TABLE IF NOT EXISTS helpee_cost_rollup_hourly (
+    bucket TIMESTAMPTZ NOT NULL,
+    model TEXT NOT NULL,
+    calls INTEGER NOT NULL DEFAULT 0,
+    prompt_tokens BIGINT NOT NULL DEFAULT 0,
+    completion_tokens BIGINT NOT NULL DEFAULT 0,
+    total_tokens BIGINT NOT NULL DEFAULT 0,
+    prompt_cost NUMERIC NOT NULL DEFAULT 0,
+    completion_cost NUMERIC NOT NULL DEFAULT 0,
+    total_cost NUMERIC NOT NULL DEFAULT 0,
+    PRIMARY KEY (bucket, model)
+);
+CREATE TABLE IF NOT EXISTS rag_query_rollup_hourly (
+    bucket TIMESTAMPTZ PRIMARY KEY,
+    interactions INTEGER NOT NULL DEFAULT 0,
+    latency_count INTEGER NOT NULL DEFAULT 0,
+    latency_ms_sum BIGINT NOT NULL DEFAULT 0,
+    latency_ms_min INTEGER,
+    latency_ms_max INTEGER,
+    token_count INTEGER NOT NULL DEFAULT 0,
+    total_tokens BIGINT NOT NULL DEFAULT 0
+);
+"""
+
+# Each statement folds the rows with %(lo)s < id <= %(hi)s into the rollups.
+# Counters are additive, so re-running a range is the only way to double count;
+# the watermark row is updated in the same transaction to prevent that.
+# query_count/positive_query_count count only votes with a user_query, so they are
+# the denominators matching the length sums (SUM(LENGTH(NULL)) contributes nothing).
+FEEDBACK_ROLLUP_SQL = [
+    """
+    INSERT INTO feedback_rollup_hourly AS r
+        (bucket, vote_count, positive_count, query_count, positive_query_count,
+         query_length_sum, positive_query_length_sum)
+    SELECT date_trunc('hour', timestamp),
+           COUNT(*),
+           COUNT(*) FILTER (WHERE %(positive_tag)s = ANY(feedback_tags)),
+           COUNT(user_query),
+           COUNT(user_query) FILTER (WHERE %(positive_tag)s = ANY(feedback_tags)),
+           COALESCE(SUM(LENGTH(user_query)), 0),
+           COALESCE(SUM(LENGTH(user_query)) FILTER (WHERE %(positive_tag)s = ANY(feedback_tags)), 0)
+    FROM votes
+    WHERE vote_id > %(lo)s AND vote_id <= %(hi)s
+    GROUP BY 1
+    ON CONFLICT (bucket) DO UPDATE SET
+        vote_count = r.vote_count + EXCLUDED.vote_count,
+        positive_count = r.positive_count + EXCLUDED.positive_count,
+        query_count = r.query_count + EXCLUDED.query_count,
+        positive_query_count = r.positive_query_count + EXCLUDED.positive_query_count,
+        query_length_sum = r.query_length_sum + EXCLUDED.query_length_sum,
+        positive_query_length_sum = r.positive_query_length_sum + EXCLUDED.positive_query_length_sum
+    """,
+    """
+    INSERT INTO feedback_tag_rollup_hourly AS r (bucket, tag, count)
+    SELECT date_trunc('hour', timestamp), tag, COUNT(*)
+    FROM votes, unnest(feedback_tags) AS tag
+    WHERE vote_id > %(lo)s AND vote_id <= %(hi)s
+    GROUP BY 1, 2
+    ON CONFLICT (bucket, tag) DO UPDATE SET count = r.count + EXCLUDED.count
+    """,
+    """
+    INSERT INTO feedback_length_rollup_daily AS r (day, length, count)
+    SELECT timestamp::date, LENGTH(user_query), COUNT(*)
+    FROM votes
+    WHERE vote_id > %(lo)s AND vote_id <= %(hi)s AND user_query IS NOT NULL
+    GROUP BY 1, 2
+    ON CONFLICT (day, length) DO UPDATE SET count = r.count + EXCLUDED.count
+    """,
+    """
+    WITH texts AS (
+        SELECT timestamp::date AS day, user_query AS text
+        FROM votes
+        WHERE vote_id > %(lo)s AND vote_id <= %(hi)s
+        UNION ALL
+        SELECT timestamp::date, tag
+        FROM votes, unnest(feedback_tags) AS tag
+        WHERE vote_id > %(lo)s AND vote_id <= %(hi)s
+    )
+    INSERT INTO feedback_word_rollup_daily AS r (day, word, count)
+    SELECT day, word, COUNT(*)
+    FROM texts, regexp_split_to_table(lower(texts.text), '\\W+') AS word
+    WHERE word <> ''
+    GROUP BY 1, 2
+    ON CONFLICT (day, word) DO UPDATE SET count = r.count + EXCLUDED.count
+    """,
+]
+
+HELPEE_COST_ROLLUP_SQL = [
+    """
+    INSERT INTO helpee_cost_rollup_hourly AS r
+        (bucket, model, calls, prompt_tokens, completion_tokens, total_tokens,
+         prompt_cost, completion_cost, total_cost)
+    SELECT date_trunc('hour', timestamp), model, COUNT(*),
+           COALESCE(SUM(prompt_tokens), 0), COALESCE(SUM(completion_tokens), 0),
+           COALESCE(SUM(total_tokens), 0), COALESCE(SUM(prompt_cost), 0),
+           COALESCE(SUM(completion_cost), 0), COALESCE(SUM(total_cost), 0)
+    FROM helpee_costs
+    WHERE id > %(lo)s AND id <= %(hi)s
+    GROUP BY 1, 2
+    ON CONFLICT (bucket, model) DO UPDATE SET
+        calls = r.calls + EXCLUDED.calls,
+        prompt_tokens = r.prompt_tokens + EXCLUDED.prompt_tokens,
+        completion_tokens = r.completion_tokens + EXCLUDED.completion_tokens,
+        total_tokens = r.total_tokens + EXCLUDED.total_tokens,
+        prompt_cost = r.prompt_cost + EXCLUDED.prompt_cost,
+        completion_cost = r.completion_cost + EXCLUDED.completion_cost,
+        total_cost = r.total_cost + EXCLUDED.total_cost
+    """,
+]
+
+RAG_QUERY_ROLLUP_SQL = [
+    """
+    INSERT INTO rag_query_rollup_hourly AS r
+        (bucket, interactions, latency_count, latency_ms_sum, latency_ms_min, latency_ms_max,
+         token_count, total_tokens)
+    SELECT date_trunc('hour', timestamp), COUNT(*), COUNT(latency_ms),
+           COALESCE(SUM(latency_ms), 0), MIN(latency_ms), MAX(latency_ms),
+           COUNT(total_tokens), COALESCE(SUM(total_tokens), 0)
+    FROM rag_queries
+    WHERE id > %(lo)s AND id <= %(hi)s
+    GROUP BY 1
+    ON CONFLICT (bucket) DO UPDATE SET
+        interactions = r.interactions + EXCLUDED.interactions,
+        latency_count = r.latency_count + EXCLUDED.latency_count,
+        latency_ms_sum = r.latency_ms_sum + EXCLUDED.latency_ms_sum,
+        latency_ms_min = LEAST(r.latency_ms_min, EXCLUDED.latency_ms_min),
+        latency_ms_max = GREATEST(r.latency_ms_max, EXCLUDED.latency_ms_max),
+        token_count = r.token_count + EXCLUDED.token_count,
+        total_tokens = r.total_tokens + EXCLUDED.total_tokens
+    """,
+]
+
+# source name -> (table, id column, rollup statements)
+SOURCES = {
+    "votes": ("votes", "vote_id", FEEDBACK_ROLLUP_SQL),
+    "helpee_costs": ("helpee_costs", "id", HELPEE_COST_ROLLUP_SQL),
+    "rag_queries": ("rag_queries", "id", RAG_QUERY_ROLLUP_SQL),
+}
+
+FEEDBACK_ROLLUP_TABLES = (
+    "feedback_rollup_hourly",
+    "feedback_tag_rollup_hourly",
+    "feedback_word_rollup_daily",
+    "feedback_length_rollup_daily",
+)
+
+ROLLUP_TABLES = FEEDBACK_ROLLUP_TABLES + (
+    "helpee_cost_rollup_hourly",
+    "rag_query_rollup_hourly",
+)
+
+
+def _range_filter(column: str) -> str:
+    return (f"(%(start)s::timestamptz IS NULL OR {column} >= %(start)s::timestamptz) "
+            f"AND (%(end)s::timestamptz IS NULL OR {column} < %(end)s::timestamptz)")
+
+
+def histogram_median(histogram: Sequence[Tuple[int, int]]) -> float:
+    """
+    Median of the values described by (value, count) pairs sorted by value.
+
+    Matches percentile_cont(0.5): the mean of the two middle values for an even total.
+    """
+    total = sum(count for _, count in histogram)
+    if not total:
+        return 0.0
+    lower_rank, upper_rank = (total - 1) // 2, total // 2
+    lower = None
+    seen = 0
+    for value, count in histogram:
+        seen += count
+        if lower is None and seen > lower_rank:
+            lower = value
+        if seen > upper_rank:
+            return (lower + value) / 2
+    return float(lower)
+
+
+class AnalyticsRollups:
+    """
+    Incrementally maintained rollups of the votes, helpee_costs and rag_queries tables.
+
+    This class is responsible for:
+    - Creating the hourly/daily rollup tables and their watermark table
+    - Folding only rows added since the last refresh into the rollups (per-source id watermark)
+    - Throttling on-read refreshes so dashboards can call refresh_if_stale() freely
+    - Answering dashboard reads from O(hours/days) rollup rows instead of O(rows) scans
+    """
+
+    def __init__(self, refresh_interval: int = ANALYTICS_ROLLUP_REFRESH_INTERVAL,
+                 settle_seconds: int = ANALYTICS_ROLLUP_SETTLE_SECONDS):
+        """
+        Initialize the rollups.
+
+        Args:
+            refresh_interval: Minimum seconds between refreshes triggered by readers
+            settle_seconds: Rows younger than this are left for the next refresh, giving
+                transactions that reserved a lower id time to commit
+        """
+        self.refresh_interval = refresh_interval
+        self.settle_seconds = settle_seconds
+        self._lock = threading.Lock()
+        self._schema_ready = False
+        self._last_refresh = 0.0
+        self._stats = {
+            "refreshes": 0,
+            "rows_folded": 0,
+            "errors": 0,
+            "last_refresh_ms": 0.0,
+        }
+
+    # ───────────── maintenance ─────────────
+
+    def ensure_schema(self, cursor) -> None:
+        """
+        Create the rollup tables (and rag_queries, which is created lazily elsewhere).
+
+        Feedback rollups built before the query-length histogram existed lack it and the
+        per-query counts, so they are emptied and refolded from the votes table once.
+        """
+        if self._schema_ready:
+            return
+        cursor.execute("SELECT to_regclass('feedback_length_rollup_daily') IS NULL")
+        upgrading = cursor.fetchone()[0]
+        cursor.execute(ROLLUP_SCHEMA_SQL)
+        if upgrading:
+            cursor.execute(f"TRUNCATE {', '.join(FEEDBACK_ROLLUP_TABLES)}")
+            cursor.execute("UPDATE analytics_rollup_state SET last_id = 0, refreshed_at = NULL WHERE source = 'votes'")
+        DatabaseManager.ensure_rag_queries_schema(cursor)
+        self._schema_ready = True
+
+    def refresh(self, sources: Optional[Iterable[str]] = None) -> Dict[str, int]:
+        """
+        Fold new rows from each source table into the rollups.
+
+        Each source is refreshed in its own transaction, with its watermark row locked
+        so concurrent refreshers (web workers, the scheduled job) never fold a range twice.
+
+        Args:
+            sources: Source names to refresh (default: all)
+
+        Returns:
+            Dict mapping source name to the number of rows folded in
+        """
+        started = time.perf_counter()
+        folded: Dict[str, int] = {}
+        with self._lock:
+            conn = DatabaseManager.get_connection()
+            try:
+                with conn.cursor() as cursor:
+                    self.ensure_schema(cursor)
+                conn.commit()
+                for source in sources or SOURCES:
+                    try:
+                        folded[source] = self._refresh_source(conn, source)
+                        conn.commit()
+                    except Exception as e:
+                        conn.rollback()
+                        self._stats["errors"] += 1
+                        logger.warning(f"Rollup refresh for {source} failed: {e}")
+            finally:
+                conn.close()
+            self._last_refresh = time.monotonic()
+            self._stats["refreshes"] += 1
+            self._stats["rows_folded"] += sum(folded.values())
+            self._stats["last_refresh_ms"] = round((time.perf_counter() - started) * 1000, 1)
+        if any(folded.values()):
+            logger.info(f"Analytics rollups refreshed: {folded}")
+        return folded
+
+    def refresh_if_stale(self) -> None:
+        """Refresh unless one ran within refresh_interval seconds or is running now; never raises."""
+        if time.monotonic() - self._last_refresh < self.refresh_interval or self._lock.locked():
+            return
+        try:
+            self.refresh()
+        except Exception as e:
+            self._stats["errors"] += 1
+            logger.warning(f"Analytics rollup refresh skipped: {e}")
+
+    def rebuild(self) -> Dict[str, int]:
+        """Empty every rollup, reset the watermarks and refold all source rows."""
+        with self._lock:
+            conn = DatabaseManager.get_connection()
+            try:
+                with conn.cursor() as cursor:
+                    self.ensure_schema(cursor)
+                    cursor.execute(f"TRUNCATE {', '.join(ROLLUP_TABLES)}")
+                    cursor.execute("UPDATE analytics_rollup_state SET last_id = 0, refreshed_at = NULL")
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+            finally:
+                conn.close()
+        return self.refresh()
+
+    def _refresh_source(self, conn, source: str) -> int:
+        table, id_column, statements = SOURCES[source]
+        with conn.cursor() as cursor:
+            cursor.execute(
+                "INSERT INTO analytics_rollup_state (source) VALUES (%s) ON CONFLICT (source) DO NOTHING",
+                (source,),
+            )
+            cursor.execute("SELECT last_id FROM analytics_rollup_state WHERE source = %s FOR UPDATE", (source,))
+            lo = cursor.fetchone()[0]
+            cursor.execute(
+                f"SELECT MAX({id_column}) FROM {table} "
+                f"WHERE {id_column} > %s AND timestamp < NOW() - make_interval(secs => %s)",
+                (lo, self.settle_seconds),
+            )
+            hi = cursor.fetchone()[0]
+            if hi is None:
+                return 0
+            cursor.execute(f"SELECT COUNT(*) FROM {table} WHERE {id_column} > %s AND {id_column} <= %s", (lo, hi))
+            count = cursor.fetchone()[0]
+            params = {"lo": lo, "hi": hi, "positive_tag": POSITIVE_TAG}
+            for statement in statements:
+                cursor.execute(statement, params)
+            cursor.execute(
+                "UPDATE analytics_rollup_state SET last_id = %s, refreshed_at = NOW() WHERE source = %s",
+                (hi, source),
+            )
+            return count
+
+    # ───────────── reads ─────────────
+
+    def _fetch(self, sql: str, params: Dict[str, Any]) -> List[tuple]:
+        self.refresh_if_stale()
+        conn = DatabaseManager.get_connection()
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute(sql, params)
+                rows = cursor.fetchall()
+            conn.rollback()
+            return rows
+        finally:
+            conn.close()
+
+    def feedback_totals(self, start: Optional[date] = None, end: Optional[date] = None) -> Dict[str, int]:
+        """
+        Get vote counts and query-length sums for the half-open range [start, end).
+
+        Returns:
+            Dict with total_feedback, positive_feedback, negative_feedback,
+            query_count and positive_query_count (votes with a non-NULL user_query,
+            the denominators for the length sums), query_length_sum and
+            positive_query_length_sum
+        """
+        rows = self._fetch(
+            "SELECT COALESCE(SUM(vote_count), 0), COALESCE(SUM(positive_count), 0), "
+            "COALESCE(SUM(query_count), 0), COALESCE(SUM(positive_query_count), 0), "
+            "COALESCE(SUM(query_length_sum), 0), COALESCE(SUM(positive_query_length_sum), 0) "
+            f"FROM feedback_rollup_hourly WHERE {_range_filter('bucket')}",
+            {"start": start, "end": end},
+        )
+        total, positive, queries, positive_queries, length_sum, positive_length_sum = (
+            (int(v) for v in rows[0]) if rows else (0, 0, 0, 0, 0, 0)
+        )
+        return {
+            "total_feedback": total,
+            "positive_feedback": positive,
+            "negative_feedback": total - positive,
+            "query_count": queries,
+            "positive_query_count": positive_queries,
+            "query_length_sum": length_sum,
+            "positive_query_length_sum": positive_length_sum,
+        }
+
+    def query_length_median(self, start: Optional[date] = None, end: Optional[date] = None) -> float:
+        """Get the median user_query length for the range from the daily length histogram."""
+        rows = self._fetch(
+            "SELECT length, SUM(count) FROM feedback_length_rollup_daily "
+            "WHERE (%(start)s::date IS NULL OR day >= %(start)s::date) "
+            "AND (%(end)s::date IS NULL OR day < %(end)s::date) "
+            "GROUP BY length ORDER BY length",
+            {"start": start, "end": end},
+        )
+        return histogram_median([(int(length), int(count)) for length, count in rows])
+
+    def tag_histogram(self, start: Optional[date] = None, end: Optional[date] = None) -> List[Dict[str, Any]]:
+        """Get feedback tag counts for the range, most frequent first."""
+        rows = self._fetch(
+            "SELECT tag, SUM(count) AS count FROM feedback_tag_rollup_hourly "
+            f"WHERE {_range_filter('bucket')} GROUP BY tag ORDER BY count DESC",
+            {"start": start, "end": end},
+        )
+        return [{"tag": tag, "count": int(count)} for tag, count in rows]
+
+    def word_counts(self, start: Optional[date] = None, end: Optional[date] = None,
+                    limit: int = 50, exclude: Iterable[str] = ()) -> Dict[str, int]:
+        """Get the most frequent words in queries and feedback tags for the range."""
+        rows = self._fetch(
+            "SELECT word, SUM(count) AS count FROM feedback_word_rollup_daily "
+            "WHERE (%(start)s::date IS NULL OR day >= %(start)s::date) "
+            "AND (%(end)s::date IS NULL OR day < %(end)s::date) "
+            "AND NOT (word = ANY(%(exclude)s)) "
+            "GROUP BY word ORDER BY count DESC, word LIMIT %(limit)s",
+            {"start": start, "end": end, "exclude": list(exclude), "limit": limit},
+        )
+        return {word: int(count) for word, count in rows}
+
+    def requests_per_hour(self, hours: int = 6) -> Dict[str, int]:
+        """Get feedback counts per hour for the last `hours` hours, keyed 'YYYY-MM-DD HH24:00'."""
+        rows = self._fetch(
+            "SELECT to_char(bucket, 'YYYY-MM-DD HH24:00'), vote_count FROM feedback_rollup_hourly "
+            "WHERE bucket >= date_trunc('hour', NOW() - make_interval(hours => %(hours)s)) "
+            "ORDER BY bucket LIMIT %(hours)s",
+            {"hours": hours},
+        )
+        return {hour: int(count) for hour, count in rows}
+
+    def cost_totals(self, start: Optional[date] = None, end: Optional[date] = None) -> List[Dict[str, Any]]:
+        """Get helpee call counts, token sums and cost sums per model for the range."""
+        rows = self._fetch(
+            "SELECT model, SUM(calls), SUM(prompt_tokens), SUM(completion_tokens), SUM(total_tokens), "
+            "SUM(prompt_cost), SUM(completion_cost), SUM(total_cost) FROM helpee_cost_rollup_hourly "
+            f"WHERE {_range_filter('bucket')} GROUP BY model ORDER BY SUM(total_cost) DESC",
+            {"start": start, "end": end},
+        )
+        keys = ("model", "calls", "prompt_tokens", "completion_tokens", "total_tokens",
+                "prompt_cost", "completion_cost", "total_cost")
+        return [
+            {k: (float(v) if k.endswith("_cost") else v) for k, v in zip(keys, row)}
+            for row in rows
+        ]
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Return refresh counters."""
+        return dict(self._stats)
+
+
+_rollups = AnalyticsRollups()
+
+
+def get_rollups() -> AnalyticsRollups:
+    """Return the process-wide analytics rollups."""
+    return _rollups
@@ -13,6 +13,8 @@ from typing import Dict, List, Any, Tuple
 import matplotlib.pyplot as plt
 import numpy as np
 from openai import AzureOpenAI
+from openai_service import OpenAIService
+from rate_limiter import BACKGROUND
 from dotenv import load_dotenv
 
 # Load environment variables
@@ -35,6 +37,7 @@ client = AzureOpenAI(
     api_key=os.getenv("AZURE_OPENAI_KEY"),
     api_version=os.getenv("AZURE_OPENAI_API_VERSION", "2024-02-01")
 )
+openai_service = OpenAIService(client=client, deployment_name=os.getenv("AZURE_OPENAI_MODEL"))
 
 def parse_log_file(log_file: str) -> List[Dict[str, Any]]:
     """
@@ -121,18 +124,17 @@ def evaluate_response_with_llm(actual: str, expected: str, query: str, domain: s
     """
     
     try:
-        response = client.chat.completions.create(
-            model=os.getenv("AZURE_OPENAI_MODEL"),
+        result = openai_service.get_chat_response(
             messages=[
                 {"role": "system", "content": "You are an expert evaluator for RAG systems."},
                 {"role": "user", "content": prompt}
             ],
             temperature=0.3,
-            max_tokens=2000
+            max_tokens=2000,
+            top_p=None, presence_penalty=None, frequency_penalty=None,
+            priority=BACKGROUND,
         )
         
-        result = response.choices[0].message.content
-        
         # Extract JSON from the response
         try:
             evaluation = json.loads(result)
@@ -0,0 +1,299 @@
+"""
+ASGI entry point serving the query endpoints through the async RAG pipeline
+
+Run with:
+    gunicorn asgi_app:app -k uvicorn.workers.UvicornWorker
+or
+    uvicorn asgi_app:app
+
+POST /api/query, /api/stream_query and /api/clear_history are handled natively
+on the event loop by AsyncRAGAssistantWithHistory; every other route is served
+by the existing Flask app through asgiref's WSGI adapter. The Flask session
+cookie is shared, so a browser keeps the same session id across both.
+"""
+import asyncio
+import json
+import logging
+import os
+import traceback
+import weakref
+from contextlib import asynccontextmanager
+from typing import Dict, Optional, Tuple
+
+from asgiref.wsgi import WsgiToAsgi
+
+from main import app as flask_app
+from async_rag_assistant import AsyncRAGAssistantWithHistory
+from client_registry import get_registry
+from session_store import SessionBusy, get_session_store
+
+logger = logging.getLogger(__name__)
+
+_wsgi_app = WsgiToAsgi(flask_app)
+
+# Conversation state is shared with the Flask routes through the session store;
+# a per-session lock keeps concurrent turns of one conversation in this worker ordered,
+# and the store's lease orders them across workers
+_session_locks: "weakref.WeakValueDictionary[str, asyncio.Lock]" = weakref.WeakValueDictionary()
+
+
+def session_lock(session_id: str) -> asyncio.Lock:
+    """Return the lock serializing load/answer/save for one session in this worker"""
+    lock = _session_locks.get(session_id)
+    if lock is None:
+        lock = asyncio.Lock()
+        _session_locks[session_id] = lock
+    return lock
+
+
+async def _store_call(fn, *args):
+    # SQLite and Redis block on I/O; keep them off the event loop
+    if get_session_store().backend == "memory":
+        return fn(*args)
+    return await asyncio.to_thread(fn, *args)
+
+
+@asynccontextmanager
+async def hold_session(session_id: str):
+    """Hold a session for one load/answer/save turn, in this worker and across workers"""
+    async with session_lock(session_id):
+        store = get_session_store()
+        token = await _store_call(store.acquire_lease, session_id)
+        try:
+            yield
+        finally:
+            if token is not None:
+                await _store_call(store.release_lease, session_id, token)
+
+
+async def get_async_rag_assistant(session_id: str) -> AsyncRAGAssistantWithHistory:
+    """Create an async RAG assistant carrying the stored conversation state for the session ID"""
+    rag_assistant = AsyncRAGAssistantWithHistory()
+    state = await _store_call(get_session_store().get, session_id)
+    if state:
+        rag_assistant.load_state(state)
+    else:
+        logger.info(f"Starting new conversation for session {session_id}")
+    return rag_assistant
+
+
+async def save_async_rag_assistant(session_id: str, rag_assistant: AsyncRAGAssistantWithHistory) -> None:
+    """Persist the assistant's conversation state for the session ID"""
+    await _store_call(get_session_store().put, session_id, rag_assistant.export_state())
+
+
+def apply_settings(rag_assistant, settings: Dict) -> None:
+    """Apply per-request settings the same way the Flask handlers do"""
+    for key, value in settings.items():
+        if hasattr(rag_assistant, key):
+            setattr(rag_assistant, key, value)
+    if "model" in settings:
+        rag_assistant.deployment_name = settings["model"]
+
+
+# ───────────── session cookie ─────────────
+def _cookie_name() -> str:
+    return flask_app.config.get("SESSION_COOKIE_NAME", "session")
+
+
+def load_session_id(scope) -> Tuple[Optional[str], Dict]:
+    """Read the session id from the signed Flask session cookie."""
+    serializer = flask_app.session_interface.get_signing_serializer(flask_app)
+    name = _cookie_name()
+    for header, value in scope.get("headers", []):
+        if header != b"cookie":
+            continue
+        for part in value.decode("latin-1").split(";"):
+            key, _, raw = part.strip().partition("=")
+            if key != name or serializer is None:
+                continue
+            try:
+                data = serializer.loads(raw, max_age=int(flask_app.permanent_session_lifetime.total_seconds()))
+                return data.get("session_id"), data
+            except Exception:
+                logger.warning("Ignoring invalid session cookie")
+    return None, {}
+
+
+def session_cookie_header(data: Dict) -> Tuple[bytes, bytes]:
+    """Build a Set-Cookie header compatible with Flask's session interface."""
+    serializer = flask_app.session_interface.get_signing_serializer(flask_app)
+    value = serializer.dumps(data)
+    cookie = f"{_cookie_name()}={value}; Path=/; HttpOnly"
+    if flask_app.config.get("SESSION_COOKIE_SECURE"):
+        cookie += "; Secure"
+    samesite = flask_app.config.get("SESSION_COOKIE_SAMESITE")
+    if samesite:
+        cookie += f"; SameSite={samesite}"
+    return b"set-cookie", cookie.encode("latin-1")
+
+
+def ensure_session(scope) -> Tuple[str, list]:
+    """Return the session id and any headers needed to persist a new one."""
+    session_id, data = load_session_id(scope)
+    if session_id:
+        return session_id, []
+    session_id = os.urandom(16).hex()
+    data = dict(data, session_id=session_id)
+    logger.info(f"Created new session ID: {session_id}")
+    return session_id, [session_cookie_header(data)]
+
+
+# ───────────── helpers ─────────────
+async def read_json(receive) -> Dict:
+    body = b""
+    more_body = True
+    while more_body:
+        message = await receive()
+        body += message.get("body", b"")
+        more_body = message.get("more_body", False)
+    return json.loads(body) if body else {}
+
+
+async def send_json(send, payload, status: int = 200, headers: Optional[list] = None) -> None:
+    body = json.dumps(payload).encode("utf-8")
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode())] + (headers or []),
+    })
+    await send({"type": "http.response.body", "body": body})
+
+
+# ───────────── handlers ─────────────
+async def api_query(scope, receive, send) -> None:
+    data = await read_json(receive)
+    user_query = data.get("query", "")
+    is_enhanced = data.get("is_enhanced", False)
+    logger.info(f"API query received: {user_query}")
+    session_id, headers = ensure_session(scope)
+
+    try:
+        async with hold_session(session_id):
+            rag_assistant = await get_async_rag_assistant(session_id)
+            settings = data.get("settings", {})
+            if settings:
+                apply_settings(rag_assistant, settings)
+
+            # The assistant logs the query to the database itself
+            answer, cited_sources, _, evaluation, context = await rag_assistant.agenerate_rag_response(
+                user_query, is_enhanced=is_enhanced
+            )
+            await save_async_rag_assistant(session_id, rag_assistant)
+        logger.info(f"API query response generated for: {user_query}")
+
+        payload = {
+            "answer": answer,
+            "sources": cited_sources,
+            "evaluation": evaluation
+        }
+        if rag_assistant.last_response_cached:
+            payload["cached"] = True
+        await send_json(send, payload, headers=headers)
+    except SessionBusy:
+        logger.warning(f"Rejected query for busy session {session_id}")
+        await send_json(send, {"error": "Another request for this conversation is still running"},
+                        status=409, headers=headers)
+    except Exception as e:
+        logger.error(f"Error in api_query: {str(e)}")
+        logger.error(f"Traceback: {traceback.format_exc()}")
+        await send_json(send, {"error": str(e)}, status=500, headers=headers)
+
+
+async def api_stream_query(scope, receive, send) -> None:
+    data = await read_json(receive)
+    user_query = data.get("query", "")
+    logger.info(f"Stream query received: {user_query}")
+    session_id, headers = ensure_session(scope)
+
+    await send({
+        "type": "http.response.start",
+        "status": 200,
+        "headers": [(b"content-type", b"text/plain; charset=utf-8")] + headers,
+    })
+
+    async def emit(text: str) -> None:
+        await send({"type": "http.response.body", "body": text.encode("utf-8"), "more_body": True})
+
+    try:
+        async with hold_session(session_id):
+            rag_assistant = await get_async_rag_assistant(session_id)
+            settings = data.get("settings", {})
+            if settings:
+                apply_settings(rag_assistant, settings)
+
+            async for chunk in rag_assistant.astream_rag_response(user_query):
+                if isinstance(chunk, str):
+                    await emit(chunk)
+                else:
+                    await emit(f"\n[[META]]{json.dumps(chunk)}")
+            await save_async_rag_assistant(session_id, rag_assistant)
+        logger.info(f"Completed stream response for: {user_query}")
+    except SessionBusy:
+        logger.warning(f"Rejected stream query for busy session {session_id}")
+        await emit("Another request for this conversation is still running. Please try again.")
+        await emit(f"\n[[META]]" + json.dumps({"error": "session busy"}))
+    except Exception as e:
+        logger.error(f"Error in stream_query: {str(e)}")
+        logger.error(f"Traceback: {traceback.format_exc()}")
+        await emit(f"Sorry, I encountered an error: {str(e)}")
+        await emit(f"\n[[META]]" + json.dumps({"error": str(e)}))
+    await send({"type": "http.response.body", "body": b""})
+
+
+async def api_clear_history(scope, receive, send) -> None:
+    """Clear the conversation history for the current session"""
+    await read_json(receive)
+    session_id, _ = load_session_id(scope)
+    try:
+        cleared = False
+        if session_id:
+            async with hold_session(session_id):
+                state = await _store_call(get_session_store().get, session_id)
+                if state:
+                    rag_assistant = AsyncRAGAssistantWithHistory()
+                    rag_assistant.load_state(state)
+                    rag_assistant.clear_conversation_history()
+                    await save_async_rag_assistant(session_id, rag_assistant)
+                    cleared = True
+        if cleared:
+            logger.info(f"Cleared conversation history for session {session_id}")
+            await send_json(send, {"success": True})
+        else:
+            logger.warning(f"No active session found to clear history")
+            await send_json(send, {"success": True, "message": "No active session found"})
+    except Exception as e:
+        logger.error(f"Error clearing conversation history: {str(e)}")
+        await send_json(send, {"success": False, "error": str(e)}, status=500)
+
+
+ASYNC_ROUTES = {
+    ("POST", "/api/query"): api_query,
+    ("POST", "/api/stream_query"): api_stream_query,
+    ("POST", "/api/clear_history"): api_clear_history,
+}
+
+
+async def lifespan(receive, send) -> None:
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            logger.info("ASGI application starting up")
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            await get_registry().aclose()
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+async def app(scope, receive, send) -> None:
+    """ASGI application: async query endpoints, Flask for everything else."""
+    if scope["type"] == "lifespan":
+        await lifespan(receive, send)
+        return
+    if scope["type"] == "http":
+        handler = ASYNC_ROUTES.get((scope["method"], scope["path"]))
+        if handler is not None:
+            await handler(scope, receive, send)
+            return
+    await _wsgi_app(scope, receive, send)
@@ -0,0 +1,331 @@
+"""
+asyncio version of the RAG assistant with in-memory conversation history
+"""
+import asyncio
+import logging
+import time
+import traceback
+from typing import Any, AsyncGenerator, Dict, List, Optional, Tuple, Union
+
+from openai_logger import log_openai_call
+from client_registry import get_async_openai_client, get_async_search_client
+from embedding_cache import get_embedding_cache
+from semantic_cache import get_semantic_cache
+from rate_limiter import get_rate_limiter
+from token_counter import count_tokens
+import speculative_retrieval
+from context_expansion import get_context_expander
+from rag_assistant_with_history_copy import FlaskRAGAssistantWithHistory, SPECULATIVE_RETRIEVAL_ENABLED
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncRAGAssistantWithHistory(FlaskRAGAssistantWithHistory):
+    """
+    asyncio variant of FlaskRAGAssistantWithHistory.
+
+    Embedding, search, query enhancement and chat completion go through the
+    async OpenAI and Azure Search clients, so one worker can keep many
+    requests in flight. History summarization, which is still blocking, runs
+    in the default thread pool. Prompt building,
+    context preparation and citation handling are inherited unchanged, and
+    the synchronous methods keep working.
+    """
+
+    def __init__(self, settings=None) -> None:
+        super().__init__(settings)
+        # Created lazily inside the event loop; serializes turns of one conversation
+        self._turn_lock: Optional[asyncio.Lock] = None
+
+    @property
+    def async_openai_client(self):
+        """The shared AsyncAzureOpenAI client for the running event loop."""
+        return get_async_openai_client(
+            azure_endpoint=self.openai_endpoint,
+            api_key=self.openai_key,
+            api_version=self.openai_api_version or "2023-05-15",
+        )
+
+    def _get_turn_lock(self) -> asyncio.Lock:
+        if self._turn_lock is None:
+            self._turn_lock = asyncio.Lock()
+        return self._turn_lock
+
+    # ───────────── rate limiting ─────────────
+    async def _arate_limit(self, deployment: str, text: str, completion_tokens: int = 0) -> None:
+        """Async version of _rate_limit."""
+        scheduler = get_rate_limiter().scheduler(deployment)
+        if not scheduler.unlimited:
+            await scheduler.aacquire(count_tokens(text, deployment) + completion_tokens,
+                                     timeout=self.openai_service.timeout)
+
+    # ───────────── embeddings ─────────────
+    async def agenerate_embedding(self, text: str) -> Optional[List[float]]:
+        """Async version of generate_embedding (shares the embedding cache)."""
+        if not text:
+            return None
+        cache = get_embedding_cache()
+        cached = cache.get(self.embedding_deployment, text)
+        if cached is not None:
+            logger.debug("Embedding cache hit")
+            return cached
+        try:
+            request = {
+                'model': self.embedding_deployment,
+                'input': text.strip(),
+            }
+            await self._arate_limit(self.embedding_deployment, request['input'])
+            resp = await self.async_openai_client.embeddings.create(**request)
+            log_openai_call(request, resp)
+            embedding = resp.data[0].embedding
+            cache.put(self.embedding_deployment, text, embedding)
+            return embedding
+        except Exception as exc:
+            logger.error("Embedding error: %s", exc)
+            return None
+
+    # ───────────── Azure Search ───────────
+    async def asearch_knowledge_base(self, query: str) -> List[Dict]:
+        """Async version of search_knowledge_base."""
+        try:
+            logger.info(f"Searching knowledge base for query: {query}")
+            client = get_async_search_client(
+                endpoint=f"https://{self.search_endpoint}.search.windows.net",
+                index_name=self.search_index,
+                api_key=self.search_key,
+            )
+            q_vec = await self.agenerate_embedding(query)
+            if not q_vec:
+                logger.error("Failed to generate embedding for query")
+                return []
+
+            results = await client.search(**self._search_kwargs(query, q_vec))
+            result_list = [r async for r in results]
+            return self._format_search_results(result_list)
+        except Exception as exc:
+            logger.error(f"Search error: {exc}", exc_info=True)
+            logger.error(f"Traceback: {traceback.format_exc()}")
+            return []
+
+    async def _afetch_parent_chunks(self, filter_expr: str, top: int) -> List[Dict]:
+        """Async version of _fetch_parent_chunks."""
+        client = get_async_search_client(
+            endpoint=f"https://{self.search_endpoint}.search.windows.net",
+            index_name=self.search_index,
+            api_key=self.search_key,
+        )
+        results = await client.search(**self._parent_search_kwargs(filter_expr, top))
+        return self._format_search_results([r async for r in results])
+
+    async def _aexpand(self, results: List[Dict]) -> List[Dict]:
+        """Async version of _expand."""
+        return await get_context_expander().aexpand(results, self._afetch_parent_chunks, inline=True)
+
+    async def _aretrieve(self, query: str, is_enhanced: bool = False) -> List[Dict]:
+        """Async version of _retrieve."""
+        if is_enhanced:
+            return await self.asearch_knowledge_base(query)
+        if not self.settings.get("speculative_retrieval", SPECULATIVE_RETRIEVAL_ENABLED):
+            return await self.asearch_knowledge_base(await self._aget_enhanced_query(query))
+
+        raw_task = asyncio.create_task(self.asearch_knowledge_base(query))
+        enhanced_query = await self._aget_enhanced_query(query)
+        if not speculative_retrieval.queries_differ(query, enhanced_query):
+            logger.info("Enhanced query matches the raw query; reusing speculative search results")
+            speculative_retrieval.record_outcome(reissued=False)
+            return await raw_task
+
+        logger.info("Enhanced query differs from the raw query; searching again")
+        speculative_retrieval.record_outcome(reissued=True)
+        enhanced_results, raw_results = await asyncio.gather(self.asearch_knowledge_base(enhanced_query), raw_task)
+        return speculative_retrieval.merge_results(enhanced_results, raw_results)
+
+    # ───────── query enhancement & chat ────────
+    async def _aget_enhanced_query(self, query: str) -> str:
+        """Async version of _get_enhanced_query."""
+        prompt = self._build_enhancement_prompt(query)
+        try:
+            await self._arate_limit(self.deployment_name, prompt, 100)
+            response = await self.async_openai_client.completions.create(
+                model=self.deployment_name,
+                prompt=prompt,
+                max_tokens=100,
+                temperature=0.2,
+            )
+            enhanced_query = response.choices[0].text.strip()
+            logger.info(f"Enhanced query: {enhanced_query}")
+            return enhanced_query
+        except Exception as e:
+            logger.error(f"Error enhancing query: {e}")
+            return query
+
+    async def _achat_answer_with_history(self, query: str, context: str, src_map: Dict) -> str:
+        """Async version of _chat_answer_with_history."""
+        logger.info("Generating response with conversation history (async)")
+        # Trimming may summarize through the blocking OpenAIService
+        messages, trimmed, _ = await asyncio.to_thread(self._build_history_messages, query, context, src_map)
+        if trimmed:
+            messages.append(self._trim_notice())
+
+        # Same parameters as the sync path's get_chat_response call
+        answer = await self.openai_service.aget_chat_response(
+            messages=messages,
+            temperature=self.temperature,
+            max_tokens=self.max_tokens,
+            top_p=self.top_p,
+            client=self.async_openai_client,
+        )
+
+        self.conversation_manager.add_assistant_message(answer)
+        self._schedule_summary_fold()
+        return answer
+
+    # ─────────── public API ───────────────
+    async def agenerate_rag_response(
+        self, query: str, is_enhanced: bool = False
+    ) -> Tuple[str, List[Dict], List[Dict], Dict[str, Any], str]:
+        """
+        Async version of generate_rag_response.
+
+        Args:
+            query: The user query
+            is_enhanced: A flag to indicate if the query is already enhanced
+
+        Returns:
+            answer, cited_sources, [], evaluation, context
+        """
+        async with self._get_turn_lock():
+            self.last_response_cached = False
+            started = time.perf_counter()
+            try:
+                cache_fingerprint = self._semantic_cache_fingerprint()
+                query_embedding = None
+                if cache_fingerprint:
+                    query_embedding = await self.agenerate_embedding(query)
+                    hit = get_semantic_cache().lookup(cache_fingerprint, query_embedding)
+                    if hit:
+                        logger.info(f"Serving answer from semantic cache (similarity={hit['similarity']:.4f})")
+                        return self._answer_from_cache(query, hit)
+
+                kb_results = await self._aretrieve(query, is_enhanced)
+                if not kb_results:
+                    return (
+                        "No relevant information found in the knowledge base.",
+                        [],
+                        [],
+                        {},
+                        "",
+                    )
+
+                kb_results = await asyncio.to_thread(self._rerank, query, kb_results)
+                kb_results = await self._aexpand(kb_results)
+                context, src_map = self._prepare_context(kb_results)
+                self.openai_service.last_usage = None
+                answer = await self._achat_answer_with_history(query, context, src_map)
+                usage = self.openai_service.last_usage
+                history_answer = answer
+
+                answer, cited_sources = self._renumber_citations(answer, src_map)
+
+                evaluation = self.fact_checker.evaluate_response(
+                    query=query,
+                    answer=answer,
+                    context=context,
+                    deployment=self.deployment_name,
+                )
+
+                latency_ms = (time.perf_counter() - started) * 1000
+                self._log_rag_query(query, answer, cited_sources, context, latency_ms=latency_ms, usage=usage)
+
+                if cache_fingerprint:
+                    self._store_in_semantic_cache(
+                        cache_fingerprint, query_embedding, answer, history_answer, cited_sources, evaluation, context,
+                        src_map,
+                    )
+
+                return answer, cited_sources, [], evaluation, context
+
+            except Exception as exc:
+                logger.error("RAG generation error: %s", exc)
+                return (
+                    "I encountered an error while generating the response.",
+                    [],
+                    [],
+                    {},
+                    "",
+                )
+
+    async def astream_rag_response(self, query: str) -> AsyncGenerator[Union[str, Dict], None]:
+        """
+        Async version of stream_rag_response.
+
+        Args:
+            query: The user query
+
+        Yields:
+            Either string chunks of the answer or a dictionary with metadata
+        """
+        async with self._get_turn_lock():
+            started = time.perf_counter()
+            try:
+                logger.info(f"========== STARTING ASYNC STREAM RAG RESPONSE WITH HISTORY ==========")
+                logger.info(f"Original query: {query}")
+
+                kb_results = await self.asearch_knowledge_base(query)
+                if not kb_results:
+                    logger.info("No relevant information found in knowledge base")
+                    yield "No relevant information found in the knowledge base."
+                    yield {
+                        "sources": [],
+                        "evaluation": {}
+                    }
+                    return
+
+                kb_results = await asyncio.to_thread(self._rerank, query, kb_results)
+                kb_results = await self._aexpand(kb_results)
+                context, src_map = self._prepare_context(kb_results)
+                logger.info(f"Retrieved {len(kb_results)} results from knowledge base")
+
+                messages, trimmed, dropped = await asyncio.to_thread(self._build_history_messages, query, context, src_map)
+                if trimmed:
+                    yield {"trimmed": True, "dropped": dropped}
+
+                collected_chunks = []
+                async for content in self.openai_service.astream_chat_response(
+                    messages, client=self.async_openai_client, **self._chat_params()
+                ):
+                    collected_chunks.append(content)
+                    yield content
+
+                collected_answer = "".join(collected_chunks)
+                usage = self.openai_service.last_usage
+                logger.info("DEBUG - Collected answer: %s", collected_answer[:100])
+
+                self.conversation_manager.add_assistant_message(collected_answer)
+                self._schedule_summary_fold()
+
+                collected_answer, cited_sources = self._renumber_citations(collected_answer, src_map)
+
+                evaluation = self.fact_checker.evaluate_response(
+                    query=query,
+                    answer=collected_answer,
+                    context=context,
+                    deployment=self.deployment_name,
+                )
+
+                latency_ms = (time.perf_counter() - started) * 1000
+                self._log_rag_query(query, collected_answer, cited_sources, context, latency_ms=latency_ms, usage=usage)
+
+                yield {
+                    "sources": cited_sources,
+                    "evaluation": evaluation
+                }
+
+            except Exception as exc:
+                logger.error("RAG streaming error: %s", exc)
+                yield "I encountered an error while generating the response."
+                yield {
+                    "sources": [],
+                    "evaluation": {},
+                    "error": str(exc)
+                }
@@ -0,0 +1,574 @@
+"""
+Incremental sidecar index over the OpenAI call log for dashboard analytics
+"""
+import bisect
+import gzip
+import hashlib
+import json
+import logging
+import os
+import re
+import struct
+import threading
+import zlib
+from array import array
+from collections import namedtuple
+from datetime import datetime
+from typing import Any, BinaryIO, Dict, Iterator, List, Optional, Tuple, Union
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - non-POSIX platforms
+    fcntl = None
+
+from config import OPENAI_LOG_PATH, OPENAI_LOG_INDEX_PATH
+
+logger = logging.getLogger(__name__)
+
+# One fixed-size entry per logged call (little-endian):
+#   u64 byte offset of the record, f64 timestamp, i32 prompt / completion / total tokens,
+#   i32 latency in ms, u16 model id (index into the state file's model table); -1 = unknown
+_ENTRY = struct.Struct("<QdiiiiH")
+INDEX_VERSION = 1
+# Bytes at the start of the log hashed to notice that it was rotated or replaced
+HEAD_BYTES = 256
+_READ_CHUNK = 1 << 20
+# Records written before the logger emitted real newlines are separated by a literal backslash-n
+_LEGACY_SEPARATOR = re.compile(rb'(?<=\})\\n(?=\{"timestamp")')
+# Suffix openai_logger gives rotated files: <log>.<YYYYmmdd-HHMMSS>[-n][.gz]
+_BACKUP_SUFFIX = re.compile(r"\d{8}-\d{6}(?:-\d+)?$")
+
+CallLogEntry = namedtuple(
+    "CallLogEntry", "offset timestamp model prompt_tokens completion_tokens total_tokens latency_ms"
+)
+
+TimeArg = Union[None, float, int, datetime]
+
+
+def _epoch(value: TimeArg) -> Optional[float]:
+    if isinstance(value, datetime):
+        return value.timestamp()
+    return value
+
+
+def _int_or_unknown(value: Any) -> int:
+    return int(value) if isinstance(value, (int, float)) and value >= 0 else -1
+
+
+def _percentile(values: List[int], fraction: float) -> Optional[float]:
+    if not values:
+        return None
+    ordered = sorted(values)
+    return float(ordered[min(len(ordered) - 1, int(fraction * len(ordered)))])
+
+
+class CallLogIndex:
+    """
+    Byte-offset index over logs/openai_calls.jsonl and its rotated backups.
+
+    This class is responsible for:
+    - Keeping a sidecar file with one fixed-size entry per logged call (offset,
+      timestamp, token counts, latency, model) and a small state file with the
+      byte offset processed so far
+    - Extending the index from that offset, so each refresh parses only new records
+    - Starting over when the log has been rotated, truncated or replaced
+    - Indexing each rotated backup (plain or gzip) once into its own sidecar, so
+      queries cover the full history openai_logger keeps, not just the current file
+    - Answering time-range queries and aggregations from the in-memory columns,
+      and reading full records on demand by seeking to their offsets
+    """
+
+    def __init__(self, log_path: str = OPENAI_LOG_PATH, index_path: Optional[str] = None):
+        """
+        Initialize the index (nothing is read until the first query or refresh).
+
+        Args:
+            log_path: The call log written by openai_logger
+            index_path: Sidecar file (defaults to OPENAI_LOG_INDEX_PATH, or the log path
+                with an .index extension); its state is kept next to it in <index_path>.json
+        """
+        self.log_path = log_path
+        self.index_path = index_path or OPENAI_LOG_INDEX_PATH or os.path.splitext(log_path)[0] + ".index"
+        self.state_path = self.index_path + ".json"
+        self._lock = threading.RLock()
+        self._identity = None
+        self._reset_columns()
+        self._stats = {"refreshes": 0, "indexed": 0, "rebuilds": 0, "bad_lines": 0, "backups_indexed": 0}
+
+    def _reset_columns(self) -> None:
+        """Drop every in-memory entry; backups are reloaded from their sidecars on the next refresh."""
+        self._offsets = array("q")
+        self._timestamps = array("d")
+        self._prompt = array("i")
+        self._completion = array("i")
+        self._total = array("i")
+        self._latency = array("i")
+        self._model_ids = array("H")
+        self._sorted = True
+        self._models: List[str] = []
+        # Backup entries come first, oldest file first; the current log's follow from _archive_len
+        self._segments: List[Tuple[int, str]] = []
+        self._archive_len = 0
+        self._archived: Optional[tuple] = None
+
+    def _truncate_columns(self, length: int) -> None:
+        if length >= len(self._offsets):
+            return
+        for column in (self._offsets, self._timestamps, self._prompt, self._completion,
+                       self._total, self._latency, self._model_ids):
+            del column[length:]
+        timestamps = self._timestamps
+        self._sorted = all(timestamps[i] <= timestamps[i + 1] for i in range(len(timestamps) - 1))
+
+    # ───────────── refresh ─────────────
+    def refresh(self) -> int:
+        """
+        Index records appended to the log since the last refresh (in this or another process).
+
+        Returns:
+            The number of newly indexed records
+        """
+        with self._lock:
+            self._stats["refreshes"] += 1
+            lock_fd = self._lock_state()
+            try:
+                self._sync_archive()
+                try:
+                    log_stat = os.stat(self.log_path)
+                except FileNotFoundError:
+                    self._truncate_columns(self._archive_len)
+                    self._identity = None
+                    return 0
+                state = self._read_state()
+                if not self._state_matches(state, log_stat):
+                    if state is not None:
+                        logger.info("OpenAI call log was rotated or replaced; rebuilding its index")
+                        self._stats["rebuilds"] += 1
+                    state = {"version": INDEX_VERSION, "inode": log_stat.st_ino, "head": "", "head_len": 0,
+                             "offset": 0, "records": 0, "models": []}
+                    self._truncate_index(0)
+                self._sync_columns(state)
+                added = self._scan(state, log_stat.st_size)
+                if added:
+                    self._write_state(state)
+                return added
+            finally:
+                self._unlock_state(lock_fd)
+
+    def rebuild(self) -> int:
+        """Drop the index and re-index the whole log."""
+        with self._lock:
+            for path in [self.state_path, self.index_path] + self._archive_sidecars():
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+            self._identity = None
+            self._reset_columns()
+            self._stats["rebuilds"] += 1
+            return self.refresh()
+
+    def _head_digest(self, length: int) -> str:
+        with open(self.log_path, "rb") as f:
+            return hashlib.blake2b(f.read(length), digest_size=16).hexdigest()
+
+    def _state_matches(self, state: Optional[Dict[str, Any]], log_stat: os.stat_result) -> bool:
+        if not state or state.get("version") != INDEX_VERSION or state.get("inode") != log_stat.st_ino:
+            return False
+        if log_stat.st_size < state["offset"]:
+            return False
+        return not state["head_len"] or self._head_digest(state["head_len"]) == state["head"]
+
+    def _sync_columns(self, state: Dict[str, Any]) -> None:
+        """Bring the in-memory columns up to the entries already in the sidecar file."""
+        identity = (state["inode"], state["head"])
+        have = len(self._offsets) - self._archive_len
+        if identity != self._identity or have > state["records"]:
+            self._truncate_columns(self._archive_len)
+            self._identity = identity
+            have = 0
+        want = state["records"]
+        if have >= want:
+            return
+        with open(self.index_path, "rb") as f:
+            f.seek(have * _ENTRY.size)
+            data = f.read((want - have) * _ENTRY.size)
+        for fields in _ENTRY.iter_unpack(data[:len(data) - len(data) % _ENTRY.size]):
+            self._append(fields, state["models"])
+        state["records"] = len(self._offsets) - self._archive_len
+
+    def _append(self, fields: tuple, models: List[str]) -> None:
+        """Add one sidecar entry; its model id indexes models (the table of the file it came from)."""
+        offset, timestamp, prompt, completion, total, latency, model_id = fields
+        if self._timestamps and timestamp < self._timestamps[-1]:
+            self._sorted = False
+        model = models[model_id] if model_id < len(models) else ""
+        try:
+            memory_id = self._models.index(model)
+        except ValueError:
+            self._models.append(model)
+            memory_id = len(self._models) - 1
+        self._offsets.append(offset)
+        self._timestamps.append(timestamp)
+        self._prompt.append(prompt)
+        self._completion.append(completion)
+        self._total.append(total)
+        self._latency.append(latency)
+        self._model_ids.append(memory_id)
+
+    @staticmethod
+    def _model_id(model: str, state: Dict[str, Any]) -> int:
+        models = state["models"]
+        try:
+            return models.index(model)
+        except ValueError:
+            models.append(model)
+            return len(models) - 1
+
+    def _parse_stream(self, f: BinaryIO, offset: int, state: Dict[str, Any]) -> Tuple[List[tuple], int]:
+        """Parse the complete records from f (positioned at offset); return them and the offset after the last."""
+        entries = []
+        pending = b""
+        pending_at = offset
+        while True:
+            chunk = f.read(_READ_CHUNK)
+            if not chunk:
+                break
+            pending += chunk
+            start = 0
+            while True:
+                end = pending.find(b"\n", start)
+                if end < 0:
+                    break
+                entries += self._parse_line(pending[start:end], pending_at + start, state)
+                start = end + 1
+            pending_at += start
+            pending = pending[start:]
+        # Legacy logs never end in a newline; their last record ends in a literal backslash-n
+        if pending.endswith(b"}\\n"):
+            entries += self._parse_line(pending, pending_at, state)
+            pending_at += len(pending)
+        return entries, pending_at
+
+    def _scan(self, state: Dict[str, Any], size: int) -> int:
+        """Parse complete records between the processed offset and the end of the log."""
+        offset = state["offset"]
+        if offset >= size:
+            return 0
+        with open(self.log_path, "rb") as f:
+            f.seek(offset)
+            entries, pending_at = self._parse_stream(f, offset, state)
+        state["offset"] = pending_at
+        if not state["head_len"] and pending_at:
+            state["head_len"] = min(HEAD_BYTES, pending_at)
+            state["head"] = self._head_digest(state["head_len"])
+            self._identity = (state["inode"], state["head"])
+
+        if entries:
+            with open(self.index_path, "ab") as f:
+                f.seek(state["records"] * _ENTRY.size)
+                f.truncate()
+                f.write(b"".join(_ENTRY.pack(*e) for e in entries))
+            for e in entries:
+                self._append(e, state["models"])
+            state["records"] = len(self._offsets) - self._archive_len
+            self._stats["indexed"] += len(entries)
+        elif pending_at != offset:
+            self._write_state(state)
+        return len(entries)
+
+    def _parse_line(self, line: bytes, offset: int, state: Dict[str, Any]) -> List[tuple]:
+        line = line.strip()
+        if not line:
+            return []
+        parts = _LEGACY_SEPARATOR.split(line) if b'}\\n{"timestamp"' in line or line.endswith(b"}\\n") else [line]
+        entries = []
+        for part in parts:
+            if part.endswith(b"}\\n"):
+                part = part[:-2]
+            try:
+                record = json.loads(part)
+            except ValueError:
+                self._stats["bad_lines"] += 1
+                continue
+            if isinstance(record, dict):
+                entries.append(self._entry_fields(record, offset, state))
+            # Records inside one legacy line share the line's offset
+        return entries
+
+    def _entry_fields(self, record: Dict[str, Any], offset: int, state: Dict[str, Any]) -> tuple:
+        request = record.get("request") if isinstance(record.get("request"), dict) else {}
+        response = record.get("response") if isinstance(record.get("response"), dict) else {}
+        usage = record.get("usage") or record.get("tokens") or response.get("usage") or {}
+        if not isinstance(usage, dict):
+            usage = {}
+        model = record.get("model") or request.get("model") or response.get("model") or ""
+        timestamp = record.get("timestamp")
+        return (
+            offset,
+            float(timestamp) if isinstance(timestamp, (int, float)) else 0.0,
+            _int_or_unknown(usage.get("prompt_tokens")),
+            _int_or_unknown(usage.get("completion_tokens")),
+            _int_or_unknown(usage.get("total_tokens")),
+            _int_or_unknown(record.get("latency_ms")),
+            self._model_id(str(model), state),
+        )
+
+    # ───────────── rotated backups ─────────────
+    def _rotated_logs(self) -> List[Tuple[str, str]]:
+        """Return (suffix, path) of each rotated backup of the log, oldest first."""
+        directory = os.path.dirname(self.log_path) or "."
+        prefix = os.path.basename(self.log_path) + "."
+        try:
+            names = sorted(os.listdir(directory))
+        except FileNotFoundError:
+            return []
+        backups: Dict[str, str] = {}
+        for name in names:
+            if not name.startswith(prefix):
+                continue
+            suffix = name[len(prefix):]
+            compressed = suffix.endswith(".gz")
+            if compressed:
+                suffix = suffix[:-3]
+            if not _BACKUP_SUFFIX.match(suffix):
+                continue
+            # While a backup is being compressed both files exist; only the plain one is complete
+            if suffix not in backups or not compressed:
+                backups[suffix] = os.path.join(directory, name)
+        return sorted(backups.items())
+
+    def _archive_sidecars(self) -> List[str]:
+        directory = os.path.dirname(self.index_path) or "."
+        prefix = os.path.basename(self.index_path) + "."
+        try:
+            names = os.listdir(directory)
+        except FileNotFoundError:
+            return []
+        return [os.path.join(directory, name) for name in names
+                if name.startswith(prefix) and _BACKUP_SUFFIX.match(name[len(prefix):])]
+
+    def _sync_archive(self) -> None:
+        """Load the entries of every rotated backup ahead of the current log's (called under the state lock)."""
+        backups = self._rotated_logs()
+        key = tuple(backups)
+        if key == self._archived:
+            return
+        self._reset_columns()
+        self._identity = None
+        complete = True
+        for suffix, path in backups:
+            loaded = self._backup_entries(suffix, path)
+            if loaded is None:
+                complete = False
+                continue
+            models, entries = loaded
+            self._segments.append((len(self._offsets), path))
+            for e in entries:
+                self._append(e, models)
+        self._archive_len = len(self._offsets)
+        # A backup that could not be read is retried on the next refresh
+        self._archived = key if complete else None
+
+        wanted = {f"{self.index_path}.{suffix}" for suffix, _ in backups}
+        for sidecar in self._archive_sidecars():
+            if sidecar not in wanted:
+                try:
+                    os.remove(sidecar)
+                except OSError:
+                    pass
+
+    def _backup_entries(self, suffix: str, path: str) -> Optional[Tuple[List[str], List[tuple]]]:
+        """Return (model table, entries) of one backup, from its sidecar or by parsing it once."""
+        sidecar = f"{self.index_path}.{suffix}"
+        try:
+            with open(sidecar, "rb") as f:
+                header = json.loads(f.readline())
+                data = f.read()
+            if header.get("version") == INDEX_VERSION and len(data) == header["records"] * _ENTRY.size:
+                return header["models"], list(_ENTRY.iter_unpack(data))
+        except (OSError, ValueError, KeyError, AttributeError):
+            pass
+
+        state = {"models": []}
+        # Offsets in a gzip backup are offsets into its decompressed stream, as in the file it was
+        opener = gzip.open if path.endswith(".gz") else open
+        try:
+            with opener(path, "rb") as f:
+                entries, _ = self._parse_stream(f, 0, state)
+        except (OSError, EOFError, zlib.error) as e:
+            logger.warning(f"Could not index rotated OpenAI call log {path}: {e}")
+            return None
+        header = {"version": INDEX_VERSION, "records": len(entries), "models": state["models"]}
+        tmp = f"{sidecar}.{os.getpid()}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(json.dumps(header).encode("utf-8") + b"\n")
+            f.write(b"".join(_ENTRY.pack(*e) for e in entries))
+        os.replace(tmp, sidecar)
+        self._stats["backups_indexed"] += 1
+        logger.info(f"Indexed {len(entries)} calls from rotated OpenAI call log {path}")
+        return state["models"], entries
+
+    # ───────────── sidecar files ─────────────
+    def _lock_state(self) -> Optional[int]:
+        directory = os.path.dirname(self.index_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        if fcntl is None:
+            return None
+        fd = os.open(self.index_path + ".lock", os.O_RDWR | os.O_CREAT, 0o644)
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        return fd
+
+    @staticmethod
+    def _unlock_state(fd: Optional[int]) -> None:
+        if fd is None:
+            return
+        fcntl.flock(fd, fcntl.LOCK_UN)
+        os.close(fd)
+
+    def _read_state(self) -> Optional[Dict[str, Any]]:
+        try:
+            with open(self.state_path, "r", encoding="utf-8") as f:
+                state = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+        # Entries past the recorded count were written by a refresh that did not finish
+        try:
+            entries = os.path.getsize(self.index_path) // _ENTRY.size
+        except FileNotFoundError:
+            entries = 0
+        if entries < state.get("records", 0):
+            return None
+        return state
+
+    def _write_state(self, state: Dict[str, Any]) -> None:
+        tmp = f"{self.state_path}.{os.getpid()}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(state, f)
+        os.replace(tmp, self.state_path)
+
+    def _truncate_index(self, records: int) -> None:
+        with open(self.index_path, "ab") as f:
+            f.truncate(records * _ENTRY.size)
+
+    # ───────────── queries ─────────────
+    def _select(self, start: TimeArg, end: TimeArg, model: Optional[str]) -> List[int]:
+        """Positions of the entries with start <= timestamp < end (and the given model)."""
+        self.refresh()
+        start, end = _epoch(start), _epoch(end)
+        timestamps = self._timestamps
+        if self._sorted:
+            lo = 0 if start is None else bisect.bisect_left(timestamps, start)
+            hi = len(timestamps) if end is None else bisect.bisect_left(timestamps, end)
+            positions = range(lo, hi)
+        else:
+            positions = [i for i, ts in enumerate(timestamps)
+                         if (start is None or ts >= start) and (end is None or ts < end)]
+        if model is not None:
+            if model not in self._models:
+                return []
+            model_id = self._models.index(model)
+            return [i for i in positions if self._model_ids[i] == model_id]
+        return list(positions)
+
+    def _entry(self, i: int) -> CallLogEntry:
+        def known(value):
+            return value if value >= 0 else None
+        return CallLogEntry(
+            self._offsets[i], self._timestamps[i], self._models[self._model_ids[i]],
+            known(self._prompt[i]), known(self._completion[i]), known(self._total[i]), known(self._latency[i]),
+        )
+
+    def entries(self, start: TimeArg = None, end: TimeArg = None, model: Optional[str] = None) -> List[CallLogEntry]:
+        """Return the indexed calls in [start, end), optionally for one model."""
+        with self._lock:
+            return [self._entry(i) for i in self._select(start, end, model)]
+
+    def token_counts(self, start: TimeArg = None, end: TimeArg = None, model: Optional[str] = None) -> List[int]:
+        """Return total_tokens of each call in [start, end) that reported usage."""
+        with self._lock:
+            return [self._total[i] for i in self._select(start, end, model) if self._total[i] >= 0]
+
+    def summary(self, start: TimeArg = None, end: TimeArg = None, model: Optional[str] = None) -> Dict[str, Any]:
+        """
+        Aggregate the calls in [start, end).
+
+        Returns:
+            Call count, token sums, average tokens per call, latency average / p95, and per-model totals
+        """
+        with self._lock:
+            positions = self._select(start, end, model)
+            totals = [self._total[i] for i in positions if self._total[i] >= 0]
+            latencies = [self._latency[i] for i in positions if self._latency[i] >= 0]
+            by_model: Dict[str, Dict[str, int]] = {}
+            for i in positions:
+                bucket = by_model.setdefault(self._models[self._model_ids[i]], {"calls": 0, "total_tokens": 0})
+                bucket["calls"] += 1
+                bucket["total_tokens"] += max(self._total[i], 0)
+            return {
+                "calls": len(positions),
+                "prompt_tokens": sum(self._prompt[i] for i in positions if self._prompt[i] >= 0),
+                "completion_tokens": sum(self._completion[i] for i in positions if self._completion[i] >= 0),
+                "total_tokens": sum(totals),
+                "avg_total_tokens": sum(totals) / len(totals) if totals else 0.0,
+                "avg_latency_ms": sum(latencies) / len(latencies) if latencies else None,
+                "p95_latency_ms": _percentile(latencies, 0.95),
+                "by_model": by_model,
+            }
+
+    def histogram(self, bucket_seconds: int = 3600, start: TimeArg = None, end: TimeArg = None,
+                  model: Optional[str] = None) -> List[Dict[str, Any]]:
+        """Return calls and tokens per time bucket (bucket = bucket start, epoch seconds), oldest first."""
+        with self._lock:
+            buckets: Dict[int, Dict[str, Any]] = {}
+            for i in self._select(start, end, model):
+                key = int(self._timestamps[i] // bucket_seconds) * bucket_seconds
+                bucket = buckets.setdefault(key, {"bucket": key, "calls": 0, "total_tokens": 0})
+                bucket["calls"] += 1
+                bucket["total_tokens"] += max(self._total[i], 0)
+            return [buckets[key] for key in sorted(buckets)]
+
+    def read_records(self, start: TimeArg = None, end: TimeArg = None,
+                     model: Optional[str] = None) -> Iterator[Dict[str, Any]]:
+        """Yield the full logged records in [start, end), reading only their lines from the log."""
+        with self._lock:
+            starts = [first for first, _ in self._segments]
+            paths = [path for _, path in self._segments] + [self.log_path]
+            locations = sorted({
+                (len(starts) if i >= self._archive_len else bisect.bisect_right(starts, i) - 1, self._offsets[i])
+                for i in self._select(start, end, model)
+            })
+        for segment in sorted({seg for seg, _ in locations}):
+            path = paths[segment]
+            if not os.path.exists(path) and os.path.exists(path + ".gz"):
+                path += ".gz"  # compressed since it was indexed; the offsets still hold
+            opener = gzip.open if path.endswith(".gz") else open
+            with opener(path, "rb") as f:
+                for _, offset in (loc for loc in locations if loc[0] == segment):
+                    f.seek(offset)
+                    line = f.readline().rstrip(b"\n")
+                    for part in _LEGACY_SEPARATOR.split(line):
+                        try:
+                            yield json.loads(part[:-2] if part.endswith(b"}\\n") else part)
+                        except ValueError:
+                            continue
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Return refresh counters and the index size."""
+        with self._lock:
+            return dict(self._stats, entries=len(self._offsets), models=len(self._models),
+                        backups=len(self._segments))
+
+
+_index: Optional[CallLogIndex] = None
+_index_lock = threading.Lock()
+
+
+def get_call_log_index() -> CallLogIndex:
+    """Return the process-wide index over the OpenAI call log."""
+    global _index
+    with _index_lock:
+        if _index is None:
+            _index = CallLogIndex()
+        return _index
@@ -0,0 +1,118 @@
+"""
+Process-wide cache of per-chunk analysis (metadata and formatted text) keyed by content hash
+"""
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Optional
+
+from config import CHUNK_ANALYSIS_CACHE_SIZE
+
+logger = logging.getLogger(__name__)
+
+
+class ChunkAnalysis:
+    """
+    Everything the procedural pipeline derives from one chunk's text.
+
+    `metadata` and `is_procedural` are computed up front; `formatted` (the text
+    as placed in the prompt) is computed on first use, since only the top
+    results are formatted.
+    """
+
+    __slots__ = ("metadata", "is_procedural", "_format", "_formatted")
+
+    def __init__(self, metadata: Dict[str, Any], is_procedural: bool, format_text: Callable[[], str]):
+        self.metadata = metadata
+        self.is_procedural = is_procedural
+        self._format = format_text
+        self._formatted = None
+
+    @property
+    def formatted(self) -> str:
+        if self._formatted is None:
+            self._formatted = self._format()
+            self._format = None
+        return self._formatted
+
+
+class ChunkAnalysisCache:
+    """
+    Caches ChunkAnalysis records keyed by a hash of the chunk text.
+
+    This class is responsible for:
+    - Running the regex analysis of a knowledge-base chunk once per process,
+      however many queries and pipeline stages see it
+    - Bounding memory with LRU eviction
+    - Tracking hit/miss counts for monitoring
+    """
+
+    def __init__(self, max_entries: int = CHUNK_ANALYSIS_CACHE_SIZE):
+        """
+        Initialize the cache.
+
+        Args:
+            max_entries: Maximum number of analysed chunks kept (0 disables caching)
+        """
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[bytes, ChunkAnalysis]" = OrderedDict()
+        self._stats = {"hits": 0, "misses": 0, "evictions": 0}
+
+    @staticmethod
+    def make_key(text: str) -> bytes:
+        """Return the 16-byte content key of a chunk."""
+        return hashlib.blake2b(text.encode("utf-8"), digest_size=16).digest()
+
+    def get_or_compute(self, text: str, analyze: Callable[[str], ChunkAnalysis]) -> ChunkAnalysis:
+        """
+        Return the cached analysis of text, running analyze(text) on a miss.
+
+        Args:
+            text: The chunk text
+            analyze: Builds the analysis (called outside the lock)
+        """
+        if self.max_entries <= 0:
+            return analyze(text)
+        key = self.make_key(text)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self._stats["hits"] += 1
+                return entry
+            self._stats["misses"] += 1
+
+        entry = analyze(text)
+        with self._lock:
+            # Another thread may have analysed the same chunk meanwhile; keep the first
+            entry = self._entries.setdefault(key, entry)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self._stats["evictions"] += 1
+        return entry
+
+    def clear(self) -> None:
+        """Drop every cached analysis."""
+        with self._lock:
+            self._entries.clear()
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Return hit/miss counters and current size."""
+        with self._lock:
+            return dict(self._stats, entries=len(self._entries))
+
+
+_cache: Optional[ChunkAnalysisCache] = None
+_cache_lock = threading.Lock()
+
+
+def get_chunk_analysis_cache() -> ChunkAnalysisCache:
+    """Return the process-wide chunk analysis cache."""
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = ChunkAnalysisCache()
+        return _cache
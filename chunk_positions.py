@@ -0,0 +1,220 @@
+"""
+Chunk position index: where each retrieved chunk sits within its parent document
+"""
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from config import SEARCH_CHUNK_ID_FIELD, SEARCH_POSITION_FIELD, CHUNK_POSITION_INDEX_PATH
+
+logger = logging.getLogger(__name__)
+
+# Integrated-vectorization keys end in _pages_<n>; other chunkers commonly end in _<n> or -<n>
+_TRAILING_ORDINAL_RE = re.compile(r"(?:_pages)?[_-](\d+)$")
+
+
+def _quote(value: str) -> str:
+    return value.replace("'", "''")
+
+
+def _runs(positions: List[int]) -> List[Tuple[int, int]]:
+    """Group sorted positions into (first, last) runs of consecutive values."""
+    runs: List[Tuple[int, int]] = []
+    for position in positions:
+        if runs and position == runs[-1][1] + 1:
+            runs[-1] = (runs[-1][0], position)
+        else:
+            runs.append((position, position))
+    return runs
+
+
+def chunk_key(text: str) -> str:
+    """Return the content key of a chunk, as stored in the sidecar file."""
+    return hashlib.blake2b(text.strip().encode("utf-8"), digest_size=12).hexdigest()
+
+
+class ChunkPositionIndex:
+    """
+    Resolves the position of a chunk within its parent document.
+
+    This class is responsible for:
+    - Reading the position from the search result itself: an explicit ordinal
+      field, or the ordinal at the end of the chunk key
+    - Falling back to a local sidecar file ({parent_id: [chunk content keys in order]}),
+      written at ingestion time with add_document() / save()
+    - Ordering sibling chunks and finding the positions missing between them
+    - Building the search filter that fetches given positions of a parent
+    """
+
+    def __init__(self, path: str = CHUNK_POSITION_INDEX_PATH, position_field: str = SEARCH_POSITION_FIELD,
+                 chunk_id_field: str = SEARCH_CHUNK_ID_FIELD):
+        """
+        Initialize the index, loading the sidecar file if there is one.
+
+        Args:
+            path: Sidecar JSON file ("" = none)
+            position_field: Search result field holding the chunk ordinal ("" = none)
+            chunk_id_field: Search result field holding the chunk key ("" = none)
+        """
+        self.path = path
+        self.position_field = position_field
+        self.chunk_id_field = chunk_id_field
+        self._lock = threading.Lock()
+        self._parents: Dict[str, List[str]] = {}
+        self._positions: Dict[str, Tuple[str, int]] = {}
+        if path and os.path.exists(path):
+            self.load()
+
+    # ───────────── sidecar file ─────────────
+    def load(self) -> None:
+        """(Re)load the sidecar file."""
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                parents = json.load(f).get("parents", {})
+        except (OSError, ValueError, AttributeError) as e:
+            logger.error(f"Could not load chunk position index {self.path}: {e}")
+            return
+        with self._lock:
+            self._parents = {}
+            self._positions = {}
+            for parent_id, keys in parents.items():
+                self._index_parent(parent_id, keys)
+        logger.info(f"Loaded chunk positions for {len(parents)} documents from {self.path}")
+
+    def save(self) -> None:
+        """Write the sidecar file atomically."""
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with self._lock:
+            data = {"parents": dict(self._parents)}
+        tmp = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(data, f)
+        os.replace(tmp, self.path)
+
+    def add_document(self, parent_id: str, chunks: Iterable[str]) -> None:
+        """Record the chunk order of one document (e.g. the output of chunk_document)."""
+        with self._lock:
+            self._index_parent(parent_id, [chunk_key(c) for c in chunks])
+
+    def _index_parent(self, parent_id: str, keys: List[str]) -> None:
+        for old in self._parents.get(parent_id, ()):
+            self._positions.pop(old, None)
+        self._parents[parent_id] = list(keys)
+        for position, key in enumerate(keys):
+            self._positions[key] = (parent_id, position)
+
+    # ───────────── lookups ─────────────
+    def select_fields(self) -> List[str]:
+        """Search fields to select so results carry their position."""
+        return [f for f in (self.chunk_id_field, self.position_field) if f]
+
+    def key_fields(self, result: Dict[str, Any]) -> Dict[str, Any]:
+        """Return the selected position fields of a raw search hit, to keep on the formatted result."""
+        return {f: result[f] for f in self.select_fields() if result.get(f) is not None}
+
+    def position_of(self, result: Dict[str, Any]) -> Optional[int]:
+        """Return the chunk's position within its parent, or None when it is unknown."""
+        if self.position_field:
+            value = result.get(self.position_field)
+            if isinstance(value, (int, float)) or (isinstance(value, str) and value.isdigit()):
+                return int(value)
+        if self.chunk_id_field:
+            match = _TRAILING_ORDINAL_RE.search(str(result.get(self.chunk_id_field) or ""))
+            if match:
+                return int(match.group(1))
+        if self._positions and result.get("chunk"):
+            found = self._positions.get(chunk_key(result["chunk"]))
+            if found and found[0] == result.get("parent_id", ""):
+                return found[1]
+        return None
+
+    def sibling_key(self, result: Dict[str, Any], position: int) -> Optional[str]:
+        """Return the key of the chunk at another position of the result's parent, if keys end in an ordinal."""
+        if not self.chunk_id_field:
+            return None
+        key = str(result.get(self.chunk_id_field) or "")
+        match = _TRAILING_ORDINAL_RE.search(key)
+        return f"{key[:match.start(1)]}{position}" if match else None
+
+    def window_filter(self, windows: Dict[str, Iterable[int]], hits: Iterable[Dict[str, Any]] = ()) -> str:
+        """
+        Return a search filter matching the given positions of each parent document.
+
+        Uses ranges on the position field when there is one, else the chunk keys
+        derived from a hit of the same parent; parents with neither (sidecar-only
+        positions) are matched whole.
+
+        Args:
+            windows: {parent_id: positions wanted}
+            hits: Results whose chunk keys give the key pattern of their parent
+        """
+        samples: Dict[str, Dict[str, Any]] = {}
+        for hit in hits:
+            if hit.get("parent_id") and self.sibling_key(hit, 0) is not None:
+                samples.setdefault(hit["parent_id"], hit)
+
+        clauses, keys, whole = [], [], []
+        for parent_id, positions in windows.items():
+            positions = sorted(set(positions))
+            if not positions:
+                continue
+            if self.position_field:
+                runs = " or ".join(f"({self.position_field} ge {lo} and {self.position_field} le {hi})"
+                                   for lo, hi in _runs(positions))
+                clauses.append(f"(parent_id eq '{_quote(parent_id)}' and ({runs}))")
+            elif parent_id in samples:
+                keys.extend(self.sibling_key(samples[parent_id], p) for p in positions)
+            else:
+                whole.append(parent_id)
+        # search.in takes a delimited list; "|" cannot appear in the base64 keys
+        if keys:
+            clauses.append(f"search.in({self.chunk_id_field}, '{'|'.join(_quote(k) for k in keys)}', '|')")
+        if whole:
+            clauses.append(f"search.in(parent_id, '{'|'.join(_quote(p) for p in whole)}', '|')")
+        return " or ".join(clauses)
+
+    def annotate(self, results: Iterable[Dict[str, Any]]) -> None:
+        """Store each result's position under "position" (computed once per result)."""
+        for result in results:
+            if "position" not in result:
+                result["position"] = self.position_of(result)
+
+    @staticmethod
+    def order(siblings: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """Sort annotated siblings by position; chunks without one keep their order, after the rest."""
+        known = sorted((r for r in siblings if r.get("position") is not None), key=lambda r: r["position"])
+        return known + [r for r in siblings if r.get("position") is None]
+
+    @staticmethod
+    def gaps(siblings: List[Dict[str, Any]], max_gap: int) -> List[int]:
+        """Positions missing between annotated siblings, skipping runs longer than max_gap."""
+        positions = sorted({r["position"] for r in siblings if r.get("position") is not None})
+        missing = []
+        for lo, hi in zip(positions, positions[1:]):
+            if 1 < hi - lo <= max_gap + 1:
+                missing.extend(range(lo + 1, hi))
+        return missing
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Return the size of the sidecar index."""
+        with self._lock:
+            return {"documents": len(self._parents), "chunks": len(self._positions)}
+
+
+_index: Optional[ChunkPositionIndex] = None
+_index_lock = threading.Lock()
+
+
+def get_chunk_position_index() -> ChunkPositionIndex:
+    """Return the process-wide chunk position index."""
+    global _index
+    with _index_lock:
+        if _index is None:
+            _index = ChunkPositionIndex()
+        return _index
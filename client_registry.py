@@ -0,0 +1,325 @@
+"""
+Process-wide registry for Azure OpenAI and Azure Cognitive Search clients
+"""
+import asyncio
+import logging
+import threading
+import weakref
+from typing import Dict, Tuple
+
+import requests
+from requests.adapters import HTTPAdapter
+import httpx
+from openai import AzureOpenAI, AsyncAzureOpenAI, DefaultHttpxClient, DefaultAsyncHttpxClient
+from azure.core.credentials import AzureKeyCredential
+from azure.core.pipeline.transport import RequestsTransport
+from azure.search.documents import SearchClient
+from azure.search.documents.aio import SearchClient as AsyncSearchClient
+
+from config import (
+    HTTP_POOL_MAX_CONNECTIONS,
+    HTTP_POOL_MAX_KEEPALIVE,
+    HTTP_KEEPALIVE_EXPIRY,
+)
+
+logger = logging.getLogger(__name__)
+
+
+class ClientRegistry:
+    """
+    Caches API clients so every caller in the worker shares them.
+
+    This class is responsible for:
+    - Owning one keep-alive HTTP connection pool for OpenAI traffic (httpx)
+    - Owning one keep-alive HTTP connection pool for Search traffic (requests)
+    - Handing out one AzureOpenAI client per (endpoint, key, api_version)
+    - Handing out one SearchClient per (endpoint, index, key)
+    - Doing the same for the asyncio clients, once per event loop
+    - Counting cache hits and misses for monitoring
+    """
+
+    def __init__(self, max_connections=HTTP_POOL_MAX_CONNECTIONS,
+                 max_keepalive=HTTP_POOL_MAX_KEEPALIVE,
+                 keepalive_expiry=HTTP_KEEPALIVE_EXPIRY):
+        """
+        Initialize an empty registry.
+
+        Args:
+            max_connections: Maximum number of concurrent connections per pool
+            max_keepalive: Maximum number of idle keep-alive connections per pool
+            keepalive_expiry: Seconds an idle connection is kept open
+        """
+        self.max_connections = max_connections
+        self.max_keepalive = max_keepalive
+        self.keepalive_expiry = keepalive_expiry
+
+        self._lock = threading.Lock()
+        self._http_client = None
+        self._search_transport = None
+        self._openai_clients: Dict[Tuple[str, str, str], AzureOpenAI] = {}
+        self._search_clients: Dict[Tuple[str, str, str], SearchClient] = {}
+        # Async clients hold loop-bound connections, so they are cached per event loop
+        self._async_clients = weakref.WeakKeyDictionary()
+        self._stats = {
+            "openai_hits": 0,
+            "openai_misses": 0,
+            "search_hits": 0,
+            "search_misses": 0,
+        }
+
+    # ───────────── connection pools ─────────────
+    def get_http_client(self) -> httpx.Client:
+        """Return the shared httpx client used by every OpenAI client."""
+        with self._lock:
+            if self._http_client is None:
+                self._http_client = DefaultHttpxClient(
+                    limits=httpx.Limits(
+                        max_connections=self.max_connections,
+                        max_keepalive_connections=self.max_keepalive,
+                        keepalive_expiry=self.keepalive_expiry,
+                    )
+                )
+                logger.info(
+                    f"Created shared OpenAI HTTP pool (max_connections={self.max_connections}, "
+                    f"max_keepalive={self.max_keepalive}, keepalive_expiry={self.keepalive_expiry}s)"
+                )
+            return self._http_client
+
+    def _loop_clients(self) -> Dict:
+        """Return the async client cache for the running event loop."""
+        # Caller must hold self._lock
+        loop = asyncio.get_running_loop()
+        clients = self._async_clients.get(loop)
+        if clients is None:
+            clients = {"http": None, "openai": {}, "search": {}}
+            self._async_clients[loop] = clients
+        return clients
+
+    def get_async_http_client(self) -> httpx.AsyncClient:
+        """Return the shared httpx async client for the running event loop."""
+        with self._lock:
+            clients = self._loop_clients()
+            if clients["http"] is None:
+                clients["http"] = DefaultAsyncHttpxClient(
+                    limits=httpx.Limits(
+                        max_connections=self.max_connections,
+                        max_keepalive_connections=self.max_keepalive,
+                        keepalive_expiry=self.keepalive_expiry,
+                    )
+                )
+                logger.info(f"Created shared async OpenAI HTTP pool (max_connections={self.max_connections})")
+            return clients["http"]
+
+    def _get_search_transport(self) -> RequestsTransport:
+        """Return the shared azure-core transport used by every SearchClient."""
+        # Caller must hold self._lock
+        if self._search_transport is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(
+                pool_connections=self.max_keepalive,
+                pool_maxsize=self.max_connections,
+            )
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            self._search_transport = RequestsTransport(session=session, session_owner=False)
+            logger.info(f"Created shared Search HTTP pool (pool_maxsize={self.max_connections})")
+        return self._search_transport
+
+    # ───────────── clients ─────────────
+    def get_openai_client(self, azure_endpoint, api_key, api_version) -> AzureOpenAI:
+        """
+        Get the shared AzureOpenAI client for the given configuration.
+
+        Args:
+            azure_endpoint: The Azure OpenAI endpoint URL
+            api_key: The API key for authentication
+            api_version: The API version to use
+
+        Returns:
+            An AzureOpenAI client backed by the shared connection pool
+        """
+        key = (azure_endpoint, api_key, api_version)
+        with self._lock:
+            client = self._openai_clients.get(key)
+            if client is not None:
+                self._stats["openai_hits"] += 1
+                return client
+            self._stats["openai_misses"] += 1
+
+        http_client = self.get_http_client()
+        client = AzureOpenAI(
+            azure_endpoint=azure_endpoint,
+            api_key=api_key,
+            api_version=api_version,
+            http_client=http_client,
+        )
+        with self._lock:
+            # Another thread may have raced us; keep the first one
+            client = self._openai_clients.setdefault(key, client)
+        logger.debug(f"Registered AzureOpenAI client for {azure_endpoint} (api_version={api_version})")
+        return client
+
+    def get_search_client(self, endpoint, index_name, api_key) -> SearchClient:
+        """
+        Get the shared SearchClient for the given index.
+
+        Args:
+            endpoint: The full Azure Search endpoint URL
+            index_name: The name of the search index
+            api_key: The admin or query key for the search service
+
+        Returns:
+            A SearchClient backed by the shared connection pool
+        """
+        key = (endpoint, index_name, api_key)
+        with self._lock:
+            client = self._search_clients.get(key)
+            if client is not None:
+                self._stats["search_hits"] += 1
+                return client
+            self._stats["search_misses"] += 1
+            client = SearchClient(
+                endpoint=endpoint,
+                index_name=index_name,
+                credential=AzureKeyCredential(api_key),
+                transport=self._get_search_transport(),
+            )
+            self._search_clients[key] = client
+        logger.debug(f"Registered SearchClient for {endpoint} (index={index_name})")
+        return client
+
+    def get_async_openai_client(self, azure_endpoint, api_key, api_version) -> AsyncAzureOpenAI:
+        """
+        Get the shared AsyncAzureOpenAI client for the running event loop.
+
+        Args:
+            azure_endpoint: The Azure OpenAI endpoint URL
+            api_key: The API key for authentication
+            api_version: The API version to use
+
+        Returns:
+            An AsyncAzureOpenAI client backed by the loop's shared connection pool
+        """
+        key = (azure_endpoint, api_key, api_version)
+        http_client = self.get_async_http_client()
+        with self._lock:
+            cache = self._loop_clients()["openai"]
+            client = cache.get(key)
+            if client is not None:
+                self._stats["openai_hits"] += 1
+                return client
+            self._stats["openai_misses"] += 1
+            client = AsyncAzureOpenAI(
+                azure_endpoint=azure_endpoint,
+                api_key=api_key,
+                api_version=api_version,
+                http_client=http_client,
+            )
+            cache[key] = client
+        logger.debug(f"Registered AsyncAzureOpenAI client for {azure_endpoint} (api_version={api_version})")
+        return client
+
+    def get_async_search_client(self, endpoint, index_name, api_key) -> AsyncSearchClient:
+        """
+        Get the shared asyncio SearchClient for the running event loop.
+
+        Args:
+            endpoint: The full Azure Search endpoint URL
+            index_name: The name of the search index
+            api_key: The admin or query key for the search service
+
+        Returns:
+            An azure.search.documents.aio.SearchClient that keeps its aiohttp session open
+        """
+        key = (endpoint, index_name, api_key)
+        with self._lock:
+            cache = self._loop_clients()["search"]
+            client = cache.get(key)
+            if client is not None:
+                self._stats["search_hits"] += 1
+                return client
+            self._stats["search_misses"] += 1
+            client = AsyncSearchClient(
+                endpoint=endpoint,
+                index_name=index_name,
+                credential=AzureKeyCredential(api_key),
+            )
+            cache[key] = client
+        logger.debug(f"Registered async SearchClient for {endpoint} (index={index_name})")
+        return client
+
+    async def aclose(self) -> None:
+        """Close the async clients that belong to the running event loop."""
+        with self._lock:
+            clients = self._async_clients.pop(asyncio.get_running_loop(), None)
+        if not clients:
+            return
+        for client in clients["search"].values():
+            await client.close()
+        if clients["http"] is not None:
+            await clients["http"].aclose()
+        logger.info("Async clients closed")
+
+    # ───────────── monitoring ─────────────
+    def get_stats(self) -> Dict:
+        """Return pool settings, client counts and hit/miss counters."""
+        with self._lock:
+            stats = dict(self._stats)
+            stats["openai_clients"] = len(self._openai_clients)
+            stats["search_clients"] = len(self._search_clients)
+            stats["async_event_loops"] = len(self._async_clients)
+        stats["max_connections"] = self.max_connections
+        stats["max_keepalive"] = self.max_keepalive
+        stats["keepalive_expiry"] = self.keepalive_expiry
+        return stats
+
+    def close(self) -> None:
+        """Close every pooled connection and forget all cached clients."""
+        with self._lock:
+            if self._http_client is not None:
+                self._http_client.close()
+                self._http_client = None
+            if self._search_transport is not None:
+                self._search_transport.session.close()
+                self._search_transport = None
+            self._openai_clients.clear()
+            self._search_clients.clear()
+        logger.info("Client registry closed")
+
+
+_registry = ClientRegistry()
+
+
+def get_registry() -> ClientRegistry:
+    """Return the process-wide client registry."""
+    return _registry
+
+
+def get_http_client() -> httpx.Client:
+    """Shortcut for get_registry().get_http_client()."""
+    return _registry.get_http_client()
+
+
+def get_openai_client(azure_endpoint, api_key, api_version) -> AzureOpenAI:
+    """Shortcut for get_registry().get_openai_client()."""
+    return _registry.get_openai_client(azure_endpoint, api_key, api_version)
+
+
+def get_search_client(endpoint, index_name, api_key) -> SearchClient:
+    """Shortcut for get_registry().get_search_client()."""
+    return _registry.get_search_client(endpoint, index_name, api_key)
+
+
+def get_async_openai_client(azure_endpoint, api_key, api_version) -> AsyncAzureOpenAI:
+    """Shortcut for get_registry().get_async_openai_client()."""
+    return _registry.get_async_openai_client(azure_endpoint, api_key, api_version)
+
+
+def get_async_search_client(endpoint, index_name, api_key) -> AsyncSearchClient:
+    """Shortcut for get_registry().get_async_search_client()."""
+    return _registry.get_async_search_client(endpoint, index_name, api_key)
+
+
+def get_pool_stats() -> Dict:
+    """Shortcut for get_registry().get_stats()."""
+    return _registry.get_stats()
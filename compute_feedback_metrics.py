@@ -2,8 +2,8 @@
 """
 compute_feedback_metrics.py
 
-Connects to PostgreSQL to fetch feedback entries and parses logs/openai_calls.jsonl
-to compute and print:
+Reads feedback totals from the analytics rollups in PostgreSQL and the
+indexed logs/openai_calls.jsonl to compute and print:
   - Total feedback count
   - Positive feedback count & percentage
   - Occurrences of a specific question
@@ -12,64 +12,25 @@ to compute and print:
 Usage:
   python compute_feedback_metrics.py [--question "your question"]
 """
-import os
-import json
 import argparse
-from psycopg2 import connect
-from psycopg2.extras import RealDictCursor
 from dotenv import load_dotenv
+from db_manager import DatabaseManager
+from analytics_rollups import get_rollups
+from call_log_index import get_call_log_index
 
 # Load environment variables from .env
 load_dotenv()
 
-DB_PARAMS = {
-    'host': os.getenv('POSTGRES_HOST'),
-    'port': os.getenv('POSTGRES_PORT'),
-    'dbname': os.getenv('POSTGRES_DB'),
-    'user': os.getenv('POSTGRES_USER'),
-    'password': os.getenv('POSTGRES_PASSWORD'),
-    'sslmode': os.getenv('POSTGRES_SSL_MODE', 'require')
-}
-
-LOG_PATH = os.path.join('logs', 'openai_calls.jsonl')
-
-POSITIVE_INDICATORS = ['good', 'helpful', 'accurate', 'clear', 'looks good']
-
-def get_feedback_rows():
-    sql = "SELECT user_query, feedback_tags FROM votes;"
-    conn = connect(**DB_PARAMS)
+def count_question(question):
+    sql = "SELECT COUNT(*) FROM votes WHERE lower(btrim(user_query, E' \\t\\r\\n')) = %s;"
+    conn = DatabaseManager.get_connection()
     try:
-        with conn.cursor(cursor_factory=RealDictCursor) as cur:
-            cur.execute(sql)
-            return cur.fetchall()
+        with conn.cursor() as cur:
+            cur.execute(sql, (question.strip().lower(),))
+            return cur.fetchone()[0]
     finally:
         conn.close()
 
-def is_positive(tags):
-    if not tags:
-        return False
-    for tag in tags:
-        tl = tag.lower()
-        for p in POSITIVE_INDICATORS:
-            if p in tl:
-                return True
-    return False
-
-def parse_openai_calls():
-    tokens = []
-    if not os.path.exists(LOG_PATH):
-        return tokens
-    with open(LOG_PATH, 'r') as f:
-        for line in f:
-            try:
-                entry = json.loads(line)
-                tot = entry.get('tokens', {}).get('total_tokens')
-                if isinstance(tot, (int, float)):
-                    tokens.append(tot)
-            except json.JSONDecodeError:
-                continue
-    return tokens
-
 def main():
     parser = argparse.ArgumentParser(description="Compute feedback and token metrics")
     parser.add_argument(
@@ -79,18 +40,18 @@ def main():
     )
     args = parser.parse_args()
 
-    # Feedback metrics
-    rows = get_feedback_rows()
-    total_fb = len(rows)
-    pos_count = sum(1 for r in rows if is_positive(r.get('feedback_tags')))
+    # Feedback metrics (totals come from the hourly rollup, brought up to date first)
+    rollups = get_rollups()
+    rollups.refresh()
+    totals = rollups.feedback_totals()
+    total_fb = totals['total_feedback']
+    pos_count = totals['positive_feedback']
     pos_pct = (pos_count / total_fb * 100) if total_fb else 0.0
 
-    q_lower = args.question.strip().lower()
-    q_count = sum(1 for r in rows if (r.get('user_query') or '').strip().lower() == q_lower)
+    q_count = count_question(args.question)
 
-    # Token metrics
-    token_list = parse_openai_calls()
-    avg_tokens = (sum(token_list) / len(token_list)) if token_list else 0.0
+    # Token metrics (only records appended since the last run are parsed)
+    avg_tokens = get_call_log_index().summary()['avg_total_tokens']
 
     # Output
     print(f"Total feedback entries: {total_fb}")
@@ -18,6 +18,119 @@ SEARCH_ENDPOINT = os.getenv("SEARCH_ENDPOINT", os.getenv("AZURE_SEARCH_SERVICE")
 SEARCH_INDEX = os.getenv("SEARCH_INDEX", os.getenv("AZURE_SEARCH_INDEX"))
 SEARCH_KEY = os.getenv("SEARCH_KEY", os.getenv("AZURE_SEARCH_KEY"))
 VECTOR_FIELD = os.getenv("VECTOR_FIELD")
+# HTTP Connection Pool Configuration (shared by all OpenAI / Search clients)
+HTTP_POOL_MAX_CONNECTIONS = int(os.getenv("HTTP_POOL_MAX_CONNECTIONS", "100"))
+HTTP_POOL_MAX_KEEPALIVE = int(os.getenv("HTTP_POOL_MAX_KEEPALIVE", "20"))
+HTTP_KEEPALIVE_EXPIRY = float(os.getenv("HTTP_KEEPALIVE_EXPIRY", "30"))
+# OpenAI Call Configuration (OpenAIService)
+OPENAI_TIMEOUT = float(os.getenv("OPENAI_TIMEOUT", "60"))            # Per-call deadline in seconds, retries included (streams: until the first chunk)
+OPENAI_STREAM_IDLE_TIMEOUT = float(os.getenv("OPENAI_STREAM_IDLE_TIMEOUT", "30"))  # Longest gap between stream chunks once streaming (0 = no limit)
+OPENAI_MAX_RETRIES = int(os.getenv("OPENAI_MAX_RETRIES", "3"))        # Retries for 429 / 5xx / connection errors
+OPENAI_BACKOFF_BASE = float(os.getenv("OPENAI_BACKOFF_BASE", "0.5"))  # First backoff step in seconds (jittered, doubling)
+OPENAI_BACKOFF_MAX = float(os.getenv("OPENAI_BACKOFF_MAX", "20"))     # Cap on a single backoff step
+OPENAI_STREAM_USAGE = os.getenv("OPENAI_STREAM_USAGE", "auto").lower()  # auto | true | false: request usage on the last stream chunk
+# OpenAI Rate Limit Configuration (per worker process: divide the deployment quota by the worker count)
+OPENAI_RPM_LIMIT = int(os.getenv("OPENAI_RPM_LIMIT", "0"))        # Requests per minute per deployment (0 = unlimited)
+OPENAI_TPM_LIMIT = int(os.getenv("OPENAI_TPM_LIMIT", "0"))        # Tokens per minute per deployment (0 = unlimited)
+OPENAI_DEPLOYMENT_LIMITS = os.getenv("OPENAI_DEPLOYMENT_LIMITS", "")  # JSON overrides, e.g. {"gpt-4o": {"rpm": 300, "tpm": 50000}}
+RATE_LIMIT_BURST_SECONDS = float(os.getenv("RATE_LIMIT_BURST_SECONDS", "10"))  # Quota the buckets may spend at once
+# OpenAI Call Log Configuration (logs/openai_calls.jsonl)
+OPENAI_LOG_PATH = os.getenv("OPENAI_LOG_PATH", os.path.join("logs", "openai_calls.jsonl"))
+OPENAI_LOG_ASYNC = os.getenv("OPENAI_LOG_ASYNC", "true").lower() in ("1", "true", "yes")  # Write from a background thread
+OPENAI_LOG_SAMPLE_RATE = float(os.getenv("OPENAI_LOG_SAMPLE_RATE", "1.0"))     # Fraction of calls logged (0 = off)
+OPENAI_LOG_BATCH_SIZE = int(os.getenv("OPENAI_LOG_BATCH_SIZE", "200"))         # Records per write
+OPENAI_LOG_FLUSH_INTERVAL = float(os.getenv("OPENAI_LOG_FLUSH_INTERVAL", "1.0"))  # Seconds a record may wait before being written
+OPENAI_LOG_MAX_QUEUE = int(os.getenv("OPENAI_LOG_MAX_QUEUE", "10000"))         # Records held in memory; further ones are dropped
+OPENAI_LOG_MAX_BYTES = int(os.getenv("OPENAI_LOG_MAX_BYTES", str(50 * 1024 * 1024)))  # Rotate past this size (0 = never)
+OPENAI_LOG_ROTATE_SECONDS = int(os.getenv("OPENAI_LOG_ROTATE_SECONDS", "86400"))  # Rotate at interval boundaries, UTC (0 = never)
+OPENAI_LOG_BACKUP_COUNT = int(os.getenv("OPENAI_LOG_BACKUP_COUNT", "7"))       # Rotated files kept (0 = all)
+OPENAI_LOG_COMPRESS = os.getenv("OPENAI_LOG_COMPRESS", "true").lower() in ("1", "true", "yes")  # gzip rotated files
+OPENAI_LOG_MESSAGES = os.getenv("OPENAI_LOG_MESSAGES", "trim").lower()         # full | trim | summary: how request messages are logged
+OPENAI_LOG_MAX_CHARS = int(os.getenv("OPENAI_LOG_MAX_CHARS", "1000"))          # Longer strings are cut (0 = no limit)
+OPENAI_LOG_INDEX_PATH = os.getenv("OPENAI_LOG_INDEX_PATH", "")                 # Sidecar index for analytics (default: <log>.index)
+# Embedding Cache Configuration
+EMBEDDING_CACHE_SIZE = int(os.getenv("EMBEDDING_CACHE_SIZE", "10000"))   # In-memory LRU entries per worker
+EMBEDDING_CACHE_PATH = os.getenv("EMBEDDING_CACHE_PATH", "")            # Set to persist vectors on disk (e.g. cache/embeddings.bin)
+EMBEDDING_CACHE_MAX_BYTES = int(os.getenv("EMBEDDING_CACHE_MAX_BYTES", str(256 * 1024 * 1024)))  # Disk store is compacted to half this when full (0 = no cap)
+# Chunk Analysis Cache Configuration
+CHUNK_ANALYSIS_CACHE_SIZE = int(os.getenv("CHUNK_ANALYSIS_CACHE_SIZE", "5000"))  # Analysed KB chunks kept per worker (0 = off)
+# Chunk Position Configuration (hierarchical retrieval ordering)
+SEARCH_CHUNK_ID_FIELD = os.getenv("SEARCH_CHUNK_ID_FIELD", "chunk_id")  # Index key; a trailing _pages_<n> / _<n> gives the position
+SEARCH_POSITION_FIELD = os.getenv("SEARCH_POSITION_FIELD", "")          # Explicit chunk ordinal field, if the index has one
+CHUNK_POSITION_INDEX_PATH = os.getenv("CHUNK_POSITION_INDEX_PATH", "")  # Sidecar JSON of chunk order per parent_id
+HIERARCHY_MAX_PARENTS = int(os.getenv("HIERARCHY_MAX_PARENTS", "3"))    # Parent documents kept by retrieve_with_hierarchy
+HIERARCHY_MAX_GAP = int(os.getenv("HIERARCHY_MAX_GAP", "4"))            # Largest run of missing siblings filled in (0 = never fetch)
+# Context Expansion Configuration (neighbour chunks of top hits)
+CONTEXT_EXPANSION_TOP_K = int(os.getenv("CONTEXT_EXPANSION_TOP_K", "3"))        # Hits whose neighbours are fetched (0 = off)
+CONTEXT_EXPANSION_BEFORE = int(os.getenv("CONTEXT_EXPANSION_BEFORE", "3"))      # Chunks added before each hit
+CONTEXT_EXPANSION_AFTER = int(os.getenv("CONTEXT_EXPANSION_AFTER", "2"))        # Chunks added after each hit
+CONTEXT_EXPANSION_CACHE_SIZE = int(os.getenv("CONTEXT_EXPANSION_CACHE_SIZE", "256"))  # Expanded parent documents kept per worker
+CONTEXT_EXPANSION_CACHE_TTL = int(os.getenv("CONTEXT_EXPANSION_CACHE_TTL", "900"))    # Seconds before a parent is fetched again
+CONTEXT_EXPANSION_DECAY = float(os.getenv("CONTEXT_EXPANSION_DECAY", "0.9"))       # Inline neighbours score hit x decay per chunk of distance
+CONTEXT_EXPANSION_FETCH_TOP = int(os.getenv("CONTEXT_EXPANSION_FETCH_TOP", "200"))  # Chunks per neighbour search; a full page is not cached
+# Reranker Configuration (local reordering of search hits before context preparation)
+RERANKER_MODE = os.getenv("RERANKER_MODE", "fusion").lower()          # none | fusion | bm25 | cross_encoder
+RERANKER_FUSION_SCORER = os.getenv("RERANKER_FUSION_SCORER", "bm25")   # Local scorer fused with the search ranking
+RERANKER_FUSION_WEIGHT = float(os.getenv("RERANKER_FUSION_WEIGHT", "0.5"))  # Share of the local scorer in fusion (0-1)
+RERANKER_MODEL = os.getenv("RERANKER_MODEL", "cross-encoder/ms-marco-MiniLM-L-6-v2")  # CPU cross-encoder (sentence-transformers)
+# Near-Duplicate Suppression Configuration (before context slots are filled)
+DEDUP_ENABLED = os.getenv("DEDUP_ENABLED", "true").lower() in ("1", "true", "yes")
+DEDUP_THRESHOLD = float(os.getenv("DEDUP_THRESHOLD", "0.8"))      # Estimated Jaccard similarity above which chunks are duplicates
+DEDUP_NUM_PERM = int(os.getenv("DEDUP_NUM_PERM", "64"))           # MinHash permutations per signature
+DEDUP_SHINGLE_SIZE = int(os.getenv("DEDUP_SHINGLE_SIZE", "3"))    # Words per shingle
+DEDUP_CACHE_SIZE = int(os.getenv("DEDUP_CACHE_SIZE", "5000"))     # Chunk signatures kept per worker
+# Context Packing Configuration (knowledge-base chunks placed in the prompt)
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "2500"))          # Prompt tokens for retrieved sources
+CONTEXT_MAX_SOURCES = int(os.getenv("CONTEXT_MAX_SOURCES", "8"))              # Upper bound on sources, however short
+CONTEXT_MIN_CHUNK_TOKENS = int(os.getenv("CONTEXT_MIN_CHUNK_TOKENS", "60"))   # Smallest truncated chunk worth including
+# Semantic Answer Cache Configuration
+SEMANTIC_CACHE_ENABLED = os.getenv("SEMANTIC_CACHE_ENABLED", "true").lower() in ("1", "true", "yes")
+SEMANTIC_CACHE_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.97"))  # Minimum cosine similarity for a hit
+SEMANTIC_CACHE_SIZE = int(os.getenv("SEMANTIC_CACHE_SIZE", "1000"))
+SEMANTIC_CACHE_TTL = int(os.getenv("SEMANTIC_CACHE_TTL", "86400"))               # Seconds; 0 = never expire
+SEMANTIC_CACHE_INDEX_VERSION = os.getenv("SEMANTIC_CACHE_INDEX_VERSION", "")    # Bump after re-indexing to invalidate answers
+# Speculative Retrieval Configuration
+SPECULATIVE_RETRIEVAL_ENABLED = os.getenv("SPECULATIVE_RETRIEVAL_ENABLED", "false").lower() in ("1", "true", "yes")
+SPECULATIVE_QUERY_OVERLAP = float(os.getenv("SPECULATIVE_QUERY_OVERLAP", "0.8"))   # Term overlap above which the raw-query results are reused
+SPECULATIVE_MAX_WORKERS = int(os.getenv("SPECULATIVE_MAX_WORKERS", "8"))
+# Database Connection Pool Configuration
+DB_POOL_MIN_SIZE = int(os.getenv("DB_POOL_MIN_SIZE", "1"))                       # Idle connections kept open
+DB_POOL_MAX_SIZE = int(os.getenv("DB_POOL_MAX_SIZE", "10"))                      # Hard cap per worker process
+DB_POOL_ACQUIRE_TIMEOUT = float(os.getenv("DB_POOL_ACQUIRE_TIMEOUT", "10"))      # Seconds to wait for a free connection
+DB_POOL_HEALTHCHECK_INTERVAL = float(os.getenv("DB_POOL_HEALTHCHECK_INTERVAL", "30"))  # Ping idle connections older than this
+DB_POOL_MAX_LIFETIME = float(os.getenv("DB_POOL_MAX_LIFETIME", "1800"))          # Recycle connections after this many seconds
+DB_POOL_MAX_IDLE = float(os.getenv("DB_POOL_MAX_IDLE", "300"))                   # Close idle connections beyond min size after this many seconds
+# Background Database Writer Configuration
+DB_WRITER_ENABLED = os.getenv("DB_WRITER_ENABLED", "true").lower() in ("1", "true", "yes")
+DB_WRITER_BATCH_SIZE = int(os.getenv("DB_WRITER_BATCH_SIZE", "50"))             # Rows per flush
+DB_WRITER_FLUSH_INTERVAL = float(os.getenv("DB_WRITER_FLUSH_INTERVAL", "2.0"))  # Seconds between flushes when the batch is not full
+DB_WRITER_MAX_QUEUE = int(os.getenv("DB_WRITER_MAX_QUEUE", "10000"))            # Records held in memory before spilling
+DB_WRITER_SPILL_PATH = os.getenv("DB_WRITER_SPILL_PATH", "cache/db_spill.jsonl")  # Records that could not be written yet
+DB_WRITER_DEAD_LETTER_PATH = os.getenv("DB_WRITER_DEAD_LETTER_PATH", "cache/db_dead_letter.jsonl")  # Records the database rejected
+# Analytics Dashboard Configuration
+ANALYTICS_CACHE_TTL = int(os.getenv("ANALYTICS_CACHE_TTL", "30"))   # Seconds a computed dashboard payload is reused
+ANALYTICS_CACHE_SIZE = int(os.getenv("ANALYTICS_CACHE_SIZE", "64"))  # Date ranges whose payload is kept per worker
+ANALYTICS_ROLLUP_REFRESH_INTERVAL = int(os.getenv("ANALYTICS_ROLLUP_REFRESH_INTERVAL", "60"))  # Min seconds between on-read rollup refreshes
+ANALYTICS_ROLLUP_SETTLE_SECONDS = int(os.getenv("ANALYTICS_ROLLUP_SETTLE_SECONDS", "5"))  # Rows younger than this wait for the next refresh
+# Session Store Configuration
+SESSION_STORE_BACKEND = os.getenv("SESSION_STORE_BACKEND", "memory")   # memory | sqlite | redis
+SESSION_TTL = int(os.getenv("SESSION_TTL", "3600"))                   # Idle seconds before a conversation expires
+SESSION_MAX_ENTRIES = int(os.getenv("SESSION_MAX_ENTRIES", "1000"))   # LRU cap on stored conversations
+SESSION_MAX_BYTES = int(os.getenv("SESSION_MAX_BYTES", str(64 * 1024 * 1024)))  # Memory cap for the in-process backend
+SESSION_SQLITE_PATH = os.getenv("SESSION_SQLITE_PATH", "cache/sessions.db")  # Shared by workers on one host
+SESSION_REDIS_URL = os.getenv("SESSION_REDIS_URL", "redis://localhost:6379/0")  # Shared by workers on any host
+SESSION_LOCK_TIMEOUT = float(os.getenv("SESSION_LOCK_TIMEOUT", "30"))  # Seconds a turn waits for the previous turn of its session
+SESSION_LOCK_TTL = int(os.getenv("SESSION_LOCK_TTL", "300"))         # Seconds before a lease left by a dead worker expires
+# Conversation State Configuration
+CONVERSATION_CHUNK_STORE_SIZE = int(os.getenv("CONVERSATION_CHUNK_STORE_SIZE", "2000"))  # Retrieved chunks interned per process
+# History Trimming Configuration
+HISTORY_TRIM_STRATEGY = os.getenv("HISTORY_TRIM_STRATEGY", "tokens")  # tokens (prompt-token budget) | turns (max_history_turns)
+HISTORY_TOKEN_BUDGET = int(os.getenv("HISTORY_TOKEN_BUDGET", "6000"))  # Prompt tokens allowed for system prompt + history + current turn
+HISTORY_COMPACTION = os.getenv("HISTORY_COMPACTION", "true").lower() in ("1", "true", "yes")  # Earlier turns send citation stubs, not their context
+# Rolling Summary Configuration
+SUMMARY_ASYNC_FOLD = os.getenv("SUMMARY_ASYNC_FOLD", "false").lower() in ("1", "true", "yes")  # Fold evicted turns after the response
+SUMMARY_CACHE_SIZE = int(os.getenv("SUMMARY_CACHE_SIZE", "1000"))   # Folded summaries kept per process
+SUMMARY_FOLD_WORKERS = int(os.getenv("SUMMARY_FOLD_WORKERS", "2"))  # Background summarization threads
 # Logging Configuration
 LOG_FORMAT = os.getenv("LOG_FORMAT", "%(asctime)s - %(levelname)s - %(message)s")
 LOG_FILE = os.getenv("LOG_FILE", "app.log")
@@ -0,0 +1,299 @@
+"""
+Context expansion: adds the neighbouring chunks of the top search hits from their parent documents
+"""
+import logging
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Set, Tuple
+
+from config import (
+    CONTEXT_EXPANSION_TOP_K,
+    CONTEXT_EXPANSION_BEFORE,
+    CONTEXT_EXPANSION_AFTER,
+    CONTEXT_EXPANSION_CACHE_SIZE,
+    CONTEXT_EXPANSION_CACHE_TTL,
+    CONTEXT_EXPANSION_DECAY,
+    CONTEXT_EXPANSION_FETCH_TOP,
+)
+from chunk_positions import ChunkPositionIndex, get_chunk_position_index
+
+logger = logging.getLogger(__name__)
+
+# A fetch runs one search with the given filter and page size and returns the formatted chunks
+FetchWindow = Callable[[str, int], List[Dict[str, Any]]]
+AsyncFetchWindow = Callable[[str, int], Awaitable[List[Dict[str, Any]]]]
+# Sibling lookup for retrieve_with_hierarchy: ({parent_id: positions}, hits) -> chunks
+FetchSiblings = Callable[[Dict[str, Set[int]], List[Dict[str, Any]]], List[Dict[str, Any]]]
+
+
+class ContextExpander:
+    """
+    Expands the top search hits with the adjacent chunks of the same parent document.
+
+    This class is responsible for:
+    - Working out which positions around the top-k hits are missing
+    - Fetching only those positions (not whole parents) in one filtered search
+    - Keeping the fetched positions of recent parents in an LRU cache (with a
+      TTL, so a re-indexed document is picked up again); a search that filled
+      its page, or a parent that came back empty, is never cached
+    - Tracking cache and fetch counts for monitoring
+    """
+
+    def __init__(self, top_k: int = CONTEXT_EXPANSION_TOP_K, before: int = CONTEXT_EXPANSION_BEFORE,
+                 after: int = CONTEXT_EXPANSION_AFTER, max_parents: int = CONTEXT_EXPANSION_CACHE_SIZE,
+                 ttl: int = CONTEXT_EXPANSION_CACHE_TTL, position_index: Optional[ChunkPositionIndex] = None,
+                 decay: float = CONTEXT_EXPANSION_DECAY, fetch_top: int = CONTEXT_EXPANSION_FETCH_TOP):
+        """
+        Initialize the expander.
+
+        Args:
+            top_k: Number of hits whose neighbours are added (0 disables expansion)
+            before: Chunks added before each hit
+            after: Chunks added after each hit
+            max_parents: Parent documents kept in the cache (0 disables caching)
+            ttl: Seconds a cached parent stays valid (0 = until evicted)
+            position_index: Resolves chunk positions (defaults to the process-wide index)
+            decay: Score kept per chunk of distance by inline neighbours
+            fetch_top: Page size of the neighbour search
+        """
+        self.top_k = top_k
+        self.before = before
+        self.after = after
+        self.max_parents = max_parents
+        self.ttl = ttl
+        self.position_index = position_index or get_chunk_position_index()
+        self.decay = decay
+        self.fetch_top = fetch_top
+        self._lock = threading.Lock()
+        # parent_id -> (cached at, {position: chunk}, positions known to be fetched)
+        self._parents: "OrderedDict[str, Tuple[float, Dict[int, Dict[str, Any]], Set[int]]]" = OrderedDict()
+        self._stats = {"expansions": 0, "added": 0, "fetches": 0, "truncated_fetches": 0,
+                       "parent_hits": 0, "parent_misses": 0}
+
+    # ───────────── parent cache ─────────────
+    def _cached(self, parent_id: str) -> Optional[Tuple[float, Dict[int, Dict[str, Any]], Set[int]]]:
+        entry = self._parents.get(parent_id)
+        if entry is None:
+            return None
+        if self.ttl and time.time() - entry[0] > self.ttl:
+            del self._parents[parent_id]
+            return None
+        self._parents.move_to_end(parent_id)
+        return entry
+
+    def _lookup(self, wanted: Dict[str, Set[int]]) -> Tuple[Dict[str, Dict[int, Dict[str, Any]]], Dict[str, Set[int]]]:
+        found, missing = {}, {}
+        with self._lock:
+            for parent_id, positions in wanted.items():
+                entry = self._cached(parent_id)
+                if entry is not None:
+                    found[parent_id] = dict(entry[1])
+                    positions = positions - entry[2]
+                if positions:
+                    missing[parent_id] = positions
+            self._stats["parent_hits"] += len(wanted) - len(missing)
+            self._stats["parent_misses"] += len(missing)
+        return found, missing
+
+    def _store(self, missing: Dict[str, Set[int]], fetched: List[Dict[str, Any]]) -> Dict[str, Dict[int, Dict[str, Any]]]:
+        self.position_index.annotate(fetched)
+        by_parent: Dict[str, Dict[int, Dict[str, Any]]] = {pid: {} for pid in missing}
+        for chunk in fetched:
+            chunks = by_parent.get(chunk.get("parent_id", ""))
+            if chunks is not None and chunk.get("position") is not None:
+                chunks.setdefault(chunk["position"], chunk)
+
+        # A full page may have cut positions off, and an empty parent may be a transient miss
+        truncated = len(fetched) >= self.fetch_top
+        if truncated:
+            logger.warning(f"Neighbour search returned a full page of {self.fetch_top} chunks; not caching it")
+        with self._lock:
+            self._stats["fetches"] += 1
+            self._stats["truncated_fetches"] += int(truncated)
+            if self.max_parents > 0 and not truncated:
+                now = time.time()
+                for parent_id, chunks in by_parent.items():
+                    if not chunks:
+                        continue
+                    entry = self._cached(parent_id)
+                    if entry is None:
+                        entry = (now, {}, set())
+                    cached_at, cached, covered = entry
+                    cached = {**cached, **chunks}
+                    self._parents[parent_id] = (cached_at, cached, covered | missing[parent_id] | set(chunks))
+                    self._parents.move_to_end(parent_id)
+                while len(self._parents) > self.max_parents:
+                    self._parents.popitem(last=False)
+        return by_parent
+
+    @staticmethod
+    def _merge(found: Dict[str, Dict[int, Dict[str, Any]]],
+               fetched: Dict[str, Dict[int, Dict[str, Any]]]) -> Dict[str, Dict[int, Dict[str, Any]]]:
+        for parent_id, chunks in fetched.items():
+            found.setdefault(parent_id, {}).update(chunks)
+        return found
+
+    def parent_chunks(self, wanted: Dict[str, Set[int]], fetch: FetchWindow,
+                      hits: List[Dict[str, Any]] = ()) -> Dict[str, Dict[int, Dict[str, Any]]]:
+        """
+        Return {parent_id: {position: chunk}} covering the wanted positions, fetching
+        the uncached ones with one search.
+
+        Args:
+            wanted: {parent_id: positions needed}
+            fetch: Runs one search with the given filter and page size
+            hits: Results of those parents (they give the chunk key pattern)
+        """
+        found, missing = self._lookup(wanted)
+        if missing:
+            filter_expr = self.position_index.window_filter(missing, hits)
+            found = self._merge(found, self._store(missing, fetch(filter_expr, self.fetch_top)))
+        return found
+
+    async def aparent_chunks(self, wanted: Dict[str, Set[int]], afetch: AsyncFetchWindow,
+                             hits: List[Dict[str, Any]] = ()) -> Dict[str, Dict[int, Dict[str, Any]]]:
+        """Async version of parent_chunks (afetch is awaited)."""
+        found, missing = self._lookup(wanted)
+        if missing:
+            filter_expr = self.position_index.window_filter(missing, hits)
+            found = self._merge(found, self._store(missing, await afetch(filter_expr, self.fetch_top)))
+        return found
+
+    def fetch_siblings(self, fetch: FetchWindow) -> FetchSiblings:
+        """Wrap a window fetch as a cached sibling lookup (for retrieve_with_hierarchy)."""
+        def cached_fetch(wanted: Dict[str, Set[int]], hits: List[Dict[str, Any]] = ()) -> List[Dict[str, Any]]:
+            parents = self.parent_chunks({pid: set(positions) for pid, positions in wanted.items()}, fetch, hits)
+            return [dict(parents[pid][position]) for pid, positions in wanted.items()
+                    for position in sorted(positions) if position in parents.get(pid, {})]
+        return cached_fetch
+
+    def clear(self) -> None:
+        """Drop every cached parent."""
+        with self._lock:
+            self._parents.clear()
+
+    # ───────────── expansion ─────────────
+    def _wanted(self, results: List[Dict[str, Any]]) -> Dict[str, Set[int]]:
+        present: Dict[str, Set[int]] = {}
+        for result in results:
+            if result.get("position") is not None:
+                present.setdefault(result.get("parent_id", ""), set()).add(result["position"])
+
+        wanted: Dict[str, Set[int]] = {}
+        for result in results[:self.top_k]:
+            parent_id, position = result.get("parent_id", ""), result.get("position")
+            if not parent_id or position is None:
+                continue
+            window = range(max(0, position - self.before), position + self.after + 1)
+            gaps = set(window) - present.get(parent_id, set())
+            if gaps:
+                wanted.setdefault(parent_id, set()).update(gaps)
+        return wanted
+
+    def _plan(self, results: List[Dict[str, Any]]) -> Dict[str, Set[int]]:
+        if self.top_k <= 0 or not results:
+            return {}
+        self.position_index.annotate(results)
+        return self._wanted(results)
+
+    def _assemble(self, results: List[Dict[str, Any]], wanted: Dict[str, Set[int]],
+                  parents: Dict[str, Dict[int, Dict[str, Any]]], inline: bool) -> List[Dict[str, Any]]:
+        if not inline:
+            added = []
+            for parent_id, positions in wanted.items():
+                chunks = parents.get(parent_id, {})
+                for position in sorted(positions):
+                    if position in chunks:
+                        added.append(dict(chunks[position], relevance=0.0, expanded=True))
+            expanded = results + added
+        else:
+            # Each neighbour goes next to the best hit whose window covers it, in document order
+            assigned: Set[Tuple[str, int]] = set()
+            before: Dict[int, List[Dict[str, Any]]] = {}
+            after: Dict[int, List[Dict[str, Any]]] = {}
+            added = []
+            for i, hit in enumerate(results[:self.top_k]):
+                parent_id, position = hit.get("parent_id", ""), hit.get("position")
+                if position is None or parent_id not in wanted:
+                    continue
+                chunks = parents.get(parent_id, {})
+                for neighbour in range(max(0, position - self.before), position + self.after + 1):
+                    key = (parent_id, neighbour)
+                    if neighbour not in wanted[parent_id] or neighbour not in chunks or key in assigned:
+                        continue
+                    assigned.add(key)
+                    relevance = hit.get("relevance", 0.0) * self.decay ** abs(neighbour - position)
+                    chunk = dict(chunks[neighbour], relevance=relevance, expanded=True)
+                    (before if neighbour < position else after).setdefault(i, []).append(chunk)
+                    added.append(chunk)
+            expanded = []
+            for i, result in enumerate(results):
+                expanded.extend(before.get(i, ()))
+                expanded.append(result)
+                expanded.extend(after.get(i, ()))
+
+        with self._lock:
+            self._stats["expansions"] += 1
+            self._stats["added"] += len(added)
+        logger.info(f"Context expansion added {len(added)} neighbouring chunks from {len(wanted)} parents")
+        return expanded
+
+    def expand(self, results: List[Dict[str, Any]], fetch: FetchWindow, inline: bool = False) -> List[Dict[str, Any]]:
+        """
+        Add the neighbours of the top-k results.
+
+        By default neighbours are appended after the original results, marked
+        "expanded" and scored 0.0, for retrieve_with_hierarchy to put in document
+        order. With inline=True each neighbour is placed next to its hit, in
+        document order, and scored as the hit times decay per chunk of distance,
+        so score-ordered context packing keeps a procedure together.
+
+        Args:
+            results: Search results, best first
+            fetch: Runs one search with the given filter and page size
+            inline: Place neighbours next to their hit instead of at the end
+
+        Returns:
+            The results plus their neighbouring chunks
+        """
+        wanted = self._plan(results)
+        if not wanted:
+            return results
+        try:
+            parents = self.parent_chunks(wanted, fetch, results[:self.top_k])
+        except Exception as exc:
+            logger.warning(f"Context expansion failed, using the hits alone: {exc}")
+            return results
+        return self._assemble(results, wanted, parents, inline)
+
+    async def aexpand(self, results: List[Dict[str, Any]], afetch: AsyncFetchWindow,
+                      inline: bool = False) -> List[Dict[str, Any]]:
+        """Async version of expand (afetch is awaited)."""
+        wanted = self._plan(results)
+        if not wanted:
+            return results
+        try:
+            parents = await self.aparent_chunks(wanted, afetch, results[:self.top_k])
+        except Exception as exc:
+            logger.warning(f"Context expansion failed, using the hits alone: {exc}")
+            return results
+        return self._assemble(results, wanted, parents, inline)
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Return expansion counters and the cache size."""
+        with self._lock:
+            return dict(self._stats, cached_parents=len(self._parents))
+
+
+_expander: Optional[ContextExpander] = None
+_expander_lock = threading.Lock()
+
+
+def get_context_expander() -> ContextExpander:
+    """Return the process-wide context expander."""
+    global _expander
+    with _expander_lock:
+        if _expander is None:
+            _expander = ContextExpander()
+        return _expander
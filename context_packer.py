@@ -0,0 +1,146 @@
+"""
+Token-budgeted packing of retrieved chunks into the prompt context
+"""
+import logging
+import re
+import threading
+from typing import Any, Callable, Dict, List, NamedTuple, Optional
+
+from config import CONTEXT_TOKEN_BUDGET, CONTEXT_MAX_SOURCES, CONTEXT_MIN_CHUNK_TOKENS
+from token_counter import count_tokens
+
+logger = logging.getLogger(__name__)
+
+# Tokens taken by the <source id="n" ...></source> wrapper and the blank line between sources
+SOURCE_OVERHEAD = 12
+
+# A sentence ends at ., ! or ? followed by whitespace, or at a line break (list items, steps)
+_SENTENCE_END_RE = re.compile(r"(?<=[.!?])\s+|\n+")
+
+
+class PackedSource(NamedTuple):
+    """One result as placed in the context."""
+    result: Dict[str, Any]
+    text: str
+    tokens: int
+    truncated: bool
+
+
+def truncate_to_tokens(text: str, max_tokens: int, model: Optional[str] = None) -> str:
+    """
+    Cut text after the last whole sentence that fits in max_tokens.
+
+    Returns an empty string when not even the first sentence fits.
+    """
+    end, used = 0, 0
+    for match in _SENTENCE_END_RE.finditer(text + "\n"):
+        sentence = text[end:match.start()]
+        cost = count_tokens(sentence, model)
+        if used + cost > max_tokens:
+            break
+        used += cost
+        end = match.end()
+    return text[:end].rstrip()
+
+
+class ContextPacker:
+    """
+    Fills a token budget with retrieved chunks.
+
+    This class is responsible for:
+    - Picking results greedily by score until the budget or the source limit is reached
+    - Truncating the chunk that does not fit at a sentence boundary, when enough budget is left
+    - Reporting the tokens used per source and tracking totals for monitoring
+    """
+
+    def __init__(self, budget: int = CONTEXT_TOKEN_BUDGET, max_sources: int = CONTEXT_MAX_SOURCES,
+                 min_chunk_tokens: int = CONTEXT_MIN_CHUNK_TOKENS):
+        """
+        Initialize the packer.
+
+        Args:
+            budget: Default token budget for the sources
+            max_sources: Maximum number of sources
+            min_chunk_tokens: Smallest truncated chunk worth including
+        """
+        self.budget = budget
+        self.max_sources = max_sources
+        self.min_chunk_tokens = min_chunk_tokens
+        self._lock = threading.Lock()
+        self._stats = {"calls": 0, "sources": 0, "tokens": 0, "truncated": 0, "skipped": 0}
+
+    def pack(self, results: List[Dict[str, Any]], format_chunk: Callable[[Dict[str, Any]], str],
+             budget: Optional[int] = None, by_score: bool = True, model: Optional[str] = None) -> List[PackedSource]:
+        """
+        Select and size the sources for one prompt.
+
+        Args:
+            results: Ranked search results
+            format_chunk: Returns the text placed in the prompt for a result
+            budget: Token budget for this call (defaults to the packer's)
+            by_score: Pick by "relevance" (True) or in the given order (False);
+                the selected sources always keep their given order
+            model: Model or deployment name used to count tokens
+
+        Returns:
+            The packed sources, in the order of results
+        """
+        budget = self.budget if budget is None else budget
+        candidates = list(range(len(results)))
+        if by_score:
+            candidates.sort(key=lambda i: results[i].get("relevance", 0.0), reverse=True)
+
+        remaining = budget
+        chosen: Dict[int, PackedSource] = {}
+        skipped = 0
+        for i in candidates:
+            if len(chosen) >= self.max_sources or remaining <= SOURCE_OVERHEAD:
+                break
+            text = format_chunk(results[i]).strip()
+            if not text:
+                continue
+            available = remaining - SOURCE_OVERHEAD
+            tokens = count_tokens(text, model)
+            truncated = False
+            if tokens > available:
+                text = truncate_to_tokens(text, available, model)
+                tokens = count_tokens(text, model) if text else 0
+                if tokens < self.min_chunk_tokens:
+                    # A smaller chunk further down may still fit
+                    skipped += 1
+                    continue
+                truncated = True
+            chosen[i] = PackedSource(results[i], text, tokens, truncated)
+            remaining -= tokens + SOURCE_OVERHEAD
+
+        packed = [chosen[i] for i in sorted(chosen)]
+        used = budget - remaining
+        with self._lock:
+            self._stats["calls"] += 1
+            self._stats["sources"] += len(packed)
+            self._stats["tokens"] += used
+            self._stats["truncated"] += sum(1 for p in packed if p.truncated)
+            self._stats["skipped"] += skipped
+        logger.info(f"Packed {len(packed)} of {len(results)} sources into {used}/{budget} context tokens "
+                    f"(per source: {[p.tokens for p in packed]})")
+        return packed
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Return packing totals and the average context size."""
+        with self._lock:
+            stats = dict(self._stats)
+        stats["avg_tokens"] = stats["tokens"] / stats["calls"] if stats["calls"] else 0.0
+        return stats
+
+
+_packer: Optional[ContextPacker] = None
+_packer_lock = threading.Lock()
+
+
+def get_context_packer() -> ContextPacker:
+    """Return the process-wide context packer."""
+    global _packer
+    with _packer_lock:
+        if _packer is None:
+            _packer = ContextPacker()
+        return _packer
@@ -3,6 +3,8 @@ ConversationManager class for managing in-memory conversation history
 """
 import logging
 
+from conversation_state import Message, encode_messages, decode_messages
+
 logger = logging.getLogger(__name__)
 
 class ConversationManager:
@@ -10,7 +12,8 @@ class ConversationManager:
     Manages the conversation history for a chat session.
     
     This class is responsible for:
-    - Maintaining the conversation history in memory
+    - Maintaining the conversation history in memory as compact Message records
+      (retrieved context is held by reference to the shared chunk store)
     - Adding user and assistant messages to the history
     - Providing access to the complete history
     - Clearing the history when needed
@@ -23,19 +26,29 @@ class ConversationManager:
         Args:
             system_message: The initial system message that defines the assistant's behavior
         """
-        self.chat_history = [{"role": "system", "content": system_message}]
+        self._messages = [Message("system", system_message)]
         logger.debug("ConversationManager initialized with system message")
+
+    @property
+    def chat_history(self):
+        """The history as chat-completions message dicts (rendered on access)."""
+        return [m.to_dict() for m in self._messages]
+
+    @chat_history.setter
+    def chat_history(self, messages):
+        self._messages = [Message.from_content(m["role"], m["content"]) for m in messages]
         
-    def add_user_message(self, message):
+    def add_user_message(self, message, sources=None):
         """
         Add a user message to the conversation history.
         
         Args:
             message: The user's message content
+            sources: Optional (title, parent_id) of each retrieved chunk in the message's context
         """
-        self.chat_history.append({"role": "user", "content": message})
+        self._messages.append(Message.from_content("user", message, sources=sources))
         logger.debug(f"Added user message to history (length: {len(message)})")
-        logger.info(f"Conversation history now has {len(self.chat_history)} messages")
+        logger.info(f"Conversation history now has {len(self._messages)} messages")
         
     def add_assistant_message(self, message):
         """
@@ -44,9 +57,9 @@ class ConversationManager:
         Args:
             message: The assistant's message content
         """
-        self.chat_history.append({"role": "assistant", "content": message})
+        self._messages.append(Message.from_content("assistant", message))
         logger.debug(f"Added assistant message to history (length: {len(message)})")
-        logger.info(f"Conversation history now has {len(self.chat_history)} messages")
+        logger.info(f"Conversation history now has {len(self._messages)} messages")
         
     def get_history(self):
         """
@@ -57,6 +70,15 @@ class ConversationManager:
         """
         return self.chat_history
     
+    def get_messages(self):
+        """
+        Get the history as Message records (cached token counts included).
+        
+        Returns:
+            The live list of Message records; get_history() renders the same messages as dicts
+        """
+        return self._messages
+    
     def clear_history(self, preserve_system_message=True):
         """
         Clear the conversation history.
@@ -64,10 +86,36 @@ class ConversationManager:
         Args:
             preserve_system_message: Whether to preserve the initial system message
         """
-        if preserve_system_message and self.chat_history and self.chat_history[0]["role"] == "system":
-            system_message = self.chat_history[0]
-            self.chat_history = [system_message]
+        if preserve_system_message and self._messages and self._messages[0].role == "system":
+            self._messages = [self._messages[0]]
             logger.debug("Cleared conversation history, preserved system message")
         else:
-            self.chat_history = []
+            self._messages = []
             logger.debug("Cleared entire conversation history including system message")
+
+    def to_bytes(self):
+        """
+        Serialize the history to the compact binary format.
+
+        Returns:
+            Bytes accepted by load_bytes()
+        """
+        return encode_messages(self._messages)
+
+    def load_bytes(self, blob):
+        """
+        Replace the history with one serialized by to_bytes().
+
+        Args:
+            blob: The serialized history
+        """
+        self._messages = decode_messages(blob)
+
+    def memory_bytes(self):
+        """
+        Approximate memory held by this history, excluding chunk text shared through the chunk store.
+
+        Returns:
+            Size in bytes
+        """
+        return sum(m.own_bytes() for m in self._messages)
@@ -0,0 +1,335 @@
+"""
+Compact conversation state: slotted message records, a shared chunk store and binary serialization
+"""
+import hashlib
+import html
+import logging
+import re
+import struct
+import sys
+import threading
+import zlib
+from collections import OrderedDict
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from config import CONVERSATION_CHUNK_STORE_SIZE
+from token_counter import count_message_tokens
+
+logger = logging.getLogger(__name__)
+
+# The user message the assistants build around every retrieval turn
+CONTEXT_MESSAGE_TEMPLATE = "<context>\n{context}\n</context>\n<user_query>\n{query}\n</user_query>"
+NO_CONTEXT = "[No context available from knowledge base]"
+# Replaces the retrieved context of earlier turns in the prompt
+STALE_CONTEXT_NOTE = "[Sources retrieved for this earlier question; content omitted]"
+
+_CONTEXT_MESSAGE_RE = re.compile(r"<context>\n(.*)\n</context>\n<user_query>\n(.*)\n</user_query>", re.S)
+_SOURCE_RE = re.compile(r'<source id="\d+">(.*?)</source>', re.S)
+
+
+def render_context(chunks: Iterable[str]) -> str:
+    """Render chunks the way _prepare_context does: numbered <source> entries, blank-line separated."""
+    entries = [f'<source id="{sid}">{chunk}</source>' for sid, chunk in enumerate(chunks, 1)]
+    return "\n\n".join(entries) if entries else NO_CONTEXT
+
+
+def render_citation_stubs(sources: Optional[Tuple[Tuple[str, str], ...]], count: int) -> str:
+    """
+    Render the short stand-in for an earlier turn's context: one self-closing <source>
+    per chunk with its title and parent_id, or just the note when those were not recorded.
+    """
+    if not count:
+        return NO_CONTEXT
+    stubs = [
+        f'<source id="{sid}" title="{html.escape(title)}" parent_id="{html.escape(parent_id)}"/>'
+        for sid, (title, parent_id) in enumerate(sources or (), 1)
+    ]
+    return "\n".join([STALE_CONTEXT_NOTE] + stubs)
+
+
+class ChunkStore:
+    """
+    Process-wide interning table for retrieved chunk text.
+
+    This class is responsible for:
+    - Returning one canonical string object per distinct chunk, so every turn and
+      session that saw the chunk references the same text instead of a copy
+    - Bounding the table with LRU eviction (messages keep their reference, so an
+      evicted chunk stays valid for as long as a conversation still uses it)
+    """
+
+    def __init__(self, max_entries: int = CONVERSATION_CHUNK_STORE_SIZE):
+        """
+        Initialize the store.
+
+        Args:
+            max_entries: Maximum number of distinct chunks kept in the table
+        """
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._chunks: "OrderedDict[bytes, str]" = OrderedDict()
+        self._stats = {"hits": 0, "misses": 0, "evictions": 0}
+
+    @staticmethod
+    def chunk_id(text: str) -> bytes:
+        """Return the 16-byte content id of a chunk."""
+        return hashlib.blake2b(text.encode("utf-8"), digest_size=16).digest()
+
+    def intern(self, text: str) -> str:
+        """Return the canonical string object for this chunk text."""
+        key = self.chunk_id(text)
+        with self._lock:
+            canonical = self._chunks.get(key)
+            if canonical is not None:
+                self._chunks.move_to_end(key)
+                self._stats["hits"] += 1
+                return canonical
+            self._chunks[key] = text
+            self._stats["misses"] += 1
+            if len(self._chunks) > self.max_entries:
+                self._chunks.popitem(last=False)
+                self._stats["evictions"] += 1
+            return text
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Return interning counters and current size."""
+        with self._lock:
+            return dict(self._stats, entries=len(self._chunks))
+
+
+_chunk_store = ChunkStore()
+
+
+def get_chunk_store() -> ChunkStore:
+    """Return the process-wide chunk store."""
+    return _chunk_store
+
+
+class Message:
+    """
+    One conversation message.
+
+    Retrieval turns keep only the user query in `text` and the retrieved chunks
+    as a tuple of references into the chunk store; the full
+    <context>/<user_query> wrapper is rendered on demand. Other messages keep
+    their content in `text` and `chunks` is None. `sources` holds the
+    (title, parent_id) of each chunk when the caller recorded them. `tokens`
+    caches the prompt token count of the rendered message once it has been computed,
+    and `compact_tokens` the count of its compacted form (see compacted()).
+    """
+
+    __slots__ = ("role", "text", "chunks", "sources", "tokens", "compact_tokens", "_compact")
+
+    def __init__(self, role: str, text: str, chunks: Optional[Tuple[str, ...]] = None,
+                 tokens: Optional[int] = None, sources: Optional[Tuple[Tuple[str, str], ...]] = None,
+                 compact_tokens: Optional[int] = None):
+        self.role = role
+        self.text = text
+        self.chunks = chunks
+        self.sources = sources
+        self.tokens = tokens
+        self.compact_tokens = compact_tokens
+        self._compact = None
+
+    @classmethod
+    def from_content(cls, role: str, content: str, store: Optional[ChunkStore] = None,
+                     sources: Optional[Iterable[Tuple[str, str]]] = None) -> "Message":
+        """
+        Build a message, splitting a context-wrapped user message into query + chunk references.
+
+        Content that does not round-trip exactly through the template is stored verbatim.
+        `sources` ((title, parent_id) per chunk, in order) is kept when it matches the chunks.
+        """
+        if role == "user" and content.startswith("<context>\n"):
+            match = _CONTEXT_MESSAGE_RE.fullmatch(content)
+            if match:
+                context, query = match.groups()
+                chunks = () if context == NO_CONTEXT else tuple(_SOURCE_RE.findall(context))
+                if render_context(chunks) == context:
+                    store = store or _chunk_store
+                    sources = tuple((str(t), str(p)) for t, p in sources) if sources is not None else None
+                    if sources is not None and len(sources) != len(chunks):
+                        sources = None
+                    return cls(role, query, tuple(store.intern(c) for c in chunks), sources=sources)
+        return cls(role, content)
+
+    @property
+    def content(self) -> str:
+        """The full message content as sent to the model."""
+        if self.chunks is None:
+            return self.text
+        return CONTEXT_MESSAGE_TEMPLATE.format(context=render_context(self.chunks), query=self.text)
+
+    def token_count(self, model: Optional[str] = None) -> int:
+        """Return the prompt tokens this message costs, counting it only the first time."""
+        if self.tokens is None:
+            self.tokens = count_message_tokens(self.role, self.content, model)
+        return self.tokens
+
+    def compacted(self) -> "Message":
+        """
+        Return a copy of a retrieval turn whose context is reduced to citation stubs.
+
+        The copy is built once per message and its token count is carried over into
+        compact_tokens, so later turns neither re-render nor re-count it.
+        """
+        if self.chunks is None:
+            return self
+        if self._compact is None:
+            stubs = render_citation_stubs(self.sources, len(self.chunks))
+            self._compact = Message(self.role, CONTEXT_MESSAGE_TEMPLATE.format(context=stubs, query=self.text),
+                                    tokens=self.compact_tokens)
+        return self._compact
+
+    def compact_token_count(self) -> Optional[int]:
+        """The cached token count of the compacted form, if it has been computed."""
+        if self._compact is not None and self._compact.tokens is not None:
+            return self._compact.tokens
+        return self.compact_tokens
+
+    def without_context(self) -> "Message":
+        """Return a copy of a retrieval turn, full or compacted, with its context removed (just the query)."""
+        if self.chunks is not None:
+            return Message(self.role, self.text)
+        if self.role == "user" and self.text.startswith("<context>\n"):
+            match = _CONTEXT_MESSAGE_RE.fullmatch(self.text)
+            if match:
+                return Message(self.role, match.group(2))
+        return self
+
+    def to_dict(self) -> Dict[str, str]:
+        """Return the chat-completions message dict."""
+        return {"role": self.role, "content": self.content}
+
+    def own_bytes(self) -> int:
+        """Approximate memory owned by this record (shared chunk text excluded)."""
+        size = sys.getsizeof(self) + sys.getsizeof(self.text)
+        if self.chunks is not None:
+            size += sys.getsizeof(self.chunks)
+        if self.sources is not None:
+            size += sys.getsizeof(self.sources) + sum(sys.getsizeof(s) for s in self.sources)
+        if self._compact is not None:
+            size += self._compact.own_bytes()
+        return size
+
+
+# ───────────── binary serialization ─────────────
+# Layout (little-endian): MAGIC, u8 flags, then the body (zlib-compressed when FLAG_ZLIB):
+#   u32 chunk count, then per chunk: u32 length + UTF-8 bytes   (each distinct chunk once)
+#   u32 message count, then per message:
+#       u8 role length + role, u32 text length + text, u32 cached token count (0xFFFFFFFF = unknown),
+#       u16 chunk reference count (0xFFFF = plain message) + u32 index per reference,
+#       then for retrieval turns u16 source count (0xFFFF = not recorded) + per source
+#       u16 title length + title, u16 parent_id length + parent_id, then u32 cached token
+#       count of the compacted form (0xFFFFFFFF = unknown)
+# CVS3 is the same without the compacted token count; CVS2 also lacks the sources;
+# CVS1 also lacks the token count.
+MAGIC = b"CVS4"
+MAGIC_V3 = b"CVS3"
+MAGIC_V2 = b"CVS2"
+MAGIC_V1 = b"CVS1"
+FLAG_ZLIB = 0x01
+_PLAIN = 0xFFFF
+_UNKNOWN_TOKENS = 0xFFFFFFFF
+_U8, _U16, _U32 = struct.Struct("<B"), struct.Struct("<H"), struct.Struct("<I")
+
+
+def encode_messages(messages: List[Message], compress_over: int = 1024) -> bytes:
+    """
+    Serialize messages, writing each distinct chunk once however many turns reference it.
+
+    Args:
+        messages: The messages to serialize
+        compress_over: Bodies larger than this many bytes are zlib-compressed (level 1)
+    """
+    index: Dict[str, int] = {}
+    chunk_parts: List[bytes] = []
+    message_parts: List[bytes] = []
+    for message in messages:
+        role = message.role.encode("utf-8")
+        text = message.text.encode("utf-8")
+        tokens = _UNKNOWN_TOKENS if message.tokens is None else message.tokens
+        message_parts += [_U8.pack(len(role)), role, _U32.pack(len(text)), text, _U32.pack(tokens)]
+        if message.chunks is None:
+            message_parts.append(_U16.pack(_PLAIN))
+            continue
+        message_parts.append(_U16.pack(len(message.chunks)))
+        for chunk in message.chunks:
+            ref = index.get(chunk)
+            if ref is None:
+                ref = index[chunk] = len(index)
+                data = chunk.encode("utf-8")
+                chunk_parts += [_U32.pack(len(data)), data]
+            message_parts.append(_U32.pack(ref))
+        if message.sources is None:
+            message_parts.append(_U16.pack(_PLAIN))
+        else:
+            message_parts.append(_U16.pack(len(message.sources)))
+            for title, parent_id in message.sources:
+                for value in (title.encode("utf-8"), parent_id.encode("utf-8")):
+                    message_parts += [_U16.pack(len(value)), value]
+        compact_tokens = message.compact_token_count()
+        message_parts.append(_U32.pack(_UNKNOWN_TOKENS if compact_tokens is None else compact_tokens))
+
+    body = b"".join([_U32.pack(len(index))] + chunk_parts + [_U32.pack(len(messages))] + message_parts)
+    flags = 0
+    if len(body) > compress_over:
+        body = zlib.compress(body, 1)
+        flags |= FLAG_ZLIB
+    return MAGIC + _U8.pack(flags) + body
+
+
+def decode_messages(blob: bytes, store: Optional[ChunkStore] = None) -> List[Message]:
+    """
+    Inverse of encode_messages; chunks are interned into the (process-wide) chunk store.
+
+    Raises:
+        ValueError: If the blob is not an encoded conversation
+    """
+    version = blob[:len(MAGIC)]
+    if version not in (MAGIC, MAGIC_V3, MAGIC_V2, MAGIC_V1):
+        raise ValueError("Not an encoded conversation")
+    has_tokens = version != MAGIC_V1
+    has_sources = version in (MAGIC, MAGIC_V3)
+    has_compact_tokens = version == MAGIC
+    store = store or _chunk_store
+    flags = blob[len(MAGIC)]
+    body = memoryview(blob)[len(MAGIC) + 1:]
+    if flags & FLAG_ZLIB:
+        body = memoryview(zlib.decompress(body))
+
+    pos = 0
+
+    def read(fmt: struct.Struct) -> int:
+        nonlocal pos
+        value = fmt.unpack_from(body, pos)[0]
+        pos += fmt.size
+        return value
+
+    def read_str(length: int) -> str:
+        nonlocal pos
+        value = str(body[pos:pos + length], "utf-8")
+        pos += length
+        return value
+
+    chunks = [store.intern(read_str(read(_U32))) for _ in range(read(_U32))]
+    messages = []
+    for _ in range(read(_U32)):
+        role = read_str(read(_U8))
+        text = read_str(read(_U32))
+        tokens = read(_U32) if has_tokens else _UNKNOWN_TOKENS
+        tokens = None if tokens == _UNKNOWN_TOKENS else tokens
+        refs = read(_U16)
+        if refs == _PLAIN:
+            messages.append(Message(role, text, tokens=tokens))
+            continue
+        refs = tuple(chunks[read(_U32)] for _ in range(refs))
+        sources = None
+        if has_sources:
+            count = read(_U16)
+            if count != _PLAIN:
+                sources = tuple((read_str(read(_U16)), read_str(read(_U16))) for _ in range(count))
+        compact_tokens = read(_U32) if has_compact_tokens else _UNKNOWN_TOKENS
+        compact_tokens = None if compact_tokens == _UNKNOWN_TOKENS else compact_tokens
+        messages.append(Message(role, text, refs, tokens, sources, compact_tokens))
+    return messages
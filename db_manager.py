@@ -15,14 +15,16 @@ from config import (
     POSTGRES_SSL_MODE
 )
 
+from db_pool import ConnectionPool
+
 logger = logging.getLogger(__name__)
 
 class DatabaseManager:
     """Handles database connections and operations for the feedback system."""
     
     @staticmethod
-    def get_connection():
-        """Create and return a database connection."""
+    def open_connection():
+        """Open a new, unpooled database connection."""
         try:
             logger.debug(f"Connecting to PostgreSQL: {POSTGRES_USER}@{POSTGRES_HOST}:{POSTGRES_PORT}/{POSTGRES_DB}")
             conn = psycopg2.connect(
@@ -38,6 +40,38 @@ class DatabaseManager:
             logger.error(f"Database connection error: {e}")
             raise
     
+    @staticmethod
+    def get_connection():
+        """Return a pooled database connection; close() hands it back to the pool."""
+        return _pool.getconn()
+    
+    @staticmethod
+    def get_pool_stats():
+        """Return connection pool usage and acquire-time statistics."""
+        return _pool.get_stats()
+    
+    @staticmethod
+    def ensure_rag_queries_schema(cursor):
+        """Create rag_queries if needed and add the usage/latency columns older tables lack."""
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS rag_queries (
+                id SERIAL PRIMARY KEY,
+                timestamp TIMESTAMP WITH TIME ZONE NOT NULL,
+                user_query TEXT NOT NULL,
+                response TEXT NOT NULL,
+                sources JSONB NOT NULL,
+                context TEXT NOT NULL,
+                sql_query TEXT
+            );
+            ALTER TABLE rag_queries
+                ADD COLUMN IF NOT EXISTS model TEXT,
+                ADD COLUMN IF NOT EXISTS latency_ms INTEGER,
+                ADD COLUMN IF NOT EXISTS prompt_tokens INTEGER,
+                ADD COLUMN IF NOT EXISTS completion_tokens INTEGER,
+                ADD COLUMN IF NOT EXISTS total_tokens INTEGER;
+            CREATE INDEX IF NOT EXISTS idx_rag_queries_timestamp ON rag_queries (timestamp);
+        """)
+    
     @staticmethod
     def save_feedback(feedback_data):
         """Save feedback to the PostgreSQL database."""
@@ -476,4 +510,8 @@ class DatabaseManager:
             raise
         finally:
             if conn is not None:
-                conn.close()
\ No newline at end of file
+                conn.close()
+
+
+# Process-wide pool behind DatabaseManager.get_connection()
+_pool = ConnectionPool(connect=DatabaseManager.open_connection)
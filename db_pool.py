@@ -0,0 +1,294 @@
+"""
+ConnectionPool class for reusing PostgreSQL connections across requests
+"""
+import logging
+import os
+import threading
+import time
+from typing import Callable, Dict, List, Tuple
+
+import psycopg2
+from psycopg2 import extensions
+
+from config import (
+    DB_POOL_MIN_SIZE,
+    DB_POOL_MAX_SIZE,
+    DB_POOL_ACQUIRE_TIMEOUT,
+    DB_POOL_HEALTHCHECK_INTERVAL,
+    DB_POOL_MAX_LIFETIME,
+    DB_POOL_MAX_IDLE,
+)
+
+logger = logging.getLogger(__name__)
+
+
+class PoolTimeoutError(psycopg2.OperationalError):
+    """Raised when no pooled connection becomes free within the acquire timeout."""
+
+
+class PooledConnection:
+    """
+    Thin wrapper around a psycopg2 connection handed out by ConnectionPool.
+
+    It behaves like the wrapped connection, except that close() returns it to
+    the pool instead of closing the socket, so existing
+    ``conn = get_connection() ... finally: conn.close()`` code pools transparently.
+    """
+
+    def __init__(self, pool: "ConnectionPool", conn) -> None:
+        self._pool = pool
+        self._conn = conn
+
+    def __getattr__(self, name):
+        conn = self.__dict__.get("_conn")
+        if conn is None:
+            raise psycopg2.InterfaceError("connection already returned to the pool")
+        return getattr(conn, name)
+
+    def __enter__(self):
+        # Same transaction semantics as psycopg2: commit/rollback, do not close
+        self._conn.__enter__()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return self._conn.__exit__(exc_type, exc, tb)
+
+    @property
+    def closed(self):
+        return 1 if self._conn is None else self._conn.closed
+
+    def close(self) -> None:
+        """Return the connection to the pool (safe to call more than once)."""
+        conn, self._conn = self._conn, None
+        if conn is not None:
+            self._pool.release(conn)
+
+
+class ConnectionPool:
+    """
+    Thread-safe pool of psycopg2 connections.
+
+    This class is responsible for:
+    - Keeping at most max_size connections open per worker process, and closing
+      idle ones beyond min_size once they have been unused for max_idle seconds
+    - Blocking callers for up to acquire_timeout seconds when every connection is busy
+    - Health-checking idle connections before reuse and recycling old ones
+    - Resetting connections (rollback) before they go back into the pool
+    - Recording acquire wait times and pool usage for monitoring
+    """
+
+    def __init__(self, connect: Callable, min_size=DB_POOL_MIN_SIZE, max_size=DB_POOL_MAX_SIZE,
+                 acquire_timeout=DB_POOL_ACQUIRE_TIMEOUT, healthcheck_interval=DB_POOL_HEALTHCHECK_INTERVAL,
+                 max_lifetime=DB_POOL_MAX_LIFETIME, max_idle=DB_POOL_MAX_IDLE):
+        """
+        Initialize an empty pool (connections are opened on demand).
+
+        Args:
+            connect: Callable that opens a new psycopg2 connection
+            min_size: Number of idle connections kept open regardless of max_idle
+            max_size: Maximum number of open connections
+            acquire_timeout: Seconds to wait for a connection before raising PoolTimeoutError
+            healthcheck_interval: Idle connections unused for longer than this are pinged before reuse
+            max_lifetime: Connections older than this are closed instead of reused (0 disables)
+            max_idle: Idle connections beyond min_size are closed after this many seconds
+        """
+        self._connect = connect
+        self.min_size = max(0, min_size)
+        self.max_size = max(1, max_size)
+        self.acquire_timeout = acquire_timeout
+        self.healthcheck_interval = healthcheck_interval
+        self.max_lifetime = max_lifetime
+        self.max_idle = max_idle
+
+        self._cond = threading.Condition()
+        # Idle connections as (conn, created_at, last_used)
+        self._idle: List[Tuple[object, float, float]] = []
+        self._created_at: Dict[int, float] = {}
+        self._in_use = 0
+        self._pid = os.getpid()
+        self._stats = {
+            "acquired": 0,
+            "created": 0,
+            "reused": 0,
+            "discarded": 0,
+            "healthcheck_failures": 0,
+            "timeouts": 0,
+            "waits": 0,
+            "acquire_ms_total": 0.0,
+            "acquire_ms_max": 0.0,
+        }
+
+    # ───────────── acquire / release ─────────────
+    def getconn(self) -> PooledConnection:
+        """Check out a connection; call close() on the result to return it."""
+        return PooledConnection(self, self.acquire())
+
+    def acquire(self):
+        """Check out a raw psycopg2 connection (pair with release())."""
+        started = time.monotonic()
+        deadline = started + self.acquire_timeout
+        waited = False
+        with self._cond:
+            self._check_fork()
+            while True:
+                if self._idle:
+                    conn, created_at, last_used = self._idle.pop()
+                    self._in_use += 1
+                    break
+                if self._total() < self.max_size:
+                    conn = None
+                    self._in_use += 1
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._stats["timeouts"] += 1
+                    raise PoolTimeoutError(
+                        f"Timed out after {self.acquire_timeout}s waiting for a database connection "
+                        f"(max_size={self.max_size})"
+                    )
+                waited = True
+                self._cond.wait(remaining)
+
+        try:
+            if conn is not None and not self._usable(conn, created_at, last_used):
+                self._close_quietly(conn)
+                conn = None
+            reused = conn is not None
+            if conn is None:
+                conn = self._connect()
+                with self._cond:
+                    self._created_at[id(conn)] = time.monotonic()
+                    self._stats["created"] += 1
+        except Exception:
+            with self._cond:
+                self._in_use -= 1
+                self._cond.notify()
+            raise
+
+        acquire_ms = (time.monotonic() - started) * 1000
+        with self._cond:
+            self._stats["acquired"] += 1
+            if reused:
+                self._stats["reused"] += 1
+            if waited:
+                self._stats["waits"] += 1
+            self._stats["acquire_ms_total"] += acquire_ms
+            self._stats["acquire_ms_max"] = max(self._stats["acquire_ms_max"], acquire_ms)
+        return conn
+
+    def release(self, conn) -> None:
+        """Return a connection obtained from acquire()."""
+        keep = self._reset(conn)
+        with self._cond:
+            self._in_use -= 1
+            if os.getpid() != self._pid:
+                keep = False
+            created_at = self._created_at.get(id(conn), time.monotonic())
+            if keep and self.max_lifetime and time.monotonic() - created_at > self.max_lifetime:
+                keep = False
+            if keep:
+                self._idle.append((conn, created_at, time.monotonic()))
+            else:
+                self._created_at.pop(id(conn), None)
+                self._stats["discarded"] += 1
+            stale = self._prune_idle()
+            self._cond.notify()
+        if not keep:
+            self._close_quietly(conn)
+        for idle_conn in stale:
+            self._close_quietly(idle_conn)
+
+    def _prune_idle(self) -> List:
+        """Drop idle connections beyond min_size that have not been used for max_idle seconds."""
+        # Caller must hold self._cond. The idle list is ordered oldest release first.
+        stale = []
+        if not self.max_idle:
+            return stale
+        cutoff = time.monotonic() - self.max_idle
+        while len(self._idle) > self.min_size and self._idle[0][2] < cutoff:
+            conn = self._idle.pop(0)[0]
+            self._created_at.pop(id(conn), None)
+            self._stats["discarded"] += 1
+            stale.append(conn)
+        return stale
+
+    # ───────────── health ─────────────
+    def _usable(self, conn, created_at: float, last_used: float) -> bool:
+        if conn.closed:
+            self._forget(conn)
+            return False
+        now = time.monotonic()
+        if self.max_lifetime and now - created_at > self.max_lifetime:
+            self._forget(conn)
+            return False
+        if self.healthcheck_interval and now - last_used > self.healthcheck_interval:
+            try:
+                with conn.cursor() as cursor:
+                    cursor.execute("SELECT 1")
+                conn.rollback()
+            except Exception as e:
+                logger.warning(f"Discarding unhealthy pooled database connection: {e}")
+                with self._cond:
+                    self._stats["healthcheck_failures"] += 1
+                self._forget(conn)
+                return False
+        return True
+
+    @staticmethod
+    def _reset(conn) -> bool:
+        """Roll back any open transaction; False when the connection cannot be reused."""
+        try:
+            if conn.closed:
+                return False
+            if conn.get_transaction_status() != extensions.TRANSACTION_STATUS_IDLE:
+                conn.rollback()
+            return True
+        except Exception:
+            return False
+
+    def _forget(self, conn) -> None:
+        with self._cond:
+            self._created_at.pop(id(conn), None)
+            self._stats["discarded"] += 1
+
+    @staticmethod
+    def _close_quietly(conn) -> None:
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def _total(self) -> int:
+        # Caller must hold self._cond
+        return self._in_use + len(self._idle)
+
+    def _check_fork(self) -> None:
+        # Caller must hold self._cond. Sockets inherited from the parent process
+        # must not be shared, so a forked worker starts with an empty pool.
+        if os.getpid() != self._pid:
+            self._pid = os.getpid()
+            self._idle = []
+            self._created_at = {}
+            self._in_use = 0
+
+    # ───────────── lifecycle / monitoring ─────────────
+    def close_all(self) -> None:
+        """Close every idle connection (busy ones are closed when released)."""
+        with self._cond:
+            idle, self._idle = self._idle, []
+            for conn, _, _ in idle:
+                self._created_at.pop(id(conn), None)
+        for conn, _, _ in idle:
+            self._close_quietly(conn)
+
+    def get_stats(self) -> Dict:
+        """Return pool size, usage and acquire wait statistics."""
+        with self._cond:
+            stats = dict(self._stats)
+            stats["in_use"] = self._in_use
+            stats["idle"] = len(self._idle)
+        stats["min_size"] = self.min_size
+        stats["max_size"] = self.max_size
+        acquired = stats["acquired"]
+        stats["acquire_ms_avg"] = stats["acquire_ms_total"] / acquired if acquired else 0.0
+        return stats
@@ -0,0 +1,473 @@
+"""
+BackgroundDBWriter class for writing log rows to PostgreSQL off the request path
+"""
+import atexit
+import json
+import logging
+import os
+import queue
+import threading
+import time
+from datetime import datetime, timezone
+from typing import Callable, Dict, List, Optional, Tuple
+
+import psycopg2
+from psycopg2.extras import Json, execute_values
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - non-POSIX platforms
+    fcntl = None
+
+from config import (
+    DB_WRITER_ENABLED,
+    DB_WRITER_BATCH_SIZE,
+    DB_WRITER_FLUSH_INTERVAL,
+    DB_WRITER_MAX_QUEUE,
+    DB_WRITER_SPILL_PATH,
+    DB_WRITER_DEAD_LETTER_PATH,
+)
+
+logger = logging.getLogger(__name__)
+
+_STOP = object()
+
+Record = Tuple[str, Dict]
+
+# Errors caused by the rows themselves (bad values, constraint violations, unadaptable
+# strings such as ones containing NUL); retrying the same rows can never succeed.
+# Anything else (connection loss, OperationalError, ...) is treated as transient.
+DATA_ERRORS = (psycopg2.DataError, psycopg2.IntegrityError, ValueError, TypeError)
+
+
+class BackgroundDBWriter:
+    """
+    Write-behind queue for the rag_queries and helpee log tables.
+
+    This class is responsible for:
+    - Accepting log records without touching the database on the caller's thread
+    - Inserting them in batches with execute_values from one background thread,
+      flushing when a batch fills up or the flush interval passes
+    - Spilling records to a local JSONL file when the database is unreachable
+      and replaying them on the next successful flush
+    - Isolating records the database rejects (by bisecting the batch) and moving
+      them to a dead-letter file, so one bad row cannot block every later flush
+    - Draining the queue when the process exits
+    """
+
+    def __init__(self, batch_size=DB_WRITER_BATCH_SIZE, flush_interval=DB_WRITER_FLUSH_INTERVAL,
+                 max_queue=DB_WRITER_MAX_QUEUE, spill_path=DB_WRITER_SPILL_PATH,
+                 enabled=DB_WRITER_ENABLED, connection_factory: Optional[Callable] = None,
+                 dead_letter_path=DB_WRITER_DEAD_LETTER_PATH):
+        """
+        Initialize the writer (the background thread starts on first use).
+
+        Args:
+            batch_size: Number of records that triggers an immediate flush
+            flush_interval: Maximum seconds a record waits before being flushed
+            max_queue: Records held in memory before new ones go straight to the spill file
+            spill_path: JSONL file for records that could not be written
+            enabled: When False every record is written synchronously on the caller's thread
+            connection_factory: Callable returning a psycopg2 connection (defaults to DatabaseManager)
+            dead_letter_path: JSONL file for records the database rejected
+        """
+        self.batch_size = max(1, batch_size)
+        self.flush_interval = flush_interval
+        self.spill_path = spill_path
+        self.dead_letter_path = dead_letter_path
+        self.enabled = enabled
+        self._connection_factory = connection_factory
+
+        self._queue: "queue.Queue" = queue.Queue(maxsize=max_queue)
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+        self._rag_table_ready = False
+        self._stats = {
+            "queued": 0,
+            "written": 0,
+            "batches": 0,
+            "failed_batches": 0,
+            "spilled": 0,
+            "replayed": 0,
+            "dead_lettered": 0,
+        }
+
+    # ───────────── public API ─────────────
+    def log_rag_query(self, query, response, sources, context, sql_query=None, model=None,
+                      latency_ms=None, prompt_tokens=None, completion_tokens=None, total_tokens=None) -> None:
+        """
+        Queue a RAG query for insertion into rag_queries.
+
+        Args:
+            query (str): The user's query
+            response (str): The generated response
+            sources (list): List of sources used in the response
+            context (str): The context used to generate the response
+            sql_query (str, optional): The SQL query used to retrieve data
+            model (str, optional): Chat deployment that produced the answer
+            latency_ms (int, optional): End-to-end time to produce the answer
+            prompt_tokens / completion_tokens / total_tokens (int, optional): Usage of the answer call
+        """
+        source_metadata = [s if isinstance(s, dict) else {"content": str(s)} for s in (sources or [])]
+        self._submit(("rag_query", {
+            "timestamp": datetime.now(timezone.utc).isoformat(),
+            "query": query,
+            "response": response,
+            "sources": source_metadata,
+            "context": context,
+            "sql_query": sql_query,
+            "model": model,
+            "latency_ms": int(latency_ms) if latency_ms is not None else None,
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": total_tokens,
+        }))
+
+    def log_helpee(self, user_query: str, response_text: str, model: str = None,
+                   prompt_tokens: int = None, completion_tokens: int = None, total_tokens: int = None,
+                   prompt_cost: float = None, completion_cost: float = None, total_cost: float = None) -> None:
+        """
+        Queue an LLM helpee call for helpee_logs and, when costs are given, helpee_costs.
+
+        The two rows are written in the same batch so the cost row can reference the log id.
+        """
+        self._submit(("helpee", {
+            "user_query": user_query,
+            "response_text": response_text,
+            "model": model,
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": total_tokens,
+            "prompt_cost": prompt_cost,
+            "completion_cost": completion_cost,
+            "total_cost": total_cost,
+        }))
+
+    def flush(self, timeout: float = 10.0) -> None:
+        """Block until every record queued so far has been written or spilled."""
+        if self._thread is None or not self._thread.is_alive():
+            return
+        done = threading.Event()
+        try:
+            self._queue.put(("flush", done), timeout=timeout)
+        except queue.Full:
+            logger.warning("DB writer queue stayed full for %.1fs; flush not confirmed", timeout)
+            return
+        done.wait(timeout)
+
+    def close(self, timeout: float = 10.0) -> None:
+        """Stop the background thread after draining the queue."""
+        thread = self._thread
+        if thread is None or not thread.is_alive() or self._pid != os.getpid():
+            return
+        try:
+            self._queue.put(_STOP, timeout=timeout / 2)
+        except queue.Full:
+            # The database is not keeping up; save what is still queued instead of hanging shutdown
+            self._spill(self._drain_queue())
+            try:
+                self._queue.put_nowait(_STOP)
+            except queue.Full:
+                logger.warning("DB writer queue still full; stopping without a clean drain")
+                return
+        thread.join(timeout)
+        if thread.is_alive():
+            logger.warning("DB writer did not drain within %.1fs", timeout)
+        else:
+            logger.info("DB writer drained and stopped")
+
+    def get_stats(self) -> Dict:
+        """Return queue depth and write/spill counters."""
+        with self._lock:
+            stats = dict(self._stats)
+        stats["pending"] = self._queue.qsize()
+        stats["enabled"] = self.enabled
+        stats["spill_bytes"] = os.path.getsize(self.spill_path) if self.spill_path and os.path.exists(self.spill_path) else 0
+        return stats
+
+    # ───────────── queueing ─────────────
+    def _submit(self, record: Record) -> None:
+        with self._lock:
+            self._stats["queued"] += 1
+        if not self.enabled:
+            self._flush([record])
+            return
+        self._ensure_thread()
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            logger.warning("DB writer queue full; spilling record to %s", self.spill_path)
+            self._spill([record])
+
+    def _drain_queue(self) -> List[Record]:
+        records = []
+        while True:
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                return records
+            if isinstance(item, tuple) and item[0] == "flush":
+                item[1].set()
+            elif item is not _STOP:
+                records.append(item)
+
+    def _ensure_thread(self) -> None:
+        # Restart after a fork (gunicorn preload) since threads do not survive it
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive() and self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name="db-writer", daemon=True)
+            self._thread.start()
+
+    def _run(self) -> None:
+        batch: List[Record] = []
+        deadline = time.monotonic() + self.flush_interval
+        while True:
+            try:
+                item = self._queue.get(timeout=max(0.0, deadline - time.monotonic()))
+            except queue.Empty:
+                item = None
+
+            if item is _STOP:
+                self._flush(batch)
+                return
+            if isinstance(item, tuple) and item[0] == "flush":
+                self._flush(batch)
+                batch = []
+                deadline = time.monotonic() + self.flush_interval
+                item[1].set()
+                continue
+            if item is not None:
+                batch.append(item)
+
+            if len(batch) >= self.batch_size or time.monotonic() >= deadline:
+                self._flush(batch)
+                batch = []
+                deadline = time.monotonic() + self.flush_interval
+
+    # ───────────── writing ─────────────
+    def _connect(self):
+        if self._connection_factory is not None:
+            return self._connection_factory()
+        from db_manager import DatabaseManager
+        return DatabaseManager.get_connection()
+
+    def _flush(self, batch: List[Record]) -> None:
+        """
+        Write the batch (plus anything spilled earlier).
+
+        Transient failures (connection, OperationalError) spill the batch for a later retry;
+        records the database rejects are isolated and moved to the dead-letter file.
+        """
+        spill_fd = self._lock_spill() if self._has_spill() else None
+        try:
+            spilled = self._read_spill(spill_fd) if spill_fd is not None else []
+            records = spilled + list(batch)
+            if not records:
+                return
+            conn = None
+            rejected = []
+            try:
+                conn = self._connect()
+                self._ensure_rag_table(conn, records)
+                try:
+                    self._write(conn, records)
+                except DATA_ERRORS as e:
+                    # Some row is bad: retry in halves, keeping what the database accepts
+                    logger.warning(f"DB writer batch of {len(records)} records rejected ({e}); isolating bad records")
+                    conn.rollback()
+                    rejected = self._write_isolating(conn, records)
+                conn.commit()
+            except Exception as e:
+                logger.error(f"DB writer failed to write {len(records)} records: {e}")
+                if conn is not None:
+                    try:
+                        conn.rollback()
+                    except Exception:
+                        pass
+                with self._lock:
+                    self._stats["failed_batches"] += 1
+                # Spilled records are still in the file; only the new ones need saving
+                self._spill(batch, spill_fd)
+                return
+            finally:
+                if conn is not None:
+                    conn.close()
+
+            if spill_fd is not None:
+                os.ftruncate(spill_fd, 0)
+                logger.info(f"Replayed {len(spilled)} spilled log records")
+            self._dead_letter(rejected)
+            with self._lock:
+                self._stats["written"] += len(records) - len(rejected)
+                self._stats["replayed"] += len(spilled)
+                self._stats["batches"] += 1
+            logger.debug(f"DB writer flushed {len(records)} records")
+        finally:
+            if spill_fd is not None:
+                self._unlock_spill(spill_fd)
+
+    def _write_isolating(self, conn, records: List[Record]) -> List[Tuple[Record, str]]:
+        """
+        Write records inside savepoints, bisecting around rows the database rejects.
+
+        Returns:
+            (record, error) for every rejected record; transient errors propagate
+        """
+        with conn.cursor() as cursor:
+            cursor.execute("SAVEPOINT db_writer_batch")
+        try:
+            self._write(conn, records)
+        except DATA_ERRORS as e:
+            with conn.cursor() as cursor:
+                cursor.execute("ROLLBACK TO SAVEPOINT db_writer_batch")
+            if len(records) == 1:
+                return [(records[0], str(e))]
+            middle = len(records) // 2
+            return self._write_isolating(conn, records[:middle]) + self._write_isolating(conn, records[middle:])
+        with conn.cursor() as cursor:
+            cursor.execute("RELEASE SAVEPOINT db_writer_batch")
+        return []
+
+    def _write(self, conn, records: List[Record]) -> None:
+        rag = [r for kind, r in records if kind == "rag_query"]
+        helpee = [r for kind, r in records if kind == "helpee"]
+        with conn.cursor() as cursor:
+            if rag:
+                execute_values(
+                    cursor,
+                    "INSERT INTO rag_queries (timestamp, user_query, response, sources, context, sql_query, "
+                    "model, latency_ms, prompt_tokens, completion_tokens, total_tokens) VALUES %s",
+                    [(r["timestamp"], r["query"], r["response"], Json(r["sources"]), r["context"], r["sql_query"],
+                      r.get("model"), r.get("latency_ms"), r.get("prompt_tokens"), r.get("completion_tokens"),
+                      r.get("total_tokens"))
+                     for r in rag],
+                    page_size=len(rag),
+                )
+            if helpee:
+                ids = execute_values(
+                    cursor,
+                    "INSERT INTO helpee_logs (user_query, response_text, prompt_tokens, completion_tokens, total_tokens, model) "
+                    "VALUES %s RETURNING id",
+                    [(r["user_query"], r["response_text"], r["prompt_tokens"], r["completion_tokens"],
+                      r["total_tokens"], r["model"]) for r in helpee],
+                    page_size=len(helpee),
+                    fetch=True,
+                )
+                costs = [
+                    (row[0], r["model"], r["prompt_tokens"], r["completion_tokens"], r["total_tokens"],
+                     r["prompt_cost"], r["completion_cost"], r["total_cost"])
+                    for row, r in zip(ids, helpee) if r["total_cost"] is not None
+                ]
+                if costs:
+                    execute_values(
+                        cursor,
+                        "INSERT INTO helpee_costs (helpee_log_id, model, prompt_tokens, completion_tokens, total_tokens, "
+                        "prompt_cost, completion_cost, total_cost) VALUES %s",
+                        costs,
+                        page_size=len(costs),
+                    )
+
+    def _ensure_rag_table(self, conn, records: List[Record]) -> None:
+        # Checked once per process instead of on every insert. The DDL is committed on its
+        # own so rolling back a batch (bad row, lost connection) cannot undo it behind the flag.
+        if self._rag_table_ready or not any(kind == "rag_query" for kind, _ in records):
+            return
+        from db_manager import DatabaseManager
+        with conn.cursor() as cursor:
+            DatabaseManager.ensure_rag_queries_schema(cursor)
+        conn.commit()
+        self._rag_table_ready = True
+
+    # ───────────── spill file ─────────────
+    def _has_spill(self) -> bool:
+        return bool(self.spill_path) and os.path.exists(self.spill_path) and os.path.getsize(self.spill_path) > 0
+
+    def _lock_spill(self) -> int:
+        directory = os.path.dirname(self.spill_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        fd = os.open(self.spill_path, os.O_RDWR | os.O_CREAT | os.O_APPEND, 0o644)
+        if fcntl is not None:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+        return fd
+
+    @staticmethod
+    def _unlock_spill(fd: int) -> None:
+        if fcntl is not None:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+        os.close(fd)
+
+    @staticmethod
+    def _read_spill(fd: int) -> List[Record]:
+        os.lseek(fd, 0, os.SEEK_SET)
+        with os.fdopen(os.dup(fd), "r", encoding="utf-8") as f:
+            records = []
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    kind, record = json.loads(line)
+                    records.append((kind, record))
+                except ValueError:
+                    logger.warning("Skipping unreadable line in DB writer spill file")
+            return records
+
+    def _spill(self, records: List[Record], fd: Optional[int] = None) -> None:
+        if not records:
+            return
+        if not self.spill_path:
+            logger.error(f"Dropping {len(records)} log records (no spill file configured)")
+            return
+        own_fd = fd is None
+        try:
+            if own_fd:
+                fd = self._lock_spill()
+            data = "".join(json.dumps([kind, record], default=str) + "\n" for kind, record in records)
+            os.write(fd, data.encode("utf-8"))
+            with self._lock:
+                self._stats["spilled"] += len(records)
+            logger.warning(f"Spilled {len(records)} log records to {self.spill_path}")
+        except OSError as e:
+            logger.error(f"Could not spill {len(records)} log records: {e}")
+        finally:
+            if own_fd and fd is not None:
+                self._unlock_spill(fd)
+
+    # ───────────── dead letters ─────────────
+    def _dead_letter(self, rejected: List[Tuple[Record, str]]) -> None:
+        if not rejected:
+            return
+        with self._lock:
+            self._stats["dead_lettered"] += len(rejected)
+        if not self.dead_letter_path:
+            logger.error(f"Dropping {len(rejected)} log records the database rejected (no dead-letter file configured)")
+            return
+        rejected_at = datetime.now(timezone.utc).isoformat()
+        data = "".join(
+            json.dumps({"kind": kind, "record": record, "error": error, "rejected_at": rejected_at}, default=str) + "\n"
+            for (kind, record), error in rejected
+        )
+        try:
+            directory = os.path.dirname(self.dead_letter_path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            with open(self.dead_letter_path, "a", encoding="utf-8") as f:
+                if fcntl is not None:
+                    fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+                f.write(data)
+            logger.error(f"Moved {len(rejected)} rejected log records to {self.dead_letter_path}")
+        except OSError as e:
+            logger.error(f"Could not dead-letter {len(rejected)} log records: {e}")
+
+
+_writer = BackgroundDBWriter()
+atexit.register(_writer.close)
+
+
+def get_db_writer() -> BackgroundDBWriter:
+    """Return the process-wide background database writer."""
+    return _writer
@@ -0,0 +1,374 @@
+"""
+Process-wide embedding cache with LRU eviction and optional on-disk persistence
+"""
+import hashlib
+import logging
+import mmap
+import os
+import re
+import struct
+import threading
+import zlib
+from collections import OrderedDict
+from typing import Dict, List, Optional
+
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - non-POSIX platforms
+    fcntl = None
+
+from config import EMBEDDING_CACHE_SIZE, EMBEDDING_CACHE_PATH, EMBEDDING_CACHE_MAX_BYTES
+
+logger = logging.getLogger(__name__)
+
+_WHITESPACE_RE = re.compile(r"\s+")
+
+
+def normalize_text(text: str) -> str:
+    """Collapse runs of whitespace and strip the ends so trivially different inputs share a key."""
+    return _WHITESPACE_RE.sub(" ", text).strip()
+
+
+def make_key(deployment: str, text: str) -> bytes:
+    """Return the 32-byte cache key for (deployment, normalized text)."""
+    raw = f"{deployment or ''}\x00{normalize_text(text)}".encode("utf-8")
+    return hashlib.sha256(raw).digest()
+
+
+class DiskEmbeddingStore:
+    """
+    Append-only, memory-mapped vector file shared between worker processes.
+
+    Layout: a fixed header followed by records of
+    [4-byte magic][32-byte key][uint32 dimension][uint32 CRC-32][dimension x float32].
+    Writers append whole records under an exclusive flock, so several
+    gunicorn workers can share one file; readers map the file read-only
+    and index any records appended since their last scan.
+
+    A record that fails its magic or checksum (torn by a crash or a full disk)
+    ends the scan, and the file is rewritten without it. When an append would
+    take the file past max_bytes, the newest records are copied into a fresh
+    file of half that size, which replaces the old one; other workers notice
+    the new inode and reopen it. The file, and the key index each worker keeps
+    for it, therefore stay bounded.
+    """
+
+    HEADER = b"EMBCACHE2\n"
+    _MAGIC = b"EMBR"
+    _KEY_SIZE = 32
+    _META = struct.Struct("<II")  # dimension, CRC-32 of key + dimension + vector
+    _RECORD_HEAD = len(_MAGIC) + _KEY_SIZE + _META.size
+    _MAX_DIM = 1 << 16
+
+    def __init__(self, path: str, max_bytes: int = EMBEDDING_CACHE_MAX_BYTES):
+        """
+        Open (or create) the store.
+
+        Args:
+            path: Location of the cache file
+            max_bytes: Size at which the file is compacted (0 = no cap)
+        """
+        self.path = path
+        self.max_bytes = max_bytes
+        self.stats = {"compactions": 0, "bad_records": 0}
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._fd = None
+        self._reopen()
+
+        self._lock_current()
+        try:
+            with open(path, "rb") as f:
+                header = f.read(len(self.HEADER))
+            if header != self.HEADER and header.startswith(b"EMBCACHE"):
+                logger.info(f"Replacing embedding cache {path} written in an older layout")
+                self._replace(b"")
+        finally:
+            self._unlock_file()
+        if header != self.HEADER and not header.startswith(b"EMBCACHE"):
+            os.close(self._fd)
+            raise ValueError(f"{path} is not an embedding cache file")
+        self.refresh()
+
+    def _reopen(self) -> None:
+        """(Re)open the file currently at self.path and forget what was indexed."""
+        if self._fd is not None:
+            os.close(self._fd)
+        self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT | os.O_APPEND, 0o644)
+        self._inode = os.fstat(self._fd).st_ino
+        self._mmap = None
+        self._scanned = len(self.HEADER)
+        self._index: Dict[bytes, tuple] = {}
+
+    def _lock_file(self) -> None:
+        if fcntl is not None:
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+
+    def _unlock_file(self) -> None:
+        if fcntl is not None:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    def _lock_current(self) -> None:
+        """Lock the file now at self.path, reopening it first if another worker replaced it."""
+        while True:
+            self._lock_file()
+            try:
+                current = os.stat(self.path).st_ino
+            except FileNotFoundError:
+                current = None
+            if current == self._inode:
+                if os.fstat(self._fd).st_size == 0:
+                    os.write(self._fd, self.HEADER)
+                return
+            self._unlock_file()
+            self._reopen()
+
+    @staticmethod
+    def _checksum(key: bytes, dim: int, payload) -> int:
+        return zlib.crc32(payload, zlib.crc32(key + struct.pack("<I", dim)))
+
+    def _scan(self) -> Optional[int]:
+        """Index records appended since the last scan; return the offset of a corrupt record, if one was hit."""
+        size = os.fstat(self._fd).st_size
+        if size <= self._scanned:
+            return None
+        # The previous mapping is released once nothing references it
+        self._mmap = mmap.mmap(self._fd, size, access=mmap.ACCESS_READ)
+        pos = self._scanned
+        head = self._RECORD_HEAD
+        bad = None
+        while pos + head <= size:
+            if self._mmap[pos:pos + len(self._MAGIC)] != self._MAGIC:
+                bad = pos
+                break
+            key_at = pos + len(self._MAGIC)
+            key = bytes(self._mmap[key_at:key_at + self._KEY_SIZE])
+            dim, crc = self._META.unpack_from(self._mmap, key_at + self._KEY_SIZE)
+            end = pos + head + dim * 4
+            if dim > self._MAX_DIM:
+                bad = pos
+                break
+            if end > size:
+                # Partially written record from another process; pick it up next time
+                break
+            if self._checksum(key, dim, self._mmap[pos + head:end]) != crc:
+                bad = pos
+                break
+            self._index[key] = (pos + head, dim)
+            pos = end
+        self._scanned = pos
+        return bad
+
+    def refresh(self) -> None:
+        """Map the current file and index records appended since the last scan."""
+        try:
+            if os.stat(self.path).st_ino != self._inode:
+                self._reopen()
+        except FileNotFoundError:
+            pass  # recreated by the next put
+        bad = self._scan()
+        if bad is None:
+            return
+        self.stats["bad_records"] += 1
+        logger.warning(f"Embedding cache {self.path} has a corrupt record at byte {bad}; "
+                       f"rewriting it without the records from there on")
+        inode = self._inode
+        self._lock_current()
+        try:
+            if self._inode == inode:
+                self._replace(bytes(self._mmap[len(self.HEADER):bad]))
+        finally:
+            self._unlock_file()
+        self._scan()
+
+    def _replace(self, records: bytes) -> None:
+        """Swap in a fresh file holding records (caller holds the lock; it is kept on the new file)."""
+        tmp = f"{self.path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp, "wb") as f:
+                f.write(self.HEADER + records)
+            os.replace(tmp, self.path)
+        except OSError:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+        # Closing the old descriptor releases its lock; workers waiting on it will reopen
+        self._reopen()
+        self._lock_file()
+
+    def _compact(self) -> None:
+        """Keep the newest records that fit in half of max_bytes (caller holds the lock)."""
+        self._scan()
+        budget = self.max_bytes // 2 - len(self.HEADER)
+        keep = []
+        for offset, dim in sorted(self._index.values(), reverse=True):
+            length = self._RECORD_HEAD + dim * 4
+            if length > budget:
+                break
+            budget -= length
+            keep.append((offset - self._RECORD_HEAD, offset + dim * 4))
+        records = b"".join(self._mmap[start:end] for start, end in reversed(keep))
+        self._replace(records)
+        self.stats["compactions"] += 1
+        logger.info(f"Compacted embedding cache {self.path} to {len(keep)} vectors")
+        self._scan()
+
+    def get(self, key: bytes) -> Optional[List[float]]:
+        """Return the stored vector for key, or None."""
+        location = self._index.get(key)
+        if location is None:
+            self.refresh()
+            location = self._index.get(key)
+            if location is None:
+                return None
+        offset, dim = location
+        return np.frombuffer(self._mmap, dtype="<f4", count=dim, offset=offset).tolist()
+
+    def put(self, key: bytes, vector: List[float]) -> None:
+        """Append a vector unless the key is already stored, compacting the file first if it is full."""
+        if key in self._index:
+            return
+        payload = np.asarray(vector, dtype="<f4").tobytes()
+        dim = len(payload) // 4
+        record = self._MAGIC + key + self._META.pack(dim, self._checksum(key, dim, payload)) + payload
+        self._lock_current()
+        try:
+            if self.max_bytes and os.fstat(self._fd).st_size + len(record) > self.max_bytes:
+                self._compact()
+            os.write(self._fd, record)
+        finally:
+            self._unlock_file()
+
+    def size_bytes(self) -> int:
+        """Return the current size of the file."""
+        return os.fstat(self._fd).st_size
+
+    def __len__(self) -> int:
+        return len(self._index)
+
+    def close(self) -> None:
+        """Close the underlying file."""
+        self._mmap = None
+        os.close(self._fd)
+
+
+class EmbeddingCache:
+    """
+    Caches embedding vectors keyed by (deployment, normalized text).
+
+    This class is responsible for:
+    - Keeping the most recently used vectors in a bounded in-memory LRU
+    - Optionally persisting vectors to a memory-mapped file so warm workers
+      and restarts can reuse them
+    - Tracking hit/miss counts for monitoring
+    """
+
+    def __init__(self, max_entries=EMBEDDING_CACHE_SIZE, disk_path=EMBEDDING_CACHE_PATH):
+        """
+        Initialize the cache.
+
+        Args:
+            max_entries: Maximum number of vectors kept in memory (0 disables the memory tier)
+            disk_path: Path of the on-disk store, or None/"" to keep vectors in memory only
+        """
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[bytes, List[float]]" = OrderedDict()
+        self._stats = {"hits": 0, "disk_hits": 0, "misses": 0, "evictions": 0}
+
+        self._disk = None
+        if disk_path:
+            try:
+                self._disk = DiskEmbeddingStore(disk_path)
+                logger.info(f"Embedding cache persisted at {disk_path} ({len(self._disk)} vectors)")
+            except Exception as e:
+                logger.error(f"Could not open embedding cache file {disk_path}, using memory only: {e}")
+
+    def get(self, deployment: str, text: str) -> Optional[List[float]]:
+        """
+        Look up a cached embedding.
+
+        Args:
+            deployment: The embedding deployment name
+            text: The text that was embedded
+
+        Returns:
+            The cached vector, or None on a miss
+        """
+        key = make_key(deployment, text)
+        with self._lock:
+            vector = self._entries.get(key)
+            if vector is not None:
+                self._entries.move_to_end(key)
+                self._stats["hits"] += 1
+                return list(vector)
+
+            if self._disk is not None:
+                vector = self._disk.get(key)
+                if vector is not None:
+                    self._stats["disk_hits"] += 1
+                    self._remember(key, vector)
+                    return list(vector)
+
+            self._stats["misses"] += 1
+            return None
+
+    def put(self, deployment: str, text: str, vector: List[float]) -> None:
+        """
+        Store an embedding.
+
+        Args:
+            deployment: The embedding deployment name
+            text: The text that was embedded
+            vector: The embedding returned by the API
+        """
+        if not vector:
+            return
+        key = make_key(deployment, text)
+        with self._lock:
+            self._remember(key, list(vector))
+            if self._disk is not None:
+                try:
+                    self._disk.put(key, vector)
+                except OSError as e:
+                    logger.error(f"Failed to persist embedding to disk: {e}")
+
+    def _remember(self, key: bytes, vector: List[float]) -> None:
+        # Caller must hold self._lock
+        if self.max_entries <= 0:
+            return
+        self._entries[key] = vector
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self._stats["evictions"] += 1
+
+    def get_stats(self) -> Dict:
+        """Return hit/miss counters, hit rate and sizes."""
+        with self._lock:
+            stats = dict(self._stats)
+            stats["size"] = len(self._entries)
+            stats["disk_entries"] = len(self._disk) if self._disk is not None else None
+            if self._disk is not None:
+                stats["disk_bytes"] = self._disk.size_bytes()
+                stats.update({f"disk_{name}": count for name, count in self._disk.stats.items()})
+        lookups = stats["hits"] + stats["disk_hits"] + stats["misses"]
+        stats["max_entries"] = self.max_entries
+        stats["hit_rate"] = (stats["hits"] + stats["disk_hits"]) / lookups if lookups else 0.0
+        return stats
+
+    def clear(self) -> None:
+        """Drop every in-memory entry (the disk store is left untouched)."""
+        with self._lock:
+            self._entries.clear()
+
+
+_cache = EmbeddingCache()
+
+
+def get_embedding_cache() -> EmbeddingCache:
+    """Return the process-wide embedding cache."""
+    return _cache
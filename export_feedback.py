@@ -5,6 +5,9 @@ export_feedback.py
 Periodically exports all rows from the `votes` table in PostgreSQL
 to a JSON file at /app/data/fallback/feedback.json. Runs once at startup
 and then every hour on the hour.
+
+Also keeps the analytics rollup tables current, folding in new votes,
+helpee_costs and rag_queries rows every few minutes.
 """
 import os
 import json
@@ -12,10 +15,12 @@ import logging
 from apscheduler.schedulers.blocking import BlockingScheduler
 from psycopg2.extras import RealDictCursor
 from db_manager import DatabaseManager
+from analytics_rollups import get_rollups
 
 # Configuration
 OUTPUT_DIR = "/app/data/fallback"
 OUTPUT_FILE = os.path.join(OUTPUT_DIR, "feedback.json")
+ROLLUP_INTERVAL_MINUTES = 5
 LOG_FORMAT = "%(asctime)s - %(levelname)s - %(message)s"
 
 # Setup logging
@@ -28,12 +33,14 @@ def dump_feedback():
         # Ensure output directory exists
         os.makedirs(OUTPUT_DIR, exist_ok=True)
 
-        # Fetch all rows from votes table
+        # Fetch all rows from votes table (the pooled connection is reused between runs)
         conn = DatabaseManager.get_connection()
-        with conn.cursor(cursor_factory=RealDictCursor) as cursor:
-            cursor.execute("SELECT * FROM votes;")
-            rows = cursor.fetchall()
-        conn.close()
+        try:
+            with conn.cursor(cursor_factory=RealDictCursor) as cursor:
+                cursor.execute("SELECT * FROM votes;")
+                rows = cursor.fetchall()
+        finally:
+            conn.close()
 
         # Write to a temp file then rename
         temp_file = OUTPUT_FILE + ".tmp"
@@ -45,14 +52,25 @@ def dump_feedback():
     except Exception as e:
         logger.error(f"Failed to export feedback: {e}", exc_info=True)
 
+def refresh_rollups():
+    """Fold rows added since the last run into the analytics rollup tables."""
+    try:
+        folded = get_rollups().refresh()
+        logger.info(f"Refreshed analytics rollups: {folded}")
+    except Exception as e:
+        logger.error(f"Failed to refresh analytics rollups: {e}", exc_info=True)
+
 if __name__ == "__main__":
     # Run once immediately
     dump_feedback()
+    refresh_rollups()
 
     # Schedule hourly on the hour
     scheduler = BlockingScheduler()
     scheduler.add_job(dump_feedback, trigger="cron", minute=0)
-    logger.info("Scheduler started: will export feedback hourly at minute 0")
+    scheduler.add_job(refresh_rollups, trigger="interval", minutes=ROLLUP_INTERVAL_MINUTES)
+    logger.info("Scheduler started: will export feedback hourly at minute 0 "
+                f"and refresh analytics rollups every {ROLLUP_INTERVAL_MINUTES} minutes")
     try:
         scheduler.start()
     except (KeyboardInterrupt, SystemExit):
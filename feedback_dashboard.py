@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 from flask import Flask, render_template, jsonify
 import psycopg2
+from db_manager import DatabaseManager
 from psycopg2.extras import RealDictCursor
 import os
 from dotenv import load_dotenv
@@ -97,9 +98,9 @@ DASHBOARD_HTML = """
 """
 
 def get_db_connection():
-    """Create and return a database connection."""
+    """Return a pooled database connection (close() hands it back)."""
     try:
-        conn = psycopg2.connect(**DB_PARAMS)
+        conn = DatabaseManager.get_connection()  # pooled
         return conn
     except Exception as e:
         print(f"Database connection error: {e}")
@@ -1,5 +1,6 @@
 #!/usr/bin/env python3
 import psycopg2
+from db_manager import DatabaseManager
 from psycopg2.extras import RealDictCursor
 import os
 import webbrowser
@@ -23,9 +24,9 @@ DB_PARAMS = {
 }
 
 def get_db_connection():
-    """Create and return a database connection."""
+    """Return a pooled database connection (close() hands it back)."""
     try:
-        conn = psycopg2.connect(**DB_PARAMS)
+        conn = DatabaseManager.get_connection()  # pooled
         return conn
     except Exception as e:
         print(f"Database connection error: {e}")
@@ -17,6 +17,8 @@ Requirements:
 """
 
 import psycopg2
+from db_manager import DatabaseManager
+from call_log_index import get_call_log_index
 from psycopg2.extras import RealDictCursor
 import os
 import webbrowser
@@ -42,7 +44,6 @@ DB_PARAMS = {
 }
 
 # Path to OpenAI calls log
-LOG_PATH = os.path.join('logs', 'openai_calls.jsonl')
 
 # HTML template for the dashboard
 HTML_TEMPLATE = """<!DOCTYPE html>
@@ -185,9 +186,9 @@ HTML_TEMPLATE = """<!DOCTYPE html>
 </html>"""
 
 def get_db_connection():
-    """Create and return a database connection."""
+    """Return a pooled database connection (close() hands it back)."""
     try:
-        conn = psycopg2.connect(**DB_PARAMS)
+        conn = DatabaseManager.get_connection()  # pooled
         return conn
     except Exception as e:
         print(f"Database connection error: {e}")
@@ -297,20 +298,8 @@ def generate_table_rows(feedback_data):
     return ''.join(rows_html)
 
 def parse_openai_calls():
-    """Parse the openai_calls.jsonl log file to compute total tokens per call."""
-    tokens = []
-    if not os.path.exists(LOG_PATH):
-        return tokens
-    with open(LOG_PATH, 'r') as f:
-        for line in f:
-            try:
-                entry = json.loads(line)
-                tot = entry.get('usage', {}).get('total_tokens')
-                if isinstance(tot, (int, float)):
-                    tokens.append(tot)
-            except (json.JSONDecodeError, AttributeError):
-                continue
-    return tokens
+    """Return total tokens per OpenAI call, from the incremental call log index."""
+    return get_call_log_index().token_counts()
 
 def generate_metrics_summary_html(metrics):
     """Generate the HTML for the metrics summary section."""
@@ -490,8 +479,7 @@ def main():
         positive_feedback_count = sum(1 for fb in feedback_data if determine_feedback_status(fb.get('feedback_tags', [])).get('status') == 'Positive')
         positive_feedback_pct = (positive_feedback_count / total_feedback * 100) if total_feedback else 0.0
         
-        token_list = parse_openai_calls()
-        avg_tokens = (sum(token_list) / len(token_list)) if token_list else 0.0
+        avg_tokens = get_call_log_index().summary()['avg_total_tokens']
         
         metrics = {
             'total_queries': total_queries,
@@ -14,6 +14,7 @@ Requirements:
 """
 
 import psycopg2
+from db_manager import DatabaseManager
 from psycopg2.extras import RealDictCursor
 import os
 import webbrowser
@@ -232,9 +233,9 @@ HTML_TEMPLATE = """<!DOCTYPE html>
 </html>"""
 
 def get_db_connection():
-    """Create and return a database connection."""
+    """Return a pooled database connection (close() hands it back)."""
     try:
-        conn = psycopg2.connect(**DB_PARAMS)
+        conn = DatabaseManager.get_connection()  # pooled
         return conn
     except Exception as e:
         print(f"Database connection error: {e}")
@@ -19,6 +19,9 @@ Requirements:
 """
 
 import psycopg2
+from db_manager import DatabaseManager
+from analytics_rollups import get_rollups
+from call_log_index import get_call_log_index
 from psycopg2.extras import RealDictCursor
 import os
 import webbrowser
@@ -29,8 +32,6 @@ logging.basicConfig(level=logging.DEBUG, format="%(asctime)s [%(levelname)s] %(m
 import html
 from datetime import datetime, timedelta
 import json
-import collections
-import re
 import statistics
 from typing import Dict, List, Any, Tuple, Optional, Union
 
@@ -52,17 +53,16 @@ DB_PARAMS = {
 }
 
 # Path to OpenAI calls log
-LOG_PATH = os.path.join('logs', 'openai_calls.jsonl')
 
 # =====================================================================
 # DATABASE FUNCTIONS
 # =====================================================================
 
 def get_db_connection():
-    """Create and return a database connection."""
+    """Return a pooled database connection (close() hands it back)."""
     try:
         print("Attempting to connect to PostgreSQL database...")
-        conn = psycopg2.connect(**DB_PARAMS)
+        conn = DatabaseManager.get_connection()  # pooled
         print("Database connection established successfully.")
         return conn
     except Exception as e:
@@ -125,89 +125,46 @@ def get_total_queries():
             conn.close()
 
 def get_requests_per_hour():
-    """Fetch count of requests grouped by hour from the database for the last 6 hours."""
-    conn = None
+    """Fetch count of requests grouped by hour for the last 6 hours from the hourly rollup."""
     try:
-        conn = get_db_connection()
-        with conn.cursor() as cursor:
-            # Explicitly limit to exactly 6 hours to prevent browser crashes
-            cursor.execute("""
-                SELECT to_char(date_trunc('hour', timestamp), 'YYYY-MM-DD HH24:00') AS hour, COUNT(*) AS count
-                FROM votes
-                WHERE timestamp >= NOW() - INTERVAL '6 hours'
-                GROUP BY hour ORDER BY hour
-                LIMIT 6;
-            """)
-            result = {row[0]: row[1] for row in cursor.fetchall()}
-            print(f"Retrieved requests per hour data: {result}")
-            return result
+        # Explicitly limit to exactly 6 hours to prevent browser crashes
+        result = get_rollups().requests_per_hour(hours=6)
+        print(f"Retrieved requests per hour data: {result}")
+        return result
     except Exception as e:
         print(f"Error fetching requests per hour: {e}")
         return {}
-    finally:
-        if conn:
-            conn.close()
 
 def get_query_complexity_metrics():
     """
     Analyze query complexity and its correlation with feedback sentiment.
     Returns metrics about query length and its relationship to feedback.
+
+    Everything comes from the feedback rollups; the median is taken from the
+    daily query-length histogram. Lengths are averaged over votes that have a
+    user_query, while positive_count/negative_count count all votes.
     """
-    conn = None
     try:
-        conn = get_db_connection()
-        with conn.cursor(cursor_factory=RealDictCursor) as cursor:
-            # Get query lengths and associated feedback
-            cursor.execute("""
-                SELECT 
-                    LENGTH(user_query) as query_length,
-                    feedback_tags
-                FROM votes
-                WHERE user_query IS NOT NULL
-            """)
-            
-            rows = cursor.fetchall()
-            
-            # Process the data
-            positive_lengths = []
-            negative_lengths = []
-            
-            for row in rows:
-                length = row['query_length']
-                tags = row['feedback_tags'] or []
-                
-                # Determine if feedback is positive
-                is_positive = False
-                if tags:
-                    positive_indicators = ['good', 'accurate', 'helpful', 'clear', 'looks good']
-                    if any(indicator in tag.lower() for tag in tags for indicator in positive_indicators):
-                        is_positive = True
-                
-                if is_positive:
-                    positive_lengths.append(length)
-                else:
-                    negative_lengths.append(length)
-            
-            # Calculate metrics
-            avg_query_length = sum(row['query_length'] for row in rows) / len(rows) if rows else 0
-            avg_positive_length = sum(positive_lengths) / len(positive_lengths) if positive_lengths else 0
-            avg_negative_length = sum(negative_lengths) / len(negative_lengths) if negative_lengths else 0
-            
-            # Calculate median and percentiles if we have enough data
-            median_length = statistics.median(row['query_length'] for row in rows) if rows else 0
-            
-            # Calculate correlation between length and sentiment
-            correlation = {
-                'avg_query_length': round(avg_query_length, 1),
-                'avg_positive_length': round(avg_positive_length, 1),
-                'avg_negative_length': round(avg_negative_length, 1),
-                'median_length': round(median_length, 1),
-                'positive_count': len(positive_lengths),
-                'negative_count': len(negative_lengths)
-            }
-            
-            print(f"Query complexity metrics calculated: {correlation}")
-            return correlation
+        rollups = get_rollups()
+        totals = rollups.feedback_totals()
+        queries = totals['query_count']
+        positive_queries = totals['positive_query_count']
+        negative_queries = queries - positive_queries
+        negative_length_sum = totals['query_length_sum'] - totals['positive_query_length_sum']
+        median_length = rollups.query_length_median()
+        
+        # Calculate correlation between length and sentiment
+        correlation = {
+            'avg_query_length': round(totals['query_length_sum'] / queries, 1) if queries else 0,
+            'avg_positive_length': round(totals['positive_query_length_sum'] / positive_queries, 1) if positive_queries else 0,
+            'avg_negative_length': round(negative_length_sum / negative_queries, 1) if negative_queries else 0,
+            'median_length': round(float(median_length), 1),
+            'positive_count': totals['positive_feedback'],
+            'negative_count': totals['negative_feedback']
+        }
+        
+        print(f"Query complexity metrics calculated: {correlation}")
+        return correlation
             
     except Exception as e:
         print(f"Error calculating query complexity metrics: {e}")
@@ -219,9 +176,6 @@ def get_query_complexity_metrics():
             'positive_count': 0,
             'negative_count': 0
         }
-    finally:
-        if conn:
-            conn.close()
 
 def get_feedback_response_time():
     """
@@ -287,64 +241,25 @@ def get_feedback_response_time():
         if conn:
             conn.close()
 
+# Common English stop words removed for a cleaner word cloud
+STOP_WORDS = frozenset(['i', 'me', 'my', 'myself', 'we', 'our', 'ours', 'ourselves', 'you', 'your', 'yours', 
+                        'he', 'him', 'his', 'she', 'her', 'hers', 'it', 'its', 'they', 'them', 'their', 
+                        'theirs', 'what', 'which', 'who', 'whom', 'this', 'that', 'these', 'those', 'am', 
+                        'is', 'are', 'was', 'were', 'be', 'been', 'being', 'have', 'has', 'had', 'do', 
+                        'does', 'did', 'a', 'an', 'the', 'and', 'but', 'if', 'or', 'because', 'as', 'of', 
+                        'at', 'by', 'for', 'with', 'about', 'to', 'from', 'in', 'out', 'on', 'off', 'over', 
+                        'so', 'than', 'too', 'very', 's', 't', 'can', 'will', 'just', 'don', 'should', 'now'])
+
 def get_word_frequencies():
-    """Compute word frequencies from user queries and feedback tags, robustly handling tag formats."""
-    conn = None
-    word_counts = collections.Counter()
+    """Get the most frequent words in user queries and feedback tags from the daily word rollup."""
     try:
-        conn = get_db_connection()
-        with conn.cursor() as cursor:
-            cursor.execute("SELECT user_query, feedback_tags FROM votes;")
-            rows = cursor.fetchall()
-            for user_query, feedback_tags_data in rows:
-                if user_query:
-                    words = re.findall(r'\b\w+\b', user_query.lower())
-                    word_counts.update(words)
-                
-                if not feedback_tags_data:
-                    continue
-
-                tags_to_process = []
-                if isinstance(feedback_tags_data, list):
-                    tags_to_process = feedback_tags_data
-                elif isinstance(feedback_tags_data, str):
-                    try:
-                        # Safer parsing than eval()
-                        parsed_tags = json.loads(feedback_tags_data)
-                        if isinstance(parsed_tags, list):
-                            tags_to_process = parsed_tags
-                        else:
-                            tags_to_process.append(str(parsed_tags))
-                    except json.JSONDecodeError:
-                        # Fallback for non-JSON strings (e.g., "{tag1,tag2}")
-                        tags_to_process.append(feedback_tags_data)
-                
-                for tag in tags_to_process:
-                    if isinstance(tag, str):
-                        tag_words = re.findall(r'\b\w+\b', tag.lower())
-                        word_counts.update(tag_words)
-        
-        # Remove common English stop words for a cleaner word cloud
-        stop_words = set(['i', 'me', 'my', 'myself', 'we', 'our', 'ours', 'ourselves', 'you', 'your', 'yours', 
-                          'he', 'him', 'his', 'she', 'her', 'hers', 'it', 'its', 'they', 'them', 'their', 
-                          'theirs', 'what', 'which', 'who', 'whom', 'this', 'that', 'these', 'those', 'am', 
-                          'is', 'are', 'was', 'were', 'be', 'been', 'being', 'have', 'has', 'had', 'do', 
-                          'does', 'did', 'a', 'an', 'the', 'and', 'but', 'if', 'or', 'because', 'as', 'of', 
-                          'at', 'by', 'for', 'with', 'about', 'to', 'from', 'in', 'out', 'on', 'off', 'over', 
-                          'so', 'than', 'too', 'very', 's', 't', 'can', 'will', 'just', 'don', 'should', 'now'])
-        for word in stop_words:
-            word_counts.pop(word, None)
-        
         # Limit to top 50 words to prevent browser crashes
-        most_common = dict(word_counts.most_common(50))
-        print(f"Word cloud limited to top 50 words (from {len(word_counts)} total)")
+        most_common = get_rollups().word_counts(limit=50, exclude=STOP_WORDS)
+        print(f"Word cloud limited to top {len(most_common)} words")
         return most_common
     except Exception as e:
         print(f"Error computing word frequencies: {e}")
         return {}
-    finally:
-        if conn:
-            conn.close()
 
 # =====================================================================
 # DATA PROCESSING FUNCTIONS
@@ -382,26 +297,9 @@ def create_tag_badges(tags):
     return ''.join(badges_html)
 
 def parse_openai_calls():
-    """Parse the openai_calls.jsonl log file to compute total tokens per call."""
-    tokens = []
-    if not os.path.exists(LOG_PATH):
-        print(f"Warning: OpenAI calls log file not found at {LOG_PATH}")
-        return tokens
-    
+    """Return total tokens per OpenAI call, from the incremental call log index."""
     try:
-        with open(LOG_PATH, 'r') as f:
-            for line in f:
-                try:
-                    entry = json.loads(line)
-                    tot = entry.get('usage', {}).get('total_tokens')
-                    if isinstance(tot, (int, float)):
-                        tokens.append(tot)
-                except (json.JSONDecodeError, AttributeError) as e:
-                    print(f"Warning: Error parsing log line: {e}")
-                    continue
-        
-        print(f"Parsed {len(tokens)} token entries from OpenAI calls log")
-        return tokens
+        return get_call_log_index().token_counts()
     except Exception as e:
         print(f"Error reading OpenAI calls log: {e}")
         return []
@@ -1016,8 +914,7 @@ def main():
         positive_feedback_pct = (positive_feedback_count / total_feedback * 100) if total_feedback else 0.0
         
         # Token usage metrics
-        token_list = parse_openai_calls()
-        avg_tokens = (sum(token_list) / len(token_list)) if token_list else 0.0
+        avg_tokens = get_call_log_index().summary()['avg_total_tokens']
         
         # New metrics
         query_complexity = get_query_complexity_metrics()
@@ -1070,8 +967,7 @@ def main():
         positive_feedback_pct = (positive_feedback_count / total_feedback * 100) if total_feedback else 0.0
         
         # Token usage metrics
-        token_list = parse_openai_calls()
-        avg_tokens = (sum(token_list) / len(token_list)) if token_list else 0.0
+        avg_tokens = get_call_log_index().summary()['avg_total_tokens']
         
         # New metrics
         query_complexity = get_query_complexity_metrics()
@@ -19,9 +19,25 @@ sas_token = os.getenv("SAS_TOKEN", "")
 # Import directly from the current directory
 from rag_assistant_with_history_copy import FlaskRAGAssistantWithHistory
 from db_manager import DatabaseManager
-from openai import AzureOpenAI
 from config import get_cost_rates
-from openai_service import OpenAIService
+from openai_service import OpenAIService, get_stats as get_openai_stats
+from client_registry import get_openai_client, get_pool_stats
+from embedding_cache import get_embedding_cache
+from semantic_cache import get_semantic_cache
+from speculative_retrieval import get_speculation_stats
+from db_writer import get_db_writer
+from analytics_engine import get_analytics_engine
+from analytics_rollups import get_rollups
+from session_store import SessionBusy, get_session_store
+from conversation_state import get_chunk_store
+from rolling_summary import get_summary_folder
+from reranker import get_reranker
+from near_duplicates import get_near_duplicate_filter
+from context_packer import get_context_packer
+from context_expansion import get_context_expander
+from rate_limiter import get_rate_limiter
+from openai_logger import get_call_logger
+from call_log_index import get_call_log_index
 
 # Configure logginghttps://content.tst-34.aws.agilent.com/wp-content/uploads/2025/05/logo-spark-1.png
 logger = logging.getLogger()
@@ -74,16 +90,23 @@ logger.info("Flask RAG application starting up")
 app = Flask(__name__)
 app.secret_key = os.getenv("FLASK_SECRET_KEY", "default-secret-key-for-sessions")
 
-# Dictionary to store RAG assistant instances by session ID
-rag_assistants = {}
-
-# Function to get or create a RAG assistant for a session
+# Conversation state lives in the session store (memory, SQLite or Redis), not in
+# long-lived assistant objects, so any worker can serve any session; every turn holds
+# get_session_store().lock(session_id) around load -> answer -> save so concurrent
+# requests for one conversation cannot overwrite each other's turns
 def get_rag_assistant(session_id):
-    """Get or create a RAG assistant for the given session ID"""
-    if session_id not in rag_assistants:
-        logger.info(f"Creating new RAG assistant for session {session_id}")
-        rag_assistants[session_id] = FlaskRAGAssistantWithHistory()
-    return rag_assistants[session_id]
+    """Create a RAG assistant carrying the stored conversation state for the given session ID"""
+    rag_assistant = FlaskRAGAssistantWithHistory()
+    state = get_session_store().get(session_id)
+    if state:
+        rag_assistant.load_state(state)
+    else:
+        logger.info(f"Starting new conversation for session {session_id}")
+    return rag_assistant
+
+def save_rag_assistant(session_id, rag_assistant):
+    """Persist the assistant's conversation state for the given session ID"""
+    get_session_store().put(session_id, rag_assistant.export_state())
 
 # LLM helpee helpers
 PROMPT_ENHANCER_SYSTEM_MESSAGE = QUERY_ENHANCER_SYSTEM_PROMPT = """
@@ -150,16 +173,38 @@ INPUT
 The following is the prompt you will improve: user-query
 """
 
+def _helpee_chat(system_message: str, input_text: str):
+    """
+    Run one prompt-enhancer completion through OpenAIService (deadline, retries, usage capture).
+
+    Returns:
+        Tuple of (answer text, usage dict with prompt/completion/total token counts)
+    """
+    service = OpenAIService(
+        api_version=os.getenv("AZURE_OPENAI_API_VERSION", "2024-02-01"),
+        deployment_name=os.getenv("AZURE_OPENAI_MODEL"),
+        # Shared (connection-pooled) Azure OpenAI client
+        client=get_openai_client(
+            azure_endpoint=os.getenv("AZURE_OPENAI_ENDPOINT"),
+            api_key=os.getenv("AZURE_OPENAI_KEY"),
+            api_version=os.getenv("AZURE_OPENAI_API_VERSION", "2024-02-01")
+        )
+    )
+    # None leaves sampling parameters at the API defaults, as these calls always have
+    answer = service.get_chat_response(
+        messages=[
+            { "role": "system", "content": system_message },
+            { "role": "user",   "content": input_text }
+        ],
+        temperature=None, max_tokens=None, top_p=None, presence_penalty=None, frequency_penalty=None
+    )
+    usage = service.last_usage or {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0}
+    return answer, usage
+
 def llm_helpee(input_text: str) -> str:
     """
     Sends PROMPT_ENHANCER_SYSTEM_MESSAGE to the Azure OpenAI model, logs usage into helpee_logs, and returns the AI output.
     """
-    # Prepare Azure OpenAI client
-    client = AzureOpenAI(
-        azure_endpoint=os.getenv("AZURE_OPENAI_ENDPOINT"),
-        api_key=os.getenv("AZURE_OPENAI_KEY"),
-        api_version=os.getenv("AZURE_OPENAI_API_VERSION", "2024-02-01")
-    )
     # Debug: log full helpee payload before sending to Azure OpenAI
     logger.debug("Helpee payload: %s", {
         "model": os.getenv("AZURE_OPENAI_MODEL"),
@@ -168,29 +213,12 @@ def llm_helpee(input_text: str) -> str:
             { "role": "user",   "content": input_text }
         ]
     })
-    response = client.chat.completions.create(
-        model=os.getenv("AZURE_OPENAI_MODEL"),
-        messages=[
-            { "role": "system", "content": PROMPT_ENHANCER_SYSTEM_MESSAGE },
-            { "role": "user",   "content": input_text }
-        ]
-    )
-    answer = response.choices[0].message.content
-    usage = getattr(response, "usage", {})
-    prompt_tokens = usage.prompt_tokens
-    completion_tokens = usage.completion_tokens
-    total_tokens = usage.total_tokens
+    answer, usage = _helpee_chat(PROMPT_ENHANCER_SYSTEM_MESSAGE, input_text)
+    prompt_tokens = usage["prompt_tokens"]
+    completion_tokens = usage["completion_tokens"]
+    total_tokens = usage["total_tokens"]
     logger.debug(f"User query: {input_text}")
     logger.debug(f"Enhanced query: {answer}")
-    # Log to database
-    log_id = DatabaseManager.log_helpee_activity(
-        user_query=input_text,  # Store the original user query
-        response_text=answer,
-        prompt_tokens=prompt_tokens,
-        completion_tokens=completion_tokens,
-        total_tokens=total_tokens,
-        model=os.getenv("AZURE_OPENAI_MODEL")
-    )
     model = os.getenv("AZURE_OPENAI_MODEL")
     rates = get_cost_rates(model)
     # The rates from get_cost_rates are already per 1M tokens (after being multiplied by 1000)
@@ -204,8 +232,10 @@ def llm_helpee(input_text: str) -> str:
         f"completion_tokens={completion_tokens}, completion_rate={rates['completion']}, completion_cost={completion_cost}, "
         f"total_cost={total_cost}"
     )
-    DatabaseManager.log_helpee_cost(
-        helpee_log_id=log_id,
+    # Queue the helpee_logs and helpee_costs rows for the background writer
+    get_db_writer().log_helpee(
+        user_query=input_text,  # Store the original user query
+        response_text=answer,
         model=model,
         prompt_tokens=prompt_tokens,
         completion_tokens=completion_tokens,
@@ -225,38 +255,10 @@ def llm_helpee_2xl(input_text: str) -> str:
     """
     Sends PROMPT_ENHANCER_SYSTEM_MESSAGE_2XL to the Azure OpenAI model, logs usage into helpee_logs, and returns the AI output.
     """
-    # Prepare Azure OpenAI client
-    client = AzureOpenAI(
-        azure_endpoint=os.getenv("AZURE_OPENAI_ENDPOINT"),
-        api_key=os.getenv("AZURE_OPENAI_KEY"),
-        api_version=os.getenv("AZURE_OPENAI_API_VERSION", "2024-02-01")
-    )
-    response = client.chat.completions.create(
-        model=os.getenv("AZURE_OPENAI_MODEL"),
-        messages= [
-            { "role": "system", "content": PROMPT_ENHANCER_SYSTEM_MESSAGE_2XL },
-            { "role": "user",   "content": input_text }
-        ]
-    )
-    answer = response.choices[0].message.content
-    usage = getattr(response, "usage", {})
-    latency = getattr(response, "latency", {})
-    logger.debug(f"Latency: {latency}")
-
-    usage = getattr(response, "usage", {})
-    prompt_tokens = usage.prompt_tokens
-    completion_tokens = usage.completion_tokens
-    total_tokens = usage.total_tokens
-    
-    # Log to database
-    log_id = DatabaseManager.log_helpee_activity(
-        user_query=input_text,  # Store the original user query
-        response_text=answer,
-        prompt_tokens=prompt_tokens,
-        completion_tokens=completion_tokens,
-        total_tokens=total_tokens,
-        model=os.getenv("AZURE_OPENAI_MODEL")
-    )
+    answer, usage = _helpee_chat(PROMPT_ENHANCER_SYSTEM_MESSAGE_2XL, input_text)
+    prompt_tokens = usage["prompt_tokens"]
+    completion_tokens = usage["completion_tokens"]
+    total_tokens = usage["total_tokens"]
     
     model = os.getenv("AZURE_OPENAI_MODEL")
     rates = get_cost_rates(model)
@@ -266,8 +268,10 @@ def llm_helpee_2xl(input_text: str) -> str:
     completion_cost = completion_tokens * rates["completion"] / 1000000
     total_cost = prompt_cost + completion_cost
     
-    DatabaseManager.log_helpee_cost(
-        helpee_log_id=log_id,
+    # Queue the helpee_logs and helpee_costs rows for the background writer
+    get_db_writer().log_helpee(
+        user_query=input_text,  # Store the original user query
+        response_text=answer,
         model=model,
         prompt_tokens=prompt_tokens,
         completion_tokens=completion_tokens,
@@ -325,7 +329,7 @@ def analytics_dashboard():
         # Import the necessary functions from feedback_dashboard_modern.py
         from feedback_dashboard_modern import get_all_feedback, get_total_queries, get_requests_per_hour
         from feedback_dashboard_modern import get_query_complexity_metrics, get_feedback_response_time
-        from feedback_dashboard_modern import parse_openai_calls, generate_dashboard_html
+        from feedback_dashboard_modern import generate_dashboard_html
         
         logger.info("Generating modern feedback dashboard")
         
@@ -341,8 +345,7 @@ def analytics_dashboard():
         positive_feedback_pct = (positive_feedback_count / total_feedback * 100) if total_feedback else 0.0
         
         # Token usage metrics
-        token_list = parse_openai_calls()
-        avg_tokens = (sum(token_list) / len(token_list)) if token_list else 0.0
+        avg_tokens = get_call_log_index().summary()['avg_total_tokens']
         
         # Additional metrics
         query_complexity = get_query_complexity_metrics()
@@ -387,27 +390,41 @@ def analytics():
     except ValueError:
         return jsonify({'error': 'Invalid date format. Use YYYY-MM-DD.'}), 400
 
-    # Fetch data from db_manager
-    feedback_summary = DatabaseManager.get_feedback_summary(start_date, end_date)
-    query_analytics = DatabaseManager.get_query_analytics(start_date, end_date)
-    tag_distribution = DatabaseManager.get_tag_distribution(start_date, end_date)
-    time_metrics = DatabaseManager.get_time_metrics(start_date, end_date)
-    token_usage_metrics = {
-        'total_tokens': 0,
-        'daily_usage': []
-    }  # Placeholder, implement if data available
-
-    # Prepare response data
-    response_data = {
-        'feedback_summary': feedback_summary,
-        'query_analytics': query_analytics,
-        'tag_distribution': tag_distribution,
-        'time_metrics': time_metrics,
-        'token_usage_metrics': token_usage_metrics
-    }
+    # All dashboard sections come from one aggregated query
+    try:
+        response_data = get_analytics_engine().get_dashboard_data(start_date, end_date)
+    except Exception as e:
+        logger.error(f"Error retrieving analytics data: {e}")
+        return jsonify({'error': str(e)}), 500
 
     return jsonify(response_data)
 
+# API endpoint exposing in-process performance counters
+@app.route('/api/metrics', methods=['GET'])
+def api_metrics():
+    """Return connection pool, cache, retrieval and database counters for this worker process."""
+    return jsonify({
+        'pid': os.getpid(),
+        'client_pool': get_pool_stats(),
+        'openai': get_openai_stats(),
+        'rate_limiter': get_rate_limiter().get_stats(),
+        'openai_call_log': get_call_logger().get_stats(),
+        'call_log_index': get_call_log_index().get_stats(),
+        'embedding_cache': get_embedding_cache().get_stats(),
+        'semantic_cache': get_semantic_cache().get_stats(),
+        'speculative_retrieval': get_speculation_stats(),
+        'db_writer': get_db_writer().get_stats(),
+        'db_pool': DatabaseManager.get_pool_stats(),
+        'analytics_rollups': get_rollups().get_stats(),
+        'session_store': get_session_store().get_stats(),
+        'chunk_store': get_chunk_store().get_stats(),
+        'summary_folder': get_summary_folder().get_stats(),
+        'reranker': get_reranker().get_stats(),
+        'near_duplicates': get_near_duplicate_filter().get_stats(),
+        'context_packer': get_context_packer().get_stats(),
+        'context_expansion': get_context_expander().get_stats()
+    })
+
 # HTML template with Tailwind CSS
 MARKED_JS_CDN = "https://cdn.jsdelivr.net/npm/marked/marked.min.js"
 HTML_TEMPLATE = """
@@ -1361,60 +1378,43 @@ def api_query():
     logger.info(f"DEBUG - Request settings: {json.dumps(settings)}")
     
     try:
-        # Get or create the RAG assistant for this session
-        rag_assistant = get_rag_assistant(session_id)
-        
-        # Update settings if provided
-        if settings:
-            for key, value in settings.items():
-                if hasattr(rag_assistant, key):
-                    setattr(rag_assistant, key, value)
+        with get_session_store().lock(session_id):
+            # Get or create the RAG assistant for this session
+            rag_assistant = get_rag_assistant(session_id)
             
-            # If model is updated, update the deployment name
-            if "model" in settings:
-                rag_assistant.deployment_name = settings["model"]
-        
-        logger.info(f"DEBUG - Using model: {rag_assistant.deployment_name}")
-        logger.info(f"DEBUG - Temperature: {rag_assistant.temperature}")
-        logger.info(f"DEBUG - Max tokens: {rag_assistant.max_tokens}")
-        logger.info(f"DEBUG - Top P: {rag_assistant.top_p}")
-        
-        answer, cited_sources, _, evaluation, context = rag_assistant.generate_rag_response(user_query, is_enhanced=is_enhanced)
+            # Update settings if provided
+            if settings:
+                for key, value in settings.items():
+                    if hasattr(rag_assistant, key):
+                        setattr(rag_assistant, key, value)
+                
+                # If model is updated, update the deployment name
+                if "model" in settings:
+                    rag_assistant.deployment_name = settings["model"]
+            
+            logger.info(f"DEBUG - Using model: {rag_assistant.deployment_name}")
+            logger.info(f"DEBUG - Temperature: {rag_assistant.temperature}")
+            logger.info(f"DEBUG - Max tokens: {rag_assistant.max_tokens}")
+            logger.info(f"DEBUG - Top P: {rag_assistant.top_p}")
+            
+            answer, cited_sources, _, evaluation, context = rag_assistant.generate_rag_response(user_query, is_enhanced=is_enhanced)
+            save_rag_assistant(session_id, rag_assistant)
         logger.info(f"API query response generated for: {user_query}")
         logger.info(f"DEBUG - Response length: {len(answer)}")
         logger.info(f"DEBUG - Number of cited sources: {len(cited_sources)}")
         
-        try:
-            from db_manager import DatabaseManager
-            # Inspired by feedback data structure, build a dict for logging
-            log_data = {
-                "question": user_query,
-                "response": answer,
-                "feedback_tags": [],  # No tags at query time
-                "comment": "",
-                "evaluation_json": {},
-                "citations": cited_sources
-            }
-            # Debug log context and response length and snippet
-            logger.debug(f"Context length: {len(context)}; snippet: {context[:100]}")
-            logger.debug(f"Response length: {len(log_data['response'])}; snippet: {log_data['response'][:100]}")
-            # Log using existing log_rag_query method by unpacking relevant fields
-            vote_id = DatabaseManager.log_rag_query(
-                query=log_data["question"],
-                response=log_data["response"],
-                sources=log_data["citations"],
-                context=context,
-                sql_query=None
-            )
-            logger.info(f"RAG query logged with ID: {vote_id}")
-        except Exception as log_exc:
-            logger.error(f"Failed to log RAG query: {log_exc}", exc_info=True)
-        
-        return jsonify({
+        # The assistant queues the rag_queries row itself
+        payload = {
             "answer": answer,
             "sources": cited_sources,
             "evaluation": evaluation
-        })
+        }
+        if rag_assistant.last_response_cached:
+            payload["cached"] = True
+        return jsonify(payload)
+    except SessionBusy as e:
+        logger.warning(f"Rejected query for busy session {session_id}")
+        return jsonify({"error": "Another request for this conversation is still running"}), 409
     except Exception as e:
         logger.error(f"Error in api_query: {str(e)}")
         logger.error(f"Traceback: {traceback.format_exc()}")
@@ -1427,9 +1427,18 @@ def api_clear_history():
     """Clear the conversation history for the current session"""
     try:
         session_id = session.get('session_id')
-        if session_id and session_id in rag_assistants:
-            logger.info(f"Clearing conversation history for session {session_id}")
-            rag_assistants[session_id].clear_conversation_history()
+        cleared = False
+        if session_id:
+            with get_session_store().lock(session_id):
+                state = get_session_store().get(session_id)
+                if state:
+                    logger.info(f"Clearing conversation history for session {session_id}")
+                    rag_assistant = FlaskRAGAssistantWithHistory()
+                    rag_assistant.load_state(state)
+                    rag_assistant.clear_conversation_history()
+                    save_rag_assistant(session_id, rag_assistant)
+                    cleared = True
+        if cleared:
             return jsonify({"success": True})
         else:
             logger.warning(f"No active session found to clear history")
@@ -1459,35 +1468,42 @@ def api_stream_query():
     
     def generate():
         try:
-            # Get or create the RAG assistant for this session
-            rag_assistant = get_rag_assistant(session_id)
-            
-            # Update settings if provided
-            if settings:
-                for key, value in settings.items():
-                    if hasattr(rag_assistant, key):
-                        setattr(rag_assistant, key, value)
+            # The generator runs after the view returns; hold the session until the turn is saved
+            with get_session_store().lock(session_id):
+                # Get or create the RAG assistant for this session
+                rag_assistant = get_rag_assistant(session_id)
                 
-                # If model is updated, update the deployment name
-                if "model" in settings:
-                    rag_assistant.deployment_name = settings["model"]
-            
-            logger.info(f"Starting stream response for: {user_query}")
-            logger.info(f"DEBUG - Using model: {rag_assistant.deployment_name}")
-            logger.info(f"DEBUG - Temperature: {rag_assistant.temperature}")
-            logger.info(f"DEBUG - Max tokens: {rag_assistant.max_tokens}")
-            logger.info(f"DEBUG - Top P: {rag_assistant.top_p}")
-            
-            # Use streaming method
-            for chunk in rag_assistant.stream_rag_response(user_query):
-                logger.info("DEBUG - AI stream chunk: %s", chunk)
-                if isinstance(chunk, str):
-                    yield chunk
-                else:
-                    yield f"\n[[META]]{json.dumps(chunk)}"
-            
+                # Update settings if provided
+                if settings:
+                    for key, value in settings.items():
+                        if hasattr(rag_assistant, key):
+                            setattr(rag_assistant, key, value)
+                    
+                    # If model is updated, update the deployment name
+                    if "model" in settings:
+                        rag_assistant.deployment_name = settings["model"]
+                
+                logger.info(f"Starting stream response for: {user_query}")
+                logger.info(f"DEBUG - Using model: {rag_assistant.deployment_name}")
+                logger.info(f"DEBUG - Temperature: {rag_assistant.temperature}")
+                logger.info(f"DEBUG - Max tokens: {rag_assistant.max_tokens}")
+                logger.info(f"DEBUG - Top P: {rag_assistant.top_p}")
+                
+                # Use streaming method
+                for chunk in rag_assistant.stream_rag_response(user_query):
+                    logger.info("DEBUG - AI stream chunk: %s", chunk)
+                    if isinstance(chunk, str):
+                        yield chunk
+                    else:
+                        yield f"\n[[META]]{json.dumps(chunk)}"
+                
+                save_rag_assistant(session_id, rag_assistant)
             logger.info(f"Completed stream response for: {user_query}")
                 
+        except SessionBusy:
+            logger.warning(f"Rejected stream query for busy session {session_id}")
+            yield "Another request for this conversation is still running. Please try again."
+            yield f"\n[[META]]" + json.dumps({"error": "session busy"})
         except Exception as e:
             logger.error(f"Error in stream_query: {str(e)}")
             logger.error(f"Traceback: {traceback.format_exc()}")
@@ -1783,44 +1799,10 @@ def get_analytics_data(start_date=None, end_date=None):
     Get analytics data from the database.
     Returns a dictionary with all analytics metrics.
     """
-    import logging
     try:
-        logging.info(f"get_analytics_data called with start_date={start_date}, end_date={end_date}")
-        # Get analytics data using DatabaseManager methods
-        feedback_summary = DatabaseManager.get_feedback_summary(start_date, end_date)
-        tag_distribution = DatabaseManager.get_tag_distribution(start_date, end_date)
-        time_metrics = DatabaseManager.get_time_metrics(start_date, end_date)
-        query_analytics = DatabaseManager.get_query_analytics(start_date, end_date)
-        
-        # Calculate response time metrics (placeholder - would need actual data)
-        response_time_metrics = {
-            "avg_response_time": 2.4,
-            "min_response_time": 1.2,
-            "max_response_time": 4.8
-        }
-        
-        # Calculate token usage metrics (placeholder - would need actual data)
-        token_usage_metrics = {
-            "total_tokens": 1200000,
-            "avg_tokens_per_query": 450,
-            "daily_usage": []
-        }
-        
-        # Add daily usage data based on time metrics
-        for metric in time_metrics:
-            token_usage_metrics["daily_usage"].append({
-                "date": metric["date"],
-                "daily_tokens": metric["interaction_count"] * 450  # Estimated tokens per interaction
-            })
-        
-        return {
-            "feedback_summary": feedback_summary,
-            "tag_distribution": tag_distribution,
-            "time_metrics": time_metrics,
-            "query_analytics": query_analytics,
-            "response_time_metrics": response_time_metrics,
-            "token_usage_metrics": token_usage_metrics
-        }
+        logger.info(f"get_analytics_data called with start_date={start_date}, end_date={end_date}")
+        # Single-pass aggregation over votes and rag_queries, with real latency and token usage
+        return get_analytics_engine().get_dashboard_data(start_date, end_date)
         
     except Exception as e:
         logger.error(f"Error getting analytics data: {e}")
@@ -1890,7 +1872,8 @@ def export_as_excel(analytics_data, timestamp):
         overview['B5'] = analytics_data.get("feedback_summary", {}).get("negative_feedback", 0)
         
         overview['A6'] = "Average Response Time"
-        overview['B6'] = f"{analytics_data.get('response_time_metrics', {}).get('avg_response_time', 0):.2f}s"
+        avg_response_time = analytics_data.get('response_time_metrics', {}).get('avg_response_time')
+        overview['B6'] = f"{avg_response_time:.2f}s" if avg_response_time is not None else "N/A"
         
         overview['A7'] = "Total Tokens Used"
         overview['B7'] = analytics_data.get("token_usage_metrics", {}).get("total_tokens", 0)
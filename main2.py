@@ -168,18 +168,19 @@ def llm_helpee(input_text: str) -> str:
             { "role": "user",   "content": input_text }
         ]
     })
-    response = client.chat.completions.create(
-        model=os.getenv("AZURE_OPENAI_MODEL"),
+    # Deadline, retries and usage capture come from OpenAIService; None keeps the API defaults
+    service = OpenAIService(client=client, deployment_name=os.getenv("AZURE_OPENAI_MODEL"))
+    answer = service.get_chat_response(
         messages=[
             { "role": "system", "content": PROMPT_ENHANCER_SYSTEM_MESSAGE },
             { "role": "user",   "content": input_text }
-        ]
+        ],
+        temperature=None, max_tokens=None, top_p=None, presence_penalty=None, frequency_penalty=None
     )
-    answer = response.choices[0].message.content
-    usage = getattr(response, "usage", {})
-    prompt_tokens = usage.prompt_tokens
-    completion_tokens = usage.completion_tokens
-    total_tokens = usage.total_tokens
+    usage = service.last_usage or {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0}
+    prompt_tokens = usage["prompt_tokens"]
+    completion_tokens = usage["completion_tokens"]
+    total_tokens = usage["total_tokens"]
     logger.debug(f"User query: {input_text}")
     logger.debug(f"Enhanced query: {answer}")
     # Log to database
@@ -231,22 +232,19 @@ def llm_helpee_2xl(input_text: str) -> str:
         api_key=os.getenv("AZURE_OPENAI_KEY"),
         api_version=os.getenv("AZURE_OPENAI_API_VERSION", "2024-02-01")
     )
-    response = client.chat.completions.create(
-        model=os.getenv("AZURE_OPENAI_MODEL"),
-        messages= [
+    # Deadline, retries and usage capture come from OpenAIService; None keeps the API defaults
+    service = OpenAIService(client=client, deployment_name=os.getenv("AZURE_OPENAI_MODEL"))
+    answer = service.get_chat_response(
+        messages=[
             { "role": "system", "content": PROMPT_ENHANCER_SYSTEM_MESSAGE_2XL },
             { "role": "user",   "content": input_text }
-        ]
+        ],
+        temperature=None, max_tokens=None, top_p=None, presence_penalty=None, frequency_penalty=None
     )
-    answer = response.choices[0].message.content
-    usage = getattr(response, "usage", {})
-    latency = getattr(response, "latency", {})
-    logger.debug(f"Latency: {latency}")
-
-    usage = getattr(response, "usage", {})
-    prompt_tokens = usage.prompt_tokens
-    completion_tokens = usage.completion_tokens
-    total_tokens = usage.total_tokens
+    usage = service.last_usage or {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0}
+    prompt_tokens = usage["prompt_tokens"]
+    completion_tokens = usage["completion_tokens"]
+    total_tokens = usage["total_tokens"]
     
     # Log to database
     log_id = DatabaseManager.log_helpee_activity(
@@ -0,0 +1,14 @@
+-- Migration: record model, latency and token usage per RAG query for the analytics dashboard
+BEGIN;
+
+ALTER TABLE rag_queries
+  ADD COLUMN IF NOT EXISTS model TEXT,
+  ADD COLUMN IF NOT EXISTS latency_ms INTEGER,
+  ADD COLUMN IF NOT EXISTS prompt_tokens INTEGER,
+  ADD COLUMN IF NOT EXISTS completion_tokens INTEGER,
+  ADD COLUMN IF NOT EXISTS total_tokens INTEGER;
+
+CREATE INDEX IF NOT EXISTS idx_rag_queries_timestamp ON rag_queries (timestamp);
+CREATE INDEX IF NOT EXISTS idx_votes_timestamp ON votes (timestamp);
+
+COMMIT;
@@ -0,0 +1,53 @@
+-- Migration: hourly/daily rollups for feedback, helpee cost and RAG usage analytics.
+-- The tables are filled incrementally by analytics_rollups.AnalyticsRollups.refresh(),
+-- which folds rows past the per-source watermark in analytics_rollup_state.
+BEGIN;
+
+CREATE TABLE IF NOT EXISTS analytics_rollup_state (
+    source TEXT PRIMARY KEY,
+    last_id BIGINT NOT NULL DEFAULT 0,
+    refreshed_at TIMESTAMPTZ
+);
+CREATE TABLE IF NOT EXISTS feedback_rollup_hourly (
+    bucket TIMESTAMPTZ PRIMARY KEY,
+    vote_count INTEGER NOT NULL DEFAULT 0,
+    positive_count INTEGER NOT NULL DEFAULT 0,
+    query_length_sum BIGINT NOT NULL DEFAULT 0,
+    positive_query_length_sum BIGINT NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS feedback_tag_rollup_hourly (
+    bucket TIMESTAMPTZ NOT NULL,
+    tag TEXT NOT NULL,
+    count INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (bucket, tag)
+);
+CREATE TABLE IF NOT EXISTS feedback_word_rollup_daily (
+    day DATE NOT NULL,
+    word TEXT NOT NULL,
+    count INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (day, word)
+);
+CREATE TABLE IF NOT EXISTS helpee_cost_rollup_hourly (
+    bucket TIMESTAMPTZ NOT NULL,
+    model TEXT NOT NULL,
+    calls INTEGER NOT NULL DEFAULT 0,
+    prompt_tokens BIGINT NOT NULL DEFAULT 0,
+    completion_tokens BIGINT NOT NULL DEFAULT 0,
+    total_tokens BIGINT NOT NULL DEFAULT 0,
+    prompt_cost NUMERIC NOT NULL DEFAULT 0,
+    completion_cost NUMERIC NOT NULL DEFAULT 0,
+    total_cost NUMERIC NOT NULL DEFAULT 0,
+    PRIMARY KEY (bucket, model)
+);
+CREATE TABLE IF NOT EXISTS rag_query_rollup_hourly (
+    bucket TIMESTAMPTZ PRIMARY KEY,
+    interactions INTEGER NOT NULL DEFAULT 0,
+    latency_count INTEGER NOT NULL DEFAULT 0,
+    latency_ms_sum BIGINT NOT NULL DEFAULT 0,
+    latency_ms_min INTEGER,
+    latency_ms_max INTEGER,
+    token_count INTEGER NOT NULL DEFAULT 0,
+    total_tokens BIGINT NOT NULL DEFAULT 0
+);
+
+COMMIT;
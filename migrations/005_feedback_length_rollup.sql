@@ -0,0 +1,25 @@
+-- Migration: per-query counts and the query-length histogram for the feedback rollups.
+-- Matches analytics_rollups.ROLLUP_SCHEMA_SQL. Rollups built before this migration lack
+-- the new counts, so (as AnalyticsRollups.ensure_schema does) they are emptied and the
+-- votes watermark is reset; the next refresh refolds them from the votes table.
+BEGIN;
+
+ALTER TABLE feedback_rollup_hourly
+    ADD COLUMN IF NOT EXISTS query_count INTEGER NOT NULL DEFAULT 0,
+    ADD COLUMN IF NOT EXISTS positive_query_count INTEGER NOT NULL DEFAULT 0;
+
+DO $$
+BEGIN
+    IF to_regclass('feedback_length_rollup_daily') IS NULL THEN
+        CREATE TABLE feedback_length_rollup_daily (
+            day DATE NOT NULL,
+            length INTEGER NOT NULL,
+            count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (day, length)
+        );
+        TRUNCATE feedback_rollup_hourly, feedback_tag_rollup_hourly, feedback_word_rollup_daily;
+        UPDATE analytics_rollup_state SET last_id = 0, refreshed_at = NULL WHERE source = 'votes';
+    END IF;
+END $$;
+
+COMMIT;
@@ -0,0 +1,156 @@
+"""
+Near-duplicate suppression for search results, using MinHash signatures of word shingles
+"""
+import hashlib
+import logging
+import re
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+
+from config import DEDUP_ENABLED, DEDUP_THRESHOLD, DEDUP_NUM_PERM, DEDUP_SHINGLE_SIZE, DEDUP_CACHE_SIZE
+
+logger = logging.getLogger(__name__)
+
+_WORD_RE = re.compile(r"\w+")
+_MERSENNE_PRIME = np.uint64((1 << 31) - 1)
+
+
+def shingles(text: str, size: int) -> List[str]:
+    """Return the overlapping word n-grams of text (the whole text when it is shorter than one shingle)."""
+    words = _WORD_RE.findall(text.lower())
+    if len(words) <= size:
+        return [" ".join(words)] if words else []
+    return [" ".join(words[i:i + size]) for i in range(len(words) - size + 1)]
+
+
+class NearDuplicateFilter:
+    """
+    Collapses near-identical chunks in a ranked result list.
+
+    This class is responsible for:
+    - Computing a MinHash signature per chunk (cached by content hash, LRU)
+    - Keeping the best-ranked chunk of each group whose estimated Jaccard
+      similarity reaches the threshold, so duplicates do not take context slots
+    - Tracking how many chunks were suppressed
+    """
+
+    def __init__(self, threshold: float = DEDUP_THRESHOLD, num_perm: int = DEDUP_NUM_PERM,
+                 shingle_size: int = DEDUP_SHINGLE_SIZE, max_entries: int = DEDUP_CACHE_SIZE,
+                 enabled: bool = DEDUP_ENABLED):
+        """
+        Initialize the filter.
+
+        Args:
+            threshold: Estimated Jaccard similarity at which a chunk is a duplicate
+            num_perm: MinHash permutations (signature length)
+            shingle_size: Words per shingle
+            max_entries: Signatures kept in the cache (0 disables caching)
+            enabled: False makes filter() return its input unchanged
+        """
+        self.threshold = threshold
+        self.num_perm = num_perm
+        self.shingle_size = shingle_size
+        self.max_entries = max_entries
+        self.enabled = enabled
+        # Fixed seed: signatures must be comparable across calls and processes
+        rng = np.random.RandomState(1)
+        self._a = rng.randint(1, int(_MERSENNE_PRIME), size=num_perm).astype(np.uint64)
+        self._b = rng.randint(0, int(_MERSENNE_PRIME), size=num_perm).astype(np.uint64)
+        self._lock = threading.Lock()
+        self._signatures: "OrderedDict[bytes, np.ndarray]" = OrderedDict()
+        self._stats = {"calls": 0, "suppressed": 0, "hits": 0, "misses": 0}
+
+    # ───────────── signatures ─────────────
+    def _compute(self, text: str) -> np.ndarray:
+        grams = shingles(text, self.shingle_size)
+        if not grams:
+            return np.full(self.num_perm, _MERSENNE_PRIME, dtype=np.uint64)
+        hashes = np.array(
+            [int.from_bytes(hashlib.blake2b(g.encode("utf-8"), digest_size=4).digest(), "little") for g in grams],
+            dtype=np.uint64,
+        )
+        # (a * x + b) mod p stays below 2**63 for 31-bit a, b and 32-bit x
+        return ((hashes[:, None] * self._a + self._b) % _MERSENNE_PRIME).min(axis=0)
+
+    def signature(self, text: str) -> np.ndarray:
+        """Return the MinHash signature of a chunk, from the cache when possible."""
+        if self.max_entries <= 0:
+            return self._compute(text)
+        key = hashlib.blake2b(text.encode("utf-8"), digest_size=16).digest()
+        with self._lock:
+            cached = self._signatures.get(key)
+            if cached is not None:
+                self._signatures.move_to_end(key)
+                self._stats["hits"] += 1
+                return cached
+            self._stats["misses"] += 1
+
+        signature = self._compute(text)
+        signature.setflags(write=False)
+        with self._lock:
+            self._signatures[key] = signature
+            while len(self._signatures) > self.max_entries:
+                self._signatures.popitem(last=False)
+        return signature
+
+    @staticmethod
+    def similarity(a: np.ndarray, b: np.ndarray) -> float:
+        """Estimated Jaccard similarity of two signatures."""
+        return float(np.mean(a == b))
+
+    # ───────────── filtering ─────────────
+    def filter(self, results: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """
+        Drop results that nearly duplicate a better-ranked one.
+
+        Args:
+            results: Search results, best first
+
+        Returns:
+            The results without near-duplicates, order preserved
+        """
+        if not self.enabled or len(results) < 2:
+            return results
+
+        kept, kept_signatures = [], []
+        for result in results:
+            signature = self.signature(result.get("chunk", "").strip())
+            if kept_signatures and max(self.similarity(signature, s) for s in kept_signatures) >= self.threshold:
+                logger.debug(f"Suppressed near-duplicate chunk from '{result.get('title', '')}'")
+                continue
+            kept.append(result)
+            kept_signatures.append(signature)
+
+        suppressed = len(results) - len(kept)
+        with self._lock:
+            self._stats["calls"] += 1
+            self._stats["suppressed"] += suppressed
+        if suppressed:
+            logger.info(f"Suppressed {suppressed} near-duplicate chunks of {len(results)}")
+        return kept
+
+    def clear(self) -> None:
+        """Drop every cached signature."""
+        with self._lock:
+            self._signatures.clear()
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Return suppression and cache counters."""
+        with self._lock:
+            return dict(self._stats, entries=len(self._signatures))
+
+
+_filter: Optional[NearDuplicateFilter] = None
+_filter_lock = threading.Lock()
+
+
+def get_near_duplicate_filter() -> NearDuplicateFilter:
+    """Return the process-wide near-duplicate filter."""
+    global _filter
+    with _filter_lock:
+        if _filter is None:
+            _filter = NearDuplicateFilter()
+        return _filter
@@ -1,22 +1,391 @@
+"""
+Background writer for the OpenAI call log (newline-delimited JSON in logs/openai_calls.jsonl)
+"""
+import atexit
+import gzip
 import json
-import time
+import logging
 import os
-from threading import Lock
+import queue
+import random
+import shutil
+import threading
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - non-POSIX platforms
+    fcntl = None
+
+from config import (
+    OPENAI_LOG_PATH,
+    OPENAI_LOG_ASYNC,
+    OPENAI_LOG_SAMPLE_RATE,
+    OPENAI_LOG_BATCH_SIZE,
+    OPENAI_LOG_FLUSH_INTERVAL,
+    OPENAI_LOG_MAX_QUEUE,
+    OPENAI_LOG_MAX_BYTES,
+    OPENAI_LOG_ROTATE_SECONDS,
+    OPENAI_LOG_BACKUP_COUNT,
+    OPENAI_LOG_COMPRESS,
+    OPENAI_LOG_MESSAGES,
+    OPENAI_LOG_MAX_CHARS,
+)
+
+logger = logging.getLogger(__name__)
+
+_STOP = object()
+
+# Keys whose values never reach the log
+SENSITIVE_KEYS = {"api_key", "api-key", "authorization", "password", "secret"}
 
-_log_lock = Lock()
+# Numeric lists longer than this (embedding vectors) are logged as their length only
+MAX_NUMERIC_LIST = 32
 
-def log_openai_call(request: dict, response) -> None:
+Item = Tuple[float, Dict[str, Any], Any, Optional[float]]
+
+
+# ───────────── redaction ─────────────
+def trim_text(text: str, max_chars: int) -> str:
+    """Cut text to max_chars, noting how much was dropped (0 = no limit)."""
+    if not max_chars or len(text) <= max_chars:
+        return text
+    return f"{text[:max_chars]}... [{len(text) - max_chars} more chars]"
+
+
+def compact_value(value: Any, max_chars: int) -> Any:
+    """Trim long strings, collapse embedding vectors and redact secrets anywhere in a JSON-like value."""
+    if isinstance(value, str):
+        return trim_text(value, max_chars)
+    if isinstance(value, dict):
+        return {
+            key: "[redacted]" if str(key).lower() in SENSITIVE_KEYS else compact_value(item, max_chars)
+            for key, item in value.items()
+        }
+    if isinstance(value, (list, tuple)):
+        if len(value) > MAX_NUMERIC_LIST and all(isinstance(x, (int, float)) for x in value[:MAX_NUMERIC_LIST]):
+            return f"[{len(value)} numbers]"
+        return [compact_value(item, max_chars) for item in value]
+    return value
+
+
+def compact_messages(messages: List[Dict[str, Any]], mode: str, max_chars: int) -> Any:
     """
-    Append each OpenAI request and response as a JSON object
-    (one per line) into logs/openai_calls.jsonl.
-    """
-    os.makedirs('logs', exist_ok=True)
-    record = {
-        "timestamp": time.time(),
-        "request": request,
-        # response may be an OpenAI response object with to_dict()
-        "response": response.to_dict() if hasattr(response, "to_dict") else dict(response)
+    Reduce a chat message array for the log.
+
+    Args:
+        messages: The request's messages
+        mode: "full" keeps them verbatim, "trim" cuts each content to max_chars,
+            "summary" keeps only counts and the last message
+        max_chars: Character limit for trimmed content
+    """
+    if mode == "full":
+        return messages
+    if mode == "summary":
+        chars = sum(len(m.get("content") or "") for m in messages)
+        last = messages[-1] if messages else None
+        return {
+            "count": len(messages),
+            "chars": chars,
+            "last": compact_value(last, max_chars),
+        }
+    return [compact_value(m, max_chars) for m in messages]
+
+
+def build_record(timestamp: float, request: Dict[str, Any], response: Any,
+                 messages_mode: str = OPENAI_LOG_MESSAGES, max_chars: int = OPENAI_LOG_MAX_CHARS,
+                 latency_ms: Optional[float] = None) -> Dict[str, Any]:
+    """
+    Build the logged record for one call.
+
+    The model, token usage and latency are lifted to the top level so readers
+    need not parse the (possibly trimmed) response.
+    """
+    # response may be an OpenAI response object with to_dict()
+    body = response.to_dict() if hasattr(response, "to_dict") else dict(response)
+    messages = request.get("messages")
+    logged = compact_value({key: value for key, value in request.items() if key != "messages"}, max_chars)
+    if isinstance(messages, list):
+        logged["messages"] = compact_messages(messages, messages_mode, max_chars)
+    usage = body.get("usage")
+    return {
+        "timestamp": timestamp,
+        "model": request.get("model"),
+        "usage": usage if isinstance(usage, dict) else None,
+        "latency_ms": round(latency_ms, 1) if latency_ms is not None else None,
+        "request": logged,
+        "response": compact_value(body, max_chars),
     }
-    path = os.path.join('logs', 'openai_calls.jsonl')
-    with _log_lock, open(path, 'a') as f:
-        f.write(json.dumps(record) + "\\n")
+
+
+class OpenAICallLogger:
+    """
+    Queue-backed writer for the OpenAI call log.
+
+    This class is responsible for:
+    - Accepting call records without serializing or touching the file on the caller's thread
+    - Sampling, trimming and redacting records before they are written
+    - Appending them in batches, one JSON object per line, from one background thread
+    - Rotating the file by size or at time-interval boundaries, gzip-compressing
+      and pruning rotated files (an exclusive file lock keeps workers that share
+      the file from rotating it twice)
+    - Draining the queue when the process exits
+    """
+
+    def __init__(self, path=OPENAI_LOG_PATH, enabled=OPENAI_LOG_ASYNC, sample_rate=OPENAI_LOG_SAMPLE_RATE,
+                 batch_size=OPENAI_LOG_BATCH_SIZE, flush_interval=OPENAI_LOG_FLUSH_INTERVAL,
+                 max_queue=OPENAI_LOG_MAX_QUEUE, max_bytes=OPENAI_LOG_MAX_BYTES,
+                 rotate_seconds=OPENAI_LOG_ROTATE_SECONDS, backup_count=OPENAI_LOG_BACKUP_COUNT,
+                 compress=OPENAI_LOG_COMPRESS, messages_mode=OPENAI_LOG_MESSAGES, max_chars=OPENAI_LOG_MAX_CHARS):
+        """
+        Initialize the logger (the background thread starts on first use).
+
+        Args:
+            path: The JSONL file to append to
+            enabled: When False every record is written synchronously on the caller's thread
+            sample_rate: Fraction of calls logged (0 disables the log)
+            batch_size: Number of records that triggers an immediate write
+            flush_interval: Maximum seconds a record waits before being written
+            max_queue: Records held in memory; further records are dropped
+            max_bytes: Rotate before the file would grow past this size (0 = never)
+            rotate_seconds: Rotate when an interval boundary (UTC) has passed since the last write (0 = never)
+            backup_count: Rotated files kept (0 = all)
+            compress: gzip rotated files
+            messages_mode: How request messages are logged (see compact_messages)
+            max_chars: Longer strings in the record are trimmed (0 = no limit)
+        """
+        self.path = path
+        self.enabled = enabled
+        self.sample_rate = sample_rate
+        self.batch_size = max(1, batch_size)
+        self.flush_interval = flush_interval
+        self.max_bytes = max_bytes
+        self.rotate_seconds = rotate_seconds
+        self.backup_count = backup_count
+        self.compress = compress
+        self.messages_mode = messages_mode
+        self.max_chars = max_chars
+
+        self._queue: "queue.Queue" = queue.Queue(maxsize=max_queue)
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+        self._stats = {
+            "queued": 0,
+            "sampled_out": 0,
+            "dropped": 0,
+            "written": 0,
+            "batches": 0,
+            "bytes_written": 0,
+            "rotations": 0,
+            "errors": 0,
+        }
+
+    # ───────────── public API ─────────────
+    def log(self, request: Dict[str, Any], response: Any, latency_ms: Optional[float] = None) -> None:
+        """Queue one OpenAI request and its response (and how long it took, when known) for the log."""
+        if self.sample_rate <= 0 or (self.sample_rate < 1 and random.random() >= self.sample_rate):
+            self._count("sampled_out")
+            return
+        # Shallow copy: the caller may reuse its request dict for the next call
+        item = (time.time(), dict(request), response, latency_ms)
+        self._count("queued")
+        if not self.enabled:
+            self._write_items([item])
+            return
+        self._ensure_thread()
+        try:
+            self._queue.put_nowait(item)
+        except queue.Full:
+            self._count("dropped")
+
+    def flush(self, timeout: float = 10.0) -> None:
+        """Block until every record queued so far has been written."""
+        if self._thread is None or not self._thread.is_alive():
+            return
+        done = threading.Event()
+        self._queue.put(("flush", done))
+        done.wait(timeout)
+
+    def close(self, timeout: float = 10.0) -> None:
+        """Stop the background thread after draining the queue."""
+        thread = self._thread
+        if thread is None or not thread.is_alive() or self._pid != os.getpid():
+            return
+        self._queue.put(_STOP)
+        thread.join(timeout)
+        if thread.is_alive():
+            logger.warning("OpenAI call log did not drain within %.1fs", timeout)
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Return queue depth and write/rotation counters."""
+        with self._lock:
+            stats = dict(self._stats)
+        stats["pending"] = self._queue.qsize()
+        stats["sample_rate"] = self.sample_rate
+        return stats
+
+    # ───────────── queueing ─────────────
+    def _count(self, key: str, n: int = 1) -> None:
+        with self._lock:
+            self._stats[key] += n
+
+    def _ensure_thread(self) -> None:
+        # Restart after a fork (gunicorn preload) since threads do not survive it
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive() and self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name="openai-call-log", daemon=True)
+            self._thread.start()
+
+    def _run(self) -> None:
+        batch: List[Item] = []
+        deadline = time.monotonic() + self.flush_interval
+        while True:
+            try:
+                item = self._queue.get(timeout=max(0.0, deadline - time.monotonic()))
+            except queue.Empty:
+                item = None
+
+            if item is _STOP:
+                self._write_items(batch)
+                return
+            if isinstance(item, tuple) and item[0] == "flush":
+                self._write_items(batch)
+                batch = []
+                deadline = time.monotonic() + self.flush_interval
+                item[1].set()
+                continue
+            if item is not None:
+                batch.append(item)
+
+            if len(batch) >= self.batch_size or time.monotonic() >= deadline:
+                self._write_items(batch)
+                batch = []
+                deadline = time.monotonic() + self.flush_interval
+
+    # ───────────── writing ─────────────
+    def _encode(self, item: Item) -> Optional[str]:
+        timestamp, request, response, latency_ms = item
+        try:
+            record = build_record(timestamp, request, response, self.messages_mode, self.max_chars, latency_ms)
+            return json.dumps(record, default=str) + "\n"
+        except Exception as e:
+            logger.warning(f"Could not serialize OpenAI call for the log: {e}")
+            self._count("errors")
+            return None
+
+    def _write_items(self, items: List[Item]) -> None:
+        lines = [line for line in map(self._encode, items) if line is not None]
+        if not lines:
+            return
+        data = "".join(lines).encode("utf-8")
+        rotated = None
+        try:
+            with self._write_lock:
+                fd = self._open_locked()
+                try:
+                    if self._should_rotate(fd, len(data)):
+                        rotated = self._rotate()
+                        self._unlock_close(fd)
+                        fd = self._open_locked()
+                    os.write(fd, data)
+                finally:
+                    self._unlock_close(fd)
+        except OSError as e:
+            logger.error(f"Could not write {len(lines)} records to {self.path}: {e}")
+            self._count("errors")
+            return
+        with self._lock:
+            self._stats["written"] += len(lines)
+            self._stats["batches"] += 1
+            self._stats["bytes_written"] += len(data)
+        if rotated:
+            self._finish_rotation(rotated)
+
+    def _open_locked(self) -> int:
+        """Open the log for appending under an exclusive lock, retrying if another process rotated it meanwhile."""
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        while True:
+            fd = os.open(self.path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+            if fcntl is None:
+                return fd
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            try:
+                if os.stat(self.path).st_ino == os.fstat(fd).st_ino:
+                    return fd
+            except FileNotFoundError:
+                pass
+            self._unlock_close(fd)
+
+    @staticmethod
+    def _unlock_close(fd: int) -> None:
+        if fcntl is not None:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+        os.close(fd)
+
+    def _should_rotate(self, fd: int, incoming: int) -> bool:
+        st = os.fstat(fd)
+        if not st.st_size:
+            return False
+        if self.max_bytes and st.st_size + incoming > self.max_bytes:
+            return True
+        return bool(self.rotate_seconds) and int(st.st_mtime // self.rotate_seconds) != int(time.time() // self.rotate_seconds)
+
+    def _rotate(self) -> str:
+        """Rename the current file to a timestamped backup (under the file lock); return the new name."""
+        base = f"{self.path}.{time.strftime('%Y%m%d-%H%M%S', time.gmtime())}"
+        target, n = base, 0
+        while os.path.exists(target) or os.path.exists(target + ".gz"):
+            n += 1
+            target = f"{base}-{n}"
+        os.rename(self.path, target)
+        self._count("rotations")
+        logger.info(f"Rotated OpenAI call log to {target}")
+        return target
+
+    def _finish_rotation(self, rotated: str) -> None:
+        """Compress the rotated file and prune old ones; runs outside the file lock."""
+        try:
+            if self.compress:
+                with open(rotated, "rb") as src, gzip.open(rotated + ".gz", "wb", compresslevel=6) as dst:
+                    shutil.copyfileobj(src, dst)
+                os.remove(rotated)
+            if self.backup_count:
+                for old in self.rotated_files()[:-self.backup_count]:
+                    os.remove(old)
+        except OSError as e:
+            logger.error(f"Could not compress or prune rotated OpenAI call logs: {e}")
+            self._count("errors")
+
+    def rotated_files(self) -> List[str]:
+        """Return the rotated log files, oldest first."""
+        directory = os.path.dirname(self.path) or "."
+        prefix = os.path.basename(self.path) + "."
+        try:
+            names = sorted(name for name in os.listdir(directory) if name.startswith(prefix))
+        except FileNotFoundError:
+            return []
+        return [os.path.join(directory, name) for name in names]
+
+
+_call_logger = OpenAICallLogger()
+atexit.register(_call_logger.close)
+
+
+def get_call_logger() -> OpenAICallLogger:
+    """Return the process-wide OpenAI call logger."""
+    return _call_logger
+
+
+def log_openai_call(request: dict, response, latency_ms: Optional[float] = None) -> None:
+    """
+    Append each OpenAI request and response as a JSON object
+    (one per line) into logs/openai_calls.jsonl, off the caller's thread.
+    """
+    _call_logger.log(request, response, latency_ms)
@@ -1,51 +1,379 @@
 """
 OpenAIService class for handling interactions with the Azure OpenAI API
 """
+import asyncio
+import email.utils
 import logging
-from openai import AzureOpenAI
+import random
+import threading
+import time
+import weakref
+from typing import Any, AsyncGenerator, Callable, Dict, Generator, List, Optional
+
+import httpx
+import openai
+from openai import AzureOpenAI, OpenAI, AsyncOpenAI
 from openai_logger import log_openai_call
+from client_registry import get_http_client
+from config import (
+    OPENAI_TIMEOUT,
+    OPENAI_STREAM_IDLE_TIMEOUT,
+    OPENAI_MAX_RETRIES,
+    OPENAI_BACKOFF_BASE,
+    OPENAI_BACKOFF_MAX,
+    OPENAI_STREAM_USAGE,
+)
+from token_counter import count_message_tokens, count_tokens, REPLY_OVERHEAD
+from rate_limiter import get_rate_limiter, INTERACTIVE, QueueTimeout
 
 logger = logging.getLogger(__name__)
 
+# Status codes worth retrying: timeouts, conflicts, rate limits and server errors
+RETRYABLE_STATUS = {408, 409, 429}
+
+# Completion tokens assumed for the rate limiter when a request sets no max_tokens
+DEFAULT_COMPLETION_ESTIMATE = 1000
+
+# Azure OpenAI accepts stream_options (usage on the last chunk) from this API version on
+STREAM_USAGE_MIN_API_VERSION = "2024-09-01"
+
+_stats_lock = threading.Lock()
+_stats = {"calls": 0, "streams": 0, "retries": 0, "errors": 0, "deadline_exceeded": 0, "stream_idle_timeouts": 0,
+          "estimated_usage": 0}
+
+# Copies of SDK clients with the SDK's own retries disabled (ours replace them)
+_no_retry_clients = weakref.WeakKeyDictionary()
+_no_retry_lock = threading.Lock()
+
+
+class DeadlineExceeded(TimeoutError):
+    """Raised when an OpenAI call (including its retries) runs past its deadline."""
+
+
+class StreamIdleTimeout(TimeoutError):
+    """Raised when a stream that already produced text goes quiet for longer than the idle timeout."""
+
+
+def usage_to_dict(usage):
+    """Convert an OpenAI usage object to a plain dict of token counts (None if absent)."""
+    if usage is None:
+        return None
+    return {
+        "prompt_tokens": getattr(usage, "prompt_tokens", None),
+        "completion_tokens": getattr(usage, "completion_tokens", None),
+        "total_tokens": getattr(usage, "total_tokens", None),
+    }
+
+
+def _count(key: str, n: int = 1) -> None:
+    with _stats_lock:
+        _stats[key] += n
+
+
+def get_stats() -> Dict[str, int]:
+    """Return process-wide call, retry and error counters."""
+    with _stats_lock:
+        return dict(_stats)
+
+
+# ───────────── retry policy ─────────────
+def is_retryable(error: Exception) -> bool:
+    """Whether a failed call may succeed if repeated (rate limits, 5xx, timeouts, dropped connections)."""
+    if isinstance(error, openai.APIConnectionError):  # includes APITimeoutError
+        return True
+    if isinstance(error, openai.APIStatusError):
+        return error.status_code in RETRYABLE_STATUS or error.status_code >= 500
+    return False
+
+
+def retry_after_seconds(error: Exception) -> Optional[float]:
+    """Read the server's requested wait from retry-after-ms / Retry-After, if it sent one."""
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None)
+    if not headers:
+        return None
+    try:
+        if headers.get("retry-after-ms"):
+            return float(headers["retry-after-ms"]) / 1000
+        value = headers.get("retry-after")
+        if not value:
+            return None
+        try:
+            return float(value)
+        except ValueError:
+            # HTTP-date form
+            return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def backoff_delay(attempt: int, retry_after: Optional[float] = None,
+                  base: float = OPENAI_BACKOFF_BASE, cap: float = OPENAI_BACKOFF_MAX) -> float:
+    """
+    Seconds to wait before retry number attempt + 1.
+
+    Uses full-jitter exponential backoff so concurrent workers do not retry in
+    lockstep; a Retry-After from the server is treated as a floor.
+    """
+    delay = random.uniform(0, min(cap, base * 2 ** attempt))
+    if retry_after is not None:
+        delay = max(delay, retry_after + random.uniform(0, base))
+    return delay
+
+
+def _without_sdk_retries(client):
+    """Return a copy of an SDK client with its built-in retries off, so they do not multiply with ours."""
+    if not isinstance(client, (OpenAI, AsyncOpenAI)) or not client.max_retries:
+        return client
+    with _no_retry_lock:
+        copy = _no_retry_clients.get(client)
+        if copy is None:
+            copy = _no_retry_clients[client] = client.with_options(max_retries=0)
+        return copy
+
+
 class OpenAIService:
     """
     Handles interactions with the Azure OpenAI API.
-    
+
     This class is responsible for:
     - Initializing the Azure OpenAI client
-    - Sending requests to the API
-    - Processing responses
+    - Sending blocking and streaming chat requests, sync and async
+    - Bounding every call by a deadline and retrying transient failures with
+      jittered exponential backoff that honours Retry-After (streams: the deadline
+      covers admission, connecting and the first chunk; later gaps are bounded by an idle timeout)
+    - Queueing calls by priority behind the deployment's RPM / TPM buckets (rate_limiter)
+    - Capturing token usage (from the final stream chunk when streaming)
     - Error handling and logging
     """
-    
-    def __init__(self, azure_endpoint=None, api_key=None, api_version="2024-02-01", deployment_name=None):
+
+    def __init__(self, azure_endpoint=None, api_key=None, api_version="2024-02-01", deployment_name=None, client=None,
+                 async_client=None, timeout=OPENAI_TIMEOUT, max_retries=OPENAI_MAX_RETRIES,
+                 stream_idle_timeout=OPENAI_STREAM_IDLE_TIMEOUT):
         """
         Initialize the OpenAI service.
-        
+
         Args:
             azure_endpoint: The Azure OpenAI endpoint URL
             api_key: The API key for authentication
             api_version: The API version to use
             deployment_name: The deployment name to use for chat completions
+            client: Optional pre-built AzureOpenAI client (e.g. from client_registry)
+            async_client: Optional AsyncAzureOpenAI client used by the async methods
+            timeout: Default per-call deadline in seconds, retries included
+            max_retries: Retries after the first attempt for transient failures
+            stream_idle_timeout: Longest wait for the next chunk once a stream has started (0 = no limit)
         """
         self.azure_endpoint = azure_endpoint
         self.api_key = api_key
         self.api_version = api_version
         self.deployment_name = deployment_name
-        
-        # Initialize the OpenAI client
-        self.client = AzureOpenAI(
-            azure_endpoint=azure_endpoint,
-            api_key=api_key,
-            api_version=api_version
-        )
-        
+        self.async_client = async_client
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.stream_idle_timeout = stream_idle_timeout
+
+        # Token usage of the most recent chat completion (None until a call succeeds)
+        self.last_usage = None
+
+        # Initialize the OpenAI client, reusing the process-wide connection pool
+        if client is not None:
+            self.client = client
+        else:
+            self.client = AzureOpenAI(
+                azure_endpoint=azure_endpoint,
+                api_key=api_key,
+                api_version=api_version,
+                http_client=get_http_client()
+            )
+
         logger.debug(f"OpenAIService initialized with endpoint: {azure_endpoint}, api_version: {api_version}, deployment: {deployment_name}")
-    
-    def get_chat_response(self, messages, temperature=0.3, max_tokens=1000, top_p=1.0, presence_penalty=0.0, frequency_penalty=0.0):
+
+    # ───────────── request building ─────────────
+    def _stream_usage_supported(self) -> bool:
+        if OPENAI_STREAM_USAGE != "auto":
+            return OPENAI_STREAM_USAGE in ("1", "true", "yes")
+        return not self.api_version or self.api_version[:10] >= STREAM_USAGE_MIN_API_VERSION
+
+    def _build_request(self, messages, stream=False, **params) -> Dict[str, Any]:
+        """Chat request for this deployment; parameters passed as None are left to the API default."""
+        request = {'model': self.deployment_name, 'messages': messages}
+        request.update({key: value for key, value in params.items() if value is not None})
+        if stream:
+            request['stream'] = True
+            if self._stream_usage_supported():
+                request['stream_options'] = {'include_usage': True}
+        return request
+
+    @staticmethod
+    def _log_call(request, response, started: Optional[float] = None) -> None:
+        # The call log must never fail the call itself
+        try:
+            latency_ms = (time.monotonic() - started) * 1000 if started is not None else None
+            log_openai_call(request, response, latency_ms)
+        except Exception as e:
+            logger.warning(f"Could not log OpenAI call: {e}")
+
+    def _expires(self, deadline: Optional[float]) -> float:
+        return time.monotonic() + (self.timeout if deadline is None else deadline)
+
+    def _next_delay(self, error: Exception, attempt: int, expires: float, scheduler=None) -> Optional[float]:
+        """Seconds to sleep before retrying, or None when the error should be raised."""
+        retry_after = retry_after_seconds(error)
+        if scheduler is not None and getattr(error, "status_code", None) == 429:
+            # Hold back everything queued for this deployment, not just this call
+            scheduler.throttled(retry_after if retry_after is not None else backoff_delay(attempt))
+        if attempt >= self.max_retries or not is_retryable(error):
+            return None
+        delay = backoff_delay(attempt, retry_after)
+        if time.monotonic() + delay >= expires:
+            logger.warning(f"Not retrying OpenAI call: a {delay:.1f}s wait would pass the deadline")
+            return None
+        logger.warning(f"OpenAI call failed ({error.__class__.__name__}), retry {attempt + 1}/{self.max_retries} in {delay:.2f}s")
+        _count("retries")
+        return delay
+
+    def _remaining(self, expires: float) -> float:
+        remaining = expires - time.monotonic()
+        if remaining <= 0:
+            _count("deadline_exceeded")
+            raise DeadlineExceeded("OpenAI call exceeded its deadline")
+        return remaining
+
+    def _stream_timeout(self, expires: float):
+        """HTTP timeout for opening a stream: the deadline for connecting, the idle timeout per read."""
+        remaining = self._remaining(expires)
+        if not self.stream_idle_timeout:
+            return httpx.Timeout(remaining, read=None)
+        return httpx.Timeout(remaining, read=self.stream_idle_timeout)
+
+    def _stream_idle_error(self, error: Exception) -> StreamIdleTimeout:
+        _count("stream_idle_timeouts")
+        return StreamIdleTimeout(f"OpenAI stream sent nothing for {self.stream_idle_timeout}s: {error}")
+
+    def _estimate_tokens(self, request: Dict[str, Any]) -> int:
+        """Tokens Azure counts against TPM for this request: the prompt plus max_tokens."""
+        prompt = REPLY_OVERHEAD + sum(
+            count_message_tokens(m["role"], m["content"] or "", self.deployment_name) for m in request["messages"]
+        )
+        return prompt + (request.get("max_tokens") or DEFAULT_COMPLETION_ESTIMATE)
+
+    def _admission(self, request: Dict[str, Any]):
+        """Return the deployment's scheduler and the request's token estimate (0 when unlimited)."""
+        scheduler = get_rate_limiter().scheduler(self.deployment_name)
+        return scheduler, (0 if scheduler.unlimited else self._estimate_tokens(request))
+
+    def _admit(self, scheduler, estimate: int, priority: int, expires: float) -> None:
+        try:
+            scheduler.acquire(estimate, priority, timeout=self._remaining(expires))
+        except QueueTimeout as e:
+            _count("deadline_exceeded")
+            raise DeadlineExceeded(str(e)) from e
+
+    async def _aadmit(self, scheduler, estimate: int, priority: int, expires: float) -> None:
+        try:
+            await scheduler.aacquire(estimate, priority, timeout=self._remaining(expires))
+        except QueueTimeout as e:
+            _count("deadline_exceeded")
+            raise DeadlineExceeded(str(e)) from e
+
+    def _settle(self, scheduler, estimate: int) -> None:
+        """Charge the deployment's TPM bucket for tokens used beyond the estimate."""
+        if estimate and self.last_usage and self.last_usage.get("total_tokens") is not None:
+            scheduler.settle(estimate, self.last_usage["total_tokens"])
+
+    def _with_retries(self, call: Callable[[], Any], expires: float, scheduler=None):
+        """Run call() until it succeeds, fails permanently or the deadline passes."""
+        attempt = 0
+        while True:
+            try:
+                return call()
+            except DeadlineExceeded:
+                raise
+            except Exception as e:
+                delay = self._next_delay(e, attempt, expires, scheduler)
+                if delay is None:
+                    _count("errors")
+                    raise
+                time.sleep(delay)
+                attempt += 1
+
+    async def _awith_retries(self, call: Callable[[], Any], expires: float, scheduler=None):
+        """Async version of _with_retries; call returns an awaitable."""
+        attempt = 0
+        while True:
+            try:
+                return await call()
+            except DeadlineExceeded:
+                raise
+            except Exception as e:
+                delay = self._next_delay(e, attempt, expires, scheduler)
+                if delay is None:
+                    _count("errors")
+                    raise
+                await asyncio.sleep(delay)
+                attempt += 1
+
+    def _async_api(self, client):
+        client = client or self.async_client
+        if client is None:
+            raise ValueError("No async OpenAI client configured for this service")
+        return _without_sdk_retries(client)
+
+    # ───────────── response handling ─────────────
+    def _finish_response(self, request, response, started: Optional[float] = None) -> str:
+        self._log_call(request, response, started)
+        self.last_usage = usage_to_dict(getattr(response, "usage", None))
+
+        # Extract and return the response text
+        answer = response.choices[0].message.content
+        logger.info(f"Received response from OpenAI (length: {len(answer)})")
+        return answer
+
+    @staticmethod
+    def _read_chunk(chunk, state: Dict[str, Any]) -> Optional[str]:
+        """Record usage / finish reason from one stream chunk and return its text delta."""
+        usage = getattr(chunk, "usage", None)
+        if usage is not None:
+            state["usage"] = usage_to_dict(usage)
+        if not chunk.choices:
+            return None
+        choice = chunk.choices[0]
+        state["finish_reason"] = getattr(choice, "finish_reason", None) or state.get("finish_reason")
+        delta = getattr(choice, "delta", None)
+        return getattr(delta, "content", None) if delta is not None else None
+
+    def _finish_stream(self, request, state: Dict[str, Any], started: Optional[float] = None) -> None:
+        text = "".join(state["pieces"])
+        usage = state.get("usage")
+        if usage is None:
+            # The deployment / API version did not report usage; count it ourselves
+            _count("estimated_usage")
+            prompt_tokens = REPLY_OVERHEAD + sum(
+                count_message_tokens(m["role"], m["content"], self.deployment_name) for m in request["messages"]
+            )
+            completion_tokens = count_tokens(text, self.deployment_name)
+            usage = {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens,
+            }
+        self.last_usage = usage
+        self._log_call(request, {
+            "type": "stream",
+            "content": text,
+            "finish_reason": state.get("finish_reason"),
+            "usage": usage,
+            "usage_estimated": "usage" not in state,
+        }, started)
+        logger.info(f"Streamed response from OpenAI (length: {len(text)})")
+
+    # ───────────── public API ─────────────
+    def get_chat_response(self, messages, temperature=0.3, max_tokens=1000, top_p=1.0, presence_penalty=0.0,
+                          frequency_penalty=0.0, deadline=None, priority=INTERACTIVE, **params):
         """
         Get a response from the OpenAI chat completions API.
-        
+
         Args:
             messages: List of message dictionaries with 'role' and 'content' keys
             temperature: Controls randomness (0.0 to 2.0)
@@ -53,43 +381,233 @@ class OpenAIService:
             top_p: Controls diversity via nucleus sampling
             presence_penalty: Penalizes new tokens based on presence in text so far
             frequency_penalty: Penalizes new tokens based on frequency in text so far
-            
+            deadline: Seconds the call may take including retries (defaults to the service timeout)
+            priority: Queue priority when the deployment is rate limited (rate_limiter.INTERACTIVE,
+                SUMMARY or BACKGROUND); waiting in the queue counts against the deadline
+            **params: Further chat.completions arguments (e.g. response_format); None means API default
+
         Returns:
             The assistant's response text
+
+        Raises:
+            DeadlineExceeded: If the deadline passes before a response arrives (or before the
+                rate limiter admits the request)
         """
         logger.info(f"Sending request to OpenAI with {len(messages)} messages")
         logger.debug(f"Using temperature: {temperature}, max_tokens: {max_tokens}, top_p: {top_p}")
-        
+
         try:
             # Prepare the request
-            request = {
-                'model': self.deployment_name,
-                'messages': messages,
-                'max_tokens': max_tokens,
-                'temperature': temperature,
-                'top_p': top_p,
-                'presence_penalty': presence_penalty,
-                'frequency_penalty': frequency_penalty
-            }
-            
+            request = self._build_request(
+                messages, temperature=temperature, max_tokens=max_tokens, top_p=top_p,
+                presence_penalty=presence_penalty, frequency_penalty=frequency_penalty, **params
+            )
+
             # Log the first and last message for debugging
             if messages:
                 logger.debug(f"First message - Role: {messages[0]['role']}")
                 logger.debug(f"Last message - Role: {messages[-1]['role']}")
-            
+
             # Send the request to the API
-            response = self.client.chat.completions.create(**request)
-            
-            # Log the API call
-            log_openai_call(request, response)
-            
-            # Extract and return the response text
-            answer = response.choices[0].message.content
-            logger.info(f"Received response from OpenAI (length: {len(answer)})")
-            
+            _count("calls")
+            api = _without_sdk_retries(self.client)
+            started = time.monotonic()
+            expires = self._expires(deadline)
+            scheduler, estimate = self._admission(request)
+
+            def attempt():
+                self._admit(scheduler, estimate, priority, expires)
+                return api.chat.completions.create(**request, timeout=self._remaining(expires))
+
+            response = self._with_retries(attempt, expires, scheduler)
+            answer = self._finish_response(request, response, started)
+            self._settle(scheduler, estimate)
             return answer
-            
+
         except Exception as e:
             logger.error(f"Error calling OpenAI API: {e}")
             # Re-raise the exception to be handled by the caller
             raise
+
+    def stream_chat_response(self, messages, temperature=0.3, max_tokens=1000, top_p=1.0, presence_penalty=0.0,
+                             frequency_penalty=0.0, deadline=None, priority=INTERACTIVE,
+                             **params) -> Generator[str, None, None]:
+        """
+        Stream a chat completion, yielding text deltas as they arrive.
+
+        Connection failures, rate limits and server errors are retried until the
+        stream opens; a stream that breaks after that raises, since its text may
+        already have been yielded. The deadline bounds admission, connecting and
+        the first chunk only; after that each chunk must follow the previous one
+        within stream_idle_timeout, however long the whole answer takes. When the
+        generator finishes, last_usage holds the usage from the final chunk (or a
+        local count if the API sent none).
+
+        Args:
+            messages: List of message dictionaries with 'role' and 'content' keys
+            temperature, max_tokens, top_p, presence_penalty, frequency_penalty: As for get_chat_response
+            deadline: Seconds until the first chunk must arrive (defaults to the service timeout)
+            priority: Queue priority when the deployment is rate limited, as for get_chat_response
+            **params: Further chat.completions arguments; None means API default
+
+        Yields:
+            Pieces of the assistant's response text
+
+        Raises:
+            DeadlineExceeded: If the deadline passes before the first chunk arrives
+            StreamIdleTimeout: If a later chunk takes longer than stream_idle_timeout
+        """
+        request = self._build_request(
+            messages, stream=True, temperature=temperature, max_tokens=max_tokens, top_p=top_p,
+            presence_penalty=presence_penalty, frequency_penalty=frequency_penalty, **params
+        )
+        logger.info(f"Streaming request to OpenAI with {len(messages)} messages")
+        _count("streams")
+        started = time.monotonic()
+        expires = self._expires(deadline)
+        api = _without_sdk_retries(self.client)
+        self.last_usage = None
+        scheduler, estimate = self._admission(request)
+
+        def attempt():
+            self._admit(scheduler, estimate, priority, expires)
+            return api.chat.completions.create(**request, timeout=self._stream_timeout(expires))
+
+        stream = self._with_retries(attempt, expires, scheduler)
+
+        state = {"pieces": []}
+        started_streaming = False
+        try:
+            for chunk in stream:
+                if not started_streaming:
+                    # Nothing has reached the caller yet, so the deadline still applies
+                    self._remaining(expires)
+                    started_streaming = True
+                delta = self._read_chunk(chunk, state)
+                if delta:
+                    state["pieces"].append(delta)
+                    yield delta
+        except (httpx.TimeoutException, openai.APITimeoutError) as e:
+            logger.error(f"OpenAI stream timed out after {len(state['pieces'])} chunks: {e}")
+            _count("errors")
+            if started_streaming:
+                raise self._stream_idle_error(e) from e
+            raise
+        except Exception as e:
+            logger.error(f"OpenAI stream failed after {len(state['pieces'])} chunks: {e}")
+            _count("errors")
+            raise
+        finally:
+            close = getattr(stream, "close", None)
+            if callable(close):
+                close()
+        self._finish_stream(request, state, started)
+        self._settle(scheduler, estimate)
+
+    async def aget_chat_response(self, messages, temperature=0.3, max_tokens=1000, top_p=1.0, presence_penalty=0.0,
+                                 frequency_penalty=0.0, deadline=None, priority=INTERACTIVE, client=None,
+                                 **params):
+        """
+        Async version of get_chat_response.
+
+        Args:
+            client: AsyncAzureOpenAI client for the running event loop (defaults to async_client)
+            Other arguments: As for get_chat_response
+
+        Returns:
+            The assistant's response text
+        """
+        logger.info(f"Sending async request to OpenAI with {len(messages)} messages")
+        try:
+            request = self._build_request(
+                messages, temperature=temperature, max_tokens=max_tokens, top_p=top_p,
+                presence_penalty=presence_penalty, frequency_penalty=frequency_penalty, **params
+            )
+            _count("calls")
+            api = self._async_api(client)
+            started = time.monotonic()
+            expires = self._expires(deadline)
+            scheduler, estimate = self._admission(request)
+
+            async def attempt():
+                await self._aadmit(scheduler, estimate, priority, expires)
+                return await api.chat.completions.create(**request, timeout=self._remaining(expires))
+
+            response = await self._awith_retries(attempt, expires, scheduler)
+            answer = self._finish_response(request, response, started)
+            self._settle(scheduler, estimate)
+            return answer
+        except Exception as e:
+            logger.error(f"Error calling OpenAI API: {e}")
+            raise
+
+    async def astream_chat_response(self, messages, temperature=0.3, max_tokens=1000, top_p=1.0,
+                                    presence_penalty=0.0, frequency_penalty=0.0, deadline=None, priority=INTERACTIVE,
+                                    client=None, **params) -> AsyncGenerator[str, None]:
+        """
+        Async version of stream_chat_response.
+
+        Args:
+            client: AsyncAzureOpenAI client for the running event loop (defaults to async_client)
+            Other arguments: As for stream_chat_response
+
+        Yields:
+            Pieces of the assistant's response text
+        """
+        request = self._build_request(
+            messages, stream=True, temperature=temperature, max_tokens=max_tokens, top_p=top_p,
+            presence_penalty=presence_penalty, frequency_penalty=frequency_penalty, **params
+        )
+        logger.info(f"Streaming async request to OpenAI with {len(messages)} messages")
+        _count("streams")
+        started = time.monotonic()
+        expires = self._expires(deadline)
+        api = self._async_api(client)
+        self.last_usage = None
+        scheduler, estimate = self._admission(request)
+
+        async def attempt():
+            await self._aadmit(scheduler, estimate, priority, expires)
+            return await api.chat.completions.create(**request, timeout=self._stream_timeout(expires))
+
+        stream = await self._awith_retries(attempt, expires, scheduler)
+
+        state = {"pieces": []}
+        chunks = stream.__aiter__()
+        started_streaming = False
+        try:
+            while True:
+                # The deadline bounds the first chunk, the idle timeout every later one
+                wait = (self.stream_idle_timeout or None) if started_streaming else self._remaining(expires)
+                try:
+                    chunk = await asyncio.wait_for(chunks.__anext__(), wait)
+                except StopAsyncIteration:
+                    break
+                except asyncio.TimeoutError as e:
+                    if started_streaming:
+                        raise self._stream_idle_error(e) from e
+                    _count("deadline_exceeded")
+                    raise DeadlineExceeded("OpenAI stream sent nothing before its deadline") from e
+                started_streaming = True
+                delta = self._read_chunk(chunk, state)
+                if delta:
+                    state["pieces"].append(delta)
+                    yield delta
+        except (httpx.TimeoutException, openai.APITimeoutError) as e:
+            logger.error(f"OpenAI stream timed out after {len(state['pieces'])} chunks: {e}")
+            _count("errors")
+            if started_streaming:
+                raise self._stream_idle_error(e) from e
+            raise
+        except Exception as e:
+            logger.error(f"OpenAI stream failed after {len(state['pieces'])} chunks: {e}")
+            _count("errors")
+            raise
+        finally:
+            close = getattr(stream, "close", None)
+            if callable(close):
+                result = close()
+                if asyncio.iscoroutine(result):
+                    await result
+        self._finish_stream(request, state, started)
+        self._settle(scheduler, estimate)
@@ -4,18 +4,18 @@ Flask-compatible version of the RAG assistant with in-memory conversation histor
 import logging
 from typing import List, Dict, Tuple, Optional, Any, Generator, Union
 import traceback
-from openai import AzureOpenAI
-from azure.search.documents import SearchClient
 from azure.search.documents.models import VectorizedQuery
-from azure.core.credentials import AzureKeyCredential
 import re
 import sys
 import os
 import re
 from openai_logger import log_openai_call
-from db_manager import DatabaseManager
+from db_writer import get_db_writer
 from conversation_manager_copy import ConversationManager
 from openai_service import OpenAIService
+from client_registry import get_openai_client, get_search_client
+from embedding_cache import get_embedding_cache
+import similarity
 
 # Import config but handle the case where it might import streamlit
 try:
@@ -117,24 +117,23 @@ Respond to the user's query using only the provided context. Your primary goal i
     def __init__(self, settings=None) -> None:
         self._init_cfg()
         
-        # Initialize the OpenAI service
-        self.openai_service = OpenAIService(
+        # Initialize the shared OpenAI client (pooled via client_registry) and service
+        self.openai_client = get_openai_client(
             azure_endpoint=self.openai_endpoint,
             api_key=self.openai_key,
             api_version=self.openai_api_version or "2023-05-15",
-            deployment_name=self.deployment_name
         )
-        
-        # Initialize the conversation manager with the system prompt
-        self.conversation_manager = ConversationManager(self.DEFAULT_SYSTEM_PROMPT)
-        
-        # For backward compatibility
-        self.openai_client = AzureOpenAI(
+        self.openai_service = OpenAIService(
             azure_endpoint=self.openai_endpoint,
             api_key=self.openai_key,
             api_version=self.openai_api_version or "2023-05-15",
+            deployment_name=self.deployment_name,
+            client=self.openai_client
         )
         
+        # Initialize the conversation manager with the system prompt
+        self.conversation_manager = ConversationManager(self.DEFAULT_SYSTEM_PROMPT)
+        
         self.fact_checker = FactCheckerStub()
         
         # Model parameters with defaults
@@ -214,6 +213,11 @@ Respond to the user's query using only the provided context. Your primary goal i
     def generate_embedding(self, text: str) -> Optional[List[float]]:
         if not text:
             return None
+        cache = get_embedding_cache()
+        cached = cache.get(self.embedding_deployment, text)
+        if cached is not None:
+            logger.debug("Embedding cache hit")
+            return cached
         try:
             request = {
                 # Arguments for self.openai_client.embeddings.create
@@ -222,7 +226,9 @@ Respond to the user's query using only the provided context. Your primary goal i
             }
             resp = self.openai_client.embeddings.create(**request)
             log_openai_call(request, resp)
-            return resp.data[0].embedding
+            embedding = resp.data[0].embedding
+            cache.put(self.embedding_deployment, text, embedding)
+            return embedding
             
         
         except Exception as exc:
@@ -231,18 +237,16 @@ Respond to the user's query using only the provided context. Your primary goal i
 
     @staticmethod
     def cosine_similarity(a: List[float], b: List[float]) -> float:
-        dot = sum(x * y for x, y in zip(a, b))
-        mag = (sum(x * x for x in a) ** 0.5) * (sum(y * y for y in b) ** 0.5)
-        return 0.0 if mag == 0 else dot / mag
+        return similarity.cosine_similarity(a, b)
 
     # ───────────── Azure Search ───────────
     def search_knowledge_base(self, query: str) -> List[Dict]:
         try:
             logger.info(f"Searching knowledge base for query: {query}")
-            client = SearchClient(
+            client = get_search_client(
                 endpoint=f"https://{self.search_endpoint}.search.windows.net",
                 index_name=self.search_index,
-                credential=AzureKeyCredential(self.search_key),
+                api_key=self.search_key,
             )
             q_vec = self.generate_embedding(query)
             if not q_vec:
@@ -530,7 +534,7 @@ Respond to the user's query using only the provided context. Your primary goal i
                 # If you have access to the actual SQL query used, set it here
                 
                 # Log the query to the database
-                DatabaseManager.log_rag_query(
+                get_db_writer().log_rag_query(
                     query=query,
                     response=answer,
                     sources=cited_sources,
@@ -611,32 +615,20 @@ Respond to the user's query using only the provided context. Your primary goal i
                 if i < 3 or i >= len(messages) - 2:  # Log first 3 and last 2 messages
                     logger.info(f"Content: {msg['content'][:100]}...")
             
-            # Stream the response
+            # Stream the response (deadline, retries and usage capture are handled by the service)
             collected_chunks = []
             collected_answer = ""
-            
-            # Use the OpenAI client directly for streaming since our OpenAIService doesn't support streaming yet
-            request = {
-                # Arguments for self.openai_client.chat.completions.create
-                'model': self.deployment_name,
-                'messages': messages,
-                'max_tokens': self.max_tokens,
-                'temperature': self.temperature,
-                'top_p': self.top_p,
-                'presence_penalty': self.presence_penalty,
-                'frequency_penalty': self.frequency_penalty,
-                'stream': True
-            }
-            log_openai_call(request, {"type": "stream_started"})
-            stream = self.openai_client.chat.completions.create(**request)
-            
-            # Process the streaming response
-            for chunk in stream:
-                if chunk.choices and chunk.choices[0].delta.content:
-                    content = chunk.choices[0].delta.content
-                    collected_chunks.append(content)
-                    collected_answer += content
-                    yield content
+            for content in self.openai_service.stream_chat_response(
+                messages,
+                max_tokens=self.max_tokens,
+                temperature=self.temperature,
+                top_p=self.top_p,
+                presence_penalty=self.presence_penalty,
+                frequency_penalty=self.frequency_penalty,
+            ):
+                collected_chunks.append(content)
+                collected_answer += content
+                yield content
             
             logger.info("DEBUG - Collected answer: %s", collected_answer[:100])
             
@@ -681,7 +673,7 @@ Respond to the user's query using only the provided context. Your primary goal i
                 # If you have access to the actual SQL query used, set it here
                 
                 # Log the query to the database
-                DatabaseManager.log_rag_query(
+                get_db_writer().log_rag_query(
                     query=query,
                     response=collected_answer,
                     sources=cited_sources,
@@ -2,20 +2,27 @@
 Improved version of the RAG assistant with better handling of procedural content
 """
 import logging
-from typing import List, Dict, Tuple, Optional, Any, Generator, Union
+from typing import List, Dict, Tuple, Optional, Any, Generator, Union, Callable, Set
 import traceback
-from openai import AzureOpenAI
-from azure.search.documents import SearchClient
 from azure.search.documents.models import VectorizedQuery
-from azure.core.credentials import AzureKeyCredential
 import re
 import sys
 import os
 import json
 from openai_logger import log_openai_call
-from db_manager import DatabaseManager
+from db_writer import get_db_writer
 from conversation_manager import ConversationManager
 from openai_service import OpenAIService
+from client_registry import get_openai_client, get_search_client
+from embedding_cache import get_embedding_cache
+from chunk_analysis_cache import ChunkAnalysis, get_chunk_analysis_cache
+from chunk_positions import ChunkPositionIndex, get_chunk_position_index
+from context_expansion import get_context_expander
+from reranker import get_reranker, search_relevance
+from near_duplicates import get_near_duplicate_filter
+from context_packer import get_context_packer
+from config import HIERARCHY_MAX_PARENTS, HIERARCHY_MAX_GAP
+import similarity
 from rag_improvement_logging import get_phase_logger, get_checkpoint_logger, get_test_logger, get_compare_logger
 
 # Import config but handle the case where it might import streamlit
@@ -126,29 +133,34 @@ def chunk_document(text: str, max_chunk_size: int = 1000) -> List[str]:
     return chunks
 
 
-def extract_metadata(chunk: str) -> Dict[str, Any]:
-    """
-    Extract metadata from chunks to improve retrieval and context.
-    
-    Args:
-        chunk: The text chunk to analyze
-        
-    Returns:
-        Dictionary of metadata about the chunk
-    """
+# Patterns used on every retrieved chunk, compiled once
+_STEP_RE = re.compile(r'(\d+)\.\s+')
+_HEADING_RE = re.compile(r'^(#+)\s+')
+_PROCEDURE_START_RE = re.compile(r'(?:how to|steps to|procedure for|guide to)')
+_STEP_START_RE = re.compile(r'\d+\.\s+[A-Z]')
+_SENTENCE_SPLIT_RE = re.compile(r'(?<=[.!?])\s+')
+_TITLE_RE = re.compile(r'(?<=\n\n)([A-Z][^\n:]{5,40})(?=\n\n)')
+_STEP_BREAK_RE = re.compile(r'(\d+\.\s+)')
+_BULLET_BREAK_RE = re.compile(r'(\•\s+)')
+_SECTION_HEADER_RE = re.compile(r'([A-Z][^\n:]{5,40}:)')
+
+INSTRUCTIONAL_KEYWORDS = ('follow', 'steps', 'procedure', 'instructions', 'guide')
+
+
+def _compute_metadata(chunk: str) -> Dict[str, Any]:
     metadata = {}
     
     # Detect if chunk contains procedural content (numbered steps)
-    metadata["is_procedural"] = bool(re.search(r'\d+\.\s+', chunk))
+    step_numbers = _STEP_RE.findall(chunk)
+    metadata["is_procedural"] = bool(step_numbers)
     
     # Extract section level/hierarchy
-    if re.search(r'^#+\s+', chunk):
+    heading_match = _HEADING_RE.search(chunk)
+    if heading_match:
         # Markdown heading level
-        heading_match = re.search(r'^(#+)\s+', chunk)
-        metadata["section_level"] = len(heading_match.group(1)) if heading_match else 0
+        metadata["section_level"] = len(heading_match.group(1))
     
     # Extract any step numbers
-    step_numbers = re.findall(r'(\d+)\.\s+', chunk)
     if step_numbers:
         metadata["steps"] = [int(num) for num in step_numbers]
         metadata["first_step"] = min(metadata["steps"])
@@ -156,45 +168,110 @@ def extract_metadata(chunk: str) -> Dict[str, Any]:
     
     # Detect if this is the start of a procedure
     metadata["is_procedure_start"] = bool(
-        re.search(r'(?:how to|steps to|procedure for|guide to)', chunk.lower()) and
-        metadata.get("is_procedural", False)
+        metadata["is_procedural"] and _PROCEDURE_START_RE.search(chunk.lower())
     )
     
     logger.debug(f"Extracted metadata: {metadata}")
     return metadata
 
 
-def retrieve_with_hierarchy(results: List[Dict]) -> List[Dict]:
+def _analyze_chunk(chunk: str) -> ChunkAnalysis:
+    is_proc = _is_procedural(chunk)
+    formatter = format_procedural_context if is_proc else format_context_text
+    return ChunkAnalysis(_compute_metadata(chunk), is_proc, lambda: formatter(chunk))
+
+
+def analyze_chunk(chunk: str) -> ChunkAnalysis:
+    """
+    Return the metadata, procedural flag and formatted text of a chunk.
+
+    Results are cached per process by content hash, so a knowledge-base chunk
+    is analysed once however many queries retrieve it.
+    """
+    return get_chunk_analysis_cache().get_or_compute(chunk, _analyze_chunk)
+
+
+def extract_metadata(chunk: str) -> Dict[str, Any]:
+    """
+    Extract metadata from chunks to improve retrieval and context.
+    
+    Args:
+        chunk: The text chunk to analyze
+        
+    Returns:
+        Dictionary of metadata about the chunk (a copy; the cached record is shared)
+    """
+    metadata = dict(analyze_chunk(chunk).metadata)
+    if "steps" in metadata:
+        metadata["steps"] = list(metadata["steps"])
+    return metadata
+
+
+def retrieve_with_hierarchy(
+    results: List[Dict],
+    position_index: Optional[ChunkPositionIndex] = None,
+    fetch_siblings: Optional[Callable[[Dict[str, Set[int]], List[Dict]], List[Dict]]] = None,
+) -> List[Dict]:
     """
     Reorganize search results to preserve document hierarchy.
     
+    Chunks of the top parent documents are put back in document order. When
+    fetch_siblings is given, chunks missing between two hits of the same parent
+    (at most HIERARCHY_MAX_GAP in a row) are fetched in one batched lookup.
+    
     Args:
         results: Original search results
+        position_index: Resolves chunk positions (defaults to the process-wide index)
+        fetch_siblings: Returns the chunks at the given {parent_id: positions} in one call,
+            given the results (whose chunk keys identify their siblings)
         
     Returns:
         Reorganized results that preserve parent document structure
     """
     logger.info(f"Reorganizing {len(results)} results to preserve hierarchy")
+    position_index = position_index or get_chunk_position_index()
     
-    # Extract parent documents and their scores
-    parent_docs = {}
+    # Group by parent in one pass; dict order is the order of each parent's best hit
+    parent_docs: Dict[str, List[Dict]] = {}
     for result in results:
         parent_id = result.get("parent_id", "")
-        if parent_id and parent_id not in parent_docs:
-            parent_docs[parent_id] = result.get("relevance", 0.0)
+        if parent_id:
+            parent_docs.setdefault(parent_id, []).append(result)
+    top_parents = sorted(
+        parent_docs, key=lambda pid: parent_docs[pid][0].get("relevance", 0.0), reverse=True
+    )[:HIERARCHY_MAX_PARENTS]
+    
+    for parent_id in top_parents:
+        position_index.annotate(parent_docs[parent_id])
+    
+    # Fill the holes between hits of the same parent with a single lookup
+    missing = {pid: set(position_index.gaps(parent_docs[pid], HIERARCHY_MAX_GAP)) for pid in top_parents}
+    missing = {pid: gaps for pid, gaps in missing.items() if gaps}
+    if missing and fetch_siblings and HIERARCHY_MAX_GAP > 0:
+        try:
+            siblings = fetch_siblings({pid: set(gaps) for pid, gaps in missing.items()}, results)
+        except Exception as exc:
+            logger.warning(f"Could not fetch sibling chunks: {exc}")
+            siblings = []
+        position_index.annotate(siblings)
+        for sibling in siblings:
+            gaps = missing.get(sibling.get("parent_id", ""))
+            if gaps and sibling["position"] in gaps:
+                gaps.discard(sibling["position"])
+                sibling.setdefault("relevance", 0.0)
+                sibling["expanded"] = True
+                parent_docs[sibling["parent_id"]].append(sibling)
+        logger.debug(f"Filled {len(siblings)} candidate siblings for {len(missing)} parents")
     
-    # For top parent documents, retrieve all their chunks in order
     ordered_results = []
-    for parent_id, score in sorted(parent_docs.items(), key=lambda x: x[1], reverse=True)[:3]:
-        # Get all chunks from this parent
-        parent_chunks = [r for r in results if r.get("parent_id", "") == parent_id]
+    for parent_id in top_parents:
+        parent_chunks = ChunkPositionIndex.order(parent_docs[parent_id])
         
-        # Add metadata to each chunk
+        # Add metadata to each chunk (kept if an earlier stage already added it)
         for chunk in parent_chunks:
-            chunk["metadata"] = extract_metadata(chunk.get("chunk", ""))
+            if "metadata" not in chunk:
+                chunk["metadata"] = extract_metadata(chunk.get("chunk", ""))
         
-        # Sort chunks by their position in the original document
-        # This is a simplified approach - ideally we would have position information
         ordered_results.extend(parent_chunks)
         logger.debug(f"Added {len(parent_chunks)} chunks from parent {parent_id}")
     
@@ -264,14 +341,14 @@ def format_context_text(text: str) -> str:
         Formatted text with preserved structure
     """
     # Add line breaks after long sentences
-    sentences = re.split(r'(?<=[.!?])\s+', text.strip())
+    sentences = _SENTENCE_SPLIT_RE.split(text.strip())
     formatted = "\n\n".join(sentence for sentence in sentences if sentence)
     
     # Emphasize headings or keywords
-    formatted = re.sub(r'(?<=\n\n)([A-Z][^\n:]{5,40})(?=\n\n)', r'**\1**', formatted)  # crude title detection
+    formatted = _TITLE_RE.sub(r'**\1**', formatted)  # crude title detection
     
     # Preserve numbered steps
-    formatted = re.sub(r'(\d+\.\s+)', r'\n\1', formatted)
+    formatted = _STEP_BREAK_RE.sub(r'\n\1', formatted)
     
     return formatted
 
@@ -287,11 +364,11 @@ def format_procedural_context(text: str) -> str:
         Formatted text with preserved procedural structure
     """
     # Identify numbered steps or bullet points
-    text = re.sub(r'(\d+\.\s+)', r'\n\1', text)
-    text = re.sub(r'(\•\s+)', r'\n\1', text)
+    text = _STEP_BREAK_RE.sub(r'\n\1', text)
+    text = _BULLET_BREAK_RE.sub(r'\n\1', text)
     
     # Emphasize section headers
-    text = re.sub(r'([A-Z][^\n:]{5,40}:)', r'\n**\1**\n', text)
+    text = _SECTION_HEADER_RE.sub(r'\n**\1**\n', text)
     
     # Preserve paragraph structure
     paragraphs = text.split('\n\n')
@@ -310,16 +387,17 @@ def is_procedural_content(text: str) -> bool:
     Returns:
         True if the text contains procedural content, False otherwise
     """
+    return analyze_chunk(text).is_procedural
+
+
+def _is_procedural(text: str) -> bool:
     # Check for numbered steps (e.g., "1. Do this")
-    if re.search(r'\d+\.\s+[A-Z]', text):
+    if _STEP_START_RE.search(text):
         return True
     
     # Check for instructional keywords
-    instructional_keywords = ['follow', 'steps', 'procedure', 'instructions', 'guide']
-    if any(keyword in text.lower() for keyword in instructional_keywords):
-        return True
-        
-    return False
+    lowered = text.lower()
+    return any(keyword in lowered for keyword in INSTRUCTIONAL_KEYWORDS)
 
 
 class FlaskRAGAssistantWithHistory:
@@ -466,24 +544,23 @@ class FlaskRAGAssistantWithHistory:
     def __init__(self, settings=None) -> None:
         self._init_cfg()
         
-        # Initialize the OpenAI service
-        self.openai_service = OpenAIService(
+        # Initialize the shared OpenAI client (pooled via client_registry) and service
+        self.openai_client = get_openai_client(
             azure_endpoint=self.openai_endpoint,
             api_key=self.openai_key,
             api_version=self.openai_api_version or "2023-05-15",
-            deployment_name=self.deployment_name
         )
-        
-        # Initialize the conversation manager with the system prompt
-        self.conversation_manager = ConversationManager(self.DEFAULT_SYSTEM_PROMPT)
-        
-        # For backward compatibility
-        self.openai_client = AzureOpenAI(
+        self.openai_service = OpenAIService(
             azure_endpoint=self.openai_endpoint,
             api_key=self.openai_key,
             api_version=self.openai_api_version or "2023-05-15",
+            deployment_name=self.deployment_name,
+            client=self.openai_client
         )
         
+        # Initialize the conversation manager with the system prompt
+        self.conversation_manager = ConversationManager(self.DEFAULT_SYSTEM_PROMPT)
+        
         self.fact_checker = FactCheckerStub()
         
         # Model parameters with defaults
@@ -575,6 +652,11 @@ class FlaskRAGAssistantWithHistory:
     def generate_embedding(self, text: str) -> Optional[List[float]]:
         if not text:
             return None
+        cache = get_embedding_cache()
+        cached = cache.get(self.embedding_deployment, text)
+        if cached is not None:
+            logger.debug("Embedding cache hit")
+            return cached
         try:
             request = {
                 # Arguments for self.openai_client.embeddings.create
@@ -583,7 +665,9 @@ class FlaskRAGAssistantWithHistory:
             }
             resp = self.openai_client.embeddings.create(**request)
             log_openai_call(request, resp)
-            return resp.data[0].embedding
+            embedding = resp.data[0].embedding
+            cache.put(self.embedding_deployment, text, embedding)
+            return embedding
             
         
         except Exception as exc:
@@ -592,18 +676,16 @@ class FlaskRAGAssistantWithHistory:
 
     @staticmethod
     def cosine_similarity(a: List[float], b: List[float]) -> float:
-        dot = sum(x * y for x, y in zip(a, b))
-        mag = (sum(x * x for x in a) ** 0.5) * (sum(y * y for y in b) ** 0.5)
-        return 0.0 if mag == 0 else dot / mag
+        return similarity.cosine_similarity(a, b)
 
     # ───────────── Azure Search ───────────
     def search_knowledge_base(self, query: str) -> List[Dict]:
         try:
             logger.info(f"Searching knowledge base for query: {query}")
-            client = SearchClient(
+            client = get_search_client(
                 endpoint=f"https://{self.search_endpoint}.search.windows.net",
                 index_name=self.search_index,
-                credential=AzureKeyCredential(self.search_key),
+                api_key=self.search_key,
             )
             q_vec = self.generate_embedding(query)
             if not q_vec:
@@ -620,11 +702,12 @@ class FlaskRAGAssistantWithHistory:
             # Log the search parameters
             logger.info(f"Search parameters: index={self.search_index}, vector_field={self.vector_field}, top=10")
             
-            # Add parent_id to select fields
+            # Add parent_id (and the chunk position fields) to select fields
+            position_index = get_chunk_position_index()
             results = client.search(
                 search_text=query,
                 vector_queries=[vec_q],
-                select=["chunk", "title", "parent_id"],  # Added parent_id here
+                select=["chunk", "title", "parent_id"] + position_index.select_fields(),
                 top=10,
             )
             
@@ -646,13 +729,28 @@ class FlaskRAGAssistantWithHistory:
                     "chunk": r.get("chunk", ""),
                     "title": r.get("title", "Untitled"),
                     "parent_id": r.get("parent_id", ""),  # Include parent_id
-                    "relevance": 1.0,
+                    "position": position_index.position_of(r),
+                    **position_index.key_fields(r),
+                    **search_relevance(r),
                 }
                 for r in result_list
             ]
             
+            # Rerank locally so expansion and hierarchy start from the best hits
+            standard_results = get_reranker().rerank(query, standard_results)
+            
+            # Add the neighbouring chunks of the top hits (one search for all their parents)
+            expander = get_context_expander()
+            def fetch(filter_expr: str, top: int) -> List[Dict]:
+                return self._fetch_parent_chunks(client, filter_expr, top)
+            expanded_results = expander.expand(standard_results, fetch)
+            
             # Apply hierarchical retrieval to preserve document structure
-            organized_results = retrieve_with_hierarchy(standard_results)
+            organized_results = retrieve_with_hierarchy(
+                expanded_results,
+                position_index=position_index,
+                fetch_siblings=expander.fetch_siblings(fetch),
+            )
             
             return organized_results
         except Exception as exc:
@@ -660,10 +758,43 @@ class FlaskRAGAssistantWithHistory:
             logger.error(f"Traceback: {traceback.format_exc()}")
             return []
 
+    def _fetch_parent_chunks(self, client, filter_expr: str, top: int) -> List[Dict]:
+        """
+        Fetch the chunks of several parent documents picked by a filter with one search.
+        
+        Args:
+            client: Search client for the knowledge-base index
+            filter_expr: Filter from ChunkPositionIndex.window_filter
+            top: Maximum number of chunks returned
+            
+        Returns:
+            Chunks in the standard result format, with their position
+        """
+        position_index = get_chunk_position_index()
+        results = client.search(
+            search_text="*",
+            filter=filter_expr,
+            select=["chunk", "title", "parent_id"] + position_index.select_fields(),
+            top=top,
+        )
+        return [
+            {
+                "chunk": r.get("chunk", ""),
+                "title": r.get("title", "Untitled"),
+                "parent_id": r.get("parent_id", ""),
+                "position": position_index.position_of(r),
+                **position_index.key_fields(r),
+            }
+            for r in results
+        ]
+
     # ───────── context & citations ────────
     def _prepare_context(self, results: List[Dict]) -> Tuple[str, Dict]:
         logger.info(f"Preparing context from {len(results)} search results")
         
+        # Collapse near-identical chunks so they do not take several of the slots
+        results = get_near_duplicate_filter().filter(results)
+        
         # Prioritize procedural content in the results
         prioritized_results = prioritize_procedural_content(results)
         logger.info(f"Results prioritized with procedural content first")
@@ -675,23 +806,22 @@ class FlaskRAGAssistantWithHistory:
         # Track if we have procedural content
         has_procedural_content = False
         
-        # Process the top results (prioritized with procedural content first)
-        for res in prioritized_results[:5]:
-            chunk = res["chunk"].strip()
-            if not chunk:
-                logger.warning(f"Empty chunk found in result {sid}, skipping")
-                continue
-
+        # Fill the context token budget in priority order (procedural content first);
+        # analysis and formatting are cached per chunk
+        packed = get_context_packer().pack(
+            prioritized_results,
+            lambda res: analyze_chunk(res["chunk"].strip()).formatted,
+            by_score=False,
+            model=CHAT_DEPLOYMENT,
+        )
+        for res, formatted_chunk, tokens, truncated in packed:
             valid_chunks += 1
             
             # Check if this is procedural content
-            is_proc = is_procedural_content(chunk)
+            is_proc = analyze_chunk(res["chunk"].strip()).is_procedural
             if is_proc:
                 has_procedural_content = True
                 logger.info(f"Source {sid} contains procedural content")
-                formatted_chunk = format_procedural_context(chunk)
-            else:
-                formatted_chunk = format_context_text(chunk)
             
             # Log parent_id if available
             parent_id = res.get("parent_id", "")
@@ -706,7 +836,8 @@ class FlaskRAGAssistantWithHistory:
             if metadata:
                 if metadata.get("is_procedural", False):
                     metadata_str = " data-procedural=\"true\""
-                if "first_step" in metadata and "last_step" in metadata:
+                # A truncated chunk may not reach its last step
+                if "first_step" in metadata and "last_step" in metadata and not truncated:
                     metadata_str += f" data-steps=\"{metadata['first_step']}-{metadata['last_step']}\""
             
             # Include metadata in the source tag
@@ -717,7 +848,9 @@ class FlaskRAGAssistantWithHistory:
                 "content": formatted_chunk,
                 "parent_id": parent_id,  # Include parent_id in source map
                 "is_procedural": is_proc,  # Track if this is procedural content
-                "metadata": metadata  # Include full metadata
+                "metadata": metadata,  # Include full metadata
+                "tokens": tokens,
+                "truncated": truncated,
             }
             sid += 1
 
@@ -1037,7 +1170,7 @@ class FlaskRAGAssistantWithHistory:
                 # If you have access to the actual SQL query used, set it here
                 
                 # Log the query to the database
-                DatabaseManager.log_rag_query(
+                get_db_writer().log_rag_query(
                     query=query,
                     response=answer,
                     sources=cited_sources,
@@ -1127,32 +1260,20 @@ class FlaskRAGAssistantWithHistory:
                 if i < 3 or i >= len(messages) - 2:  # Log first 3 and last 2 messages
                     logger.info(f"Content: {msg['content'][:100]}...")
             
-            # Stream the response
+            # Stream the response (deadline, retries and usage capture are handled by the service)
             collected_chunks = []
             collected_answer = ""
-            
-            # Use the OpenAI client directly for streaming since our OpenAIService doesn't support streaming yet
-            request = {
-                # Arguments for self.openai_client.chat.completions.create
-                'model': self.deployment_name,
-                'messages': messages,
-                'max_tokens': self.max_tokens,
-                'temperature': self.temperature,
-                'top_p': self.top_p,
-                'presence_penalty': self.presence_penalty,
-                'frequency_penalty': self.frequency_penalty,
-                'stream': True
-            }
-            log_openai_call(request, {"type": "stream_started"})
-            stream = self.openai_client.chat.completions.create(**request)
-            
-            # Process the streaming response
-            for chunk in stream:
-                if chunk.choices and chunk.choices[0].delta.content:
-                    content = chunk.choices[0].delta.content
-                    collected_chunks.append(content)
-                    collected_answer += content
-                    yield content
+            for content in self.openai_service.stream_chat_response(
+                messages,
+                max_tokens=self.max_tokens,
+                temperature=self.temperature,
+                top_p=self.top_p,
+                presence_penalty=self.presence_penalty,
+                frequency_penalty=self.frequency_penalty,
+            ):
+                collected_chunks.append(content)
+                collected_answer += content
+                yield content
             
             logger.info("DEBUG - Collected answer: %s", collected_answer[:100])
             
@@ -1198,7 +1319,7 @@ class FlaskRAGAssistantWithHistory:
                 # If you have access to the actual SQL query used, set it here
                 
                 # Log the query to the database
-                DatabaseManager.log_rag_query(
+                get_db_writer().log_rag_query(
                     query=query,
                     response=collected_answer,
                     sources=cited_sources,
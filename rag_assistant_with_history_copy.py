@@ -4,20 +4,32 @@ Flask-compatible version of the RAG assistant with in-memory conversation histor
 """
 import logging
 from typing import List, Dict, Tuple, Optional, Any, Generator, Union
+import time
 import traceback
-from openai import AzureOpenAI
-from azure.search.documents import SearchClient
 from azure.search.documents.models import VectorizedQuery
-from azure.core.credentials import AzureKeyCredential
 import re
 import sys
 import os
 import re
 import json
 from openai_logger import log_openai_call
-from db_manager import DatabaseManager
+from db_writer import get_db_writer
 from conversation_manager_copy import ConversationManager
+from conversation_state import Message
+from token_counter import REPLY_OVERHEAD, count_tokens
+from rolling_summary import get_summary_folder
 from openai_service import OpenAIService
+from rate_limiter import get_rate_limiter, SUMMARY
+from client_registry import get_openai_client, get_search_client
+from embedding_cache import get_embedding_cache
+import similarity
+from semantic_cache import get_semantic_cache, make_fingerprint
+import speculative_retrieval
+from reranker import get_reranker, search_relevance
+from near_duplicates import get_near_duplicate_filter
+from context_packer import get_context_packer
+from chunk_positions import get_chunk_position_index
+from context_expansion import get_context_expander
 
 # Import config but handle the case where it might import streamlit
 try:
@@ -31,6 +43,12 @@ try:
         SEARCH_INDEX,
         SEARCH_KEY,
         VECTOR_FIELD,
+        SPECULATIVE_RETRIEVAL_ENABLED,
+        HISTORY_TRIM_STRATEGY,
+        HISTORY_TOKEN_BUDGET,
+        SUMMARY_ASYNC_FOLD,
+        HISTORY_COMPACTION,
+        CONTEXT_TOKEN_BUDGET,
     )
 except ImportError as e:
     if 'streamlit' in str(e):
@@ -44,6 +62,12 @@ except ImportError as e:
         SEARCH_INDEX = os.environ.get("SEARCH_INDEX")
         SEARCH_KEY = os.environ.get("SEARCH_KEY")
         VECTOR_FIELD = os.environ.get("VECTOR_FIELD")
+        SPECULATIVE_RETRIEVAL_ENABLED = os.environ.get("SPECULATIVE_RETRIEVAL_ENABLED", "false").lower() in ("1", "true", "yes")
+        HISTORY_TRIM_STRATEGY = os.environ.get("HISTORY_TRIM_STRATEGY", "tokens")
+        HISTORY_TOKEN_BUDGET = int(os.environ.get("HISTORY_TOKEN_BUDGET", "6000"))
+        SUMMARY_ASYNC_FOLD = os.environ.get("SUMMARY_ASYNC_FOLD", "false").lower() in ("1", "true", "yes")
+        HISTORY_COMPACTION = os.environ.get("HISTORY_COMPACTION", "true").lower() in ("1", "true", "yes")
+        CONTEXT_TOKEN_BUDGET = int(os.environ.get("CONTEXT_TOKEN_BUDGET", "2500"))
     else:
         raise
 
@@ -126,24 +150,23 @@ class FlaskRAGAssistantWithHistory:
     def __init__(self, settings=None) -> None:
         self._init_cfg()
         
-        # Initialize the OpenAI service
-        self.openai_service = OpenAIService(
+        # Initialize the shared OpenAI client (pooled via client_registry) and service
+        self.openai_client = get_openai_client(
             azure_endpoint=self.openai_endpoint,
             api_key=self.openai_key,
             api_version=self.openai_api_version or "2023-05-15",
-            deployment_name=self.deployment_name
         )
-        
-        # Initialize the conversation manager with the system prompt
-        self.conversation_manager = ConversationManager(self.DEFAULT_SYSTEM_PROMPT)
-        
-        # For backward compatibility
-        self.openai_client = AzureOpenAI(
+        self.openai_service = OpenAIService(
             azure_endpoint=self.openai_endpoint,
             api_key=self.openai_key,
             api_version=self.openai_api_version or "2023-05-15",
+            deployment_name=self.deployment_name,
+            client=self.openai_client
         )
         
+        # Initialize the conversation manager with the system prompt
+        self.conversation_manager = ConversationManager(self.DEFAULT_SYSTEM_PROMPT)
+        
         self.fact_checker = FactCheckerStub()
         
         # Model parameters with defaults
@@ -156,16 +179,35 @@ class FlaskRAGAssistantWithHistory:
         # Conversation history window size (in turns)
         self.max_history_turns = 5
         
+        # History trimming: "tokens" fits history into a prompt-token budget, "turns" keeps max_history_turns
+        self.history_trim_strategy = HISTORY_TRIM_STRATEGY
+        self.history_token_budget = HISTORY_TOKEN_BUDGET
+        
+        # Replace earlier turns' retrieved context with citation stubs in the prompt
+        self.history_compaction = HISTORY_COMPACTION
+        
+        # Prompt tokens for the retrieved sources, filled greedily by score
+        self.context_token_budget = CONTEXT_TOKEN_BUDGET
+        
         # Flag to track if history was trimmed in the most recent request
         self._history_trimmed = False
         
+        # Flag to track if the most recent answer was served from the semantic cache
+        self.last_response_cached = False
+        
         # Summarization settings
         self.summarization_settings = {
             "enabled": True,                # Whether to use summarization (vs. simple truncation)
             "max_summary_tokens": 800,      # Maximum length of summaries
             "summary_temperature": 0.3,     # Temperature for summary generation
+            "async_fold": SUMMARY_ASYNC_FOLD,  # Fold evicted turns after the response instead of before it
         }
         
+        # Running summary of the turns evicted from the prompt; it covers history[1:summary_watermark]
+        self.rolling_summary = ""
+        self.summary_watermark = 0
+        self._pending_fold = None
+        
         # Load settings if provided
         self.settings = settings or {}
         self._load_settings()
@@ -208,6 +250,14 @@ class FlaskRAGAssistantWithHistory:
         if "max_history_turns" in settings:
             self.max_history_turns = settings["max_history_turns"]
             logger.info(f"Setting max_history_turns to {self.max_history_turns}")
+        if "history_trim_strategy" in settings:
+            self.history_trim_strategy = settings["history_trim_strategy"]
+        if "history_token_budget" in settings:
+            self.history_token_budget = settings["history_token_budget"]
+        if "history_compaction" in settings:
+            self.history_compaction = settings["history_compaction"]
+        if "context_token_budget" in settings:
+            self.context_token_budget = settings["context_token_budget"]
             
         # Update summarization settings
         if "summarization_settings" in settings:
@@ -231,19 +281,34 @@ class FlaskRAGAssistantWithHistory:
                 self.conversation_manager.chat_history = [{"role": "system", "content": combined_prompt}]
                 logger.info(f"System prompt appended with custom prompt")
 
+    # ───────────── rate limiting ─────────────
+    def _rate_limit(self, deployment: str, text: str, completion_tokens: int = 0) -> None:
+        """Wait for the deployment's rate limiter before a call made directly on the SDK client."""
+        scheduler = get_rate_limiter().scheduler(deployment)
+        if not scheduler.unlimited:
+            scheduler.acquire(count_tokens(text, deployment) + completion_tokens, timeout=self.openai_service.timeout)
+
     # ───────────── embeddings ─────────────
     def generate_embedding(self, text: str) -> Optional[List[float]]:
         if not text:
             return None
+        cache = get_embedding_cache()
+        cached = cache.get(self.embedding_deployment, text)
+        if cached is not None:
+            logger.debug("Embedding cache hit")
+            return cached
         try:
             request = {
                 # Arguments for self.openai_client.embeddings.create
                 'model': self.embedding_deployment,
                 'input': text.strip(),
             }
+            self._rate_limit(self.embedding_deployment, request['input'])
             resp = self.openai_client.embeddings.create(**request)
             log_openai_call(request, resp)
-            return resp.data[0].embedding
+            embedding = resp.data[0].embedding
+            cache.put(self.embedding_deployment, text, embedding)
+            return embedding
             
         
         except Exception as exc:
@@ -252,75 +317,151 @@ class FlaskRAGAssistantWithHistory:
 
     @staticmethod
     def cosine_similarity(a: List[float], b: List[float]) -> float:
-        dot = sum(x * y for x, y in zip(a, b))
-        mag = (sum(x * x for x in a) ** 0.5) * (sum(y * y for y in b) ** 0.5)
-        return 0.0 if mag == 0 else dot / mag
+        return similarity.cosine_similarity(a, b)
 
     # ───────────── Azure Search ───────────
     def search_knowledge_base(self, query: str) -> List[Dict]:
         try:
             logger.info(f"Searching knowledge base for query: {query}")
-            client = SearchClient(
-                endpoint=f"https://{self.search_endpoint}.search.windows.net",
-                index_name=self.search_index,
-                credential=AzureKeyCredential(self.search_key),
-            )
+            client = self._search_client()
             q_vec = self.generate_embedding(query)
             if not q_vec:
                 logger.error("Failed to generate embedding for query")
                 return []
 
-            logger.info(f"Executing vector search with fields: {self.vector_field}")
-            vec_q = VectorizedQuery(
-                vector=q_vec,
-                k_nearest_neighbors=10,
-                fields=self.vector_field,
-            )
-            
-            # Log the search parameters
-            logger.info(f"Search parameters: index={self.search_index}, vector_field={self.vector_field}, top=10")
-            
-            # Add parent_id to select fields
-            results = client.search(
-                search_text=query,
-                vector_queries=[vec_q],
-                select=["chunk", "title", "parent_id"],  # Added parent_id here
-                top=10,
-            )
+            results = client.search(**self._search_kwargs(query, q_vec))
             
             # Convert results to list and log count
             result_list = list(results)
-            logger.info(f"Search returned {len(result_list)} results")
-            
-            # Debug log the first result if available
-            if result_list and len(result_list) > 0:
-                first_result = result_list[0]
-                logger.debug(f"First result - title: {first_result.get('title', 'No title')}")
-                logger.debug(f"First result - has parent_id: {'Yes' if 'parent_id' in first_result else 'No'}")
-                if 'parent_id' in first_result:
-                    logger.debug(f"First result - parent_id: {first_result.get('parent_id')[:30]}..." if first_result.get('parent_id') else "None")
-            
-            return [
-                {
-                    "chunk": r.get("chunk", ""),
-                    "title": r.get("title", "Untitled"),
-                    "parent_id": r.get("parent_id", ""),  # Include parent_id
-                    "relevance": 1.0,
-                }
-                for r in result_list
-            ]
+            return self._format_search_results(result_list)
         except Exception as exc:
             logger.error(f"Search error: {exc}", exc_info=True)
             logger.error(f"Traceback: {traceback.format_exc()}")
             return []
 
+    def _retrieve(self, query: str, is_enhanced: bool = False) -> List[Dict]:
+        """
+        Enhance the query (unless it already is) and search the knowledge base.
+
+        In speculative mode the search for the raw query starts right away and runs
+        while the enhancement completion is in flight; it is only searched again
+        when the enhanced query differs materially from the raw one.
+        """
+        if is_enhanced:
+            return self.search_knowledge_base(query)
+        if not self.settings.get("speculative_retrieval", SPECULATIVE_RETRIEVAL_ENABLED):
+            return self.search_knowledge_base(self._get_enhanced_query(query))
+
+        raw_future = speculative_retrieval.get_executor().submit(self.search_knowledge_base, query)
+        enhanced_query = self._get_enhanced_query(query)
+        if not speculative_retrieval.queries_differ(query, enhanced_query):
+            logger.info("Enhanced query matches the raw query; reusing speculative search results")
+            speculative_retrieval.record_outcome(reissued=False)
+            return raw_future.result()
+
+        logger.info("Enhanced query differs from the raw query; searching again")
+        speculative_retrieval.record_outcome(reissued=True)
+        enhanced_results = self.search_knowledge_base(enhanced_query)
+        return speculative_retrieval.merge_results(enhanced_results, raw_future.result())
+
+    def _search_kwargs(self, query: str, q_vec: List[float]) -> Dict[str, Any]:
+        """Build the hybrid (keyword + vector) search arguments shared by the sync and async clients."""
+        logger.info(f"Executing vector search with fields: {self.vector_field}")
+        vec_q = VectorizedQuery(
+            vector=q_vec,
+            k_nearest_neighbors=10,
+            fields=self.vector_field,
+        )
+        
+        # Log the search parameters
+        logger.info(f"Search parameters: index={self.search_index}, vector_field={self.vector_field}, top=10")
+        
+        # Add parent_id to select fields
+        return {
+            "search_text": query,
+            "vector_queries": [vec_q],
+            "select": ["chunk", "title", "parent_id"] + get_chunk_position_index().select_fields(),
+            "top": 10,
+        }
+
+    @staticmethod
+    def _parent_search_kwargs(filter_expr: str, top: int) -> Dict[str, Any]:
+        """Build one filtered search returning the neighbouring chunks picked by filter_expr."""
+        return {
+            "search_text": "*",
+            "filter": filter_expr,
+            "select": ["chunk", "title", "parent_id"] + get_chunk_position_index().select_fields(),
+            "top": top,
+        }
+
+    @staticmethod
+    def _format_search_results(result_list: List[Dict]) -> List[Dict]:
+        """Convert raw search hits into the result dicts used by _prepare_context."""
+        logger.info(f"Search returned {len(result_list)} results")
+        
+        # Debug log the first result if available
+        if result_list and len(result_list) > 0:
+            first_result = result_list[0]
+            logger.debug(f"First result - title: {first_result.get('title', 'No title')}")
+            logger.debug(f"First result - has parent_id: {'Yes' if 'parent_id' in first_result else 'No'}")
+            if 'parent_id' in first_result:
+                logger.debug(f"First result - parent_id: {first_result.get('parent_id')[:30]}..." if first_result.get('parent_id') else "None")
+        
+        position_index = get_chunk_position_index()
+        results = []
+        for r in result_list:
+            result = {
+                "chunk": r.get("chunk", ""),
+                "title": r.get("title", "Untitled"),
+                "parent_id": r.get("parent_id", ""),  # Include parent_id
+                **position_index.key_fields(r),
+                **search_relevance(r),
+            }
+            # Position within the parent document, used to add neighbouring chunks
+            position = position_index.position_of(r)
+            if position is not None:
+                result["position"] = position
+            results.append(result)
+        return results
+
+    def _search_client(self):
+        """Return the shared SearchClient for this assistant's index."""
+        return get_search_client(
+            endpoint=f"https://{self.search_endpoint}.search.windows.net",
+            index_name=self.search_index,
+            api_key=self.search_key,
+        )
+
+    def _fetch_parent_chunks(self, filter_expr: str, top: int) -> List[Dict]:
+        """Fetch the chunks of several parent documents picked by filter_expr with one search."""
+        results = self._search_client().search(**self._parent_search_kwargs(filter_expr, top))
+        return self._format_search_results(list(results))
+
+    def _expand(self, results: List[Dict]) -> List[Dict]:
+        """
+        Add the chunks around the top hits (e.g. steps 1-3 of a hit on step 4).
+
+        Neighbours are placed next to their hit with a slightly lower score, and the
+        positions missing around the hits are fetched with one search (or served
+        from the cache).
+        """
+        return get_context_expander().expand(results, self._fetch_parent_chunks, inline=True)
+
+    @staticmethod
+    def _rerank(query: str, results: List[Dict]) -> List[Dict]:
+        """Reorder search results with the local reranker so the best chunks reach _prepare_context first."""
+        return get_reranker().rerank(query, results)
+
     # ───────── context & citations ────────
-    def summarize_history(self, messages_to_summarize: List[Dict]) -> Dict:
+    SUMMARY_PREFIX = "Previous conversation summary: "
+
+    def summarize_history(self, messages_to_summarize: List[Dict], previous_summary: str = "") -> Dict:
         """
         Summarize a portion of conversation history while preserving key information.
         
         Args:
             messages_to_summarize: List of message dictionaries to summarize
+            previous_summary: Summary of the conversation before these messages, to be extended
             
         Returns:
             A single system message containing the summary
@@ -346,6 +487,9 @@ class FlaskRAGAssistantWithHistory:
         Conversation to summarize:
         """
         
+        if previous_summary:
+            prompt += f"\n\nSUMMARY OF THE EARLIER CONVERSATION (extend it, keeping what still matters):\n{previous_summary}\n\nNEWER MESSAGES:"
+        
         for msg in messages_to_summarize:
             prompt += f"\n\n{msg['role'].upper()}: {msg['content']}"
         
@@ -363,11 +507,64 @@ class FlaskRAGAssistantWithHistory:
         summary_response = self.openai_service.get_chat_response(
             messages=summary_messages,
             temperature=self.summarization_settings.get("summary_temperature", 0.3),
-            max_tokens=self.summarization_settings.get("max_summary_tokens", 800)
+            max_tokens=self.summarization_settings.get("max_summary_tokens", 800),
+            priority=SUMMARY,
         )
         
         logger.info(f"Generated summary of length {len(summary_response)}")
-        return {"role": "system", "content": f"Previous conversation summary: {summary_response}"}
+        return {"role": "system", "content": f"{self.SUMMARY_PREFIX}{summary_response}"}
+    
+    def _fold_summary(self, summary: str, messages: List[Dict]) -> str:
+        """Fold newly evicted messages into the running summary text."""
+        content = self.summarize_history(messages, summary)["content"]
+        return content[len(self.SUMMARY_PREFIX):] if content.startswith(self.SUMMARY_PREFIX) else content
+    
+    def _rolling_summary_message(self, messages: List[Dict], cut: int) -> Tuple[Optional[Dict], int]:
+        """
+        Return the running summary of messages[1:cut], folding in only what was evicted since last time.
+        
+        The summary and its watermark persist with the session. Folds are cached
+        process-wide, so a fold finished in the background after an earlier response
+        is picked up here. With async_fold enabled, messages that are not folded yet
+        stay in the prompt for this turn and are folded after the response.
+        
+        Args:
+            messages: The prompt messages, system message first
+            cut: Index of the first message that must stay in the prompt verbatim
+            
+        Returns:
+            Tuple of (summary system message or None, covered) where messages[1:covered]
+            are represented by the summary and messages[covered:] must be sent as-is
+        """
+        if not (1 <= self.summary_watermark < len(messages)):
+            # No summary yet, or the history it described was cleared or replaced
+            self.rolling_summary, self.summary_watermark = "", 1
+        
+        folder = get_summary_folder()
+        if self.summary_watermark < cut:
+            pending = messages[self.summary_watermark:cut]
+            summary, folded = folder.lookup(self.rolling_summary, pending)
+            self.rolling_summary, self.summary_watermark = summary, self.summary_watermark + folded
+            pending = pending[folded:]
+            if pending:
+                if self.summarization_settings.get("async_fold", False):
+                    logger.info(f"Deferring summary fold of {len(pending)} messages until after the response")
+                    self._pending_fold = (self.rolling_summary, pending)
+                else:
+                    logger.info(f"Folding {len(pending)} newly evicted messages into the running summary")
+                    self.rolling_summary = folder.fold(self.rolling_summary, pending, self._fold_summary)
+                    self.summary_watermark = cut
+        
+        if not self.rolling_summary:
+            return None, 1
+        return {"role": "system", "content": f"{self.SUMMARY_PREFIX}{self.rolling_summary}"}, self.summary_watermark
+    
+    def _schedule_summary_fold(self) -> None:
+        """Start the summary fold deferred during trimming, once the response is out."""
+        if self._pending_fold is not None:
+            summary, pending = self._pending_fold
+            self._pending_fold = None
+            get_summary_folder().fold_in_background(summary, pending, self._fold_summary)
     
     def _trim_history(self, messages: List[Dict]) -> Tuple[List[Dict], bool]:
         """
@@ -379,6 +576,13 @@ class FlaskRAGAssistantWithHistory:
         Returns:
             Tuple of (trimmed_messages, was_trimmed)
         """
+        records = self._prompt_records(messages)
+        if self.history_compaction:
+            messages = [m.to_dict() for m in records]
+        
+        if self.history_trim_strategy == "tokens":
+            return self._trim_history_to_budget(messages, records)
+        
         logger.info(
             f"TRIM_DEBUG: Called with {len(messages)} messages. Cap is {self.max_history_turns*2+1}"
         )
@@ -413,41 +617,131 @@ class FlaskRAGAssistantWithHistory:
         # Extract the system message (first message)
         system_message = messages[0]
         
-        # Determine which messages to keep and which to summarize
-        messages_to_keep = messages[-self.max_history_turns*2:]  # Keep the most recent N turns
-        messages_to_summarize = messages[1:-self.max_history_turns*2]  # Summarize older messages (excluding system)
-        
-        # If there are messages to summarize, generate a summary
-        if messages_to_summarize:
-            logger.info(f"Summarizing {len(messages_to_summarize)} messages")
-            summary_message = self.summarize_history(messages_to_summarize)
-            
+        # Keep the most recent N turns; older messages are represented by the running summary
+        summary_message, covered = self._rolling_summary_message(messages, len(messages) - self.max_history_turns*2)
+        if summary_message:
             # Construct the new message list: system message + summary + recent messages
-            trimmed_messages = [system_message, summary_message] + messages_to_keep
+            trimmed_messages = [system_message, summary_message] + messages[covered:]
         else:
-            # If no messages to summarize, just keep system + recent
-            trimmed_messages = [system_message] + messages_to_keep
+            # If there is no summary (yet), just keep system + recent
+            trimmed_messages = [system_message] + messages[covered:]
         
         logger.info(f"After trimming with summarization: {len(trimmed_messages)} messages")
         self._history_trimmed = True
         
         return trimmed_messages, dropped
         
+    def _prompt_records(self, messages: List[Dict]) -> List[Message]:
+        """
+        Return the history as Message records, with earlier turns compacted if enabled.
+        
+        Only the current turn keeps its retrieved context; earlier turns carry
+        citation stubs (source title and parent_id) instead of re-sending their chunks.
+        
+        Args:
+            messages: List of message dictionaries (the rendered conversation history)
+        """
+        records = self.conversation_manager.get_messages()
+        if len(records) != len(messages):
+            # Not the live conversation; build (uncached) records for this call
+            records = [Message.from_content(m["role"], m["content"]) for m in messages]
+        if not self.history_compaction:
+            return records
+        current = max((i for i, m in enumerate(records) if m.role == "user"), default=len(records))
+        return [m.compacted() if i < current else m for i, m in enumerate(records)]
+    
+    def _trim_history_to_budget(self, messages: List[Dict], records: List[Message]) -> Tuple[List[Dict], bool]:
+        """
+        Fit the history into history_token_budget prompt tokens.
+        
+        Token counts are computed once per message and cached on the conversation's
+        Message records. When the history is over budget, in order:
+        1. older turns lose their retrieved <context> or citation stubs (the query text is kept),
+        2. the oldest messages are dropped (the current turn is always kept),
+        3. dropped messages are summarized into one system message, if enabled.
+        The stored history is not modified; only the prompt is.
+        
+        Args:
+            messages: List of message dictionaries (the prompt history)
+            records: The same messages as Message records
+            
+        Returns:
+            Tuple of (trimmed_messages, was_trimmed)
+        """
+        model = self.deployment_name
+        budget = self.history_token_budget
+        head = [records[0]] if records and records[0].role == "system" else []
+        rest = list(records[len(head):])
+        total = REPLY_OVERHEAD + sum(m.token_count(model) for m in head + rest)
+        
+        if total <= budget:
+            self._history_trimmed = False
+            logger.info(f"No trimming needed. History is {total} tokens, budget {budget}")
+            return messages, False
+        
+        logger.info(f"History is {total} tokens, over the {budget} token budget; trimming")
+        summarize = self.summarization_settings.get("enabled", True)
+        # Leave room for the summary that replaces whatever gets dropped
+        target = budget - (self.summarization_settings.get("max_summary_tokens", 800) if summarize else 0)
+        
+        # The latest user message (the current turn) and anything after it are never touched
+        current = max((i for i, m in enumerate(rest) if m.role == "user"), default=len(rest) - 1)
+        
+        # 1. Strip retrieved context from older turns, oldest first
+        for i in range(current):
+            if total <= budget:
+                break
+            stripped = rest[i].without_context()
+            if stripped is not rest[i]:
+                total -= rest[i].token_count(model) - stripped.token_count(model)
+                rest[i] = stripped
+        
+        # 2. Drop the oldest messages, never leaving a dangling assistant reply at the front
+        dropped = []
+        if total > budget:
+            while current > 0 and (total > target or rest[0].role == "assistant"):
+                message = rest.pop(0)
+                dropped.append(message)
+                total -= message.token_count(model)
+                current -= 1
+        
+        trimmed_messages = [m.to_dict() for m in head]
+        if head and summarize and (dropped or self.rolling_summary):
+            # The running summary may cover more (or, while a fold is deferred, fewer) messages than were dropped
+            prompt = trimmed_messages + [m.to_dict() for m in dropped + rest]
+            summary_message, covered = self._rolling_summary_message(prompt, len(head) + len(dropped))
+            trimmed_messages += ([summary_message] if summary_message else []) + prompt[covered:]
+        else:
+            trimmed_messages += [m.to_dict() for m in rest]
+        
+        logger.info(f"After token trimming: {len(trimmed_messages)} messages, ~{total} tokens before summary")
+        self._history_trimmed = True
+        return trimmed_messages, True
+    
+    def _trim_notice(self) -> Dict[str, str]:
+        """System note appended to the prompt when the history was trimmed."""
+        if self.history_trim_strategy == "tokens":
+            return {"role": "system", "content": "[Earlier history condensed to fit the prompt budget]"}
+        return {"role": "system", "content": f"[History trimmed to last {self.max_history_turns} turns]"}
+        
     def _prepare_context(self, results: List[Dict]) -> Tuple[str, Dict]:
         logger.debug(f"_prepare_context input results count: {len(results)} snippet: {results[:3]}")
         logger.info(f"Preparing context from {len(results)} search results")
+        # Collapse near-identical chunks so they do not take several of the slots
+        results = get_near_duplicate_filter().filter(results)
         entries, src_map = [], {}
         sid = 1
         valid_chunks = 0
         
-        for res in results[:5]:
-            chunk = res["chunk"].strip()
-            if not chunk:
-                logger.warning(f"Empty chunk found in result {sid}, skipping")
-                continue
-
+        # Fill the context token budget by score; the chunk that overflows is cut at a sentence
+        packed = get_context_packer().pack(
+            results,
+            lambda res: format_context_text(res["chunk"].strip()),
+            budget=self.context_token_budget,
+            model=self.deployment_name,
+        )
+        for res, formatted_chunk, tokens, truncated in packed:
             valid_chunks += 1
-            formatted_chunk = format_context_text(chunk)
             
             # Log parent_id if available
             parent_id = res.get("parent_id", "")
@@ -460,7 +754,9 @@ class FlaskRAGAssistantWithHistory:
             src_map[str(sid)] = {
                 "title": res["title"],
                 "content": formatted_chunk,
-                "parent_id": parent_id  # Include parent_id in source map
+                "parent_id": parent_id,  # Include parent_id in source map
+                "tokens": tokens,
+                "truncated": truncated,
             }
             sid += 1
 
@@ -476,6 +772,62 @@ class FlaskRAGAssistantWithHistory:
         """Generate a response using the conversation history"""
         logger.info("Generating response with conversation history")
         
+        messages, trimmed, _ = self._build_history_messages(query, context, src_map)
+        if trimmed:
+            # Add a system notification at the end of history
+            messages.append(self._trim_notice())
+        
+        # Get response from OpenAI service
+        import json
+        payload = {
+            "model": self.deployment_name,
+            "messages": messages,
+            "max_tokens": self.max_tokens,
+            "temperature": self.temperature,
+            "top_p": self.top_p,
+            "presence_penalty": self.presence_penalty,
+            "frequency_penalty": self.frequency_penalty
+        }
+        logger.info("========== OPENAI RAW PAYLOAD ==========")
+        logger.info(json.dumps(payload, indent=2))
+        response = self.openai_service.get_chat_response(
+            messages=messages,
+            temperature=self.temperature,
+            max_tokens=self.max_tokens,
+            top_p=self.top_p
+        )
+        
+        # Add the assistant's response to conversation history
+        self.conversation_manager.add_assistant_message(response)
+        self._schedule_summary_fold()
+        
+        return response
+
+    def _chat_params(self) -> Dict[str, Any]:
+        """This assistant's model parameters, as keyword arguments for OpenAIService chat calls."""
+        return {
+            'max_tokens': self.max_tokens,
+            'temperature': self.temperature,
+            'top_p': self.top_p,
+            'presence_penalty': self.presence_penalty,
+            'frequency_penalty': self.frequency_penalty,
+        }
+
+    def _build_history_messages(self, query: str, context: str,
+                                src_map: Optional[Dict] = None) -> Tuple[List[Dict], bool, int]:
+        """
+        Add the context-wrapped user query to the conversation history and return
+        the (possibly compacted and trimmed) message list to send to the model.
+        
+        Args:
+            query: The user query
+            context: The context string from _prepare_context
+            src_map: The matching source map; its titles and parent_ids become the
+                citation stubs that replace this context on later turns
+        
+        Returns:
+            Tuple of (messages, was_trimmed, number_of_messages_dropped)
+        """
         # Check if custom prompt is available in settings
         settings = self.settings
         custom_prompt = settings.get("custom_prompt", "")
@@ -500,16 +852,13 @@ class FlaskRAGAssistantWithHistory:
         
         # Add the user message to conversation history (only once)
         logger.info(f"Adding user message to conversation history")
-        self.conversation_manager.add_user_message(context_message)
+        self.conversation_manager.add_user_message(context_message, sources=self._source_stubs(src_map))
         
         # Get the complete conversation history
         raw_messages = self.conversation_manager.get_history()
         
         # Trim history if needed
         messages, trimmed = self._trim_history(raw_messages)
-        if trimmed:
-            # Add a system notification at the end of history
-            messages.append({"role": "system", "content": f"[History trimmed to last {self.max_history_turns} turns]"})
         
         # Log the conversation history
         logger.info(f"Conversation history has {len(messages)} messages (trimmed: {trimmed})")
@@ -518,30 +867,7 @@ class FlaskRAGAssistantWithHistory:
             if i < 3 or i >= len(messages) - 2:  # Log first 3 and last 2 messages
                 logger.info(f"Content: {msg['content'][:100]}...")
         
-        # Get response from OpenAI service
-        import json
-        payload = {
-            "model": self.deployment_name,
-            "messages": messages,
-            "max_tokens": self.max_tokens,
-            "temperature": self.temperature,
-            "top_p": self.top_p,
-            "presence_penalty": self.presence_penalty,
-            "frequency_penalty": self.frequency_penalty
-        }
-        logger.info("========== OPENAI RAW PAYLOAD ==========")
-        logger.info(json.dumps(payload, indent=2))
-        response = self.openai_service.get_chat_response(
-            messages=messages,
-            temperature=self.temperature,
-            max_tokens=self.max_tokens,
-            top_p=self.top_p
-        )
-        
-        # Add the assistant's response to conversation history
-        self.conversation_manager.add_assistant_message(response)
-        
-        return response
+        return messages, trimmed, len(raw_messages) - len(messages)
 
     def _filter_cited(self, answer: str, src_map: Dict) -> List[Dict]:
         logger.debug(f"_filter_cited received answer snippet: {answer[:300]}")
@@ -618,7 +944,25 @@ class FlaskRAGAssistantWithHistory:
         """
         Enhance the user query with conversation history.
         """
+        prompt = self._build_enhancement_prompt(query)
         
+        try:
+            self._rate_limit(self.deployment_name, prompt, 100)
+            response = self.openai_client.completions.create(
+                model=self.deployment_name,
+                prompt=prompt,
+                max_tokens=100,
+                temperature=0.2,
+            )
+            enhanced_query = response.choices[0].text.strip()
+            logger.info(f"Enhanced query: {enhanced_query}")
+            return enhanced_query
+        except Exception as e:
+            logger.error(f"Error enhancing query: {e}")
+            return query
+
+    def _build_enhancement_prompt(self, query: str) -> str:
+        """Build the completion prompt used to rewrite the query as a standalone search query."""
         # Get the last few messages from the history
         history = self.conversation_manager.get_history()[-5:]
         
@@ -629,20 +973,111 @@ class FlaskRAGAssistantWithHistory:
             prompt += f"{msg['role']}: {msg['content']}\n"
             
         prompt += f"\nGenerate a search query for the last user message: '{query}'"
+        return prompt
+
+    def _renumber_citations(self, answer: str, src_map: Dict) -> Tuple[str, List[Dict]]:
+        """Keep only the cited sources and renumber them (and the answer's markers) 1, 2, 3…"""
+        cited_raw = self._filter_cited(answer, src_map)
         
+        renumber_map = {}
+        cited_sources = []
+        for new_id, src in enumerate(cited_raw, 1):
+            old_id = src["id"]
+            renumber_map[old_id] = str(new_id)
+            entry = {
+                "id": str(new_id), 
+                "title": src["title"], 
+                "content": src["content"],
+                "parent_id": src.get("parent_id", "")  # Include parent_id in cited sources
+            }
+            if "url" in src:
+                entry["url"] = src["url"]
+            cited_sources.append(entry)
+        for old, new in renumber_map.items():
+            answer = re.sub(rf"\[{old}\]", f"[{new}]", answer)
+        return answer, cited_sources
+
+    def _log_rag_query(self, query: str, answer: str, cited_sources: List[Dict], context: str,
+                       latency_ms: Optional[float] = None, usage: Optional[Dict] = None) -> None:
+        """Queue the query, response, sources, latency and token usage for the database without failing the request."""
         try:
-            response = self.openai_client.completions.create(
+            # Get the SQL query used to retrieve the results (if available)
+            sql_query = None
+            # If you have access to the actual SQL query used, set it here
+            
+            # Queue the row for the background writer (no database round-trip here)
+            get_db_writer().log_rag_query(
+                query=query,
+                response=answer,
+                sources=cited_sources,
+                context=context,
+                sql_query=sql_query,
                 model=self.deployment_name,
-                prompt=prompt,
-                max_tokens=100,
-                temperature=0.2,
+                latency_ms=latency_ms,
+                **(usage or {})
             )
-            enhanced_query = response.choices[0].text.strip()
-            logger.info(f"Enhanced query: {enhanced_query}")
-            return enhanced_query
-        except Exception as e:
-            logger.error(f"Error enhancing query: {e}")
-            return query
+        except Exception as log_exc:
+            logger.error(f"Error logging RAG query to database: {log_exc}")
+            # Continue even if logging fails
+
+    # ─────────── semantic answer cache ───────────
+    def _semantic_cache_fingerprint(self) -> Optional[str]:
+        """
+        Return the semantic cache namespace for this assistant, or None when the cache
+        must not be used (disabled in settings, or the session already has history that
+        could change the answer to a follow-up question).
+        """
+        if not self.settings.get("semantic_cache", True):
+            return None
+        history = self.conversation_manager.get_history()
+        if len(history) > 1:
+            return None
+        system_prompt = history[0]["content"] if history else self.DEFAULT_SYSTEM_PROMPT
+        return make_fingerprint(
+            search_endpoint=self.search_endpoint,
+            search_index=self.search_index,
+            deployment=self.deployment_name,
+            system_prompt=system_prompt,
+            custom_prompt=self.settings.get("custom_prompt", ""),
+            reranker=get_reranker().mode,
+        )
+
+    def _answer_from_cache(self, query: str, hit: Dict[str, Any]) -> Tuple[str, List[Dict], List[Dict], Dict[str, Any], str]:
+        """Replay a cached answer into the conversation history and return it."""
+        custom_prompt = self.settings.get("custom_prompt", "")
+        if custom_prompt:
+            query = f"{custom_prompt}\n\n{query}"
+        context = hit["context"]
+        # Entries stored before source stubs were cached compact to the bare note
+        stubs = hit.get("source_stubs")
+        self.conversation_manager.add_user_message(
+            f"<context>\n{context}\n</context>\n<user_query>\n{query}\n</user_query>",
+            sources=[tuple(stub) for stub in stubs] if stubs else None,
+        )
+        self.conversation_manager.add_assistant_message(hit["history_answer"])
+        self.last_response_cached = True
+        return hit["answer"], hit["sources"], [], hit["evaluation"], context
+
+    def _store_in_semantic_cache(self, fingerprint: str, query_embedding: List[float], answer: str,
+                                 history_answer: str, cited_sources: List[Dict], evaluation: Dict[str, Any],
+                                 context: str, src_map: Optional[Dict] = None) -> None:
+        """Remember a freshly generated answer for _answer_from_cache."""
+        get_semantic_cache().store(fingerprint, query_embedding, {
+            "answer": answer,
+            "history_answer": history_answer,
+            "sources": cited_sources,
+            "evaluation": evaluation,
+            "context": context,
+            # (title, parent_id) per context source, so a replayed turn compacts to citation stubs
+            "source_stubs": [list(stub) for stub in self._source_stubs(src_map) or []],
+        })
+
+    @staticmethod
+    def _source_stubs(src_map: Optional[Dict]) -> Optional[List[Tuple[str, str]]]:
+        """(title, parent_id) of each source in the context, or None when there is no source map."""
+        if not src_map:
+            return None
+        return [(src.get("title", ""), src.get("parent_id", "")) for src in src_map.values()]
 
     # ─────────── public API ───────────────
     def generate_rag_response(
@@ -658,12 +1093,20 @@ class FlaskRAGAssistantWithHistory:
         Returns:
             answer, cited_sources, [], evaluation, context
         """
+        self.last_response_cached = False
+        started = time.perf_counter()
         try:
-            if not is_enhanced:
-                enhanced_query = self._get_enhanced_query(query)
-            else:
-                enhanced_query = query
-            kb_results = self.search_knowledge_base(enhanced_query)
+            # Serve near-duplicate questions from the semantic cache
+            cache_fingerprint = self._semantic_cache_fingerprint()
+            query_embedding = None
+            if cache_fingerprint:
+                query_embedding = self.generate_embedding(query)
+                hit = get_semantic_cache().lookup(cache_fingerprint, query_embedding)
+                if hit:
+                    logger.info(f"Serving answer from semantic cache (similarity={hit['similarity']:.4f})")
+                    return self._answer_from_cache(query, hit)
+
+            kb_results = self._retrieve(query, is_enhanced)
             if not kb_results:
                 return (
                     "No relevant information found in the knowledge base.",
@@ -673,31 +1116,17 @@ class FlaskRAGAssistantWithHistory:
                     "",
                 )
 
+            kb_results = self._expand(self._rerank(query, kb_results))
             context, src_map = self._prepare_context(kb_results)
             
             # Use the conversation history to generate the answer
+            self.openai_service.last_usage = None
             answer = self._chat_answer_with_history(query, context, src_map)
+            usage = self.openai_service.last_usage
+            history_answer = answer
 
-            # Collect only the sources actually cited
-            cited_raw = self._filter_cited(answer, src_map)
-
-            # Renumber in cited order: 1, 2, 3…
-            renumber_map = {}
-            cited_sources = []
-            for new_id, src in enumerate(cited_raw, 1):
-                old_id = src["id"]
-                renumber_map[old_id] = str(new_id)
-                entry = {
-                    "id": str(new_id), 
-                    "title": src["title"], 
-                    "content": src["content"],
-                    "parent_id": src.get("parent_id", "")  # Include parent_id in cited sources
-                }
-                if "url" in src:
-                    entry["url"] = src["url"]
-                cited_sources.append(entry)
-            for old, new in renumber_map.items():
-                answer = re.sub(rf"\[{old}\]", f"[{new}]", answer)
+            # Collect only the sources actually cited, renumbered in cited order: 1, 2, 3…
+            answer, cited_sources = self._renumber_citations(answer, src_map)
 
             evaluation = self.fact_checker.evaluate_response(
                 query=query,
@@ -707,22 +1136,14 @@ class FlaskRAGAssistantWithHistory:
             )
             
             # Log the query, response, and sources to the database
-            try:
-                # Get the SQL query used to retrieve the results (if available)
-                sql_query = None
-                # If you have access to the actual SQL query used, set it here
-                
-                # Log the query to the database
-                DatabaseManager.log_rag_query(
-                    query=query,
-                    response=answer,
-                    sources=cited_sources,
-                    context=context,
-                    sql_query=sql_query
+            latency_ms = (time.perf_counter() - started) * 1000
+            self._log_rag_query(query, answer, cited_sources, context, latency_ms=latency_ms, usage=usage)
+            
+            if cache_fingerprint:
+                self._store_in_semantic_cache(
+                    cache_fingerprint, query_embedding, answer, history_answer, cited_sources, evaluation, context,
+                    src_map,
                 )
-            except Exception as log_exc:
-                logger.error(f"Error logging RAG query to database: {log_exc}")
-                # Continue even if logging fails
             
             return answer, cited_sources, [], evaluation, context
         
@@ -746,6 +1167,7 @@ class FlaskRAGAssistantWithHistory:
         Yields:
             Either string chunks of the answer or a dictionary with metadata
         """
+        started = time.perf_counter()
         try:
             logger.info(f"========== STARTING STREAM RAG RESPONSE WITH HISTORY ==========")
             logger.info(f"Original query: {query}")
@@ -760,96 +1182,33 @@ class FlaskRAGAssistantWithHistory:
                 }
                 return
 
+            kb_results = self._expand(self._rerank(query, kb_results))
             context, src_map = self._prepare_context(kb_results)
             logger.info(f"Retrieved {len(kb_results)} results from knowledge base")
             
-            # Check if custom prompt is available in settings
-            settings = self.settings
-            custom_prompt = settings.get("custom_prompt", "")
-            
-            # Apply custom prompt to query if available
-            if custom_prompt:
-                query = f"{custom_prompt}\n\n{query}"
-                logger.info(f"Applied custom prompt to query: {custom_prompt[:100]}...")
-            
-            # Create a context message
-            context_message = f"<context>\n{context}\n</context>\n<user_query>\n{query}\n</user_query>"
-            
-            # Add the user message to conversation history
-            self.conversation_manager.add_user_message(context_message)
-            
-            # Get the complete conversation history
-            raw_messages = self.conversation_manager.get_history()
-            
-            # Trim history if needed
-            messages, trimmed = self._trim_history(raw_messages)
+            messages, trimmed, dropped = self._build_history_messages(query, context, src_map)
             if trimmed:
                 # Yield a notification about trimming
-                yield {"trimmed": True, "dropped": len(raw_messages) - len(messages)}
+                yield {"trimmed": True, "dropped": dropped}
             
-            # Log the conversation history
-            logger.info(f"Conversation history has {len(messages)} messages (trimmed: {trimmed})")
-            for i, msg in enumerate(messages):
-                logger.info(f"Message {i} - Role: {msg['role']}")
-                if i < 3 or i >= len(messages) - 2:  # Log first 3 and last 2 messages
-                    logger.info(f"Content: {msg['content'][:100]}...")
-            
-            # Stream the response
+            # Stream the response (deadline, retries and usage capture are handled by the service)
             collected_chunks = []
-            collected_answer = ""
-            
-            # Use the OpenAI client directly for streaming since our OpenAIService doesn't support streaming yet
-            request = {
-                # Arguments for self.openai_client.chat.completions.create
-                'model': self.deployment_name,
-                'messages': messages,
-                'max_tokens': self.max_tokens,
-                'temperature': self.temperature,
-                'top_p': self.top_p,
-                'presence_penalty': self.presence_penalty,
-                'frequency_penalty': self.frequency_penalty,
-                'stream': True
-            }
-            log_openai_call(request, {"type": "stream_started"})
-            stream = self.openai_client.chat.completions.create(**request)
-            
-            # Process the streaming response
-            for chunk in stream:
-                if chunk.choices and chunk.choices[0].delta.content:
-                    content = chunk.choices[0].delta.content
-                    collected_chunks.append(content)
-                    collected_answer += content
-                    # Yield the raw content - the client-side will handle markdown rendering
-                    # This ensures consistent rendering across all response types
-                    yield content
+            for content in self.openai_service.stream_chat_response(messages, **self._chat_params()):
+                collected_chunks.append(content)
+                # Yield the raw content - the client-side will handle markdown rendering
+                # This ensures consistent rendering across all response types
+                yield content
+            collected_answer = "".join(collected_chunks)
+            usage = self.openai_service.last_usage
             
             logger.info("DEBUG - Collected answer: %s", collected_answer[:100])
             
             # Add the assistant's response to conversation history
             self.conversation_manager.add_assistant_message(collected_answer)
+            self._schedule_summary_fold()
             
-            # Filter cited sources
-            cited_raw = self._filter_cited(collected_answer, src_map)
-            
-            # Renumber in cited order: 1, 2, 3…
-            renumber_map = {}
-            cited_sources = []
-            for new_id, src in enumerate(cited_raw, 1):
-                old_id = src["id"]
-                renumber_map[old_id] = str(new_id)
-                entry = {
-                    "id": str(new_id), 
-                    "title": src["title"], 
-                    "content": src["content"],
-                    "parent_id": src.get("parent_id", "")  # Include parent_id in cited sources
-                }
-                if "url" in src:
-                    entry["url"] = src["url"]
-                cited_sources.append(entry)
-            
-            # Apply renumbering to the answer
-            for old, new in renumber_map.items():
-                collected_answer = re.sub(rf"\[{old}\]", f"[{new}]", collected_answer)
+            # Filter cited sources and renumber in cited order: 1, 2, 3…
+            collected_answer, cited_sources = self._renumber_citations(collected_answer, src_map)
             
             # Get evaluation
             evaluation = self.fact_checker.evaluate_response(
@@ -860,22 +1219,8 @@ class FlaskRAGAssistantWithHistory:
             )
             
             # Log the query, response, and sources to the database
-            try:
-                # Get the SQL query used to retrieve the results (if available)
-                sql_query = None
-                # If you have access to the actual SQL query used, set it here
-                
-                # Log the query to the database
-                DatabaseManager.log_rag_query(
-                    query=query,
-                    response=collected_answer,
-                    sources=cited_sources,
-                    context=context,
-                    sql_query=sql_query
-                )
-            except Exception as log_exc:
-                logger.error(f"Error logging RAG query to database: {log_exc}")
-                # Continue even if logging fails
+            latency_ms = (time.perf_counter() - started) * 1000
+            self._log_rag_query(query, collected_answer, cited_sources, context, latency_ms=latency_ms, usage=usage)
             
             # Yield the metadata
             yield {
@@ -892,6 +1237,44 @@ class FlaskRAGAssistantWithHistory:
                 "error": str(exc)
             }
             
+    # ───────────────────────── session state ─────────────────────────
+    # Per-session attributes that survive between requests; everything else is rebuilt
+    SESSION_STATE_FIELDS = (
+        "deployment_name", "temperature", "top_p", "max_tokens", "presence_penalty",
+        "frequency_penalty", "max_history_turns", "history_trim_strategy", "history_token_budget",
+        "history_compaction", "context_token_budget", "summarization_settings", "rolling_summary", "summary_watermark",
+        "search_index", "settings",
+    )
+
+    def export_state(self) -> Dict[str, Any]:
+        """
+        Return the compact, JSON-serializable state of this conversation.
+
+        Returns:
+            Dict with the binary-encoded conversation and the per-session settings
+        """
+        return {
+            "conversation": self.conversation_manager.to_bytes(),
+            "attrs": {name: getattr(self, name) for name in self.SESSION_STATE_FIELDS},
+        }
+
+    def load_state(self, state: Dict[str, Any]) -> None:
+        """
+        Restore a conversation previously captured with export_state().
+
+        Args:
+            state: The dict returned by export_state()
+        """
+        for name, value in state.get("attrs", {}).items():
+            if name in self.SESSION_STATE_FIELDS:
+                setattr(self, name, value)
+        self.openai_service.deployment_name = self.deployment_name
+        if "conversation" in state:
+            self.conversation_manager.load_bytes(state["conversation"])
+        elif "history" in state:
+            # States saved before conversations were binary-encoded
+            self.conversation_manager.chat_history = list(state["history"])
+
     def clear_conversation_history(self, preserve_system_message: bool = True) -> None:
         """
         Clear the conversation history.
@@ -900,4 +1283,5 @@ class FlaskRAGAssistantWithHistory:
             preserve_system_message: Whether to preserve the initial system message
         """
         self.conversation_manager.clear_history(preserve_system_message)
+        self.rolling_summary, self.summary_watermark = "", 0
         logger.info(f"Conversation history cleared (preserve_system_message={preserve_system_message})")
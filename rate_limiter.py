@@ -0,0 +1,328 @@
+"""
+Client-side request scheduling for Azure OpenAI RPM / TPM quotas
+"""
+import asyncio
+import heapq
+import itertools
+import json
+import logging
+import threading
+import time
+from typing import Any, Dict, Optional, Tuple
+
+from config import (
+    OPENAI_RPM_LIMIT,
+    OPENAI_TPM_LIMIT,
+    OPENAI_DEPLOYMENT_LIMITS,
+    RATE_LIMIT_BURST_SECONDS,
+)
+
+logger = logging.getLogger(__name__)
+
+# Priorities: lower values are served first
+INTERACTIVE = 0   # Answers, query enhancement and query embeddings a user is waiting for
+SUMMARY = 1       # History summarization
+BACKGROUND = 2    # Evaluation, analysis and other batch work
+
+PRIORITY_NAMES = {INTERACTIVE: "interactive", SUMMARY: "summary", BACKGROUND: "background"}
+
+# How often a waiter that is not at the head of the queue re-checks (async waiters cannot be notified)
+_POLL_SECONDS = 0.02
+
+
+class QueueTimeout(TimeoutError):
+    """Raised when a request cannot be scheduled before its deadline."""
+
+
+def _parse_limits(raw: str) -> Dict[str, Dict[str, int]]:
+    if not raw:
+        return {}
+    try:
+        return {name: {k: int(v) for k, v in limits.items()} for name, limits in json.loads(raw).items()}
+    except (ValueError, AttributeError) as e:
+        logger.error(f"Ignoring invalid OPENAI_DEPLOYMENT_LIMITS: {e}")
+        return {}
+
+
+class _Waiter:
+    __slots__ = ("priority", "seq", "tokens", "enqueued", "cancelled")
+
+    def __init__(self, priority: int, seq: int, tokens: int):
+        self.priority = priority
+        self.seq = seq
+        self.tokens = tokens
+        self.enqueued = time.monotonic()
+        self.cancelled = False
+
+    def __lt__(self, other: "_Waiter") -> bool:
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+
+class DeploymentScheduler:
+    """
+    Token buckets and a priority queue for one deployment.
+
+    This class is responsible for:
+    - Holding a request bucket (RPM) and a token bucket (TPM), refilled continuously
+      and sized to RATE_LIMIT_BURST_SECONDS worth of quota, so bursts stay inside
+      the short windows Azure also enforces
+    - Admitting waiting requests strictly in (priority, arrival) order
+    - Pausing admissions when the service answers 429 with a Retry-After
+    - Recording queue depth and wait times
+    """
+
+    def __init__(self, name: str, rpm: int = 0, tpm: int = 0, burst_seconds: float = RATE_LIMIT_BURST_SECONDS):
+        """
+        Initialize the scheduler.
+
+        Args:
+            name: Deployment name (for logs and metrics)
+            rpm: Requests per minute allowed (0 = unlimited)
+            tpm: Tokens per minute allowed (0 = unlimited)
+            burst_seconds: Seconds of quota the buckets can hold
+        """
+        self.name = name
+        self.rpm = rpm
+        self.tpm = tpm
+        window = min(max(burst_seconds, 1.0), 60.0) / 60.0
+        self.request_capacity = max(1.0, rpm * window) if rpm else 0.0
+        self.token_capacity = max(1.0, tpm * window) if tpm else 0.0
+        self._requests = self.request_capacity
+        self._tokens = self.token_capacity
+        self._refilled = time.monotonic()
+        self._paused_until = 0.0
+
+        self._cond = threading.Condition()
+        self._queue = []
+        self._seq = itertools.count()
+        self._stats = {
+            "admitted": 0, "timeouts": 0, "throttled": 0, "max_queue_depth": 0,
+            "wait_seconds": 0.0, "max_wait_seconds": 0.0,
+            "admitted_by_priority": {name: 0 for name in PRIORITY_NAMES.values()},
+        }
+
+    @property
+    def unlimited(self) -> bool:
+        return not self.rpm and not self.tpm
+
+    def _refill(self, now: float) -> None:
+        elapsed = now - self._refilled
+        self._refilled = now
+        if self.rpm:
+            self._requests = min(self.request_capacity, self._requests + elapsed * self.rpm / 60.0)
+        if self.tpm:
+            self._tokens = min(self.token_capacity, self._tokens + elapsed * self.tpm / 60.0)
+
+    def _enqueue(self, tokens: int, priority: int) -> _Waiter:
+        if self.token_capacity:
+            # A request larger than the bucket is admitted once the bucket is full
+            tokens = min(tokens, int(self.token_capacity))
+        waiter = _Waiter(priority, next(self._seq), tokens)
+        heapq.heappush(self._queue, waiter)
+        self._stats["max_queue_depth"] = max(self._stats["max_queue_depth"], len(self._queue))
+        return waiter
+
+    def _try_admit(self, waiter: _Waiter) -> float:
+        """Admit waiter if it is next and affordable; otherwise return seconds to wait. Call under the lock."""
+        while self._queue and self._queue[0].cancelled:
+            heapq.heappop(self._queue)
+        now = time.monotonic()
+        if now < self._paused_until:
+            return self._paused_until - now
+        if self._queue[0] is not waiter:
+            return _POLL_SECONDS
+        self._refill(now)
+        wait = 0.0
+        if self.rpm and self._requests < 1:
+            wait = max(wait, (1 - self._requests) * 60.0 / self.rpm)
+        if self.tpm and self._tokens < waiter.tokens:
+            wait = max(wait, (waiter.tokens - self._tokens) * 60.0 / self.tpm)
+        if wait > 0:
+            return wait
+
+        heapq.heappop(self._queue)
+        if self.rpm:
+            self._requests -= 1
+        if self.tpm:
+            self._tokens -= waiter.tokens
+        waited = now - waiter.enqueued
+        stats = self._stats
+        stats["admitted"] += 1
+        key = PRIORITY_NAMES.get(waiter.priority, str(waiter.priority))
+        stats["admitted_by_priority"][key] = stats["admitted_by_priority"].get(key, 0) + 1
+        stats["wait_seconds"] += waited
+        stats["max_wait_seconds"] = max(stats["max_wait_seconds"], waited)
+        self._cond.notify_all()
+        return 0.0
+
+    def _give_up(self, waiter: _Waiter) -> None:
+        waiter.cancelled = True
+        self._stats["timeouts"] += 1
+        self._cond.notify_all()
+
+    def acquire(self, tokens: int, priority: int = INTERACTIVE, timeout: Optional[float] = None) -> None:
+        """
+        Block until the request may be sent.
+
+        Args:
+            tokens: Estimated tokens the request counts against TPM
+            priority: INTERACTIVE, SUMMARY or BACKGROUND
+            timeout: Maximum seconds to wait (None = no limit)
+
+        Raises:
+            QueueTimeout: If the request could not be admitted within timeout
+        """
+        if self.unlimited:
+            return
+        expires = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            waiter = self._enqueue(tokens, priority)
+            while True:
+                wait = self._try_admit(waiter)
+                if wait <= 0:
+                    return
+                if expires is not None:
+                    left = expires - time.monotonic()
+                    if left <= 0 or (waiter is self._queue[0] and wait > left):
+                        self._give_up(waiter)
+                        raise QueueTimeout(f"Rate limit queue for {self.name} did not admit the request in time")
+                    wait = min(wait, left)
+                self._cond.wait(wait)
+
+    async def aacquire(self, tokens: int, priority: int = INTERACTIVE, timeout: Optional[float] = None) -> None:
+        """Async version of acquire; waits without blocking the event loop."""
+        if self.unlimited:
+            return
+        expires = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            waiter = self._enqueue(tokens, priority)
+        while True:
+            with self._cond:
+                wait = self._try_admit(waiter)
+                if wait <= 0:
+                    return
+                if expires is not None:
+                    left = expires - time.monotonic()
+                    if left <= 0 or (waiter is self._queue[0] and wait > left):
+                        self._give_up(waiter)
+                        raise QueueTimeout(f"Rate limit queue for {self.name} did not admit the request in time")
+                    wait = min(wait, left)
+            try:
+                await asyncio.sleep(min(wait, 1.0))
+            except asyncio.CancelledError:
+                with self._cond:
+                    self._give_up(waiter)
+                raise
+
+    def settle(self, estimated: int, actual: Optional[int]) -> None:
+        """
+        Charge tokens a request used beyond its estimate.
+
+        Unused estimate is not refunded: Azure counts the estimate (prompt + max_tokens)
+        against TPM when the request arrives, so refunding would overshoot the quota.
+        """
+        if not self.tpm or actual is None or actual <= estimated:
+            return
+        with self._cond:
+            self._refill(time.monotonic())
+            self._tokens -= actual - estimated
+
+    def throttled(self, retry_after: float) -> None:
+        """Pause admissions after a 429, so queued requests do not all fail the same way."""
+        with self._cond:
+            self._paused_until = max(self._paused_until, time.monotonic() + retry_after)
+            self._stats["throttled"] += 1
+            # Whatever the buckets held was evidently not available server-side
+            self._requests = min(self._requests, 0.0)
+            self._tokens = min(self._tokens, 0.0)
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Return limits, queue depth and wait-time counters."""
+        with self._cond:
+            self._refill(time.monotonic())
+            stats = dict(self._stats, admitted_by_priority=dict(self._stats["admitted_by_priority"]))
+            depth = sum(1 for w in self._queue if not w.cancelled)
+            paused = max(0.0, self._paused_until - time.monotonic())
+            requests, tokens = self._requests, self._tokens
+        admitted = stats["admitted"]
+        stats.update(
+            rpm=self.rpm,
+            tpm=self.tpm,
+            queue_depth=depth,
+            avg_wait_seconds=stats["wait_seconds"] / admitted if admitted else 0.0,
+            paused_seconds=paused,
+            available_requests=requests if self.rpm else None,
+            available_tokens=tokens if self.tpm else None,
+        )
+        return stats
+
+
+class RateLimiter:
+    """
+    Process-wide registry of per-deployment schedulers.
+
+    This class is responsible for:
+    - Resolving each deployment's RPM / TPM limits (OPENAI_DEPLOYMENT_LIMITS, then the defaults)
+    - Handing out one DeploymentScheduler per deployment
+    - Aggregating their metrics
+    """
+
+    def __init__(self, rpm: int = OPENAI_RPM_LIMIT, tpm: int = OPENAI_TPM_LIMIT,
+                 deployment_limits: Optional[Dict[str, Dict[str, int]]] = None):
+        """
+        Initialize the limiter.
+
+        Args:
+            rpm: Default requests per minute per deployment (0 = unlimited)
+            tpm: Default tokens per minute per deployment (0 = unlimited)
+            deployment_limits: {deployment: {"rpm": ..., "tpm": ...}} overrides
+        """
+        self.rpm = rpm
+        self.tpm = tpm
+        self.deployment_limits = _parse_limits(OPENAI_DEPLOYMENT_LIMITS) if deployment_limits is None else deployment_limits
+        self._lock = threading.Lock()
+        self._schedulers: Dict[str, DeploymentScheduler] = {}
+
+    def limits_for(self, deployment: str) -> Tuple[int, int]:
+        """Return (rpm, tpm) for a deployment."""
+        limits = self.deployment_limits.get(deployment, {})
+        return limits.get("rpm", self.rpm), limits.get("tpm", self.tpm)
+
+    def scheduler(self, deployment: Optional[str]) -> DeploymentScheduler:
+        """Return the scheduler for a deployment, creating it on first use."""
+        name = deployment or "default"
+        with self._lock:
+            scheduler = self._schedulers.get(name)
+            if scheduler is None:
+                rpm, tpm = self.limits_for(name)
+                scheduler = self._schedulers[name] = DeploymentScheduler(name, rpm=rpm, tpm=tpm)
+            return scheduler
+
+    def acquire(self, deployment: Optional[str], tokens: int, priority: int = INTERACTIVE,
+                timeout: Optional[float] = None) -> None:
+        """Block until a request to deployment may be sent (see DeploymentScheduler.acquire)."""
+        self.scheduler(deployment).acquire(tokens, priority, timeout)
+
+    async def aacquire(self, deployment: Optional[str], tokens: int, priority: int = INTERACTIVE,
+                       timeout: Optional[float] = None) -> None:
+        """Async version of acquire."""
+        await self.scheduler(deployment).aacquire(tokens, priority, timeout)
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Return per-deployment scheduler metrics."""
+        with self._lock:
+            schedulers = list(self._schedulers.values())
+        return {s.name: s.get_stats() for s in schedulers}
+
+
+_rate_limiter: Optional[RateLimiter] = None
+_rate_limiter_lock = threading.Lock()
+
+
+def get_rate_limiter() -> RateLimiter:
+    """Return the process-wide rate limiter."""
+    global _rate_limiter
+    with _rate_limiter_lock:
+        if _rate_limiter is None:
+            _rate_limiter = RateLimiter()
+        return _rate_limiter
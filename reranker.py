@@ -0,0 +1,228 @@
+"""
+Local reranking of knowledge-base search hits before context preparation
+"""
+import logging
+import math
+import re
+import threading
+import time
+from collections import Counter
+from typing import Any, Callable, Dict, List, Optional
+
+try:
+    from sentence_transformers import CrossEncoder
+except ImportError:  # pragma: no cover - optional dependency
+    CrossEncoder = None
+
+from config import RERANKER_MODE, RERANKER_FUSION_SCORER, RERANKER_FUSION_WEIGHT, RERANKER_MODEL
+
+logger = logging.getLogger(__name__)
+
+# A scorer maps (query, chunk texts) to one score per chunk; higher is better
+Scorer = Callable[[str, List[str]], List[float]]
+
+_TOKEN_RE = re.compile(r"\w+")
+_STOPWORDS = frozenset(
+    "a an and are as at be by can do for from how i in is it of on or the this to what when where which with you your".split()
+)
+RRF_K = 60
+
+
+def tokenize(text: str) -> List[str]:
+    """Lowercase word tokens without stopwords."""
+    return [t for t in _TOKEN_RE.findall(text.lower()) if t not in _STOPWORDS]
+
+
+def bm25_scores(query: str, chunks: List[str], k1: float = 1.5, b: float = 0.75) -> List[float]:
+    """
+    Okapi BM25 of each chunk against the query, with IDF taken over the chunks themselves.
+
+    Args:
+        query: The search query
+        chunks: Candidate chunk texts
+        k1: Term frequency saturation
+        b: Length normalization
+
+    Returns:
+        One score per chunk
+    """
+    docs = [Counter(tokenize(c)) for c in chunks]
+    if not docs:
+        return []
+    lengths = [sum(d.values()) for d in docs]
+    avg_len = (sum(lengths) / len(docs)) or 1.0
+    terms = set(tokenize(query))
+    idf = {}
+    for term in terms:
+        df = sum(1 for d in docs if term in d)
+        idf[term] = math.log(1 + (len(docs) - df + 0.5) / (df + 0.5))
+
+    scores = []
+    for doc, length in zip(docs, lengths):
+        score = 0.0
+        for term in terms:
+            tf = doc.get(term, 0)
+            if tf:
+                score += idf[term] * tf * (k1 + 1) / (tf + k1 * (1 - b + b * length / avg_len))
+        scores.append(score)
+    return scores
+
+
+_cross_encoder = None
+_cross_encoder_lock = threading.Lock()
+
+
+def cross_encoder_scores(query: str, chunks: List[str]) -> List[float]:
+    """Score (query, chunk) pairs with a CPU cross-encoder, loaded once per process."""
+    global _cross_encoder
+    with _cross_encoder_lock:
+        if _cross_encoder is None:
+            if CrossEncoder is None:
+                raise RuntimeError("sentence-transformers is not installed")
+            _cross_encoder = CrossEncoder(RERANKER_MODEL, device="cpu")
+            logger.info(f"Loaded cross-encoder {RERANKER_MODEL}")
+    return [float(s) for s in _cross_encoder.predict([(query, c) for c in chunks])]
+
+
+SCORERS: Dict[str, Scorer] = {"bm25": bm25_scores, "cross_encoder": cross_encoder_scores}
+
+
+def register_scorer(name: str, scorer: Scorer) -> None:
+    """Make a local scorer available as a reranker mode (and as a fusion scorer)."""
+    SCORERS[name] = scorer
+
+
+def search_relevance(hit: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Return the score fields of a raw Azure Search hit.
+
+    The semantic reranker score is preferred over the search score; hits
+    without either keep relevance 1.0.
+    """
+    fields: Dict[str, Any] = {}
+    for key, name in (("@search.score", "search_score"), ("@search.reranker_score", "reranker_score")):
+        if hit.get(key) is not None:
+            fields[name] = float(hit[key])
+    fields["relevance"] = fields.get("reranker_score", fields.get("search_score", 1.0))
+    return fields
+
+
+class Reranker:
+    """
+    Reorders search hits with a local scorer.
+
+    This class is responsible for:
+    - Ranking by the search score alone ("none"), by a local scorer
+      ("bm25", "cross_encoder" or any registered scorer), or by reciprocal
+      rank fusion of the search ranking with a local scorer ("fusion")
+    - Falling back to BM25 when the configured scorer is unavailable
+    - Timing each stage (scoring and fusion) for monitoring
+    """
+
+    def __init__(self, mode: str = RERANKER_MODE, fusion_scorer: str = RERANKER_FUSION_SCORER,
+                 fusion_weight: float = RERANKER_FUSION_WEIGHT):
+        """
+        Initialize the reranker.
+
+        Args:
+            mode: none | fusion | the name of a registered scorer
+            fusion_scorer: Scorer fused with the search ranking in fusion mode
+            fusion_weight: Share of the local scorer in fusion (0-1)
+        """
+        self.mode = mode
+        self.fusion_scorer = fusion_scorer
+        self.fusion_weight = min(max(fusion_weight, 0.0), 1.0)
+        self._lock = threading.Lock()
+        self._stats = {"calls": 0, "fallbacks": 0, "candidates": 0, "stage_ms": {"score": 0.0, "fuse": 0.0}}
+        self.last_timings: Dict[str, float] = {}
+
+    def _score(self, name: str, query: str, chunks: List[str]) -> List[float]:
+        try:
+            return SCORERS[name](query, chunks)
+        except Exception as exc:
+            if name == "bm25":
+                raise
+            logger.warning(f"Reranker scorer '{name}' unavailable, using bm25: {exc}")
+            with self._lock:
+                self._stats["fallbacks"] += 1
+            return bm25_scores(query, chunks)
+
+    @staticmethod
+    def _ranks(scores: List[float]) -> List[int]:
+        order = sorted(range(len(scores)), key=lambda i: scores[i], reverse=True)
+        ranks = [0] * len(scores)
+        for rank, i in enumerate(order, start=1):
+            ranks[i] = rank
+        return ranks
+
+    def rerank(self, query: str, results: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """
+        Return the results best first, with "relevance" set to the final score.
+
+        The original score stays in "search_score"; the local score is kept
+        under "rerank_score".
+
+        Args:
+            query: The user query
+            results: Search results (dicts with "chunk" and "relevance")
+        """
+        if len(results) < 2 or self.mode == "none":
+            return sorted(results, key=lambda r: r.get("relevance", 0.0), reverse=True)
+
+        chunks = [r.get("chunk", "") for r in results]
+        scorer = self.fusion_scorer if self.mode == "fusion" else self.mode
+        if scorer not in SCORERS:
+            logger.warning(f"Unknown reranker '{scorer}', using bm25")
+            scorer = "bm25"
+
+        started = time.perf_counter()
+        local = self._score(scorer, query, chunks)
+        scored = time.perf_counter()
+        if self.mode == "fusion":
+            # Reciprocal rank fusion: robust to the different scales of the two scores
+            search_ranks = self._ranks([r.get("relevance", 0.0) for r in results])
+            local_ranks = self._ranks(local)
+            final = [
+                (1 - self.fusion_weight) / (RRF_K + s) + self.fusion_weight / (RRF_K + l)
+                for s, l in zip(search_ranks, local_ranks)
+            ]
+        else:
+            final = local
+        for result, score, local_score in zip(results, final, local):
+            result["rerank_score"] = local_score
+            result["relevance"] = score
+        ordered = sorted(results, key=lambda r: r["relevance"], reverse=True)
+        finished = time.perf_counter()
+
+        self.last_timings = {"score": (scored - started) * 1000, "fuse": (finished - scored) * 1000}
+        with self._lock:
+            self._stats["calls"] += 1
+            self._stats["candidates"] += len(results)
+            for stage, ms in self.last_timings.items():
+                self._stats["stage_ms"][stage] += ms
+        logger.debug(f"Reranked {len(results)} results with {self.mode} ({scorer}): "
+                     f"score={self.last_timings['score']:.1f}ms fuse={self.last_timings['fuse']:.1f}ms")
+        return ordered
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Return call counts and cumulative per-stage time."""
+        with self._lock:
+            stats = dict(self._stats, stage_ms=dict(self._stats["stage_ms"]))
+        stats["mode"] = self.mode
+        stats["avg_ms"] = {
+            stage: (ms / stats["calls"] if stats["calls"] else 0.0) for stage, ms in stats["stage_ms"].items()
+        }
+        return stats
+
+
+_reranker: Optional[Reranker] = None
+_reranker_lock = threading.Lock()
+
+
+def get_reranker() -> Reranker:
+    """Return the process-wide reranker."""
+    global _reranker
+    with _reranker_lock:
+        if _reranker is None:
+            _reranker = Reranker()
+        return _reranker
@@ -0,0 +1,148 @@
+"""
+Incremental rolling summaries of conversation history evicted from the prompt
+"""
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from config import SUMMARY_CACHE_SIZE, SUMMARY_FOLD_WORKERS
+
+logger = logging.getLogger(__name__)
+
+
+class SummaryFolder:
+    """
+    Process-wide cache and background runner for summary folds.
+
+    A fold turns (running summary, newly evicted messages) into a new running
+    summary. Folds are keyed by the content of both, so a result computed for one
+    request (or in the background after it) is found by the next request of the
+    same conversation even though assistants are rebuilt from the session store.
+
+    This class is responsible for:
+    - Caching folded summaries with LRU eviction
+    - Finding the longest prefix of the evicted messages that was already folded
+    - Running folds on a small thread pool, at most once per key at a time
+    """
+
+    def __init__(self, max_entries: int = SUMMARY_CACHE_SIZE, max_workers: int = SUMMARY_FOLD_WORKERS):
+        """
+        Initialize the folder.
+
+        Args:
+            max_entries: Maximum number of folded summaries kept
+            max_workers: Threads used for background folds
+        """
+        self.max_entries = max_entries
+        self.max_workers = max_workers
+        self._lock = threading.Lock()
+        self._summaries: "OrderedDict[str, str]" = OrderedDict()
+        self._in_flight = set()
+        self._executor = None
+        self._stats = {"hits": 0, "misses": 0, "folds": 0, "background": 0, "errors": 0}
+
+    @staticmethod
+    def prefix_keys(summary: str, messages: List[Dict]) -> List[str]:
+        """
+        Return the fold key of every prefix of messages: keys[i] covers messages[:i + 1].
+
+        Keys are a running hash, so all prefixes cost one pass over the messages.
+        """
+        digest = hashlib.blake2b(summary.encode("utf-8"), digest_size=16)
+        keys = []
+        for msg in messages:
+            digest.update(b"\x00" + msg["role"].encode("utf-8") + b"\x00" + msg["content"].encode("utf-8"))
+            keys.append(digest.copy().hexdigest())
+        return keys
+
+    def lookup(self, summary: str, messages: List[Dict]) -> Tuple[str, int]:
+        """
+        Find the longest already-folded prefix of messages.
+
+        Args:
+            summary: The running summary the messages would be folded into
+            messages: Messages evicted since that summary was made, oldest first
+
+        Returns:
+            Tuple of (summary covering the prefix, number of messages in the prefix);
+            (summary, 0) when nothing was folded yet
+        """
+        keys = self.prefix_keys(summary, messages)
+        with self._lock:
+            for n in range(len(keys), 0, -1):
+                folded = self._summaries.get(keys[n - 1])
+                if folded is not None:
+                    self._summaries.move_to_end(keys[n - 1])
+                    self._stats["hits"] += 1
+                    return folded, n
+            self._stats["misses"] += 1
+        return summary, 0
+
+    def put(self, summary: str, messages: List[Dict], folded: str) -> None:
+        """Store the result of folding messages into summary."""
+        key = self.prefix_keys(summary, messages)[-1]
+        with self._lock:
+            self._summaries[key] = folded
+            self._summaries.move_to_end(key)
+            while len(self._summaries) > self.max_entries:
+                self._summaries.popitem(last=False)
+
+    def fold(self, summary: str, messages: List[Dict], fold_fn: Callable[[str, List[Dict]], str]) -> str:
+        """Fold messages into summary now (blocking) and cache the result."""
+        folded = fold_fn(summary, messages)
+        self.put(summary, messages, folded)
+        with self._lock:
+            self._stats["folds"] += 1
+        return folded
+
+    def fold_in_background(self, summary: str, messages: List[Dict],
+                           fold_fn: Callable[[str, List[Dict]], str]) -> bool:
+        """
+        Schedule a fold on the thread pool unless the same fold is already running.
+
+        Returns:
+            True if a fold was scheduled
+        """
+        key = self.prefix_keys(summary, messages)[-1]
+        with self._lock:
+            if key in self._in_flight or key in self._summaries:
+                return False
+            self._in_flight.add(key)
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="summary-fold")
+            self._stats["background"] += 1
+
+        def run():
+            try:
+                self.fold(summary, messages, fold_fn)
+            except Exception as e:
+                logger.error(f"Background summary fold failed: {e}")
+                with self._lock:
+                    self._stats["errors"] += 1
+            finally:
+                with self._lock:
+                    self._in_flight.discard(key)
+
+        self._executor.submit(run)
+        return True
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Return fold counters and current size."""
+        with self._lock:
+            return dict(self._stats, entries=len(self._summaries), in_flight=len(self._in_flight))
+
+
+_summary_folder: Optional[SummaryFolder] = None
+_summary_folder_lock = threading.Lock()
+
+
+def get_summary_folder() -> SummaryFolder:
+    """Return the process-wide summary folder."""
+    global _summary_folder
+    with _summary_folder_lock:
+        if _summary_folder is None:
+            _summary_folder = SummaryFolder()
+        return _summary_folder
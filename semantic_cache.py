@@ -0,0 +1,199 @@
+"""
+Semantic answer cache for repeated knowledge-base questions
+"""
+import hashlib
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict
+from itertools import count
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+
+import similarity
+from config import (
+    SEMANTIC_CACHE_ENABLED,
+    SEMANTIC_CACHE_THRESHOLD,
+    SEMANTIC_CACHE_SIZE,
+    SEMANTIC_CACHE_TTL,
+    SEMANTIC_CACHE_INDEX_VERSION,
+)
+
+logger = logging.getLogger(__name__)
+
+
+def make_fingerprint(**parts: Any) -> str:
+    """
+    Build a cache namespace from everything that changes what a correct answer looks like
+    (search index, index version, system prompt, model, ...).
+
+    Entries are only matched within the same fingerprint, so changing any part
+    effectively invalidates every answer produced under the old configuration.
+    """
+    parts.setdefault("index_version", SEMANTIC_CACHE_INDEX_VERSION)
+    raw = json.dumps(parts, sort_keys=True, default=str)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+class SemanticCache:
+    """
+    Maps query embeddings to previously generated answers.
+
+    This class is responsible for:
+    - Storing (query embedding -> answer payload) entries per fingerprint
+    - Returning the best stored answer whose cosine similarity clears the threshold
+    - Bounding memory with LRU eviction and expiring entries after a TTL
+    - Tracking hit/miss counts for monitoring
+    """
+
+    def __init__(self, threshold=SEMANTIC_CACHE_THRESHOLD, max_entries=SEMANTIC_CACHE_SIZE,
+                 ttl=SEMANTIC_CACHE_TTL, enabled=SEMANTIC_CACHE_ENABLED):
+        """
+        Initialize the cache.
+
+        Args:
+            threshold: Minimum cosine similarity for a cached answer to be reused
+            max_entries: Maximum number of answers kept in memory
+            ttl: Seconds an answer stays valid (0 disables expiry)
+            enabled: Whether lookups and stores do anything at all
+        """
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.enabled = enabled
+
+        self._lock = threading.Lock()
+        self._ids = count(1)
+        # entry_id -> (fingerprint, unit vector, payload, created_at)
+        self._entries: "OrderedDict[int, tuple]" = OrderedDict()
+        # fingerprint -> (entry ids, stacked unit vectors); rebuilt lazily after changes
+        self._matrices: Dict[str, tuple] = {}
+        self._stats = {"hits": 0, "misses": 0, "stores": 0, "evictions": 0, "expired": 0}
+
+    @staticmethod
+    def _unit(vector: List[float]) -> Optional[np.ndarray]:
+        vec = similarity.normalize(vector)
+        return vec if vec.any() else None
+
+    def _matrix_for(self, fingerprint: str) -> tuple:
+        # Caller must hold self._lock
+        cached = self._matrices.get(fingerprint)
+        if cached is None:
+            ids = [eid for eid, entry in self._entries.items() if entry[0] == fingerprint]
+            matrix = np.stack([self._entries[eid][1] for eid in ids]) if ids else None
+            cached = (ids, matrix)
+            self._matrices[fingerprint] = cached
+        return cached
+
+    def lookup(self, fingerprint: str, embedding: List[float]) -> Optional[Dict[str, Any]]:
+        """
+        Find a cached answer for a semantically equivalent query.
+
+        Args:
+            fingerprint: Namespace returned by make_fingerprint
+            embedding: Embedding of the incoming query
+
+        Returns:
+            The stored payload plus a 'similarity' key, or None on a miss
+        """
+        if not self.enabled or not embedding:
+            return None
+        query = self._unit(embedding)
+        if query is None:
+            return None
+
+        with self._lock:
+            ids, matrix = self._matrix_for(fingerprint)
+            if matrix is None or matrix.shape[1] != query.shape[0]:
+                self._stats["misses"] += 1
+                return None
+
+            indices, scores = similarity.top_k(query, matrix, 1, normalized=True)
+            best, score = int(indices[0]), float(scores[0])
+            if score < self.threshold:
+                self._stats["misses"] += 1
+                return None
+
+            entry_id = ids[best]
+            _, _, payload, created_at = self._entries[entry_id]
+            if self.ttl and time.time() - created_at > self.ttl:
+                self._remove(entry_id)
+                self._stats["expired"] += 1
+                self._stats["misses"] += 1
+                return None
+
+            self._entries.move_to_end(entry_id)
+            self._stats["hits"] += 1
+
+        logger.info(f"Semantic cache hit (similarity={score:.4f})")
+        result = dict(payload)
+        result["similarity"] = score
+        return result
+
+    def store(self, fingerprint: str, embedding: List[float], payload: Dict[str, Any]) -> None:
+        """
+        Remember an answer for later reuse.
+
+        Args:
+            fingerprint: Namespace returned by make_fingerprint
+            embedding: Embedding of the query that produced the answer
+            payload: Answer data to hand back on a hit (answer, sources, context, ...)
+        """
+        if not self.enabled or not embedding or self.max_entries <= 0:
+            return
+        vector = self._unit(embedding)
+        if vector is None:
+            return
+
+        with self._lock:
+            entry_id = next(self._ids)
+            self._entries[entry_id] = (fingerprint, vector, payload, time.time())
+            self._matrices.pop(fingerprint, None)
+            self._stats["stores"] += 1
+            while len(self._entries) > self.max_entries:
+                oldest = next(iter(self._entries))
+                self._remove(oldest)
+                self._stats["evictions"] += 1
+
+    def _remove(self, entry_id: int) -> None:
+        # Caller must hold self._lock
+        fingerprint = self._entries.pop(entry_id)[0]
+        self._matrices.pop(fingerprint, None)
+
+    def invalidate(self, fingerprint: Optional[str] = None) -> None:
+        """
+        Drop cached answers.
+
+        Args:
+            fingerprint: Only drop entries in this namespace; drop everything when None
+        """
+        with self._lock:
+            if fingerprint is None:
+                self._entries.clear()
+                self._matrices.clear()
+            else:
+                for entry_id in [eid for eid, e in self._entries.items() if e[0] == fingerprint]:
+                    del self._entries[entry_id]
+                self._matrices.pop(fingerprint, None)
+        logger.info(f"Semantic cache invalidated ({'all' if fingerprint is None else fingerprint[:12]})")
+
+    def get_stats(self) -> Dict:
+        """Return hit/miss counters, hit rate and size."""
+        with self._lock:
+            stats = dict(self._stats)
+            stats["size"] = len(self._entries)
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = stats["hits"] / lookups if lookups else 0.0
+        stats["enabled"] = self.enabled
+        stats["threshold"] = self.threshold
+        return stats
+
+
+_cache = SemanticCache()
+
+
+def get_semantic_cache() -> SemanticCache:
+    """Return the process-wide semantic answer cache."""
+    return _cache
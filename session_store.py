@@ -0,0 +1,520 @@
+"""
+Session store classes for keeping per-session conversation state outside the assistant objects
+"""
+import json
+import logging
+import os
+import sqlite3
+import struct
+import threading
+import time
+import uuid
+import weakref
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, Optional, Tuple
+
+from config import (
+    SESSION_STORE_BACKEND,
+    SESSION_TTL,
+    SESSION_MAX_ENTRIES,
+    SESSION_MAX_BYTES,
+    SESSION_SQLITE_PATH,
+    SESSION_REDIS_URL,
+    SESSION_LOCK_TIMEOUT,
+    SESSION_LOCK_TTL,
+)
+
+logger = logging.getLogger(__name__)
+
+
+# Stored layout: ENVELOPE, u32 header length, JSON header (everything but the
+# conversation), then the conversation bytes from ConversationManager.to_bytes()
+ENVELOPE = b"SES1"
+_HEADER_LEN = struct.Struct("<I")
+
+
+def encode_state(state: Dict[str, Any]) -> bytes:
+    """Serialize a conversation state dict for storage."""
+    header = dict(state)
+    conversation = header.pop("conversation", None)
+    header["has_conversation"] = conversation is not None
+    raw = json.dumps(header, separators=(",", ":"), ensure_ascii=False).encode("utf-8")
+    return b"".join([ENVELOPE, _HEADER_LEN.pack(len(raw)), raw, conversation or b""])
+
+
+def decode_state(blob: bytes) -> Dict[str, Any]:
+    """Inverse of encode_state; plain JSON states written by older versions are also accepted."""
+    if blob[:len(ENVELOPE)] != ENVELOPE:
+        return json.loads(blob)
+    start = len(ENVELOPE) + _HEADER_LEN.size
+    end = start + _HEADER_LEN.unpack_from(blob, len(ENVELOPE))[0]
+    state = json.loads(blob[start:end])
+    if state.pop("has_conversation", False):
+        state["conversation"] = bytes(blob[end:])
+    return state
+
+
+class SessionBusy(Exception):
+    """Raised when a session is still locked by another turn after the lock timeout."""
+
+
+class _LocalLock:
+    # threading.Lock cannot be weakly referenced; this holder can
+    __slots__ = ("lock", "__weakref__")
+
+    def __init__(self):
+        self.lock = threading.Lock()
+
+
+class SessionStore(ABC):
+    """
+    Base class for session stores.
+
+    This class is responsible for:
+    - Mapping session ids to compact conversation state (encoded history + settings), never assistant objects
+    - Expiring sessions idle for longer than the TTL (each read or write renews it)
+    - Serializing the load/answer/save of concurrent turns of one session (lock())
+    - Counting hits, misses and evictions for /api/metrics
+
+    Subclasses implement _load, _save and _delete on encoded bytes; shared backends
+    also implement _try_lease and _release_lease so turns are ordered across workers.
+    """
+
+    backend = "base"
+
+    def __init__(self, ttl: int = SESSION_TTL):
+        """
+        Initialize the store.
+
+        Args:
+            ttl: Idle seconds after which a session is dropped
+        """
+        self.ttl = ttl
+        self.lease_ttl = SESSION_LOCK_TTL
+        self._local_locks: "weakref.WeakValueDictionary[str, _LocalLock]" = weakref.WeakValueDictionary()
+        self._local_locks_guard = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "puts": 0, "deletes": 0, "expired": 0, "evicted": 0, "errors": 0,
+                       "lock_waits": 0, "lock_timeouts": 0}
+
+    def get(self, session_id: str) -> Optional[Dict[str, Any]]:
+        """
+        Get the stored state for a session.
+
+        Args:
+            session_id: The session id
+
+        Returns:
+            The state dict, or None if the session is unknown or expired
+        """
+        try:
+            blob = self._load(session_id)
+        except Exception as e:
+            self._stats["errors"] += 1
+            logger.error(f"Session store ({self.backend}) read failed: {e}")
+            blob = None
+        if blob is None:
+            self._stats["misses"] += 1
+            return None
+        self._stats["hits"] += 1
+        return decode_state(blob)
+
+    def put(self, session_id: str, state: Dict[str, Any]) -> None:
+        """
+        Store the state for a session, replacing any previous state.
+
+        Args:
+            session_id: The session id
+            state: A JSON-serializable state dict; its "conversation" entry may be bytes
+        """
+        try:
+            self._save(session_id, encode_state(state))
+            self._stats["puts"] += 1
+        except Exception as e:
+            self._stats["errors"] += 1
+            logger.error(f"Session store ({self.backend}) write failed: {e}")
+
+    def delete(self, session_id: str) -> None:
+        """Forget a session."""
+        try:
+            self._delete(session_id)
+            self._stats["deletes"] += 1
+        except Exception as e:
+            self._stats["errors"] += 1
+            logger.error(f"Session store ({self.backend}) delete failed: {e}")
+
+    @contextmanager
+    def lock(self, session_id: str, timeout: float = SESSION_LOCK_TIMEOUT) -> Iterator[None]:
+        """
+        Hold a session exclusively for one load -> answer -> save turn.
+
+        Threads of this process queue on a per-session lock; shared backends add a
+        lease in the store so workers in other processes queue as well.
+
+        Raises:
+            SessionBusy: If the session is still held by another turn after timeout seconds
+        """
+        deadline = time.monotonic() + timeout
+        with self._local_locks_guard:
+            holder = self._local_locks.get(session_id)
+            if holder is None:
+                holder = _LocalLock()
+                self._local_locks[session_id] = holder
+        if not holder.lock.acquire(blocking=False):
+            self._stats["lock_waits"] += 1
+            if not holder.lock.acquire(timeout=max(0.0, deadline - time.monotonic())):
+                self._stats["lock_timeouts"] += 1
+                raise SessionBusy(f"Session {session_id} is busy")
+        try:
+            token = self.acquire_lease(session_id, max(0.0, deadline - time.monotonic()))
+            try:
+                yield
+            finally:
+                if token is not None:
+                    self.release_lease(session_id, token)
+        finally:
+            holder.lock.release()
+
+    def acquire_lease(self, session_id: str, timeout: float = SESSION_LOCK_TIMEOUT) -> Optional[str]:
+        """
+        Take the store-level lease on a session, waiting up to timeout seconds.
+
+        Returns:
+            The lease token, or None if the backend could not be reached (the turn proceeds unleased)
+
+        Raises:
+            SessionBusy: If another worker still holds the lease after timeout seconds
+        """
+        token = uuid.uuid4().hex
+        deadline = time.monotonic() + timeout
+        waited = False
+        while True:
+            try:
+                if self._try_lease(session_id, token):
+                    return token
+            except Exception as e:
+                self._stats["errors"] += 1
+                logger.error(f"Session store ({self.backend}) lease failed: {e}")
+                return None
+            if not waited:
+                waited = True
+                self._stats["lock_waits"] += 1
+            if time.monotonic() >= deadline:
+                self._stats["lock_timeouts"] += 1
+                raise SessionBusy(f"Session {session_id} is busy")
+            time.sleep(0.05)
+
+    def release_lease(self, session_id: str, token: str) -> None:
+        """Give up a lease taken with acquire_lease (only if this token still holds it)."""
+        try:
+            self._release_lease(session_id, token)
+        except Exception as e:
+            self._stats["errors"] += 1
+            logger.error(f"Session store ({self.backend}) lease release failed: {e}")
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Return store counters."""
+        return dict(self._stats, backend=self.backend)
+
+    def _try_lease(self, session_id: str, token: str) -> bool:
+        # In-process backends are covered by the per-session thread lock alone
+        return True
+
+    def _release_lease(self, session_id: str, token: str) -> None:
+        pass
+
+    @abstractmethod
+    def _load(self, session_id: str) -> Optional[bytes]:
+        """Return the encoded state for session_id and renew its TTL, or None when missing or expired."""
+
+    @abstractmethod
+    def _save(self, session_id: str, blob: bytes) -> None:
+        """Store the encoded state for session_id and renew its TTL."""
+
+    @abstractmethod
+    def _delete(self, session_id: str) -> None:
+        """Remove session_id if present."""
+
+
+class MemorySessionStore(SessionStore):
+    """
+    In-process store with TTL, LRU eviction and entry/byte caps.
+
+    States are kept encoded, so the byte cap reflects what is actually held
+    and callers never share mutable state with the store.
+    """
+
+    backend = "memory"
+
+    def __init__(self, ttl: int = SESSION_TTL, max_entries: int = SESSION_MAX_ENTRIES,
+                 max_bytes: int = SESSION_MAX_BYTES):
+        """
+        Initialize the store.
+
+        Args:
+            ttl: Idle seconds after which a session is dropped
+            max_entries: Maximum number of sessions kept
+            max_bytes: Maximum total size of the encoded states
+        """
+        super().__init__(ttl)
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[str, Tuple[float, bytes]]" = OrderedDict()
+        self._bytes = 0
+
+    def _load(self, session_id: str) -> Optional[bytes]:
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(session_id)
+            if entry is None:
+                return None
+            expires_at, blob = entry
+            if expires_at <= now:
+                self._remove(session_id)
+                self._stats["expired"] += 1
+                return None
+            self._entries[session_id] = (now + self.ttl, blob)
+            self._entries.move_to_end(session_id)
+            return blob
+
+    def _save(self, session_id: str, blob: bytes) -> None:
+        now = time.monotonic()
+        with self._lock:
+            self._remove(session_id)
+            self._entries[session_id] = (now + self.ttl, blob)
+            self._bytes += len(blob)
+            self._evict(now)
+
+    def _delete(self, session_id: str) -> None:
+        with self._lock:
+            self._remove(session_id)
+
+    def _remove(self, session_id: str) -> None:
+        entry = self._entries.pop(session_id, None)
+        if entry is not None:
+            self._bytes -= len(entry[1])
+
+    def _evict(self, now: float) -> None:
+        # Expired sessions first (oldest access is at the front), then LRU until under the caps
+        while self._entries:
+            oldest_id, (expires_at, _) = next(iter(self._entries.items()))
+            if expires_at > now:
+                break
+            self._remove(oldest_id)
+            self._stats["expired"] += 1
+        while self._entries and (len(self._entries) > self.max_entries or self._bytes > self.max_bytes):
+            oldest_id = next(iter(self._entries))
+            self._remove(oldest_id)
+            self._stats["evicted"] += 1
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Return store counters plus current size."""
+        with self._lock:
+            return dict(super().get_stats(), entries=len(self._entries), bytes=self._bytes)
+
+
+class SQLiteSessionStore(SessionStore):
+    """
+    SQLite-backed store shared by every worker process on one host.
+
+    Uses WAL mode so readers in one worker do not block writers in another.
+    Expired rows are purged, and the oldest-accessed rows trimmed to
+    max_entries, every `prune_every` writes.
+    """
+
+    backend = "sqlite"
+
+    def __init__(self, path: str = SESSION_SQLITE_PATH, ttl: int = SESSION_TTL,
+                 max_entries: int = SESSION_MAX_ENTRIES, prune_every: int = 100):
+        """
+        Initialize the store.
+
+        Args:
+            path: Database file location
+            ttl: Idle seconds after which a session is dropped
+            max_entries: Maximum number of sessions kept
+            prune_every: Number of writes between expiry/LRU sweeps
+        """
+        super().__init__(ttl)
+        self.path = path
+        self.max_entries = max_entries
+        self.prune_every = prune_every
+        self._writes = 0
+        self._lock = threading.Lock()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._conn = sqlite3.connect(path, timeout=10, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS sessions ("
+            " session_id TEXT PRIMARY KEY, state BLOB NOT NULL, expires_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_sessions_accessed_at ON sessions (accessed_at)")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS session_leases ("
+            " session_id TEXT PRIMARY KEY, token TEXT NOT NULL, expires_at REAL NOT NULL)"
+        )
+
+    def _load(self, session_id: str) -> Optional[bytes]:
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT state, expires_at FROM sessions WHERE session_id = ?", (session_id,)
+            ).fetchone()
+            if row is None:
+                return None
+            if row[1] <= now:
+                self._conn.execute("DELETE FROM sessions WHERE session_id = ?", (session_id,))
+                self._stats["expired"] += 1
+                return None
+            self._conn.execute(
+                "UPDATE sessions SET expires_at = ?, accessed_at = ? WHERE session_id = ?",
+                (now + self.ttl, now, session_id),
+            )
+            return bytes(row[0])
+
+    def _save(self, session_id: str, blob: bytes) -> None:
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO sessions (session_id, state, expires_at, accessed_at) VALUES (?, ?, ?, ?)",
+                (session_id, sqlite3.Binary(blob), now + self.ttl, now),
+            )
+            self._writes += 1
+            if self._writes % self.prune_every == 0:
+                self._prune(now)
+
+    def _delete(self, session_id: str) -> None:
+        with self._lock:
+            self._conn.execute("DELETE FROM sessions WHERE session_id = ?", (session_id,))
+
+    def _try_lease(self, session_id: str, token: str) -> bool:
+        # One statement, so taking a free or expired lease is a compare-and-set across processes
+        now = time.time()
+        with self._lock:
+            taken = self._conn.execute(
+                "INSERT INTO session_leases (session_id, token, expires_at) VALUES (?, ?, ?) "
+                "ON CONFLICT (session_id) DO UPDATE SET token = excluded.token, expires_at = excluded.expires_at "
+                "WHERE session_leases.expires_at <= ?",
+                (session_id, token, now + self.lease_ttl, now),
+            ).rowcount
+        return taken == 1
+
+    def _release_lease(self, session_id: str, token: str) -> None:
+        with self._lock:
+            self._conn.execute("DELETE FROM session_leases WHERE session_id = ? AND token = ?", (session_id, token))
+
+    def _prune(self, now: float) -> None:
+        expired = self._conn.execute("DELETE FROM sessions WHERE expires_at <= ?", (now,)).rowcount
+        self._conn.execute("DELETE FROM session_leases WHERE expires_at <= ?", (now,))
+        evicted = self._conn.execute(
+            "DELETE FROM sessions WHERE session_id IN ("
+            " SELECT session_id FROM sessions ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)",
+            (self.max_entries,),
+        ).rowcount
+        self._stats["expired"] += max(expired, 0)
+        self._stats["evicted"] += max(evicted, 0)
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Return store counters plus current size."""
+        with self._lock:
+            entries = self._conn.execute("SELECT COUNT(*) FROM sessions").fetchone()[0]
+        return dict(super().get_stats(), entries=entries)
+
+
+_RELEASE_LEASE_SCRIPT = """
+if redis.call("get", KEYS[1]) == ARGV[1] then
+    return redis.call("del", KEYS[1])
+end
+return 0
+"""
+
+
+class RedisSessionStore(SessionStore):
+    """
+    Redis-backed store shared by workers on any host.
+
+    Expiry uses Redis key TTLs; the entry and memory caps are enforced by the
+    server's maxmemory / maxmemory-policy (allkeys-lru or volatile-lru).
+    Requires the optional `redis` package.
+    """
+
+    backend = "redis"
+
+    def __init__(self, url: str = SESSION_REDIS_URL, ttl: int = SESSION_TTL, prefix: str = "rag:session:",
+                 client=None):
+        """
+        Initialize the store.
+
+        Args:
+            url: Redis connection URL
+            ttl: Idle seconds after which a session is dropped
+            prefix: Key prefix for session entries
+            client: An existing Redis-compatible client (defaults to one created from url)
+        """
+        super().__init__(ttl)
+        self.prefix = prefix
+        if client is None:
+            import redis  # optional dependency, only needed for this backend
+            client = redis.Redis.from_url(url)
+        self._client = client
+
+    def _key(self, session_id: str) -> str:
+        return f"{self.prefix}{session_id}"
+
+    def _load(self, session_id: str) -> Optional[bytes]:
+        pipe = self._client.pipeline()
+        pipe.get(self._key(session_id))
+        pipe.expire(self._key(session_id), self.ttl)
+        blob, _ = pipe.execute()
+        return blob
+
+    def _save(self, session_id: str, blob: bytes) -> None:
+        self._client.set(self._key(session_id), blob, ex=self.ttl)
+
+    def _delete(self, session_id: str) -> None:
+        self._client.delete(self._key(session_id))
+
+    def _try_lease(self, session_id: str, token: str) -> bool:
+        return bool(self._client.set(f"{self._key(session_id)}:lease", token, nx=True, ex=self.lease_ttl))
+
+    def _release_lease(self, session_id: str, token: str) -> None:
+        # Compare-and-delete: never drop a lease that expired and was taken by another worker
+        self._client.eval(_RELEASE_LEASE_SCRIPT, 1, f"{self._key(session_id)}:lease", token)
+
+
+def create_session_store(backend: str = SESSION_STORE_BACKEND) -> SessionStore:
+    """
+    Create a session store for the configured backend.
+
+    Falls back to the in-process store (with a warning) if the backend cannot be opened.
+    """
+    try:
+        if backend == "sqlite":
+            return SQLiteSessionStore()
+        if backend == "redis":
+            return RedisSessionStore()
+        if backend != "memory":
+            logger.warning(f"Unknown SESSION_STORE_BACKEND '{backend}', using memory")
+    except Exception as e:
+        logger.warning(f"Could not open {backend} session store ({e}); using memory")
+    return MemorySessionStore()
+
+
+_store: Optional[SessionStore] = None
+_store_lock = threading.Lock()
+
+
+def get_session_store() -> SessionStore:
+    """Return the process-wide session store, creating it on first use."""
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                _store = create_session_store()
+                logger.info(f"Session store initialized ({_store.backend})")
+    return _store
@@ -0,0 +1,92 @@
+"""
+Vectorized cosine similarity helpers backed by NumPy
+"""
+from typing import Sequence, Tuple, Union
+
+import numpy as np
+
+VectorLike = Union[Sequence[float], np.ndarray]
+MatrixLike = Union[Sequence[Sequence[float]], np.ndarray]
+
+
+def as_vector(vector: VectorLike) -> np.ndarray:
+    """Convert a list of floats (or array) to a 1-D float32 array."""
+    return np.asarray(vector, dtype=np.float32).reshape(-1)
+
+
+def as_matrix(vectors: MatrixLike) -> np.ndarray:
+    """Convert a list of equal-length vectors (or array) to a 2-D float32 array."""
+    matrix = np.asarray(vectors, dtype=np.float32)
+    if matrix.ndim == 1:
+        matrix = matrix.reshape(1, -1)
+    return matrix
+
+
+def normalize(vector: VectorLike) -> np.ndarray:
+    """Return the unit-length version of a vector (all zeros stays all zeros)."""
+    vec = as_vector(vector)
+    norm = np.linalg.norm(vec)
+    return vec if norm == 0 else vec / norm
+
+
+def normalize_rows(vectors: MatrixLike) -> np.ndarray:
+    """Return a copy of an N x D matrix with every row scaled to unit length."""
+    matrix = as_matrix(vectors)
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+
+def cosine_similarity(a: VectorLike, b: VectorLike) -> float:
+    """
+    Cosine similarity between two vectors.
+
+    Returns 0.0 when either vector has zero magnitude.
+    """
+    va, vb = as_vector(a), as_vector(b)
+    mag = np.linalg.norm(va) * np.linalg.norm(vb)
+    return 0.0 if mag == 0 else float(np.dot(va, vb) / mag)
+
+
+def cosine_similarities(query: VectorLike, vectors: MatrixLike, normalized: bool = False) -> np.ndarray:
+    """
+    Score one query vector against every row of an N x D matrix in a single call.
+
+    Args:
+        query: The query vector (D,)
+        vectors: Candidate vectors (N x D)
+        normalized: Set when the rows of vectors are already unit length to skip re-normalizing
+
+    Returns:
+        Array of N cosine similarities
+    """
+    matrix = as_matrix(vectors) if normalized else normalize_rows(vectors)
+    if matrix.size == 0:
+        return np.zeros(0, dtype=np.float32)
+    return matrix @ normalize(query)
+
+
+def top_k(query: VectorLike, vectors: MatrixLike, k: int, normalized: bool = False) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Return the indices and scores of the k rows most similar to the query, best first.
+
+    Args:
+        query: The query vector (D,)
+        vectors: Candidate vectors (N x D)
+        k: Number of results to return (clamped to N)
+        normalized: Set when the rows of vectors are already unit length
+
+    Returns:
+        Tuple of (indices, scores), both of length min(k, N)
+    """
+    scores = cosine_similarities(query, vectors, normalized=normalized)
+    n = scores.shape[0]
+    k = min(k, n)
+    if k <= 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+    if k < n:
+        candidates = np.argpartition(-scores, k - 1)[:k]
+    else:
+        candidates = np.arange(n)
+    order = candidates[np.argsort(-scores[candidates], kind="stable")]
+    return order, scores[order]
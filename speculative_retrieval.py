@@ -0,0 +1,94 @@
+"""
+Helpers for running knowledge-base retrieval speculatively alongside query enhancement
+"""
+import logging
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List
+
+from config import SPECULATIVE_QUERY_OVERLAP, SPECULATIVE_MAX_WORKERS
+
+logger = logging.getLogger(__name__)
+
+_TERM_RE = re.compile(r"\w+")
+
+_executor = None
+_executor_lock = threading.Lock()
+_stats_lock = threading.Lock()
+_stats = {"reused": 0, "reissued": 0}
+
+
+def get_executor() -> ThreadPoolExecutor:
+    """Return the process-wide thread pool used for speculative searches."""
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=SPECULATIVE_MAX_WORKERS,
+                thread_name_prefix="speculative-search",
+            )
+        return _executor
+
+
+def query_terms(text: str) -> set:
+    """Lower-cased word set of a query."""
+    return set(_TERM_RE.findall((text or "").lower()))
+
+
+def queries_differ(raw_query: str, enhanced_query: str, min_overlap: float = SPECULATIVE_QUERY_OVERLAP) -> bool:
+    """
+    Decide whether the enhanced query is different enough to be worth searching again.
+
+    Args:
+        raw_query: The query as typed by the user
+        enhanced_query: The rewritten query
+        min_overlap: Jaccard overlap of the two term sets at or above which they count as the same
+
+    Returns:
+        True when the results for the raw query should not be reused as-is
+    """
+    raw_terms, enhanced_terms = query_terms(raw_query), query_terms(enhanced_query)
+    if not raw_terms or not enhanced_terms:
+        return raw_terms != enhanced_terms
+    overlap = len(raw_terms & enhanced_terms) / len(raw_terms | enhanced_terms)
+    return overlap < min_overlap
+
+
+def merge_results(primary: List[Dict], secondary: List[Dict], limit: int = 10) -> List[Dict]:
+    """
+    Merge two search result lists, keeping primary's order and dropping repeated chunks.
+
+    Args:
+        primary: Results for the enhanced query (ranked first)
+        secondary: Results for the raw query (fill the remaining slots)
+        limit: Maximum number of results to return
+
+    Returns:
+        The merged result list
+    """
+    merged, seen = [], set()
+    for res in list(primary) + list(secondary):
+        key = (res.get("parent_id", ""), res.get("chunk", ""))
+        if key in seen:
+            continue
+        seen.add(key)
+        merged.append(res)
+        if len(merged) >= limit:
+            break
+    return merged
+
+
+def record_outcome(reissued: bool) -> None:
+    """Count whether a speculative search was reused or had to be re-issued."""
+    with _stats_lock:
+        _stats["reissued" if reissued else "reused"] += 1
+
+
+def get_speculation_stats() -> Dict:
+    """Return how often speculative results were reused."""
+    with _stats_lock:
+        stats = dict(_stats)
+    total = stats["reused"] + stats["reissued"]
+    stats["reuse_rate"] = stats["reused"] / total if total else 0.0
+    return stats
@@ -0,0 +1,109 @@
+"""
+Unit tests for the AnalyticsEngine class
+"""
+import time
+import unittest
+from datetime import date, datetime
+from unittest.mock import MagicMock, patch
+import logging
+from analytics_engine import AnalyticsEngine, date_bounds
+
+# Configure logging for tests
+logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+RAW_ROW = {
+    "vote_totals": {"total_feedback": 4, "positive_feedback": 3, "total_queries": 3},
+    "tags": [{"tag": "Looks Good / Accurate & Clear", "count": 3}, {"tag": "Inaccurate", "count": 1}],
+    "recent": [{"vote_id": 9, "user_query": "q", "feedback_status": "Positive", "timestamp": "2024-05-02T10:00:00"}],
+    "query_totals": {"interactions": 10, "avg_latency_ms": 2350.0, "min_latency_ms": 900,
+                     "max_latency_ms": 5100, "total_tokens": 12000, "avg_tokens": 1200.4},
+    "daily": [
+        {"date": "2024-05-01", "interaction_count": 4, "avg_latency_ms": 2000.0, "daily_tokens": 5000},
+        {"date": "2024-05-02", "interaction_count": 6, "avg_latency_ms": None, "daily_tokens": 7000},
+    ],
+}
+
+
+class TestAnalyticsEngine(unittest.TestCase):
+    """Test cases for the AnalyticsEngine class"""
+
+    def setUp(self):
+        self.cursor = MagicMock()
+        self.cursor.fetchone.return_value = (RAW_ROW,)
+        self.conn = MagicMock()
+        self.conn.cursor.return_value.__enter__.return_value = self.cursor
+        patcher = patch('analytics_engine.DatabaseManager')
+        self.db = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.db.get_connection.return_value = self.conn
+        patcher = patch('analytics_engine.get_rollups')
+        self.rollups = patcher.start().return_value
+        self.addCleanup(patcher.stop)
+
+    def test_date_bounds(self):
+        """Test that end dates are inclusive and strings, dates and datetimes are accepted"""
+        self.assertEqual(date_bounds("2024-05-01", "2024-05-03"), (date(2024, 5, 1), date(2024, 5, 4)))
+        self.assertEqual(date_bounds(datetime(2024, 5, 1, 12), None), (date(2024, 5, 1), None))
+        self.assertEqual(date_bounds(None, ""), (None, None))
+
+    def test_single_query_and_shape(self):
+        """Test that one statement produces every dashboard section"""
+        data = AnalyticsEngine(cache_ttl=0).get_dashboard_data("2024-05-01", "2024-05-02")
+
+        self.assertEqual(self.cursor.execute.call_count, 1)
+        params = self.cursor.execute.call_args.args[1]
+        self.assertEqual((params["start"], params["end"]), (date(2024, 5, 1), date(2024, 5, 3)))
+        self.rollups.refresh_if_stale.assert_called_once()
+        self.rollups.ensure_schema.assert_called_once()
+        self.conn.close.assert_called_once()
+
+        self.assertEqual(data["feedback_summary"]["negative_feedback"], 1)
+        self.assertEqual(data["tag_distribution"][0]["count"], 3)
+        self.assertEqual(data["response_time_metrics"],
+                         {"avg_response_time": 2.35, "min_response_time": 0.9, "max_response_time": 5.1})
+        self.assertEqual(data["token_usage_metrics"]["total_tokens"], 12000)
+        self.assertEqual(data["token_usage_metrics"]["avg_tokens_per_query"], 1200)
+        self.assertEqual(data["token_usage_metrics"]["daily_usage"][1], {"date": "2024-05-02", "daily_tokens": 7000})
+        self.assertEqual(data["time_metrics"][0]["response_time"], 2.0)
+        self.assertIsNone(data["time_metrics"][1]["response_time"])
+        self.assertEqual(data["query_analytics"]["recent_queries"][0]["feedback_status"], "Positive")
+
+    def test_empty_database(self):
+        """Test that missing aggregates produce zeros rather than placeholders"""
+        self.cursor.fetchone.return_value = ({"vote_totals": None, "tags": [], "recent": [],
+                                              "query_totals": None, "daily": []},)
+        data = AnalyticsEngine(cache_ttl=0).get_dashboard_data()
+        self.assertEqual(data["token_usage_metrics"]["total_tokens"], 0)
+        self.assertIsNone(data["response_time_metrics"]["avg_response_time"])
+        self.assertEqual(data["feedback_summary"]["total_feedback"], 0)
+
+    def test_payload_is_cached(self):
+        """Test that repeated requests for the same range reuse the payload"""
+        engine = AnalyticsEngine(cache_ttl=60)
+        engine.get_dashboard_data("2024-05-01", "2024-05-02")
+        engine.get_dashboard_data("2024-05-01", "2024-05-02")
+        self.assertEqual(self.cursor.execute.call_count, 1)
+
+        engine.invalidate()
+        engine.get_dashboard_data("2024-05-01", "2024-05-02")
+        self.assertEqual(self.cursor.execute.call_count, 2)
+
+    def test_cache_is_bounded_and_returns_copies(self):
+        """Test that the cache keeps the most recent ranges, drops expired ones and hands out copies"""
+        engine = AnalyticsEngine(cache_ttl=60, max_entries=2)
+        first = engine.get_dashboard_data("2024-05-01", "2024-05-02")
+        first["feedback_summary"]["total_feedback"] = -1
+        self.assertNotEqual(engine.get_dashboard_data("2024-05-01", "2024-05-02")["feedback_summary"]["total_feedback"], -1)
+        self.assertEqual(self.cursor.execute.call_count, 1)
+
+        engine.get_dashboard_data("2024-05-03", "2024-05-04")
+        engine.get_dashboard_data("2024-05-05", "2024-05-06")
+        self.assertEqual(list(engine._cache), [date_bounds("2024-05-03", "2024-05-04"), date_bounds("2024-05-05", "2024-05-06")])
+
+        with patch('analytics_engine.time.monotonic', return_value=time.monotonic() + 120):
+            engine.get_dashboard_data("2024-05-07", "2024-05-08")
+        self.assertEqual(list(engine._cache), [date_bounds("2024-05-07", "2024-05-08")])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,131 @@
+"""
+Unit tests for the AnalyticsRollups class
+"""
+import unittest
+from unittest.mock import MagicMock, patch
+import logging
+from analytics_rollups import AnalyticsRollups, FEEDBACK_ROLLUP_SQL, histogram_median
+
+# Configure logging for tests
+logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+
+class TestAnalyticsRollups(unittest.TestCase):
+    """Test cases for the AnalyticsRollups class"""
+
+    def setUp(self):
+        self.cursor = MagicMock()
+        self.conn = MagicMock()
+        self.conn.cursor.return_value.__enter__.return_value = self.cursor
+        patcher = patch('analytics_rollups.DatabaseManager')
+        self.db = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.db.get_connection.return_value = self.conn
+        self.rollups = AnalyticsRollups(refresh_interval=60, settle_seconds=5)
+
+    def executed(self):
+        return [c.args[0] for c in self.cursor.execute.call_args_list]
+
+    def test_refresh_folds_rows_past_watermark(self):
+        """Test that only ids between the watermark and the newest settled row are folded in"""
+        # histogram table missing?, last_id, newest settled id, rows in range
+        self.cursor.fetchone.side_effect = [(False,), (10,), (25,), (15,)]
+        folded = self.rollups.refresh(sources=["votes"])
+
+        self.assertEqual(folded, {"votes": 15})
+        for statement in FEEDBACK_ROLLUP_SQL:
+            self.assertIn(statement, self.executed())
+        rollup_call = next(c for c in self.cursor.execute.call_args_list if c.args[0] == FEEDBACK_ROLLUP_SQL[0])
+        self.assertEqual((rollup_call.args[1]["lo"], rollup_call.args[1]["hi"]), (10, 25))
+        update = self.cursor.execute.call_args_list[-1]
+        self.assertIn("UPDATE analytics_rollup_state", update.args[0])
+        self.assertEqual(update.args[1], (25, "votes"))
+        self.db.ensure_rag_queries_schema.assert_called_once()
+        self.conn.close.assert_called_once()
+        self.assertEqual(self.rollups.get_stats()["rows_folded"], 15)
+
+    def test_refresh_without_new_rows_is_a_no_op(self):
+        """Test that the watermark stays put when no settled rows are newer than it"""
+        self.cursor.fetchone.side_effect = [(False,), (25,), (None,)]
+        folded = self.rollups.refresh(sources=["votes"])
+
+        self.assertEqual(folded, {"votes": 0})
+        self.assertFalse(any("INSERT INTO feedback_rollup_hourly" in sql for sql in self.executed()))
+        self.assertFalse(any("UPDATE analytics_rollup_state" in sql for sql in self.executed()))
+
+    def test_failing_source_is_rolled_back(self):
+        """Test that one missing source table does not stop the other sources refreshing"""
+        self.cursor.fetchone.side_effect = [(False,), Exception('relation "helpee_costs" does not exist'),
+                                            (0,), (None,)]
+        folded = self.rollups.refresh(sources=["helpee_costs", "rag_queries"])
+
+        self.assertEqual(folded, {"rag_queries": 0})
+        self.conn.rollback.assert_called_once()
+        self.assertEqual(self.rollups.get_stats()["errors"], 1)
+
+    def test_refresh_if_stale_is_throttled(self):
+        """Test that readers trigger at most one refresh per interval"""
+        with patch.object(self.rollups, "refresh") as refresh:
+            self.rollups.refresh_if_stale()
+            self.assertEqual(refresh.call_count, 1)
+            self.rollups._last_refresh = float("inf")
+            self.rollups.refresh_if_stale()
+            self.assertEqual(refresh.call_count, 1)
+
+    def test_word_counts_read_rollup(self):
+        """Test that word counts come from the daily rollup with stop words excluded in SQL"""
+        self.rollups._last_refresh = float("inf")
+        self.cursor.fetchall.return_value = [("vpn", 12), ("password", 7)]
+        words = self.rollups.word_counts(limit=2, exclude={"the"})
+
+        self.assertEqual(words, {"vpn": 12, "password": 7})
+        sql, params = self.cursor.execute.call_args.args
+        self.assertIn("feedback_word_rollup_daily", sql)
+        self.assertEqual((params["exclude"], params["limit"]), (["the"], 2))
+
+    def test_feedback_totals_derive_negative_count(self):
+        """Test that negative feedback is total minus positive"""
+        self.rollups._last_refresh = float("inf")
+        self.cursor.fetchall.return_value = [(10, 7, 9, 7, 400, 210)]
+        totals = self.rollups.feedback_totals()
+        self.assertEqual(totals["negative_feedback"], 3)
+        self.assertEqual((totals["query_count"], totals["positive_query_count"]), (9, 7))
+        self.assertEqual(totals["positive_query_length_sum"], 210)
+
+    def test_null_queries_are_not_counted_as_queries(self):
+        """Test that the per-query denominators and the length histogram skip NULL user_query"""
+        rollup = FEEDBACK_ROLLUP_SQL[0]
+        self.assertIn("COUNT(user_query)", rollup)
+        histogram = next(sql for sql in FEEDBACK_ROLLUP_SQL if "feedback_length_rollup_daily" in sql)
+        self.assertIn("user_query IS NOT NULL", histogram)
+
+    def test_histogram_median(self):
+        """Test that the histogram median matches percentile_cont(0.5) over the expanded values"""
+        self.assertEqual(histogram_median([]), 0.0)
+        self.assertEqual(histogram_median([(12, 3)]), 12)
+        self.assertEqual(histogram_median([(10, 1), (20, 1)]), 15)
+        self.assertEqual(histogram_median([(5, 2), (8, 1), (30, 4)]), 30)
+        self.assertEqual(histogram_median([(5, 2), (8, 1), (30, 1)]), 6.5)
+
+    def test_query_length_median_reads_histogram(self):
+        """Test that the median comes from the length rollup, not from the votes table"""
+        self.rollups._last_refresh = float("inf")
+        self.cursor.fetchall.return_value = [(10, 2), (40, 1)]
+        self.assertEqual(self.rollups.query_length_median(), 10)
+        sql = self.cursor.execute.call_args.args[0]
+        self.assertIn("feedback_length_rollup_daily", sql)
+        self.assertNotIn("votes", sql)
+
+    def test_rollups_without_histogram_are_refolded(self):
+        """Test that feedback rollups predating the length histogram are rebuilt from the votes table"""
+        self.cursor.fetchone.side_effect = [(True,), (0,), (None,)]
+        self.rollups.refresh(sources=["votes"])
+        executed = self.executed()
+        truncate = next(sql for sql in executed if sql.startswith("TRUNCATE"))
+        self.assertIn("feedback_length_rollup_daily", truncate)
+        self.assertNotIn("helpee_cost_rollup_hourly", truncate)
+        self.assertTrue(any("last_id = 0" in sql and "'votes'" in sql for sql in executed))
+
+
+if __name__ == "__main__":
+    unittest.main()
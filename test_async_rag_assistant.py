@@ -0,0 +1,135 @@
+"""
+Unit tests for the AsyncRAGAssistantWithHistory class
+"""
+import asyncio
+import unittest
+from types import SimpleNamespace
+from unittest.mock import AsyncMock, MagicMock, patch
+import logging
+from async_rag_assistant import AsyncRAGAssistantWithHistory
+from embedding_cache import get_embedding_cache
+
+# Configure logging for tests
+logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+
+class _AsyncResults:
+    """Minimal stand-in for the aio search result pager"""
+
+    def __init__(self, items):
+        self._items = list(items)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if not self._items:
+            raise StopAsyncIteration
+        return self._items.pop(0)
+
+
+class _AsyncStream:
+    """Minimal stand-in for an async chat completion stream"""
+
+    def __init__(self, pieces):
+        self._chunks = [
+            SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=p))]) for p in pieces
+        ]
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if not self._chunks:
+            raise StopAsyncIteration
+        return self._chunks.pop(0)
+
+
+class TestAsyncRAGAssistant(unittest.TestCase):
+    """Test cases for the async RAG pipeline"""
+
+    def setUp(self):
+        """Build an assistant whose sync and async clients are all mocks"""
+        patcher = patch('rag_assistant_with_history_copy.get_openai_client', return_value=MagicMock())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.async_openai = MagicMock()
+        self.async_openai.embeddings.create = AsyncMock(
+            return_value=SimpleNamespace(data=[SimpleNamespace(embedding=[0.1, 0.2, 0.3])])
+        )
+        self.async_openai.completions.create = AsyncMock(
+            return_value=SimpleNamespace(choices=[SimpleNamespace(text=" enhanced query ")])
+        )
+        self.async_openai.chat.completions.create = AsyncMock(
+            return_value=SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content="Answer [1]"))])
+        )
+        self.search_client = MagicMock()
+        self.search_client.search = AsyncMock(side_effect=lambda **kwargs: _AsyncResults([
+            {"chunk": "Some chunk", "title": "Doc", "parent_id": "p1"},
+        ]))
+
+        for target, value in (
+            ('async_rag_assistant.get_async_openai_client', self.async_openai),
+            ('async_rag_assistant.get_async_search_client', self.search_client),
+            ('async_rag_assistant.log_openai_call', None),
+            ('openai_service.log_openai_call', None),
+        ):
+            p = patch(target, return_value=value)
+            p.start()
+            self.addCleanup(p.stop)
+
+        self.assistant = AsyncRAGAssistantWithHistory(settings={"semantic_cache": False})
+        self.assistant.embedding_deployment = "test-async-embedding"
+        self.assistant._log_rag_query = MagicMock()
+
+    def tearDown(self):
+        get_embedding_cache().clear()
+
+    def test_agenerate_embedding_uses_cache(self):
+        """Test that repeated texts only hit the API once"""
+        first = asyncio.run(self.assistant.agenerate_embedding("hello async"))
+        second = asyncio.run(self.assistant.agenerate_embedding("hello async"))
+
+        self.assertEqual(first, [0.1, 0.2, 0.3])
+        self.assertEqual(second, first)
+        self.assertEqual(self.async_openai.embeddings.create.await_count, 1)
+
+    def test_asearch_knowledge_base(self):
+        """Test that async search results are formatted like the sync ones"""
+        results = asyncio.run(self.assistant.asearch_knowledge_base("query"))
+
+        self.assertEqual(results, [{"chunk": "Some chunk", "title": "Doc", "parent_id": "p1", "relevance": 1.0}])
+        kwargs = self.search_client.search.await_args.kwargs
+        self.assertEqual(kwargs["search_text"], "query")
+        self.assertEqual(kwargs["top"], 10)
+
+    def test_agenerate_rag_response(self):
+        """Test the full async pipeline end to end"""
+        answer, sources, _, _, context = asyncio.run(self.assistant.agenerate_rag_response("What is X?"))
+
+        self.assertIn("[1]", answer)
+        self.assertEqual(len(sources), 1)
+        self.assertIn("Some chunk", context)
+        self.assertEqual(self.search_client.search.await_args.kwargs["search_text"], "enhanced query")
+        self.assistant._log_rag_query.assert_called_once()
+
+        history = self.assistant.conversation_manager.get_history()
+        self.assertEqual(history[-1], {"role": "assistant", "content": "Answer [1]"})
+
+    def test_astream_rag_response(self):
+        """Test that streamed chunks are yielded and metadata comes last"""
+        self.async_openai.chat.completions.create = AsyncMock(return_value=_AsyncStream(["Ans", "wer [1]"]))
+
+        async def collect():
+            return [chunk async for chunk in self.assistant.astream_rag_response("What is X?")]
+
+        chunks = asyncio.run(collect())
+
+        self.assertEqual(chunks[:2], ["Ans", "wer [1]"])
+        self.assertEqual(len(chunks[-1]["sources"]), 1)
+        self.assertTrue(self.async_openai.chat.completions.create.await_args.kwargs["stream"])
+
+
+if __name__ == "__main__":
+    unittest.main()
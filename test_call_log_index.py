@@ -0,0 +1,174 @@
+"""
+Unit tests for the incremental OpenAI call log index
+"""
+import gzip
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from unittest.mock import patch
+import logging
+from call_log_index import CallLogIndex
+
+# Configure logging for tests
+logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+
+def record(timestamp, total, model="gpt-4o", latency_ms=None):
+    return {
+        "timestamp": timestamp,
+        "model": model,
+        "usage": {"prompt_tokens": total - 10, "completion_tokens": 10, "total_tokens": total},
+        "latency_ms": latency_ms,
+        "request": {"model": model, "messages": [{"role": "user", "content": "q"}]},
+        "response": {"content": "a"},
+    }
+
+
+class TestCallLogIndex(unittest.TestCase):
+    """Test cases for the CallLogIndex class"""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.log_path = os.path.join(self.tmpdir, "openai_calls.jsonl")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def append(self, *records, raw=None):
+        with open(self.log_path, "a", encoding="utf-8") as f:
+            for r in records:
+                f.write(json.dumps(r) + "\n")
+            if raw:
+                f.write(raw)
+
+    def test_incremental_refresh_parses_only_new_records(self):
+        """Test that a second refresh reads only what was appended since the first"""
+        self.append(record(100, 50), record(200, 70))
+        index = CallLogIndex(self.log_path)
+        self.assertEqual(index.refresh(), 2)
+        self.append(record(300, 90))
+        with patch.object(index, "_entry_fields", wraps=index._entry_fields) as parsed:
+            self.assertEqual(index.refresh(), 1)
+        self.assertEqual(parsed.call_count, 1)
+        self.assertEqual(index.token_counts(), [50, 70, 90])
+
+    def test_index_is_reused_across_instances(self):
+        """Test that a new process picks the index up from the sidecar instead of re-parsing the log"""
+        self.append(record(100, 50), record(200, 70))
+        CallLogIndex(self.log_path).refresh()
+        index = CallLogIndex(self.log_path)
+        with patch.object(index, "_entry_fields", wraps=index._entry_fields) as parsed:
+            self.assertEqual(index.summary()["calls"], 2)
+        self.assertEqual(parsed.call_count, 0)
+
+    def test_partial_line_waits_for_its_newline(self):
+        """Test that a record still being written is indexed once it is complete"""
+        line = json.dumps(record(100, 50))
+        self.append(raw=line[:20])
+        index = CallLogIndex(self.log_path)
+        self.assertEqual(index.refresh(), 0)
+        self.append(raw=line[20:] + "\n")
+        self.assertEqual(index.refresh(), 1)
+
+    def test_time_range_and_aggregation(self):
+        """Test range queries, per-model totals, latency and hourly buckets"""
+        self.append(record(3600, 100, latency_ms=200), record(3700, 300, "gpt-35", latency_ms=400),
+                    record(7300, 500, latency_ms=600))
+        index = CallLogIndex(self.log_path)
+        summary = index.summary(start=3600, end=7200)
+        self.assertEqual(summary["calls"], 2)
+        self.assertEqual(summary["total_tokens"], 400)
+        self.assertEqual(summary["avg_total_tokens"], 200)
+        self.assertEqual(summary["avg_latency_ms"], 300)
+        self.assertEqual(summary["by_model"]["gpt-35"], {"calls": 1, "total_tokens": 300})
+        self.assertEqual([e.total_tokens for e in index.entries(model="gpt-4o")], [100, 500])
+        self.assertEqual([b["calls"] for b in index.histogram(3600)], [2, 1])
+
+    def test_read_records_seeks_to_offsets(self):
+        """Test that full records are read back for just the selected range"""
+        self.append(record(100, 50), record(200, 70), record(300, 90))
+        index = CallLogIndex(self.log_path)
+        records = list(index.read_records(start=150, end=250))
+        self.assertEqual([r["usage"]["total_tokens"] for r in records], [70])
+
+    def test_rotation_rebuilds_the_index(self):
+        """Test that a rotated (replaced) log is indexed from the start"""
+        self.append(record(100, 50), record(200, 70))
+        index = CallLogIndex(self.log_path)
+        index.refresh()
+        os.rename(self.log_path, self.log_path + ".1")
+        self.append(record(300, 90))
+        self.assertEqual(index.token_counts(), [90])
+        self.assertEqual(index.get_stats()["rebuilds"], 1)
+
+    def test_legacy_literal_newline_records(self):
+        """Test that logs written with a literal backslash-n separator are still readable"""
+        raw = "".join(json.dumps(r) + "\\n" for r in (record(100, 50), record(200, 70)))
+        self.append(raw=raw)
+        index = CallLogIndex(self.log_path)
+        self.assertEqual(index.token_counts(), [50, 70])
+
+    def test_older_record_layouts(self):
+        """Test that usage is found in the response or a 'tokens' field when not at the top level"""
+        self.append({"timestamp": 1, "request": {"model": "m"}, "response": {"usage": {"total_tokens": 5}}},
+                    {"timestamp": 2, "tokens": {"total_tokens": 6}})
+        index = CallLogIndex(self.log_path)
+        self.assertEqual(index.token_counts(), [5, 6])
+
+    def write_backup(self, suffix, *records, compress=False):
+        path = f"{self.log_path}.{suffix}" + (".gz" if compress else "")
+        with (gzip.open if compress else open)(path, "wt", encoding="utf-8") as f:
+            for r in records:
+                f.write(json.dumps(r) + "\n")
+        return path
+
+    def test_rotated_backups_are_indexed(self):
+        """Test that plain and gzip backups stay queryable after daily rotation, parsed only once"""
+        self.write_backup("20240501-000000", record(100, 50), record(200, 70), compress=True)
+        self.write_backup("20240502-000000", record(300, 90))
+        self.append(record(400, 110, model="gpt-4o-mini"))
+        index = CallLogIndex(self.log_path)
+        self.assertEqual(index.token_counts(), [50, 70, 90, 110])
+        self.assertEqual(index.token_counts(start=150, end=350), [70, 90])
+        self.assertEqual([r["usage"]["total_tokens"] for r in index.read_records(start=150)], [70, 90, 110])
+        self.assertEqual(index.summary(model="gpt-4o-mini")["calls"], 1)
+        self.assertEqual(index.get_stats()["backups"], 2)
+
+        # The current log moves on without re-reading the backups
+        self.append(record(500, 130))
+        self.assertEqual(index.token_counts(start=450), [130])
+        self.assertEqual(index.get_stats()["backups_indexed"], 2)
+
+        reopened = CallLogIndex(self.log_path)
+        self.assertEqual(reopened.summary()["calls"], 5)
+        self.assertEqual(reopened.get_stats()["backups_indexed"], 0)
+
+    def test_backup_compression_and_pruning(self):
+        """Test that a backup being compressed is read from its plain file, and pruned backups drop out"""
+        plain = self.write_backup("20240501-000000", record(100, 50))
+        with open(plain + ".gz", "wb") as f:
+            f.write(b"\x1f\x8b partial")
+        self.append(record(200, 70))
+        index = CallLogIndex(self.log_path)
+        self.assertEqual(index.token_counts(), [50, 70])
+
+        os.remove(plain + ".gz")
+        with open(plain, "rb") as src, gzip.open(plain + ".gz", "wb") as dst:
+            dst.write(src.read())
+        os.remove(plain)
+        self.assertEqual([r["usage"]["total_tokens"] for r in index.read_records()], [50, 70])
+
+        os.remove(plain + ".gz")
+        self.assertEqual(index.token_counts(), [70])
+        self.assertFalse(any(".20240501" in name for name in os.listdir(self.tmpdir)))
+
+    def test_missing_log(self):
+        """Test that a missing log yields empty results"""
+        index = CallLogIndex(self.log_path)
+        self.assertEqual(index.summary()["calls"], 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,104 @@
+"""
+Unit tests for the chunk analysis cache used by the procedural pipeline
+"""
+import unittest
+from unittest.mock import patch
+import logging
+import rag_assistant_with_history_alternate as alternate
+from chunk_analysis_cache import ChunkAnalysis, ChunkAnalysisCache
+
+# Configure logging for tests
+logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+PROCEDURE = "How to reset the VPN:\n1. Open Settings. 2. Select Network. 3. Click Reset."
+INFO = "The VPN gateway is hosted in two regions. It is maintained weekly."
+
+
+class TestChunkAnalysisCache(unittest.TestCase):
+    """Test cases for the ChunkAnalysisCache class"""
+
+    def analysis(self, text):
+        return ChunkAnalysis({"len": len(text)}, False, lambda: text.upper())
+
+    def test_hit_returns_the_same_record(self):
+        """Test that a chunk is analysed once and then served from the cache"""
+        cache = ChunkAnalysisCache(max_entries=10)
+        calls = []
+
+        def analyze(text):
+            calls.append(text)
+            return self.analysis(text)
+
+        first = cache.get_or_compute("abc", analyze)
+        self.assertIs(cache.get_or_compute("abc", analyze), first)
+        self.assertEqual(calls, ["abc"])
+        self.assertEqual(cache.get_stats(), {"hits": 1, "misses": 1, "evictions": 0, "entries": 1})
+
+    def test_lru_eviction(self):
+        """Test that the least recently used chunk is evicted first"""
+        cache = ChunkAnalysisCache(max_entries=2)
+        a = cache.get_or_compute("a", self.analysis)
+        cache.get_or_compute("b", self.analysis)
+        cache.get_or_compute("a", self.analysis)
+        cache.get_or_compute("c", self.analysis)
+        self.assertIs(cache.get_or_compute("a", self.analysis), a)
+        self.assertEqual(cache.get_stats()["evictions"], 1)
+
+    def test_disabled(self):
+        """Test that a zero-size cache analyses every time and stores nothing"""
+        cache = ChunkAnalysisCache(max_entries=0)
+        self.assertIsNot(cache.get_or_compute("a", self.analysis), cache.get_or_compute("a", self.analysis))
+        self.assertEqual(cache.get_stats()["entries"], 0)
+
+    def test_formatted_text_is_lazy(self):
+        """Test that formatting runs on first access only"""
+        calls = []
+        analysis = ChunkAnalysis({}, False, lambda: calls.append(1) or "formatted")
+        self.assertEqual(calls, [])
+        self.assertEqual(analysis.formatted, "formatted")
+        self.assertEqual(analysis.formatted, "formatted")
+        self.assertEqual(calls, [1])
+
+
+class TestProceduralPipelineCaching(unittest.TestCase):
+    """Test cases for the cached analysis in rag_assistant_with_history_alternate"""
+
+    def setUp(self):
+        cache = ChunkAnalysisCache(max_entries=100)
+        patcher = patch('rag_assistant_with_history_alternate.get_chunk_analysis_cache', return_value=cache)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_results_match_the_uncached_functions(self):
+        """Test that cached metadata, detection and formatting equal a fresh analysis"""
+        for text in (PROCEDURE, INFO, "# Heading\nplain"):
+            metadata = alternate._compute_metadata(text)
+            self.assertEqual(alternate.extract_metadata(text), metadata)
+            self.assertEqual(alternate.is_procedural_content(text), alternate._is_procedural(text))
+        self.assertEqual(alternate.analyze_chunk(PROCEDURE).formatted, alternate.format_procedural_context(PROCEDURE))
+        self.assertEqual(alternate.analyze_chunk(INFO).formatted, alternate.format_context_text(INFO))
+
+    def test_metadata_copies_are_independent(self):
+        """Test that callers mutating their metadata do not change the cached record"""
+        first = alternate.extract_metadata(PROCEDURE)
+        first["steps"].append(99)
+        first["extra"] = True
+        self.assertEqual(alternate.extract_metadata(PROCEDURE)["steps"], [1, 2, 3])
+        self.assertNotIn("extra", alternate.extract_metadata(PROCEDURE))
+
+    def test_each_chunk_is_analysed_once_across_stages_and_queries(self):
+        """Test that hierarchy, prioritization and context preparation share one analysis per chunk"""
+        assistant = alternate.FlaskRAGAssistantWithHistory.__new__(alternate.FlaskRAGAssistantWithHistory)
+        with patch.object(alternate, "_compute_metadata", wraps=alternate._compute_metadata) as computed:
+            for _ in range(3):
+                results = [
+                    {"chunk": PROCEDURE, "title": "VPN", "parent_id": "p1", "relevance": 0.9},
+                    {"chunk": INFO, "title": "VPN", "parent_id": "p1", "relevance": 0.8},
+                ]
+                context, src_map = assistant._prepare_context(alternate.retrieve_with_hierarchy(results))
+                self.assertTrue(src_map["1"]["is_procedural"])
+        self.assertEqual(computed.call_count, 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
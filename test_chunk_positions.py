@@ -0,0 +1,105 @@
+"""
+Unit tests for chunk position resolution and ordered hierarchical retrieval
+"""
+import os
+import shutil
+import tempfile
+import unittest
+from unittest.mock import MagicMock
+import logging
+import rag_assistant_with_history_alternate as alternate
+from chunk_positions import ChunkPositionIndex
+
+# Configure logging for tests
+logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+
+def hit(parent_id, n, relevance=1.0):
+    return {"chunk": f"{parent_id} step {n}", "title": parent_id, "parent_id": parent_id,
+            "chunk_id": f"{parent_id}_pages_{n}", "relevance": relevance}
+
+
+class TestChunkPositionIndex(unittest.TestCase):
+    """Test cases for the ChunkPositionIndex class"""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, "positions.json")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_position_from_schema_fields(self):
+        """Test that an explicit ordinal wins over the chunk key suffix"""
+        index = ChunkPositionIndex(path="", position_field="ordinal")
+        self.assertEqual(index.position_of({"chunk_id": "abc_pages_7"}), 7)
+        self.assertEqual(index.position_of({"chunk_id": "abc-12", "ordinal": "3"}), 3)
+        self.assertIsNone(index.position_of({"chunk_id": "abc"}))
+
+    def test_sidecar_round_trip(self):
+        """Test that positions recorded at ingestion are found after a reload"""
+        index = ChunkPositionIndex(path=self.path, chunk_id_field="")
+        index.add_document("doc", ["first", "second", "third"])
+        index.save()
+        reloaded = ChunkPositionIndex(path=self.path, chunk_id_field="")
+        self.assertEqual(reloaded.position_of({"chunk": "third", "parent_id": "doc"}), 2)
+        self.assertIsNone(reloaded.position_of({"chunk": "third", "parent_id": "other"}))
+        self.assertEqual(reloaded.get_stats(), {"documents": 1, "chunks": 3})
+
+    def test_order_and_gaps(self):
+        """Test ordering with unknown positions last, and bounded gap detection"""
+        siblings = [{"position": 5}, {"position": None, "id": "x"}, {"position": 1}, {"position": 20}]
+        self.assertEqual([s["position"] for s in ChunkPositionIndex.order(siblings)], [1, 5, 20, None])
+        self.assertEqual(ChunkPositionIndex.gaps(siblings, max_gap=4), [2, 3, 4])
+
+    def test_window_filter(self):
+        """Test that only the wanted positions are searched for, by ordinal range or by chunk key"""
+        windows = {"a": [5, 1, 2, 3], "o'b": [0]}
+        by_ordinal = ChunkPositionIndex(path="", position_field="ordinal")
+        self.assertEqual(by_ordinal.window_filter(windows),
+                         "(parent_id eq 'a' and ((ordinal ge 1 and ordinal le 3) or (ordinal ge 5 and ordinal le 5)))"
+                         " or (parent_id eq 'o''b' and ((ordinal ge 0 and ordinal le 0)))")
+        by_key = ChunkPositionIndex(path="")
+        self.assertEqual(by_key.window_filter(windows, [hit("a", 4)]),
+                         "search.in(chunk_id, 'a_pages_1|a_pages_2|a_pages_3|a_pages_5', '|')"
+                         " or search.in(parent_id, 'o''b', '|')")
+
+
+class TestRetrieveWithHierarchy(unittest.TestCase):
+    """Test cases for position-aware retrieve_with_hierarchy"""
+
+    def setUp(self):
+        self.index = ChunkPositionIndex(path="")
+
+    def test_siblings_are_in_document_order(self):
+        """Test that chunks of a parent come back in position order, best parent first"""
+        results = [hit("a", 3, 0.9), hit("b", 1, 0.8), hit("a", 1, 0.7), hit("a", 2, 0.6)]
+        ordered = alternate.retrieve_with_hierarchy(results, position_index=self.index)
+        self.assertEqual([r["chunk_id"] for r in ordered], ["a_pages_1", "a_pages_2", "a_pages_3", "b_pages_1"])
+
+    def test_gaps_are_filled_with_one_lookup(self):
+        """Test that missing steps between hits are fetched in a single batched call"""
+        fetch = MagicMock(return_value=[hit("a", n) for n in range(1, 6)] + [hit("b", n) for n in range(1, 4)])
+        results = [hit("a", 4, 0.9), hit("a", 1, 0.8), hit("b", 1, 0.7), hit("b", 3, 0.6)]
+        ordered = alternate.retrieve_with_hierarchy(results, position_index=self.index, fetch_siblings=fetch)
+        fetch.assert_called_once_with({"a": {2, 3}, "b": {2}}, results)
+        self.assertEqual([r["chunk_id"] for r in ordered],
+                         ["a_pages_1", "a_pages_2", "a_pages_3", "a_pages_4", "b_pages_1", "b_pages_2", "b_pages_3"])
+        self.assertTrue(ordered[1]["expanded"])
+
+    def test_no_lookup_without_gaps(self):
+        """Test that contiguous hits do not trigger a sibling fetch"""
+        fetch = MagicMock(return_value=[])
+        alternate.retrieve_with_hierarchy([hit("a", 1), hit("a", 2)], position_index=self.index, fetch_siblings=fetch)
+        fetch.assert_not_called()
+
+    def test_fetch_failure_keeps_hits(self):
+        """Test that a failed sibling lookup still returns the ordered hits"""
+        fetch = MagicMock(side_effect=RuntimeError("search down"))
+        ordered = alternate.retrieve_with_hierarchy([hit("a", 3), hit("a", 1)], position_index=self.index,
+                                                    fetch_siblings=fetch)
+        self.assertEqual([r["chunk_id"] for r in ordered], ["a_pages_1", "a_pages_3"])
+
+
+if __name__ == "__main__":
+    unittest.main()
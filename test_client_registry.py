@@ -0,0 +1,80 @@
+"""
+Unit tests for the ClientRegistry class
+"""
+import unittest
+from unittest.mock import MagicMock
+import logging
+from client_registry import ClientRegistry
+from openai_service import OpenAIService
+
+# Configure logging for tests
+logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+class TestClientRegistry(unittest.TestCase):
+    """Test cases for the ClientRegistry class"""
+
+    def setUp(self):
+        """Set up a fresh registry for each test"""
+        self.registry = ClientRegistry(max_connections=10, max_keepalive=5, keepalive_expiry=15)
+        self.endpoint = "https://test-endpoint.openai.azure.com"
+
+    def tearDown(self):
+        self.registry.close()
+
+    def test_openai_client_is_shared(self):
+        """Test that the same configuration returns the same client"""
+        first = self.registry.get_openai_client(self.endpoint, "key", "2024-02-01")
+        second = self.registry.get_openai_client(self.endpoint, "key", "2024-02-01")
+        other = self.registry.get_openai_client(self.endpoint, "key", "2023-05-15")
+
+        self.assertIs(first, second)
+        self.assertIsNot(first, other)
+
+        stats = self.registry.get_stats()
+        self.assertEqual(stats["openai_hits"], 1)
+        self.assertEqual(stats["openai_misses"], 2)
+        self.assertEqual(stats["openai_clients"], 2)
+
+    def test_openai_clients_share_connection_pool(self):
+        """Test that all OpenAI clients use the registry's HTTP client"""
+        first = self.registry.get_openai_client(self.endpoint, "key", "2024-02-01")
+        other = self.registry.get_openai_client(self.endpoint, "key", "2023-05-15")
+
+        http_client = self.registry.get_http_client()
+        self.assertIs(first._client, http_client)
+        self.assertIs(other._client, http_client)
+
+    def test_search_client_is_shared(self):
+        """Test that SearchClients are cached per index"""
+        endpoint = "https://test.search.windows.net"
+        first = self.registry.get_search_client(endpoint, "index-a", "key")
+        second = self.registry.get_search_client(endpoint, "index-a", "key")
+        other = self.registry.get_search_client(endpoint, "index-b", "key")
+
+        self.assertIs(first, second)
+        self.assertIsNot(first, other)
+
+        stats = self.registry.get_stats()
+        self.assertEqual(stats["search_hits"], 1)
+        self.assertEqual(stats["search_misses"], 2)
+
+    def test_stats_include_pool_settings(self):
+        """Test that pool size settings are reported"""
+        stats = self.registry.get_stats()
+        self.assertEqual(stats["max_connections"], 10)
+        self.assertEqual(stats["max_keepalive"], 5)
+        self.assertEqual(stats["keepalive_expiry"], 15)
+
+    def test_openai_service_accepts_shared_client(self):
+        """Test that OpenAIService uses an injected client instead of building one"""
+        client = MagicMock()
+        service = OpenAIService(
+            azure_endpoint=self.endpoint,
+            api_key="key",
+            deployment_name="test-deployment",
+            client=client
+        )
+        self.assertIs(service.client, client)
+
+if __name__ == "__main__":
+    unittest.main()
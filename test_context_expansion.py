@@ -0,0 +1,225 @@
+"""
+Unit tests for neighbour-chunk context expansion
+"""
+import asyncio
+import re
+import unittest
+from unittest.mock import AsyncMock, MagicMock, patch
+import logging
+import rag_assistant_with_history_alternate as alternate
+from async_rag_assistant import AsyncRAGAssistantWithHistory
+from rag_assistant_with_history_copy import FlaskRAGAssistantWithHistory
+from chunk_positions import ChunkPositionIndex
+from context_expansion import ContextExpander
+
+# Configure logging for tests
+logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+
+def chunk(parent_id, n, relevance=None):
+    result = {"chunk": f"{parent_id} step {n}", "title": parent_id, "parent_id": parent_id,
+              "chunk_id": f"{parent_id}_pages_{n}"}
+    if relevance is not None:
+        result["relevance"] = relevance
+    return result
+
+
+def document(parent_id, length):
+    return [chunk(parent_id, n) for n in range(length)]
+
+
+def serving(*docs):
+    """Fetch stand-in returning the chunks whose key the filter names, up to the page size"""
+    chunks = [c for doc in docs for c in doc]
+
+    def fetch(filter_expr, top):
+        keys = set(re.findall(r"\w+_pages_\d+", filter_expr))
+        return [dict(c) for c in chunks if c["chunk_id"] in keys][:top]
+    return MagicMock(side_effect=fetch)
+
+
+class TestContextExpander(unittest.TestCase):
+    """Test cases for the ContextExpander class"""
+
+    def expander(self, **kwargs):
+        options = dict(top_k=2, before=3, after=1, max_parents=10, ttl=0, position_index=ChunkPositionIndex(path=""))
+        options.update(kwargs)
+        return ContextExpander(**options)
+
+    def test_neighbours_of_top_hits_in_one_fetch(self):
+        """Test that steps before and after the top hits are added with a single search"""
+        fetch = MagicMock(return_value=document("a", 8) + document("b", 3))
+        results = [chunk("a", 4, 0.9), chunk("b", 0, 0.8), chunk("c", 5, 0.7)]
+        expanded = self.expander().expand(results, fetch)
+        fetch.assert_called_once_with(
+            "search.in(chunk_id, 'a_pages_1|a_pages_2|a_pages_3|a_pages_5|b_pages_1', '|')", 200)
+        added = [r["chunk_id"] for r in expanded[3:]]
+        self.assertEqual(added, ["a_pages_1", "a_pages_2", "a_pages_3", "a_pages_5", "b_pages_1"])
+        self.assertTrue(all(r["expanded"] and r["relevance"] == 0.0 for r in expanded[3:]))
+
+    def test_recently_expanded_parents_are_cached(self):
+        """Test that a second query on the same parent does not search again"""
+        fetch = MagicMock(return_value=document("a", 8))
+        expander = self.expander()
+        expander.expand([chunk("a", 4, 0.9)], fetch)
+        expanded = expander.expand([chunk("a", 6, 0.9)], fetch)
+        self.assertEqual(fetch.call_count, 1)
+        self.assertEqual([r["chunk_id"] for r in expanded[1:]], ["a_pages_3", "a_pages_4", "a_pages_5", "a_pages_7"])
+        self.assertEqual(expander.get_stats()["parent_hits"], 1)
+
+    def test_only_uncached_positions_are_fetched(self):
+        """Test that a later hit on the same parent searches for the positions not yet cached"""
+        fetch = serving(document("a", 10))
+        expander = self.expander()
+        expander.expand([chunk("a", 4, 0.9)], fetch)
+        expanded = expander.expand([chunk("a", 6, 0.9)], fetch)
+        self.assertEqual(fetch.call_args.args[0], "search.in(chunk_id, 'a_pages_4|a_pages_7', '|')")
+        self.assertEqual([r["chunk_id"] for r in expanded[1:]], ["a_pages_3", "a_pages_4", "a_pages_5", "a_pages_7"])
+
+    def test_full_or_empty_fetch_is_not_cached(self):
+        """Test that a search that filled its page, or found nothing for a parent, is retried next time"""
+        fetch = serving(document("a", 8))
+        expander = self.expander(fetch_top=2)
+        expander.expand([chunk("a", 4, 0.9)], fetch)
+        expander.expand([chunk("a", 4, 0.9)], fetch)
+        self.assertEqual(fetch.call_count, 2)
+        self.assertEqual(expander.get_stats()["truncated_fetches"], 2)
+        self.assertEqual(expander.get_stats()["cached_parents"], 0)
+
+        fetch = MagicMock(return_value=[])
+        expander = self.expander()
+        self.assertEqual(len(expander.expand([chunk("a", 4, 0.9)], fetch)), 1)
+        expander.expand([chunk("a", 4, 0.9)], fetch)
+        self.assertEqual(fetch.call_count, 2)
+        self.assertEqual(expander.get_stats()["cached_parents"], 0)
+
+    def test_lru_eviction_and_ttl(self):
+        """Test that the cache is bounded and entries expire"""
+        fetch = serving(document("a", 3), document("b", 3))
+        expander = self.expander(max_parents=1)
+        expander.expand([chunk("a", 2, 0.9)], fetch)
+        expander.expand([chunk("b", 2, 0.9)], fetch)
+        expander.expand([chunk("a", 2, 0.9)], fetch)
+        self.assertEqual(fetch.call_count, 3)
+        self.assertEqual(expander.get_stats()["cached_parents"], 1)
+
+        expander = self.expander(ttl=-1)
+        expander.expand([chunk("a", 2, 0.9)], fetch)
+        expander.expand([chunk("a", 2, 0.9)], fetch)
+        self.assertEqual(fetch.call_count, 5)
+
+    def test_nothing_to_fetch(self):
+        """Test that complete or unpositioned hits do not trigger a search"""
+        fetch = MagicMock(return_value=[])
+        expander = self.expander(before=1, after=0)
+        results = [chunk("a", 1, 0.9), chunk("a", 0, 0.8), {"chunk": "x", "parent_id": "p", "relevance": 0.7}]
+        self.assertEqual(expander.expand(results, fetch), results)
+        self.assertEqual(self.expander(top_k=0).expand(results, fetch), results)
+        fetch.assert_not_called()
+
+    def test_fetch_failure_returns_hits(self):
+        """Test that a failed expansion search leaves the results unchanged"""
+        results = [chunk("a", 4, 0.9)]
+        self.assertEqual(self.expander().expand(results, MagicMock(side_effect=RuntimeError("down"))), results)
+
+    def test_expanded_results_reach_the_context_in_order(self):
+        """Test that a hit on step 4 yields steps 1-4 in order after hierarchical retrieval"""
+        index = ChunkPositionIndex(path="")
+        expander = self.expander(position_index=index, after=0)
+        fetch = serving(document("a", 6))
+        results = expander.expand([chunk("a", 4, 0.9), chunk("b", 0, 0.5)], fetch)
+        ordered = alternate.retrieve_with_hierarchy(results, position_index=index,
+                                                    fetch_siblings=expander.fetch_siblings(fetch))
+        self.assertEqual([r["chunk_id"] for r in ordered],
+                         ["a_pages_1", "a_pages_2", "a_pages_3", "a_pages_4", "b_pages_0"])
+
+
+STEPS = [
+    "How to reset the VPN:",
+    "Step 1. Open the VPN client from the system tray.",
+    "Step 2. Choose Settings and then the Account tab.",
+    "Step 3. Sign out and close the client completely.",
+    "Step 4. Start the client again and sign in with your new password.",
+    "Contact the service desk if the connection still fails.",
+]
+
+
+def vpn_chunk(n, score=None):
+    hit = {"chunk": STEPS[n], "title": "VPN guide", "parent_id": "vpn", "chunk_id": f"vpn_pages_{n}"}
+    if score is not None:
+        hit["@search.score"] = score
+    return hit
+
+
+class _AsyncResults:
+    """Minimal stand-in for the aio search result pager"""
+
+    def __init__(self, items):
+        self._items = list(items)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if not self._items:
+            raise StopAsyncIteration
+        return self._items.pop(0)
+
+
+class TestProductionAssistantExpansion(unittest.TestCase):
+    """Test cases for neighbour expansion in the served (copy and async) assistants"""
+
+    def setUp(self):
+        expander = ContextExpander(top_k=3, before=3, after=0, max_parents=10, ttl=0,
+                                   position_index=ChunkPositionIndex(path=""))
+        for target in ('rag_assistant_with_history_copy.get_context_expander',
+                       'async_rag_assistant.get_context_expander'):
+            patcher = patch(target, return_value=expander)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        patcher = patch('rag_assistant_with_history_copy.get_chunk_position_index', return_value=ChunkPositionIndex(path=""))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def assistant(self, cls):
+        assistant = cls.__new__(cls)
+        assistant.search_endpoint, assistant.search_index, assistant.search_key = "svc", "kb", "key"
+        assistant.deployment_name = "gpt-4o"
+        assistant.context_token_budget = 2500
+        return assistant
+
+    def assert_steps_in_context(self, src_map, search):
+        self.assertEqual([s["content"].split(".")[0] for s in src_map.values()][:4],
+                         ["Step 1", "Step 2", "Step 3", "Step 4"])
+        kwargs = search.call_args.kwargs
+        self.assertEqual(kwargs["filter"], "search.in(chunk_id, 'vpn_pages_1|vpn_pages_2|vpn_pages_3', '|')")
+        self.assertIn("chunk_id", kwargs["select"])
+
+    def test_hit_on_step_4_brings_steps_1_to_3(self):
+        """Test that a hit on step 4 puts steps 1-3, in order, into the source map with one search"""
+        assistant = self.assistant(FlaskRAGAssistantWithHistory)
+        client = MagicMock()
+        client.search.return_value = [vpn_chunk(n) for n in range(len(STEPS))]
+        with patch('rag_assistant_with_history_copy.get_search_client', return_value=client):
+            hits = assistant._format_search_results([vpn_chunk(4, 0.9), {"chunk": "Printer queues", "title": "Print",
+                                                                          "parent_id": "print", "@search.score": 0.5}])
+            results = assistant._expand(assistant._rerank("reset vpn password", hits))
+            _, src_map = assistant._prepare_context(results)
+        client.search.assert_called_once()
+        self.assert_steps_in_context(src_map, client.search)
+
+    def test_async_assistant_expands_with_one_search(self):
+        """Test that the async assistant fetches the neighbours with one async filtered search"""
+        assistant = self.assistant(AsyncRAGAssistantWithHistory)
+        client = MagicMock()
+        client.search = AsyncMock(return_value=_AsyncResults([vpn_chunk(n) for n in range(len(STEPS))]))
+        with patch('async_rag_assistant.get_async_search_client', return_value=client):
+            hits = assistant._format_search_results([vpn_chunk(4, 0.9)])
+            results = asyncio.run(assistant._aexpand(hits))
+        _, src_map = assistant._prepare_context(results)
+        client.search.assert_awaited_once()
+        self.assert_steps_in_context(src_map, client.search)
+
+
+if __name__ == "__main__":
+    unittest.main()
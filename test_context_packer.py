@@ -0,0 +1,91 @@
+"""
+Unit tests for token-budgeted context packing
+"""
+import unittest
+import logging
+from context_packer import ContextPacker, SOURCE_OVERHEAD, truncate_to_tokens
+from token_counter import count_tokens
+from rag_assistant_with_history_copy import FlaskRAGAssistantWithHistory
+
+# Configure logging for tests
+logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+SENTENCE = "The quick brown fox jumps over the lazy dog near the river bank today. "
+
+
+def result(title, sentences, relevance):
+    return {"chunk": (SENTENCE * sentences).strip(), "title": title, "parent_id": title, "relevance": relevance}
+
+
+def text_of(res):
+    return res["chunk"]
+
+
+class TestContextPacker(unittest.TestCase):
+    """Test cases for the ContextPacker class"""
+
+    def setUp(self):
+        self.sentence_tokens = count_tokens(SENTENCE.strip())
+
+    def test_truncates_at_sentence_boundaries(self):
+        """Test that truncation keeps whole sentences within the limit"""
+        text = (SENTENCE * 5).strip()
+        cut = truncate_to_tokens(text, self.sentence_tokens * 2 + 1)
+        self.assertEqual(cut, (SENTENCE * 2).strip())
+        self.assertEqual(truncate_to_tokens(text, 1), "")
+        self.assertEqual(truncate_to_tokens("Step one\nStep two", 100), "Step one\nStep two")
+
+    def test_fills_budget_greedily_by_score(self):
+        """Test that the best results are packed first and output keeps the input order"""
+        budget = (self.sentence_tokens * 2 + SOURCE_OVERHEAD) * 2
+        packer = ContextPacker(budget=budget, max_sources=8, min_chunk_tokens=1)
+        results = [result("low", 2, 0.1), result("high", 2, 0.9), result("mid", 2, 0.5)]
+        packed = packer.pack(results, text_of)
+        self.assertEqual([p.result["title"] for p in packed], ["high", "mid"])
+        self.assertTrue(sum(p.tokens + SOURCE_OVERHEAD for p in packed) <= budget)
+
+        in_order = packer.pack(results, text_of, by_score=False)
+        self.assertEqual([p.result["title"] for p in in_order], ["low", "high"])
+
+    def test_overflowing_chunk_is_truncated_or_skipped(self):
+        """Test that the chunk that does not fit is cut, unless too little of it would remain"""
+        budget = self.sentence_tokens * 3 + SOURCE_OVERHEAD * 2 + 2
+        results = [result("first", 2, 0.9), result("long", 10, 0.8), result("short", 1, 0.1)]
+        packed = ContextPacker(budget=budget, min_chunk_tokens=1).pack(results, text_of)
+        self.assertEqual([(p.result["title"], p.truncated) for p in packed], [("first", False), ("long", True)])
+        self.assertEqual(packed[1].tokens, count_tokens(SENTENCE.strip()))
+
+        strict = ContextPacker(budget=budget, min_chunk_tokens=self.sentence_tokens * 2).pack(results, text_of)
+        self.assertEqual([p.result["title"] for p in strict], ["first", "short"])
+
+    def test_source_limit_and_stats(self):
+        """Test the source cap and the reported totals"""
+        packer = ContextPacker(budget=10000, max_sources=2, min_chunk_tokens=1)
+        packed = packer.pack([result(str(i), 1, 1.0 - i / 10) for i in range(5)], text_of)
+        self.assertEqual(len(packed), 2)
+        stats = packer.get_stats()
+        self.assertEqual(stats["sources"], 2)
+        self.assertEqual(stats["tokens"], sum(p.tokens + SOURCE_OVERHEAD for p in packed))
+
+
+class TestPreparedContextBudget(unittest.TestCase):
+    """Test cases for the packed context in _prepare_context"""
+
+    def test_source_map_reports_tokens(self):
+        """Test that the context stays within budget and each source reports its tokens"""
+        assistant = FlaskRAGAssistantWithHistory.__new__(FlaskRAGAssistantWithHistory)
+        assistant.deployment_name = "gpt-4o"
+        assistant.context_token_budget = 200
+        results = [
+            {"chunk": ". ".join(" ".join(f"term{i}x{j}x{k}" for k in range(8)) for j in range(6)) + ".",
+             "title": f"doc{i}", "parent_id": f"p{i}", "relevance": 1.0 - i / 10}
+            for i in range(6)
+        ]
+        context, src_map = assistant._prepare_context(results)
+        self.assertLessEqual(sum(s["tokens"] for s in src_map.values()), 200)
+        self.assertTrue(all(s["tokens"] > 0 for s in src_map.values()))
+        self.assertEqual(src_map["1"]["title"], "doc0")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,125 @@
+"""
+Unit tests for the compact conversation state
+"""
+import unittest
+import logging
+from conversation_state import (
+    ChunkStore, Message, CONTEXT_MESSAGE_TEMPLATE, render_context, encode_messages, decode_messages, FLAG_ZLIB, MAGIC,
+)
+from conversation_manager_copy import ConversationManager
+
+# Configure logging for tests
+logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+CHUNKS = [f"Chunk {i}: " + "Reset the VPN profile from the portal and sign in again. " * 20 for i in range(5)]
+
+
+def context_message(query, chunks=CHUNKS):
+    return CONTEXT_MESSAGE_TEMPLATE.format(context=render_context(chunks), query=query)
+
+
+class TestMessage(unittest.TestCase):
+    """Test cases for Message records"""
+
+    def setUp(self):
+        self.store = ChunkStore(max_entries=100)
+
+    def test_context_message_is_stored_by_reference(self):
+        """Test that a retrieval turn keeps the query and chunk references and renders back exactly"""
+        content = context_message("how do I reset my vpn?")
+        message = Message.from_content("user", content, self.store)
+        self.assertEqual(message.text, "how do I reset my vpn?")
+        self.assertEqual(len(message.chunks), 5)
+        self.assertEqual(message.content, content)
+
+        again = Message.from_content("user", context_message("and on mobile?"), self.store)
+        self.assertTrue(all(a is b for a, b in zip(message.chunks, again.chunks)))
+        self.assertEqual(self.store.get_stats()["hits"], 5)
+
+    def test_no_context_fallback(self):
+        """Test that the empty-context placeholder round-trips"""
+        content = CONTEXT_MESSAGE_TEMPLATE.format(context=render_context([]), query="q")
+        message = Message.from_content("user", content, self.store)
+        self.assertEqual(message.chunks, ())
+        self.assertEqual(message.content, content)
+
+    def test_unrecognized_content_is_kept_verbatim(self):
+        """Test that content not produced by the template is stored as-is"""
+        content = "<context>\nfree text without sources\n</context>\n<user_query>\nq\n</user_query>"
+        message = Message.from_content("user", content, self.store)
+        self.assertIsNone(message.chunks)
+        self.assertEqual(message.content, content)
+
+    def test_slots(self):
+        """Test that records have no per-instance dict"""
+        self.assertFalse(hasattr(Message("user", "hi"), "__dict__"))
+
+
+class TestSerialization(unittest.TestCase):
+    """Test cases for the binary format"""
+
+    def test_round_trip_dedupes_chunks(self):
+        """Test that each distinct chunk is written once however many turns use it"""
+        store = ChunkStore()
+        messages = [Message("system", "sys")]
+        for i in range(10):
+            messages.append(Message.from_content("user", context_message(f"question {i}"), store))
+            messages.append(Message("assistant", f"answer {i} [1]"))
+
+        blob = encode_messages(messages, compress_over=10**9)
+        self.assertTrue(blob.startswith(MAGIC))
+        self.assertLess(len(blob), sum(len(c) for c in CHUNKS) + 1000)
+
+        decoded = decode_messages(blob, store)
+        self.assertEqual([m.to_dict() for m in decoded], [m.to_dict() for m in messages])
+
+    def test_compression(self):
+        """Test that large bodies are compressed and still decode"""
+        messages = [Message("user", "x" * 5000)]
+        blob = encode_messages(messages)
+        self.assertTrue(blob[len(MAGIC)] & FLAG_ZLIB)
+        self.assertLess(len(blob), 1000)
+        self.assertEqual(decode_messages(blob)[0].text, "x" * 5000)
+
+    def test_rejects_foreign_data(self):
+        """Test that non-conversation bytes raise ValueError"""
+        with self.assertRaises(ValueError):
+            decode_messages(b'{"history": []}')
+
+
+class TestCompactConversationManager(unittest.TestCase):
+    """Test cases for ConversationManager on top of the compact state"""
+
+    def test_history_api_is_unchanged(self):
+        """Test that chat_history still reads and writes plain message dicts"""
+        manager = ConversationManager("sys")
+        manager.add_user_message(context_message("q"))
+        manager.add_assistant_message("a")
+        history = manager.get_history()
+        self.assertEqual(history[1], {"role": "user", "content": context_message("q")})
+
+        manager.chat_history = [{"role": "system", "content": "override"}]
+        self.assertEqual(manager.get_history(), [{"role": "system", "content": "override"}])
+
+    def test_bytes_round_trip(self):
+        """Test that a conversation survives to_bytes/load_bytes"""
+        manager = ConversationManager("sys")
+        for i in range(3):
+            manager.add_user_message(context_message(f"q{i}"))
+            manager.add_assistant_message(f"a{i}")
+        restored = ConversationManager("other")
+        restored.load_bytes(manager.to_bytes())
+        self.assertEqual(restored.get_history(), manager.get_history())
+
+    def test_memory_drops_by_an_order_of_magnitude(self):
+        """Test that ten retrieval turns own far less memory than their rendered text"""
+        manager = ConversationManager("sys")
+        for i in range(10):
+            manager.add_user_message(context_message(f"question {i}"))
+            manager.add_assistant_message(f"answer {i}")
+        rendered = sum(len(m["content"]) for m in manager.get_history())
+        self.assertLess(manager.memory_bytes() * 10, rendered)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,122 @@
+"""
+Unit tests for the ConnectionPool class
+"""
+import threading
+import time
+import unittest
+from unittest.mock import MagicMock
+import logging
+from psycopg2 import extensions
+from db_pool import ConnectionPool, PoolTimeoutError
+
+# Configure logging for tests
+logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+
+def make_conn():
+    """Create a mock psycopg2 connection that reports an idle, open session"""
+    conn = MagicMock()
+    conn.closed = 0
+    conn.get_transaction_status.return_value = extensions.TRANSACTION_STATUS_IDLE
+    return conn
+
+
+class TestConnectionPool(unittest.TestCase):
+    """Test cases for the ConnectionPool class"""
+
+    def setUp(self):
+        self.connect = MagicMock(side_effect=lambda: make_conn())
+
+    def make_pool(self, **kwargs):
+        kwargs.setdefault("min_size", 1)
+        kwargs.setdefault("max_size", 2)
+        kwargs.setdefault("acquire_timeout", 0.2)
+        kwargs.setdefault("healthcheck_interval", 30)
+        kwargs.setdefault("max_lifetime", 0)
+        kwargs.setdefault("max_idle", 0)
+        return ConnectionPool(connect=self.connect, **kwargs)
+
+    def test_close_returns_connection_for_reuse(self):
+        """Test that closing a pooled connection does not close the socket"""
+        pool = self.make_pool()
+        first = pool.getconn()
+        raw = first._conn
+        first.close()
+        first.close()  # second close is a no-op
+
+        second = pool.getconn()
+        self.assertIs(second._conn, raw)
+        raw.close.assert_not_called()
+        self.assertEqual(self.connect.call_count, 1)
+
+        stats = pool.get_stats()
+        self.assertEqual(stats["acquired"], 2)
+        self.assertEqual(stats["reused"], 1)
+        self.assertEqual(stats["in_use"], 1)
+
+    def test_acquire_timeout(self):
+        """Test that callers time out once max_size connections are busy"""
+        pool = self.make_pool(max_size=1)
+        held = pool.getconn()
+        with self.assertRaises(PoolTimeoutError):
+            pool.getconn()
+        self.assertEqual(pool.get_stats()["timeouts"], 1)
+        held.close()
+
+    def test_waiter_gets_released_connection(self):
+        """Test that a blocked caller is woken up by release()"""
+        pool = self.make_pool(max_size=1, acquire_timeout=2)
+        held = pool.getconn()
+        threading.Timer(0.05, held.close).start()
+
+        conn = pool.getconn()
+        self.assertIsNotNone(conn._conn)
+        stats = pool.get_stats()
+        self.assertEqual(stats["waits"], 1)
+        self.assertGreater(stats["acquire_ms_max"], 0)
+
+    def test_open_transaction_is_rolled_back(self):
+        """Test that a connection returned mid-transaction is reset"""
+        pool = self.make_pool()
+        conn = pool.getconn()
+        raw = conn._conn
+        raw.get_transaction_status.return_value = extensions.TRANSACTION_STATUS_INTRANS
+        conn.close()
+        raw.rollback.assert_called_once()
+
+    def test_unhealthy_connection_is_replaced(self):
+        """Test that an idle connection failing its ping is discarded"""
+        pool = self.make_pool(healthcheck_interval=0.01)
+        conn = pool.getconn()
+        raw = conn._conn
+        conn.close()
+        raw.cursor.return_value.__enter__.return_value.execute.side_effect = Exception("server closed the connection")
+        time.sleep(0.02)
+
+        replacement = pool.getconn()
+        self.assertIsNot(replacement._conn, raw)
+        self.assertEqual(pool.get_stats()["healthcheck_failures"], 1)
+
+    def test_closed_connection_is_not_pooled(self):
+        """Test that a broken connection is dropped on release"""
+        pool = self.make_pool()
+        conn = pool.getconn()
+        conn._conn.closed = 2
+        conn.close()
+        self.assertEqual(pool.get_stats()["idle"], 0)
+        self.assertEqual(pool.get_stats()["discarded"], 1)
+
+    def test_idle_connections_beyond_min_size_are_pruned(self):
+        """Test that extra idle connections are closed after max_idle seconds"""
+        pool = self.make_pool(min_size=1, max_size=3, max_idle=0.01)
+        a, b = pool.getconn(), pool.getconn()
+        raw_a = a._conn
+        a.close()
+        time.sleep(0.02)
+        b.close()
+        raw_a.close.assert_called_once()
+        self.assertEqual(pool.get_stats()["idle"], 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,223 @@
+"""
+Unit tests for the BackgroundDBWriter class
+"""
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from unittest.mock import MagicMock, patch
+import logging
+import psycopg2
+from db_writer import BackgroundDBWriter
+
+# Configure logging for tests
+logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+
+class TestBackgroundDBWriter(unittest.TestCase):
+    """Test cases for the BackgroundDBWriter class"""
+
+    def setUp(self):
+        """Set up a writer with a mock connection and a temporary spill file"""
+        self.tmpdir = tempfile.mkdtemp()
+        self.spill_path = os.path.join(self.tmpdir, "spill.jsonl")
+        self.dead_letter_path = os.path.join(self.tmpdir, "dead_letter.jsonl")
+        self.conn = MagicMock()
+        self.connect = MagicMock(return_value=self.conn)
+
+        patcher = patch('db_writer.execute_values')
+        self.execute_values = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.execute_values.side_effect = lambda cur, sql, rows, **kw: [(i,) for i, _ in enumerate(rows, 1)] if kw.get("fetch") else None
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def make_writer(self, **kwargs):
+        kwargs.setdefault("batch_size", 50)
+        kwargs.setdefault("flush_interval", 60)
+        kwargs.setdefault("dead_letter_path", self.dead_letter_path)
+        writer = BackgroundDBWriter(spill_path=self.spill_path, connection_factory=self.connect, **kwargs)
+        self.addCleanup(writer.close)
+        return writer
+
+    def inserted_rows(self, table):
+        rows = []
+        for call in self.execute_values.call_args_list:
+            if f"INSERT INTO {table} " in call.args[1]:
+                rows.extend(call.args[2])
+        return rows
+
+    def test_batches_rows_in_one_insert(self):
+        """Test that queued rows are written together with one execute_values call"""
+        writer = self.make_writer()
+        for i in range(3):
+            writer.log_rag_query(f"q{i}", "answer", [{"id": "1"}, "raw source"], "ctx")
+        writer.flush()
+
+        rows = self.inserted_rows("rag_queries")
+        self.assertEqual([r[1] for r in rows], ["q0", "q1", "q2"])
+        self.assertEqual(len([c for c in self.execute_values.call_args_list if "rag_queries" in c.args[1]]), 1)
+        self.assertEqual(rows[0][3].adapted, [{"id": "1"}, {"content": "raw source"}])
+        # The rag_queries schema is committed first, then the batch
+        self.assertEqual(self.conn.commit.call_count, 2)
+        self.assertEqual(writer.get_stats()["written"], 3)
+
+    def test_flushes_when_batch_is_full(self):
+        """Test that reaching batch_size triggers a flush without waiting for the interval"""
+        writer = self.make_writer(batch_size=2)
+        writer.log_rag_query("q1", "a", [], "ctx")
+        writer.log_rag_query("q2", "a", [], "ctx")
+        writer.close()
+        self.assertEqual(len(self.inserted_rows("rag_queries")), 2)
+
+    def test_helpee_cost_rows_reference_log_ids(self):
+        """Test that helpee_costs rows use the ids returned for helpee_logs"""
+        writer = self.make_writer(enabled=False)
+        writer.log_helpee("q", "r", model="gpt", prompt_tokens=1, completion_tokens=2, total_tokens=3,
+                          prompt_cost=0.1, completion_cost=0.2, total_cost=0.3)
+
+        self.assertEqual(self.inserted_rows("helpee_logs"), [("q", "r", 1, 2, 3, "gpt")])
+        self.assertEqual(self.inserted_rows("helpee_costs"), [(1, "gpt", 1, 2, 3, 0.1, 0.2, 0.3)])
+
+    def test_spills_on_failure_and_replays(self):
+        """Test that rows survive a database outage and are written once it recovers"""
+        writer = self.make_writer(enabled=False)
+        self.connect.side_effect = Exception("database down")
+        writer.log_rag_query("lost?", "a", [], "ctx")
+        self.assertGreater(os.path.getsize(self.spill_path), 0)
+        self.assertEqual(writer.get_stats()["spilled"], 1)
+
+        self.connect.side_effect = None
+        writer.log_rag_query("next", "a", [], "ctx")
+
+        self.assertEqual([r[1] for r in self.inserted_rows("rag_queries")], ["lost?", "next"])
+        self.assertEqual(os.path.getsize(self.spill_path), 0)
+        self.assertEqual(writer.get_stats()["replayed"], 1)
+
+    def test_close_drains_queue(self):
+        """Test that close writes everything still waiting in the queue"""
+        writer = self.make_writer()
+        writer.log_rag_query("q", "a", [], "ctx")
+        writer.close()
+        self.assertEqual(len(self.inserted_rows("rag_queries")), 1)
+        self.assertEqual(writer.get_stats()["pending"], 0)
+
+    def reject_nul_queries(self):
+        """Make inserts fail like PostgreSQL does for a query containing a NUL byte; return the committed rows"""
+        written = []
+
+        def insert(cur, sql, rows, **kw):
+            if any("\x00" in str(row[1]) for row in rows):
+                raise psycopg2.DataError("invalid byte sequence for encoding \"UTF8\": 0x00")
+            written.extend(rows)
+            return [(i,) for i, _ in enumerate(rows, 1)] if kw.get("fetch") else None
+
+        self.execute_values.side_effect = insert
+        return written
+
+    def dead_letters(self):
+        with open(self.dead_letter_path, encoding="utf-8") as f:
+            return [json.loads(line) for line in f]
+
+    def test_bad_record_is_dead_lettered(self):
+        """Test that one bad record among good ones is isolated and the good ones are written"""
+        written = self.reject_nul_queries()
+        writer = self.make_writer()
+        for query in ["q0", "bad\x00", "q2", "q3"]:
+            writer.log_rag_query(query, "a", [], "ctx")
+        writer.flush()
+
+        self.assertEqual([r[1] for r in written], ["q0", "q2", "q3"])
+        letters = self.dead_letters()
+        self.assertEqual([(d["kind"], d["record"]["query"]) for d in letters], [("rag_query", "bad\x00")])
+        self.assertIn("0x00", letters[0]["error"])
+        self.assertFalse(os.path.exists(self.spill_path) and os.path.getsize(self.spill_path))
+        stats = writer.get_stats()
+        self.assertEqual((stats["written"], stats["dead_lettered"], stats["failed_batches"]), (3, 1, 0))
+
+        writer.log_rag_query("later", "a", [], "ctx")
+        writer.flush()
+        self.assertEqual(written[-1][1], "later")
+
+    def test_spilled_bad_record_does_not_block_replay(self):
+        """Test that a bad record spilled during an outage is dead-lettered instead of spilled forever"""
+        written = self.reject_nul_queries()
+        writer = self.make_writer(enabled=False)
+        self.connect.side_effect = psycopg2.OperationalError("server closed the connection unexpectedly")
+        writer.log_rag_query("bad\x00", "a", [], "ctx")
+        writer.log_rag_query("good", "a", [], "ctx")
+        self.assertEqual(writer.get_stats()["spilled"], 2)
+
+        self.connect.side_effect = None
+        writer.log_rag_query("next", "a", [], "ctx")
+
+        self.assertEqual([r[1] for r in written], ["good", "next"])
+        self.assertEqual([d["record"]["query"] for d in self.dead_letters()], ["bad\x00"])
+        self.assertEqual(os.path.getsize(self.spill_path), 0)
+
+    def test_rejected_row_in_first_batch_keeps_schema(self):
+        """Test that rolling back a first batch with a bad row does not undo the rag_queries DDL"""
+        schema = {"pending": False, "committed": False}
+        written = []
+
+        def insert(cur, sql, rows, **kw):
+            if not (schema["pending"] or schema["committed"]):
+                raise psycopg2.ProgrammingError('relation "rag_queries" does not exist')
+            if any("\x00" in str(row[1]) for row in rows):
+                raise psycopg2.DataError("invalid byte sequence for encoding \"UTF8\": 0x00")
+            written.extend(rows)
+
+        self.execute_values.side_effect = insert
+        self.conn.commit.side_effect = lambda: schema.update(committed=schema["committed"] or schema["pending"])
+        self.conn.rollback.side_effect = lambda: schema.update(pending=False)
+        with patch('db_manager.DatabaseManager.ensure_rag_queries_schema',
+                   side_effect=lambda cur: schema.update(pending=True)) as ensure:
+            writer = self.make_writer()
+            writer.log_rag_query("q0", "a", [], "ctx")
+            writer.log_rag_query("bad\x00", "a", [], "ctx")
+            writer.flush()
+            writer.log_rag_query("q2", "a", [], "ctx")
+            writer.flush()
+
+        self.assertEqual([r[1] for r in written], ["q0", "q2"])
+        self.assertEqual([d["record"]["query"] for d in self.dead_letters()], ["bad\x00"])
+        self.assertEqual(writer.get_stats()["spilled"], 0)
+        ensure.assert_called_once()
+
+    def test_transient_write_error_spills(self):
+        """Test that an OperationalError during the insert is retried later rather than dead-lettered"""
+        writer = self.make_writer(enabled=False)
+        self.execute_values.side_effect = psycopg2.OperationalError("connection reset")
+        writer.log_rag_query("q", "a", [], "ctx")
+        self.assertEqual(writer.get_stats()["spilled"], 1)
+        self.assertFalse(os.path.exists(self.dead_letter_path))
+
+    def test_close_does_not_hang_on_full_queue(self):
+        """Test that close spills what is queued when the writer thread is stuck"""
+        entered, release = threading.Event(), threading.Event()
+
+        def stuck_connect():
+            entered.set()
+            release.wait(5)
+            return self.conn
+
+        self.connect.side_effect = stuck_connect
+        writer = self.make_writer(batch_size=1, max_queue=1)
+        self.addCleanup(release.set)
+        writer.log_rag_query("in flight", "a", [], "ctx")
+        self.assertTrue(entered.wait(5))
+        writer.log_rag_query("queued", "a", [], "ctx")
+
+        started = time.monotonic()
+        writer.close(timeout=0.2)
+        self.assertLess(time.monotonic() - started, 2)
+        with open(self.spill_path, encoding="utf-8") as f:
+            self.assertEqual([json.loads(line)[1]["query"] for line in f], ["queued"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,121 @@
+"""
+Unit tests for the EmbeddingCache class
+"""
+import os
+import shutil
+import tempfile
+import unittest
+import logging
+from embedding_cache import DiskEmbeddingStore, EmbeddingCache, make_key, normalize_text
+
+# Configure logging for tests
+logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+class TestEmbeddingCache(unittest.TestCase):
+    """Test cases for the EmbeddingCache class"""
+
+    def setUp(self):
+        """Set up a scratch directory for on-disk stores"""
+        self.tmp_dir = tempfile.mkdtemp()
+        self.disk_path = os.path.join(self.tmp_dir, "embeddings.bin")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+    def test_normalize_text(self):
+        """Test that whitespace differences are normalized away"""
+        self.assertEqual(normalize_text("  How do I\n  calibrate   the LC? "), "How do I calibrate the LC?")
+
+    def test_hit_and_miss(self):
+        """Test basic get/put and hit-rate accounting"""
+        cache = EmbeddingCache(max_entries=10, disk_path=None)
+        self.assertIsNone(cache.get("embed", "hello world"))
+
+        cache.put("embed", "hello world", [0.1, 0.2, 0.3])
+        self.assertEqual(cache.get("embed", "hello   world "), [0.1, 0.2, 0.3])
+
+        stats = cache.get_stats()
+        self.assertEqual(stats["hits"], 1)
+        self.assertEqual(stats["misses"], 1)
+        self.assertAlmostEqual(stats["hit_rate"], 0.5)
+
+    def test_key_includes_deployment(self):
+        """Test that different deployments do not share vectors"""
+        cache = EmbeddingCache(max_entries=10, disk_path=None)
+        cache.put("embed-small", "query", [1.0])
+        self.assertIsNone(cache.get("embed-large", "query"))
+
+    def test_lru_eviction(self):
+        """Test that the least recently used entry is evicted first"""
+        cache = EmbeddingCache(max_entries=2, disk_path=None)
+        cache.put("embed", "a", [1.0])
+        cache.put("embed", "b", [2.0])
+        cache.get("embed", "a")  # 'a' is now most recently used
+        cache.put("embed", "c", [3.0])
+
+        self.assertEqual(cache.get("embed", "a"), [1.0])
+        self.assertIsNone(cache.get("embed", "b"))
+        self.assertEqual(cache.get_stats()["evictions"], 1)
+
+    def test_disk_persistence(self):
+        """Test that vectors survive a new cache instance via the disk store"""
+        cache = EmbeddingCache(max_entries=10, disk_path=self.disk_path)
+        cache.put("embed", "persist me", [0.5, -0.25, 1.0])
+
+        restarted = EmbeddingCache(max_entries=10, disk_path=self.disk_path)
+        self.assertEqual(restarted.get("embed", "persist me"), [0.5, -0.25, 1.0])
+        self.assertEqual(restarted.get_stats()["disk_hits"], 1)
+
+    def test_disk_sees_other_writers(self):
+        """Test that a reader picks up records appended by another process"""
+        reader = EmbeddingCache(max_entries=10, disk_path=self.disk_path)
+        writer = EmbeddingCache(max_entries=10, disk_path=self.disk_path)
+        writer.put("embed", "shared", [0.75])
+
+        self.assertEqual(reader.get("embed", "shared"), [0.75])
+
+    def test_disk_store_is_capped(self):
+        """Test that a full store is compacted to its newest vectors, and other workers follow the new file"""
+        vector = [0.5] * 16
+        record_size = 44 + 16 * 4
+        writer = DiskEmbeddingStore(self.disk_path, max_bytes=10 + 10 * record_size)
+        reader = DiskEmbeddingStore(self.disk_path, max_bytes=10 + 10 * record_size)
+        for i in range(25):
+            writer.put(make_key("embed", str(i)), vector)
+            self.assertLessEqual(os.path.getsize(self.disk_path), writer.max_bytes)
+        self.assertEqual(writer.stats["compactions"], 3)
+        self.assertIsNone(reader.get(make_key("embed", "0")))
+        self.assertEqual(reader.get(make_key("embed", "24")), vector)
+        self.assertEqual(len(reader), 7)
+
+        reader.put(make_key("embed", "from reader"), [1.0])
+        self.assertEqual(writer.get(make_key("embed", "from reader")), [1.0])
+
+    def test_torn_record_is_dropped(self):
+        """Test that a record torn mid-write stops the scan and is cut from the file, not read as garbage"""
+        store = DiskEmbeddingStore(self.disk_path)
+        store.put(make_key("embed", "kept"), [0.25, 0.5])
+        with open(self.disk_path, "ab") as f:
+            f.write(DiskEmbeddingStore._MAGIC + make_key("embed", "torn") + b"\x02\x00\x00\x00\x00")
+        DiskEmbeddingStore(self.disk_path).put(make_key("embed", "after"), [0.75, 1.0])
+
+        reopened = DiskEmbeddingStore(self.disk_path)
+        self.assertEqual(reopened.get(make_key("embed", "kept")), [0.25, 0.5])
+        self.assertIsNone(reopened.get(make_key("embed", "torn")))
+        self.assertEqual(reopened.stats["bad_records"], 1)
+        reopened.put(make_key("embed", "later"), [2.0])
+        self.assertEqual(DiskEmbeddingStore(self.disk_path).get(make_key("embed", "later")), [2.0])
+
+    def test_older_layout_is_replaced(self):
+        """Test that a file written without record checksums is started over instead of misread"""
+        with open(self.disk_path, "wb") as f:
+            f.write(b"EMBCACHE1\n" + make_key("embed", "old") + b"\x01\x00\x00\x00" + b"\x00\x00\x80\x3f")
+        store = DiskEmbeddingStore(self.disk_path)
+        self.assertEqual(len(store), 0)
+        with open(self.disk_path, "wb") as f:
+            f.write(b"not a cache")
+        with self.assertRaises(ValueError):
+            DiskEmbeddingStore(self.disk_path)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,120 @@
+"""
+Unit tests for compacting earlier turns' retrieved context into citation stubs
+"""
+import json
+import unittest
+from unittest.mock import MagicMock, patch
+import logging
+import conversation_state
+from conversation_state import (
+    Message, CONTEXT_MESSAGE_TEMPLATE, render_context, encode_messages, decode_messages, STALE_CONTEXT_NOTE,
+)
+from rag_assistant_with_history_copy import FlaskRAGAssistantWithHistory
+
+# Configure logging for tests
+logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+CHUNKS = [f"Chunk {i}: " + "Reset the VPN profile from the portal and sign in again. " * 20 for i in range(3)]
+SRC_MAP = {str(i + 1): {"title": f"VPN Guide {i}", "content": c, "parent_id": f"doc-{i}"} for i, c in enumerate(CHUNKS)}
+
+
+def context_message(query):
+    return CONTEXT_MESSAGE_TEMPLATE.format(context=render_context(CHUNKS), query=query)
+
+
+class TestCompactedMessage(unittest.TestCase):
+    """Test cases for Message.compacted"""
+
+    def test_stubs_carry_title_and_parent_id(self):
+        """Test that a compacted turn keeps the query and one stub per source"""
+        message = Message.from_content("user", context_message("q"), sources=[(s["title"], s["parent_id"])
+                                                                              for s in SRC_MAP.values()])
+        content = message.compacted().content
+        self.assertIn(STALE_CONTEXT_NOTE, content)
+        self.assertIn('<source id="2" title="VPN Guide 1" parent_id="doc-1"/>', content)
+        self.assertNotIn("Reset the VPN profile", content)
+        self.assertTrue(content.endswith("<user_query>\nq\n</user_query>"))
+        self.assertEqual(message.compacted().without_context().content, "q")
+
+    def test_unrecorded_sources(self):
+        """Test that turns stored without source metadata still compact"""
+        message = Message.from_content("user", context_message("q"))
+        self.assertIsNone(message.sources)
+        self.assertIn(STALE_CONTEXT_NOTE, message.compacted().content)
+        plain = Message("assistant", "a")
+        self.assertIs(plain.compacted(), plain)
+
+    def test_sources_survive_serialization(self):
+        """Test that recorded sources are stored with the conversation"""
+        message = Message.from_content("user", context_message("q"), sources=[("T", "p")] * 3)
+        decoded = decode_messages(encode_messages([message]))[0]
+        self.assertEqual(decoded.sources, (("T", "p"),) * 3)
+
+    def test_compacted_form_is_cached(self):
+        """Test that a turn is compacted and counted once, and the count is stored with the conversation"""
+        message = Message.from_content("user", context_message("q"), sources=[("T", "p")] * 3)
+        self.assertIs(message.compacted(), message.compacted())
+        tokens = message.compacted().token_count()
+        decoded = decode_messages(encode_messages([message]))[0]
+        self.assertEqual(decoded.compacted().tokens, tokens)
+
+
+class TestAssistantCompaction(unittest.TestCase):
+    """Test cases for history compaction in FlaskRAGAssistantWithHistory"""
+
+    @patch('rag_assistant_with_history_copy.get_openai_client', return_value=MagicMock())
+    def test_only_current_turn_keeps_context(self, _client):
+        """Test that earlier turns are sent as stubs while the stored history keeps full context"""
+        assistant = FlaskRAGAssistantWithHistory()
+        assistant.history_token_budget = 10**6
+        context = render_context(CHUNKS)
+        assistant._build_history_messages("first question", context, SRC_MAP)
+        assistant.conversation_manager.add_assistant_message("answer [1]")
+        messages, trimmed, _ = assistant._build_history_messages("follow-up", context, SRC_MAP)
+
+        self.assertFalse(trimmed)
+        self.assertIn('title="VPN Guide 0" parent_id="doc-0"', messages[1]["content"])
+        self.assertNotIn(CHUNKS[0], messages[1]["content"])
+        self.assertIn(CHUNKS[0], messages[-1]["content"])
+        self.assertIn(CHUNKS[0], assistant.conversation_manager.get_history()[1]["content"])
+        self.assertLess(sum(len(m["content"]) for m in messages),
+                        sum(len(m["content"]) for m in assistant.conversation_manager.get_history()))
+
+    @patch('rag_assistant_with_history_copy.get_openai_client', return_value=MagicMock())
+    def test_later_turns_do_not_recount_compacted_history(self, _client):
+        """Test that a new turn, even in a fresh assistant restored from the session, counts only new messages"""
+        assistant = FlaskRAGAssistantWithHistory()
+        assistant.history_token_budget = 10**6
+        context = render_context(CHUNKS)
+        assistant._build_history_messages("first question", context, SRC_MAP)
+        assistant.conversation_manager.add_assistant_message("answer [1]")
+        assistant._build_history_messages("second question", context, SRC_MAP)
+        assistant.conversation_manager.add_assistant_message("answer [2]")
+
+        restored = FlaskRAGAssistantWithHistory()
+        restored.load_state(assistant.export_state())
+        restored.history_token_budget = 10**6
+        with patch('conversation_state.count_message_tokens',
+                   wraps=conversation_state.count_message_tokens) as counted:
+            restored._build_history_messages("third question", context, SRC_MAP)
+        # The second turn's user message (now compacted), its answer and the new turn
+        self.assertEqual(counted.call_count, 3)
+
+    @patch('rag_assistant_with_history_copy.get_openai_client', return_value=MagicMock())
+    def test_cached_answer_keeps_citation_stubs(self, _client):
+        """Test that a turn replayed from the semantic cache later compacts to its title/parent_id stubs"""
+        assistant = FlaskRAGAssistantWithHistory()
+        cache = MagicMock()
+        with patch('rag_assistant_with_history_copy.get_semantic_cache', return_value=cache):
+            assistant._store_in_semantic_cache("fp", [0.1], "answer [1]", "answer [1]", [], {},
+                                               render_context(CHUNKS), SRC_MAP)
+        hit = json.loads(json.dumps(cache.store.call_args.args[2]))
+
+        assistant._answer_from_cache("same question", dict(hit, similarity=0.99))
+        replayed = assistant.conversation_manager.get_messages()[-2]
+        self.assertEqual(replayed.sources, tuple((s["title"], s["parent_id"]) for s in SRC_MAP.values()))
+        self.assertIn('title="VPN Guide 2" parent_id="doc-2"', replayed.compacted().content)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,75 @@
+"""
+Unit tests for near-duplicate chunk suppression
+"""
+import unittest
+from unittest.mock import patch
+import logging
+from near_duplicates import NearDuplicateFilter, shingles
+from rag_assistant_with_history_copy import FlaskRAGAssistantWithHistory
+
+# Configure logging for tests
+logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+SECTION = ("To configure calendar permissions open Outlook, right click the calendar, choose Properties, "
+           "select the Permissions tab, add the delegate and pick the permission level, then click OK to save.")
+SECTION_COPY = "Calendar permissions. " + SECTION
+OTHER = ("The VPN client reconnects automatically after a network change. If it does not, restart the client "
+         "and sign in again with your corporate account and the code from the authenticator app.")
+
+
+class TestNearDuplicateFilter(unittest.TestCase):
+    """Test cases for the NearDuplicateFilter class"""
+
+    def test_shingles(self):
+        """Test word shingling, including texts shorter than one shingle"""
+        self.assertEqual(shingles("One two, three four", 3), ["one two three", "two three four"])
+        self.assertEqual(shingles("Short", 3), ["short"])
+        self.assertEqual(shingles("", 3), [])
+
+    def test_similarity_estimates(self):
+        """Test that copies score high and unrelated chunks low"""
+        dedup = NearDuplicateFilter(num_perm=128)
+        self.assertEqual(dedup.similarity(dedup.signature(SECTION), dedup.signature(SECTION)), 1.0)
+        self.assertGreater(dedup.similarity(dedup.signature(SECTION), dedup.signature(SECTION_COPY)), 0.8)
+        self.assertLess(dedup.similarity(dedup.signature(SECTION), dedup.signature(OTHER)), 0.2)
+
+    def test_keeps_best_ranked_copy(self):
+        """Test that the first of a group of near-duplicates is kept and order is preserved"""
+        dedup = NearDuplicateFilter()
+        results = [{"chunk": SECTION, "title": "Manual"}, {"chunk": OTHER, "title": "VPN"},
+                   {"chunk": SECTION_COPY, "title": "Manual (old)"}]
+        self.assertEqual([r["title"] for r in dedup.filter(results)], ["Manual", "VPN"])
+        self.assertEqual(dedup.get_stats()["suppressed"], 1)
+
+    def test_signatures_are_cached(self):
+        """Test that a chunk's signature is computed once"""
+        dedup = NearDuplicateFilter()
+        with patch.object(dedup, "_compute", wraps=dedup._compute) as computed:
+            for _ in range(3):
+                dedup.filter([{"chunk": SECTION}, {"chunk": OTHER}])
+        self.assertEqual(computed.call_count, 2)
+        self.assertEqual(dedup.get_stats()["hits"], 4)
+
+    def test_disabled(self):
+        """Test that a disabled filter returns its input"""
+        results = [{"chunk": SECTION}, {"chunk": SECTION}]
+        self.assertEqual(NearDuplicateFilter(enabled=False).filter(results), results)
+
+
+class TestContextSlots(unittest.TestCase):
+    """Test cases for duplicate suppression in _prepare_context"""
+
+    def test_duplicates_do_not_take_slots(self):
+        """Test that the freed slots go to distinct sources"""
+        assistant = FlaskRAGAssistantWithHistory.__new__(FlaskRAGAssistantWithHistory)
+        assistant.context_token_budget = 2500
+        assistant.deployment_name = "gpt-4o"
+        results = [{"chunk": SECTION, "title": f"Copy {i}", "parent_id": f"p{i}"} for i in range(4)]
+        results += [{"chunk": OTHER, "title": "VPN", "parent_id": "v"}]
+        with patch("rag_assistant_with_history_copy.get_near_duplicate_filter", return_value=NearDuplicateFilter()):
+            _, src_map = assistant._prepare_context(results)
+        self.assertEqual([s["title"] for s in src_map.values()], ["Copy 0", "VPN"])
+
+
+if __name__ == "__main__":
+    unittest.main()
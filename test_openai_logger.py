@@ -0,0 +1,129 @@
+"""
+Unit tests for the OpenAI call logger
+"""
+import gzip
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from unittest.mock import MagicMock
+import logging
+from openai_logger import OpenAICallLogger, build_record, compact_messages
+
+# Configure logging for tests
+logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+REQUEST = {"model": "gpt-4o", "messages": [{"role": "system", "content": "sys"}, {"role": "user", "content": "hi"}]}
+RESPONSE = {"type": "stream", "content": "hello", "usage": {"prompt_tokens": 5, "completion_tokens": 2, "total_tokens": 7}}
+
+
+class TestOpenAICallLogger(unittest.TestCase):
+    """Test cases for the OpenAICallLogger class"""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, "openai_calls.jsonl")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def make_logger(self, **kwargs):
+        kwargs.setdefault("flush_interval", 60)
+        kwargs.setdefault("rotate_seconds", 0)
+        call_logger = OpenAICallLogger(path=self.path, **kwargs)
+        self.addCleanup(call_logger.close)
+        return call_logger
+
+    def read_lines(self):
+        with open(self.path, encoding="utf-8") as f:
+            return f.read().splitlines()
+
+    def test_records_are_newline_delimited(self):
+        """Test that each call becomes one JSON line with model and usage at the top level"""
+        call_logger = self.make_logger()
+        for _ in range(3):
+            call_logger.log(REQUEST, RESPONSE)
+        call_logger.flush()
+        lines = self.read_lines()
+        self.assertEqual(len(lines), 3)
+        record = json.loads(lines[0])
+        self.assertEqual(record["model"], "gpt-4o")
+        self.assertEqual(record["usage"]["total_tokens"], 7)
+        self.assertEqual(call_logger.get_stats()["batches"], 1)
+
+    def test_nothing_is_written_on_the_callers_thread(self):
+        """Test that log() only queues until the batch is flushed"""
+        call_logger = self.make_logger()
+        call_logger.log(REQUEST, RESPONSE)
+        self.assertFalse(os.path.exists(self.path))
+        self.assertEqual(call_logger.get_stats()["queued"], 1)
+
+    def test_synchronous_mode(self):
+        """Test that a disabled background thread writes immediately"""
+        call_logger = self.make_logger(enabled=False)
+        call_logger.log(REQUEST, RESPONSE)
+        self.assertEqual(len(self.read_lines()), 1)
+
+    def test_sampling(self):
+        """Test that a zero sample rate logs nothing"""
+        call_logger = self.make_logger(enabled=False, sample_rate=0)
+        call_logger.log(REQUEST, RESPONSE)
+        self.assertFalse(os.path.exists(self.path))
+        self.assertEqual(call_logger.get_stats()["sampled_out"], 1)
+
+    def test_size_rotation_compresses_and_prunes(self):
+        """Test that the file rotates past max_bytes, keeping backup_count gzipped files"""
+        call_logger = self.make_logger(enabled=False, max_bytes=1, backup_count=2)
+        for _ in range(5):
+            call_logger.log(REQUEST, RESPONSE)
+        rotated = call_logger.rotated_files()
+        self.assertEqual(len(rotated), 2)
+        self.assertTrue(all(name.endswith(".gz") for name in rotated))
+        with gzip.open(rotated[-1], "rt", encoding="utf-8") as f:
+            self.assertEqual(json.loads(f.readline())["model"], "gpt-4o")
+        self.assertEqual(len(self.read_lines()), 1)
+        self.assertEqual(call_logger.get_stats()["rotations"], 4)
+
+    def test_time_rotation(self):
+        """Test that a write after an interval boundary starts a new file"""
+        call_logger = self.make_logger(enabled=False, rotate_seconds=60, compress=False)
+        call_logger.log(REQUEST, RESPONSE)
+        os.utime(self.path, (0, 0))
+        call_logger.log(REQUEST, RESPONSE)
+        self.assertEqual(len(call_logger.rotated_files()), 1)
+        self.assertEqual(len(self.read_lines()), 1)
+
+    def test_unserializable_response_is_skipped(self):
+        """Test that a bad record does not stop the rest of the batch"""
+        call_logger = self.make_logger(enabled=False)
+        call_logger.log(REQUEST, 42)
+        call_logger.log(REQUEST, RESPONSE)
+        self.assertEqual(len(self.read_lines()), 1)
+        self.assertEqual(call_logger.get_stats()["errors"], 1)
+
+
+class TestRedaction(unittest.TestCase):
+    """Test cases for record trimming and redaction"""
+
+    def test_long_strings_and_vectors_are_trimmed(self):
+        """Test that message content is cut and embedding vectors are collapsed"""
+        response = MagicMock()
+        response.to_dict.return_value = {"data": [{"embedding": [0.1] * 1536}], "usage": {"total_tokens": 3}}
+        request = {"model": "emb", "messages": [{"role": "user", "content": "x" * 5000}], "api_key": "secret"}
+        record = build_record(0.0, request, response, messages_mode="trim", max_chars=100)
+        self.assertLess(len(record["request"]["messages"][0]["content"]), 200)
+        self.assertEqual(record["response"]["data"][0]["embedding"], "[1536 numbers]")
+        self.assertEqual(record["request"]["api_key"], "[redacted]")
+
+    def test_message_modes(self):
+        """Test the full and summary message modes"""
+        messages = REQUEST["messages"]
+        self.assertIs(compact_messages(messages, "full", 10), messages)
+        summary = compact_messages(messages, "summary", 10)
+        self.assertEqual(summary["count"], 2)
+        self.assertEqual(summary["last"], {"role": "user", "content": "hi"})
+
+
+if __name__ == "__main__":
+    unittest.main()
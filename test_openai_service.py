@@ -1,10 +1,16 @@
 """
 Unit tests for the OpenAIService class
 """
+import asyncio
 import unittest
-from unittest.mock import patch, MagicMock
+from types import SimpleNamespace
+from unittest.mock import patch, MagicMock, AsyncMock
 import logging
-from openai_service import OpenAIService
+import time
+import httpx
+import openai
+from openai import AzureOpenAI
+from openai_service import OpenAIService, DeadlineExceeded, StreamIdleTimeout, backoff_delay, retry_after_seconds, _without_sdk_retries
 
 # Configure logging for tests
 logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
@@ -162,5 +168,244 @@ class TestOpenAIService(unittest.TestCase):
         # Verify the logger was called
         mock_log_openai_call.assert_called_once()
 
+def _status_error(cls, status, headers=None):
+    response = httpx.Response(status, headers=headers or {}, request=httpx.Request("POST", "https://example.test"))
+    return cls(f"HTTP {status}", response=response, body=None)
+
+
+def _chunk(text=None, usage=None, finish_reason=None):
+    choices = [] if text is None and finish_reason is None else [
+        SimpleNamespace(delta=SimpleNamespace(content=text), finish_reason=finish_reason)]
+    return SimpleNamespace(choices=choices, usage=usage)
+
+
+class _AsyncStream:
+    """Minimal stand-in for an async chat completion stream"""
+
+    def __init__(self, chunks, delays=None):
+        self._chunks = list(chunks)
+        self._delays = list(delays or [])
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if not self._chunks:
+            raise StopAsyncIteration
+        if self._delays:
+            await asyncio.sleep(self._delays.pop(0))
+        return self._chunks.pop(0)
+
+
+def _slow_stream(chunks, delays):
+    """Sync stream yielding each chunk after its delay"""
+    for chunk, delay in zip(chunks, delays):
+        time.sleep(delay)
+        yield chunk
+
+
+MESSAGES = [{"role": "user", "content": "Hello"}]
+
+
+@patch('openai_service.log_openai_call')
+class TestOpenAIServiceRetries(unittest.TestCase):
+    """Test cases for deadlines and retry behaviour"""
+
+    def setUp(self):
+        self.client = MagicMock()
+        self.service = OpenAIService(client=self.client, deployment_name="test-deployment", max_retries=3)
+        ok = MagicMock()
+        ok.choices = [MagicMock()]
+        ok.choices[0].message.content = "ok"
+        self.ok = ok
+
+    @patch('openai_service.time.sleep')
+    def test_retries_rate_limit_honouring_retry_after(self, sleep, _log):
+        """Test that a 429 is retried after at least the server's Retry-After"""
+        self.client.chat.completions.create.side_effect = [
+            _status_error(openai.RateLimitError, 429, {"retry-after": "2"}), self.ok]
+        self.assertEqual(self.service.get_chat_response(MESSAGES), "ok")
+        self.assertEqual(self.client.chat.completions.create.call_count, 2)
+        self.assertGreaterEqual(sleep.call_args.args[0], 2)
+        self.assertIn("timeout", self.client.chat.completions.create.call_args.kwargs)
+
+    @patch('openai_service.time.sleep')
+    def test_client_errors_are_not_retried(self, sleep, _log):
+        """Test that a 400 fails immediately"""
+        self.client.chat.completions.create.side_effect = _status_error(openai.BadRequestError, 400)
+        with self.assertRaises(openai.BadRequestError):
+            self.service.get_chat_response(MESSAGES)
+        sleep.assert_not_called()
+
+    @patch('openai_service.time.sleep')
+    def test_gives_up_after_max_retries(self, sleep, _log):
+        """Test that server errors are retried max_retries times"""
+        self.client.chat.completions.create.side_effect = _status_error(openai.InternalServerError, 503)
+        with self.assertRaises(openai.InternalServerError):
+            self.service.get_chat_response(MESSAGES)
+        self.assertEqual(self.client.chat.completions.create.call_count, 4)
+
+    @patch('openai_service.time.sleep')
+    def test_no_retry_past_the_deadline(self, sleep, _log):
+        """Test that a Retry-After longer than the remaining deadline is not waited for"""
+        self.client.chat.completions.create.side_effect = _status_error(openai.RateLimitError, 429, {"retry-after": "30"})
+        with self.assertRaises(openai.RateLimitError):
+            self.service.get_chat_response(MESSAGES, deadline=5)
+        sleep.assert_not_called()
+
+    def test_expired_deadline(self, _log):
+        """Test that a call with no time left is not sent"""
+        with self.assertRaises(DeadlineExceeded):
+            self.service.get_chat_response(MESSAGES, deadline=0)
+        self.client.chat.completions.create.assert_not_called()
+
+    def test_none_parameters_are_omitted(self, _log):
+        """Test that parameters passed as None are left to the API defaults"""
+        self.client.chat.completions.create.return_value = self.ok
+        self.service.get_chat_response(MESSAGES, temperature=None, max_tokens=None, response_format={"type": "json_object"})
+        kwargs = self.client.chat.completions.create.call_args.kwargs
+        self.assertNotIn("temperature", kwargs)
+        self.assertNotIn("max_tokens", kwargs)
+        self.assertEqual(kwargs["response_format"], {"type": "json_object"})
+
+
+class TestRetryHelpers(unittest.TestCase):
+    """Test cases for the backoff helpers"""
+
+    def test_backoff_is_jittered_and_capped(self):
+        """Test that delays stay within the exponential envelope"""
+        for attempt in range(8):
+            self.assertLessEqual(backoff_delay(attempt, base=0.5, cap=4), 4)
+        self.assertGreaterEqual(backoff_delay(0, retry_after=3, base=0.5), 3)
+
+    def test_retry_after_headers(self):
+        """Test that both retry-after-ms and Retry-After are understood"""
+        self.assertEqual(retry_after_seconds(_status_error(openai.RateLimitError, 429, {"retry-after-ms": "1500"})), 1.5)
+        self.assertEqual(retry_after_seconds(_status_error(openai.RateLimitError, 429, {"retry-after": "7"})), 7)
+        self.assertIsNone(retry_after_seconds(Exception("no response")))
+
+    def test_sdk_retries_disabled(self):
+        """Test that SDK clients are used with their built-in retries off"""
+        client = AzureOpenAI(azure_endpoint="https://example.test", api_key="k", api_version="2024-02-01")
+        self.assertEqual(_without_sdk_retries(client).max_retries, 0)
+        self.assertIs(_without_sdk_retries(client), _without_sdk_retries(client))
+
+
+@patch('openai_service.log_openai_call')
+class TestOpenAIServiceStreaming(unittest.TestCase):
+    """Test cases for the streaming API"""
+
+    def test_stream_yields_text_and_captures_usage(self, log):
+        """Test that deltas are yielded and usage is read from the final chunk"""
+        client = MagicMock()
+        client.chat.completions.create.return_value = iter([
+            _chunk("Hel"), _chunk("lo", finish_reason="stop"),
+            _chunk(usage=SimpleNamespace(prompt_tokens=10, completion_tokens=2, total_tokens=12)),
+        ])
+        service = OpenAIService(client=client, deployment_name="d", api_version="2024-10-21")
+        self.assertEqual(list(service.stream_chat_response(MESSAGES)), ["Hel", "lo"])
+        self.assertEqual(service.last_usage, {"prompt_tokens": 10, "completion_tokens": 2, "total_tokens": 12})
+        kwargs = client.chat.completions.create.call_args.kwargs
+        self.assertTrue(kwargs["stream"])
+        self.assertEqual(kwargs["stream_options"], {"include_usage": True})
+        self.assertEqual(log.call_args.args[1]["content"], "Hello")
+
+    def test_usage_is_estimated_for_older_api_versions(self, _log):
+        """Test that API versions without stream usage get a local token count instead"""
+        client = MagicMock()
+        client.chat.completions.create.return_value = iter([_chunk("Hello there")])
+        service = OpenAIService(client=client, deployment_name="d", api_version="2023-05-15")
+        list(service.stream_chat_response(MESSAGES))
+        self.assertNotIn("stream_options", client.chat.completions.create.call_args.kwargs)
+        usage = service.last_usage
+        self.assertGreater(usage["prompt_tokens"], 0)
+        self.assertEqual(usage["total_tokens"], usage["prompt_tokens"] + usage["completion_tokens"])
+
+    @patch('openai_service.time.sleep')
+    def test_stream_retries_before_first_chunk(self, _sleep, _log):
+        """Test that a stream that fails to open is retried"""
+        client = MagicMock()
+        client.chat.completions.create.side_effect = [
+            _status_error(openai.RateLimitError, 429), iter([_chunk("ok")])]
+        service = OpenAIService(client=client, deployment_name="d")
+        self.assertEqual(list(service.stream_chat_response(MESSAGES)), ["ok"])
+
+    def test_async_stream(self, _log):
+        """Test the async streaming API"""
+        client = MagicMock()
+        client.chat.completions.create = AsyncMock(return_value=_AsyncStream([
+            _chunk("A"), _chunk("B"), _chunk(usage=SimpleNamespace(prompt_tokens=5, completion_tokens=2, total_tokens=7)),
+        ]))
+        service = OpenAIService(client=MagicMock(), deployment_name="d")
+
+        async def collect():
+            return [piece async for piece in service.astream_chat_response(MESSAGES, client=client)]
+
+        self.assertEqual(asyncio.run(collect()), ["A", "B"])
+        self.assertEqual(service.last_usage["total_tokens"], 7)
+
+
+@patch('openai_service.log_openai_call')
+class TestStreamTimeouts(unittest.TestCase):
+    """Test cases for the stream deadline (until the first chunk) and idle timeout (between chunks)"""
+
+    CHUNKS = [_chunk("a"), _chunk("b"), _chunk("c"), _chunk("d")]
+
+    def test_long_stream_outlives_the_deadline(self, _log):
+        """Test that a stream taking longer in total than the deadline still completes"""
+        client = MagicMock()
+        client.chat.completions.create.return_value = _slow_stream(self.CHUNKS, [0, 0.04, 0.04, 0.04])
+        service = OpenAIService(client=client, deployment_name="d", stream_idle_timeout=7)
+        self.assertEqual(list(service.stream_chat_response(MESSAGES, deadline=0.05)), ["a", "b", "c", "d"])
+        timeout = client.chat.completions.create.call_args.kwargs["timeout"]
+        self.assertIsInstance(timeout, httpx.Timeout)
+        self.assertEqual(timeout.read, 7)
+        self.assertLessEqual(timeout.connect, 0.05)
+
+    def test_first_chunk_is_bound_by_the_deadline(self, _log):
+        """Test that a stream whose first chunk arrives after the deadline raises before yielding"""
+        client = MagicMock()
+        client.chat.completions.create.return_value = _slow_stream(self.CHUNKS, [0.1, 0, 0, 0])
+        service = OpenAIService(client=client, deployment_name="d")
+        with self.assertRaises(DeadlineExceeded):
+            list(service.stream_chat_response(MESSAGES, deadline=0.05))
+
+    def test_read_timeout_mid_stream_is_an_idle_timeout(self, _log):
+        """Test that a transport read timeout after the first chunk surfaces as StreamIdleTimeout"""
+        def stalled():
+            yield _chunk("a")
+            raise httpx.ReadTimeout("timed out")
+
+        client = MagicMock()
+        client.chat.completions.create.return_value = stalled()
+        service = OpenAIService(client=client, deployment_name="d")
+        pieces = []
+        with self.assertRaises(StreamIdleTimeout):
+            for piece in service.stream_chat_response(MESSAGES):
+                pieces.append(piece)
+        self.assertEqual(pieces, ["a"])
+
+    def run_async_stream(self, delays, deadline, idle):
+        client = MagicMock()
+        client.chat.completions.create = AsyncMock(return_value=_AsyncStream(self.CHUNKS, delays))
+        service = OpenAIService(client=MagicMock(), deployment_name="d", stream_idle_timeout=idle)
+        pieces = []
+
+        async def collect():
+            async for piece in service.astream_chat_response(MESSAGES, client=client, deadline=deadline):
+                pieces.append(piece)
+
+        asyncio.run(collect())
+        return pieces
+
+    def test_async_stream_timeouts(self, _log):
+        """Test the async stream: total time is unbounded, first chunk and gaps are bounded"""
+        self.assertEqual(self.run_async_stream([0, 0.04, 0.04, 0.04], deadline=0.05, idle=1), ["a", "b", "c", "d"])
+        with self.assertRaises(DeadlineExceeded):
+            self.run_async_stream([0.2], deadline=0.05, idle=1)
+        with self.assertRaises(StreamIdleTimeout):
+            self.run_async_stream([0, 0.2], deadline=1, idle=0.05)
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,169 @@
+"""
+Unit tests for the Azure OpenAI rate limiter and request scheduler
+"""
+import asyncio
+import threading
+import time
+import unittest
+from unittest.mock import patch, MagicMock
+import logging
+import httpx
+import openai
+from openai_service import OpenAIService, DeadlineExceeded
+from rate_limiter import DeploymentScheduler, RateLimiter, QueueTimeout, INTERACTIVE, SUMMARY, BACKGROUND
+
+# Configure logging for tests
+logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+MESSAGES = [{"role": "user", "content": "Hello"}]
+
+
+class TestDeploymentScheduler(unittest.TestCase):
+    """Test cases for the per-deployment token buckets and queue"""
+
+    def test_unlimited_is_a_fast_path(self):
+        """Test that a deployment without limits never waits or queues"""
+        scheduler = DeploymentScheduler("d")
+        self.assertTrue(scheduler.unlimited)
+        for _ in range(1000):
+            scheduler.acquire(10**6, timeout=0)
+        self.assertEqual(scheduler.get_stats()["max_queue_depth"], 0)
+
+    def test_rpm_bucket(self):
+        """Test that requests beyond the RPM burst wait, and time out when they cannot be admitted"""
+        scheduler = DeploymentScheduler("d", rpm=60, burst_seconds=2)
+        scheduler.acquire(1, timeout=0.01)
+        scheduler.acquire(1, timeout=0.01)
+        with self.assertRaises(QueueTimeout):
+            scheduler.acquire(1, timeout=0.05)
+        stats = scheduler.get_stats()
+        self.assertEqual(stats["admitted"], 2)
+        self.assertEqual(stats["timeouts"], 1)
+        self.assertEqual(stats["queue_depth"], 0)
+
+    def test_tpm_bucket_waits_for_refill(self):
+        """Test that a request waits until the token bucket holds its estimate"""
+        scheduler = DeploymentScheduler("d", tpm=6000, burst_seconds=1)  # 100 tokens, 100 per second
+        scheduler.acquire(100)
+        start = time.monotonic()
+        scheduler.acquire(20, timeout=1)
+        self.assertGreaterEqual(time.monotonic() - start, 0.15)
+
+    def test_oversized_request_is_admitted_when_bucket_is_full(self):
+        """Test that an estimate above the bucket size does not block forever"""
+        scheduler = DeploymentScheduler("d", tpm=6000, burst_seconds=1)
+        scheduler.acquire(10**6, timeout=0.01)
+
+    def test_settle_charges_only_the_overrun(self):
+        """Test that actual usage above the estimate is charged and unused estimate is kept"""
+        scheduler = DeploymentScheduler("d", tpm=60000, burst_seconds=1)  # 1000 tokens
+        scheduler.acquire(500)
+        scheduler.settle(500, 100)
+        self.assertLess(scheduler.get_stats()["available_tokens"], 600)
+        scheduler.settle(100, 600)
+        self.assertLess(scheduler.get_stats()["available_tokens"], 100)
+
+    def test_priority_order(self):
+        """Test that an interactive request queued after background work is admitted first"""
+        scheduler = DeploymentScheduler("d", rpm=600, burst_seconds=1)  # 10 requests, one per 0.1s
+        for _ in range(10):
+            scheduler.acquire(1)
+        order = []
+
+        def worker(priority):
+            scheduler.acquire(1, priority, timeout=5)
+            order.append(priority)
+
+        threads = [threading.Thread(target=worker, args=(BACKGROUND,))]
+        threads[0].start()
+        time.sleep(0.02)
+        threads += [threading.Thread(target=worker, args=(p,)) for p in (SUMMARY, INTERACTIVE)]
+        for t in threads[1:]:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(order, [INTERACTIVE, SUMMARY, BACKGROUND])
+        self.assertEqual(scheduler.get_stats()["admitted_by_priority"]["background"], 1)
+
+    def test_throttled_pauses_admissions(self):
+        """Test that a 429 pause holds back requests the buckets would otherwise allow"""
+        scheduler = DeploymentScheduler("d", rpm=6000)
+        scheduler.throttled(0.2)
+        with self.assertRaises(QueueTimeout):
+            scheduler.acquire(1, timeout=0.05)
+        scheduler.acquire(1, timeout=1)
+        self.assertEqual(scheduler.get_stats()["throttled"], 1)
+
+    def test_async_acquire(self):
+        """Test that async waiters share the buckets and time out the same way"""
+        scheduler = DeploymentScheduler("d", rpm=60, burst_seconds=1)
+
+        async def run():
+            await scheduler.aacquire(1, timeout=0.01)
+            with self.assertRaises(QueueTimeout):
+                await scheduler.aacquire(1, timeout=0.05)
+
+        asyncio.run(run())
+        self.assertEqual(scheduler.get_stats()["timeouts"], 1)
+
+
+class TestRateLimiter(unittest.TestCase):
+    """Test cases for per-deployment limit resolution"""
+
+    def test_deployment_overrides(self):
+        """Test that per-deployment limits override the defaults"""
+        limiter = RateLimiter(rpm=100, tpm=1000, deployment_limits={"gpt-4o": {"tpm": 5000}})
+        self.assertEqual(limiter.limits_for("gpt-4o"), (100, 5000))
+        self.assertEqual(limiter.limits_for("other"), (100, 1000))
+        self.assertIs(limiter.scheduler("gpt-4o"), limiter.scheduler("gpt-4o"))
+        self.assertEqual(set(limiter.get_stats()), {"gpt-4o"})
+
+
+@patch('openai_service.log_openai_call')
+class TestOpenAIServiceScheduling(unittest.TestCase):
+    """Test cases for OpenAIService calls going through the scheduler"""
+
+    def setUp(self):
+        self.limiter = RateLimiter(rpm=60, tpm=100000, deployment_limits={})
+        patcher = patch('openai_service.get_rate_limiter', return_value=self.limiter)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.client = MagicMock()
+        ok = MagicMock()
+        ok.choices = [MagicMock()]
+        ok.choices[0].message.content = "ok"
+        ok.usage.prompt_tokens, ok.usage.completion_tokens, ok.usage.total_tokens = 10, 5, 15
+        self.client.chat.completions.create.return_value = ok
+        self.service = OpenAIService(client=self.client, deployment_name="chat", max_retries=2)
+
+    def test_calls_are_admitted_with_priority(self, _log):
+        """Test that each call is counted against the deployment's buckets under its priority"""
+        self.service.get_chat_response(MESSAGES, max_tokens=200, priority=SUMMARY)
+        stats = self.limiter.get_stats()["chat"]
+        self.assertEqual(stats["admitted_by_priority"]["summary"], 1)
+        self.assertLess(stats["available_tokens"], 100000 * 10 / 60 - 200)
+
+    def test_queue_timeout_becomes_deadline_exceeded(self, _log):
+        """Test that a call the queue cannot admit before its deadline is not sent"""
+        scheduler = self.limiter.scheduler("chat")
+        for _ in range(int(scheduler.request_capacity)):
+            scheduler.acquire(1)
+        with self.assertRaises(DeadlineExceeded):
+            self.service.get_chat_response(MESSAGES, deadline=0.1)
+        self.client.chat.completions.create.assert_not_called()
+
+    @patch('openai_service.time.sleep')
+    def test_429_pauses_the_deployment(self, _sleep, _log):
+        """Test that a rate-limit response pauses the whole deployment for its Retry-After"""
+        response = httpx.Response(429, headers={"retry-after": "1"}, request=httpx.Request("POST", "https://example.test"))
+        self.client.chat.completions.create.side_effect = [
+            openai.RateLimitError("HTTP 429", response=response, body=None), self.client.chat.completions.create.return_value]
+        with patch.object(DeploymentScheduler, "acquire"):
+            self.assertEqual(self.service.get_chat_response(MESSAGES), "ok")
+        stats = self.limiter.get_stats()["chat"]
+        self.assertEqual(stats["throttled"], 1)
+        self.assertGreater(stats["paused_seconds"], 0.5)
+
+
+if __name__ == "__main__":
+    unittest.main()
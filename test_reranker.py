@@ -0,0 +1,86 @@
+"""
+Unit tests for the local reranking stage
+"""
+import unittest
+from unittest.mock import patch
+import logging
+import reranker
+from reranker import Reranker, bm25_scores, search_relevance
+from rag_assistant_with_history_copy import FlaskRAGAssistantWithHistory
+
+# Configure logging for tests
+logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+QUERY = "reset vpn password"
+
+
+def results():
+    return [
+        {"chunk": "The cafeteria menu changes weekly.", "title": "Menu", "relevance": 0.9},
+        {"chunk": "To reset your VPN password open the portal and choose reset password.", "title": "VPN", "relevance": 0.5},
+        {"chunk": "VPN gateways are in two regions.", "title": "Network", "relevance": 0.7},
+    ]
+
+
+class TestReranker(unittest.TestCase):
+    """Test cases for the Reranker class"""
+
+    def test_search_scores_are_preserved(self):
+        """Test that the semantic reranker score wins over the search score, and 1.0 is the fallback"""
+        self.assertEqual(search_relevance({"@search.score": 0.03}), {"search_score": 0.03, "relevance": 0.03})
+        self.assertEqual(search_relevance({"@search.score": 0.03, "@search.reranker_score": 2.5})["relevance"], 2.5)
+        self.assertEqual(search_relevance({}), {"relevance": 1.0})
+
+    def test_bm25_prefers_matching_chunks(self):
+        """Test that BM25 ranks the chunk covering the query terms first"""
+        scores = bm25_scores(QUERY, [r["chunk"] for r in results()])
+        self.assertEqual(scores.index(max(scores)), 1)
+        self.assertEqual(scores[0], 0.0)
+
+    def test_modes(self):
+        """Test ordering by search score, by BM25 and by fusion of the two"""
+        self.assertEqual([r["title"] for r in Reranker(mode="none").rerank(QUERY, results())], ["Menu", "Network", "VPN"])
+        self.assertEqual([r["title"] for r in Reranker(mode="bm25").rerank(QUERY, results())][0], "VPN")
+        fused = Reranker(mode="fusion", fusion_weight=0.7).rerank(QUERY, results())
+        self.assertEqual([r["title"] for r in fused], ["VPN", "Network", "Menu"])
+        self.assertIn("rerank_score", fused[0])
+        self.assertEqual([r["title"] for r in Reranker(mode="fusion", fusion_weight=0.0).rerank(QUERY, results())],
+                         ["Menu", "Network", "VPN"])
+
+    def test_registered_scorer_and_fallback(self):
+        """Test that custom scorers plug in and a failing model falls back to BM25"""
+        with patch.dict(reranker.SCORERS, {"length": lambda q, chunks: [len(c) for c in chunks]}):
+            self.assertEqual(Reranker(mode="length").rerank(QUERY, results())[0]["title"], "VPN")
+
+        def broken(query, chunks):
+            raise RuntimeError("model missing")
+
+        with patch.dict(reranker.SCORERS, {"cross_encoder": broken}):
+            ranker = Reranker(mode="cross_encoder")
+            self.assertEqual(ranker.rerank(QUERY, results())[0]["title"], "VPN")
+            self.assertEqual(ranker.get_stats()["fallbacks"], 1)
+
+    def test_stage_timings(self):
+        """Test that scoring and fusion times are recorded"""
+        ranker = Reranker(mode="fusion")
+        ranker.rerank(QUERY, results())
+        stats = ranker.get_stats()
+        self.assertEqual(stats["calls"], 1)
+        self.assertEqual(set(stats["stage_ms"]), {"score", "fuse"})
+        self.assertEqual(set(ranker.last_timings), {"score", "fuse"})
+
+
+class TestAssistantSearchScores(unittest.TestCase):
+    """Test cases for score handling in the assistant"""
+
+    def test_format_search_results_keeps_scores(self):
+        """Test that search hits keep their scores instead of a constant relevance"""
+        formatted = FlaskRAGAssistantWithHistory._format_search_results(
+            [{"chunk": "c", "title": "t", "parent_id": "p", "@search.score": 0.42}]
+        )
+        self.assertEqual(formatted[0]["relevance"], 0.42)
+        self.assertEqual(formatted[0]["search_score"], 0.42)
+
+
+if __name__ == "__main__":
+    unittest.main()
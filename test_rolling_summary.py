@@ -0,0 +1,121 @@
+"""
+Unit tests for incremental rolling summaries
+"""
+import time
+import unittest
+from unittest.mock import MagicMock, patch
+import logging
+from rolling_summary import SummaryFolder
+from rag_assistant_with_history_copy import FlaskRAGAssistantWithHistory
+
+# Configure logging for tests
+logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+
+def messages(*texts):
+    return [{"role": "user", "content": t} for t in texts]
+
+
+class TestSummaryFolder(unittest.TestCase):
+    """Test cases for the fold cache"""
+
+    def test_longest_prefix_lookup(self):
+        """Test that lookups find the longest folded prefix of the evicted messages"""
+        folder = SummaryFolder()
+        folder.put("", messages("a"), "S1")
+        folder.put("", messages("a", "b"), "S2")
+        self.assertEqual(folder.lookup("", messages("a", "b", "c")), ("S2", 2))
+        self.assertEqual(folder.lookup("other", messages("a")), ("other", 0))
+
+    def test_background_fold_runs_once(self):
+        """Test that the same fold is not scheduled twice while it runs or once it is cached"""
+        folder = SummaryFolder()
+        fold = MagicMock(side_effect=lambda summary, msgs: (time.sleep(0.05), "S")[1])
+        self.assertTrue(folder.fold_in_background("", messages("a"), fold))
+        self.assertFalse(folder.fold_in_background("", messages("a"), fold))
+        folder._executor.shutdown(wait=True)
+        self.assertFalse(folder.fold_in_background("", messages("a"), fold))
+        fold.assert_called_once()
+        self.assertEqual(folder.lookup("", messages("a")), ("S", 1))
+
+
+class TestAssistantRollingSummary(unittest.TestCase):
+    """Test cases for incremental summarization in FlaskRAGAssistantWithHistory"""
+
+    def setUp(self):
+        for target, value in (('rag_assistant_with_history_copy.get_openai_client', MagicMock()),
+                              ('rag_assistant_with_history_copy.get_summary_folder', SummaryFolder())):
+            patcher = patch(target, return_value=value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.assistant = self.new_assistant()
+
+    def new_assistant(self):
+        assistant = FlaskRAGAssistantWithHistory()
+        assistant.history_trim_strategy = "turns"
+        assistant.max_history_turns = 1
+        assistant.summarize_history = MagicMock(
+            side_effect=lambda msgs, previous="": {
+                "role": "system",
+                "content": assistant.SUMMARY_PREFIX + previous + "".join(m["content"] for m in msgs)})
+        return assistant
+
+    def turn(self, n):
+        manager = self.assistant.conversation_manager
+        manager.add_user_message(f"q{n}")
+        trimmed, _ = self.assistant._trim_history(manager.get_history())
+        manager.add_assistant_message(f"a{n}")
+        self.assistant._schedule_summary_fold()
+        return trimmed
+
+    def test_only_new_evictions_are_folded(self):
+        """Test that each turn folds just the messages evicted since the previous one"""
+        self.turn(0)
+        trimmed = self.turn(1)
+        self.assertEqual(trimmed[1]["content"], "Previous conversation summary: q0")
+        trimmed = self.turn(2)
+        self.assertEqual(trimmed[1]["content"], "Previous conversation summary: q0a0q1")
+        self.assertEqual([m["content"] for m in trimmed[2:]], ["a1", "q2"])
+        calls = self.assistant.summarize_history.call_args_list
+        self.assertEqual([len(c.args[0]) for c in calls], [1, 2])
+        self.assertEqual(calls[1].args[1], "q0")
+
+    def test_summary_survives_session_reload(self):
+        """Test that a rebuilt assistant resumes the summary instead of re-summarizing"""
+        self.turn(0)
+        self.turn(1)
+        state = self.assistant.export_state()
+        self.assistant = self.new_assistant()
+        self.assistant.load_state(state)
+        trimmed = self.turn(2)
+        self.assertEqual(trimmed[1]["content"], "Previous conversation summary: q0a0q1")
+        self.assertEqual(self.assistant.summarize_history.call_args.args, (
+            [{"role": "assistant", "content": "a0"}, {"role": "user", "content": "q1"}], "q0"))
+
+    def test_async_fold_happens_after_the_response(self):
+        """Test that deferred folds keep messages verbatim for one turn and are reused afterwards"""
+        self.assistant.summarization_settings["async_fold"] = True
+        self.turn(0)
+        trimmed = self.turn(1)
+        self.assertEqual([m["content"] for m in trimmed[1:]], ["q0", "a0", "q1"])
+
+        # The fold scheduled after turn 1's response lands in the shared cache
+        from rag_assistant_with_history_copy import get_summary_folder
+        get_summary_folder()._executor.shutdown(wait=True)
+        self.assistant.summarize_history.reset_mock()
+        self.assistant.summarization_settings["async_fold"] = False
+        trimmed = self.turn(2)
+        self.assertEqual(trimmed[1]["content"], "Previous conversation summary: q0a0q1")
+        self.assertEqual(self.assistant.summarize_history.call_args.args, (
+            [{"role": "assistant", "content": "a0"}, {"role": "user", "content": "q1"}], "q0"))
+
+    def test_clear_resets_summary(self):
+        """Test that clearing the conversation drops the running summary"""
+        self.turn(0)
+        self.turn(1)
+        self.assistant.clear_conversation_history()
+        self.assertEqual((self.assistant.rolling_summary, self.assistant.summary_watermark), ("", 0))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,77 @@
+"""
+Unit tests for the SemanticCache class
+"""
+import unittest
+from unittest.mock import patch
+import logging
+from semantic_cache import SemanticCache, make_fingerprint
+
+# Configure logging for tests
+logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+class TestSemanticCache(unittest.TestCase):
+    """Test cases for the SemanticCache class"""
+
+    def setUp(self):
+        """Set up a new cache and a default fingerprint for each test"""
+        self.cache = SemanticCache(threshold=0.95, max_entries=3, ttl=60, enabled=True)
+        self.fingerprint = make_fingerprint(search_index="kb", system_prompt="Answer with citations.")
+        self.payload = {"answer": "Use the purge valve [1].", "sources": [{"id": "1"}], "context": "ctx"}
+
+    def test_hit_above_threshold(self):
+        """Test that a near-identical embedding returns the stored answer"""
+        self.cache.store(self.fingerprint, [1.0, 0.0, 0.0], self.payload)
+        hit = self.cache.lookup(self.fingerprint, [0.99, 0.05, 0.0])
+
+        self.assertIsNotNone(hit)
+        self.assertEqual(hit["answer"], self.payload["answer"])
+        self.assertGreaterEqual(hit["similarity"], 0.95)
+
+    def test_miss_below_threshold(self):
+        """Test that a dissimilar embedding is a miss"""
+        self.cache.store(self.fingerprint, [1.0, 0.0, 0.0], self.payload)
+        self.assertIsNone(self.cache.lookup(self.fingerprint, [0.0, 1.0, 0.0]))
+
+        stats = self.cache.get_stats()
+        self.assertEqual(stats["hits"], 0)
+        self.assertEqual(stats["misses"], 1)
+
+    def test_fingerprint_isolation(self):
+        """Test that a changed system prompt or index does not reuse old answers"""
+        self.cache.store(self.fingerprint, [1.0, 0.0, 0.0], self.payload)
+        other = make_fingerprint(search_index="kb", system_prompt="A different prompt.")
+        self.assertNotEqual(self.fingerprint, other)
+        self.assertIsNone(self.cache.lookup(other, [1.0, 0.0, 0.0]))
+
+    def test_invalidate(self):
+        """Test explicit invalidation"""
+        self.cache.store(self.fingerprint, [1.0, 0.0, 0.0], self.payload)
+        self.cache.invalidate(self.fingerprint)
+        self.assertIsNone(self.cache.lookup(self.fingerprint, [1.0, 0.0, 0.0]))
+
+    def test_lru_eviction(self):
+        """Test that the oldest entry is evicted once the cache is full"""
+        vectors = [[1.0, 0.0, 0.0], [0.0, 1.0, 0.0], [0.0, 0.0, 1.0], [1.0, 1.0, 0.0]]
+        for i, vec in enumerate(vectors):
+            self.cache.store(self.fingerprint, vec, {"answer": str(i)})
+
+        self.assertIsNone(self.cache.lookup(self.fingerprint, [1.0, 0.0, 0.0]))
+        self.assertEqual(self.cache.lookup(self.fingerprint, [1.0, 1.0, 0.0])["answer"], "3")
+        self.assertEqual(self.cache.get_stats()["evictions"], 1)
+
+    def test_ttl_expiry(self):
+        """Test that entries older than the TTL are not served"""
+        with patch("semantic_cache.time.time", return_value=1000.0):
+            self.cache.store(self.fingerprint, [1.0, 0.0, 0.0], self.payload)
+        with patch("semantic_cache.time.time", return_value=1100.0):
+            self.assertIsNone(self.cache.lookup(self.fingerprint, [1.0, 0.0, 0.0]))
+        self.assertEqual(self.cache.get_stats()["expired"], 1)
+
+    def test_disabled(self):
+        """Test that a disabled cache never stores or serves answers"""
+        cache = SemanticCache(enabled=False)
+        cache.store(self.fingerprint, [1.0, 0.0], self.payload)
+        self.assertIsNone(cache.lookup(self.fingerprint, [1.0, 0.0]))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,287 @@
+"""
+Unit tests for the session store backends
+"""
+import os
+import tempfile
+import threading
+import time
+import unittest
+from unittest.mock import MagicMock, patch
+import logging
+from session_store import SessionBusy, SessionStore, MemorySessionStore, SQLiteSessionStore, RedisSessionStore, encode_state
+from rag_assistant_with_history_copy import FlaskRAGAssistantWithHistory
+
+# Configure logging for tests
+logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+STATE = {"history": [{"role": "system", "content": "sys"}, {"role": "user", "content": "hi"}],
+         "attrs": {"temperature": 0.1}}
+
+
+class TestSessionStoreBase(unittest.TestCase):
+    """Test cases for the SessionStore base class"""
+
+    def test_backends_must_implement_storage(self):
+        """Test that the base class and incomplete backends cannot be instantiated"""
+        self.assertRaises(TypeError, SessionStore)
+
+        class Incomplete(SessionStore):
+            def _load(self, session_id):
+                return None
+
+        self.assertRaises(TypeError, Incomplete)
+
+
+class TestMemorySessionStore(unittest.TestCase):
+    """Test cases for the in-process backend"""
+
+    def test_round_trip_returns_copy(self):
+        """Test that stored state comes back equal but not shared"""
+        store = MemorySessionStore(ttl=60, max_entries=10, max_bytes=10**6)
+        store.put("a", STATE)
+        loaded = store.get("a")
+        self.assertEqual(loaded, STATE)
+        loaded["history"].append({"role": "user", "content": "mutated"})
+        self.assertEqual(store.get("a"), STATE)
+        self.assertIsNone(store.get("missing"))
+        self.assertEqual(store.get_stats()["misses"], 1)
+
+    def test_lru_eviction_by_entries(self):
+        """Test that the least recently used session is evicted first"""
+        store = MemorySessionStore(ttl=60, max_entries=2, max_bytes=10**6)
+        store.put("a", STATE)
+        store.put("b", STATE)
+        store.get("a")  # b is now least recently used
+        store.put("c", STATE)
+        self.assertIsNone(store.get("b"))
+        self.assertIsNotNone(store.get("a"))
+        self.assertEqual(store.get_stats()["evicted"], 1)
+
+    def test_byte_cap(self):
+        """Test that the byte cap bounds the total encoded size"""
+        size = len(encode_state(STATE))
+        store = MemorySessionStore(ttl=60, max_entries=100, max_bytes=size * 2)
+        for sid in "abcd":
+            store.put(sid, STATE)
+        stats = store.get_stats()
+        self.assertEqual(stats["entries"], 2)
+        self.assertLessEqual(stats["bytes"], size * 2)
+
+    def test_ttl_expiry(self):
+        """Test that idle sessions expire"""
+        store = MemorySessionStore(ttl=0.01, max_entries=10, max_bytes=10**6)
+        store.put("a", STATE)
+        time.sleep(0.02)
+        self.assertIsNone(store.get("a"))
+        self.assertEqual(store.get_stats()["expired"], 1)
+
+
+class TestSQLiteSessionStore(unittest.TestCase):
+    """Test cases for the SQLite backend"""
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.path = os.path.join(self.tmp.name, "sessions.db")
+
+    def test_shared_between_instances(self):
+        """Test that a second store (another worker) sees the same sessions"""
+        SQLiteSessionStore(path=self.path, ttl=60).put("a", STATE)
+        other = SQLiteSessionStore(path=self.path, ttl=60)
+        self.assertEqual(other.get("a"), STATE)
+        other.delete("a")
+        self.assertIsNone(other.get("a"))
+
+    def test_expiry_and_pruning(self):
+        """Test that expired rows are ignored and the LRU cap is enforced on prune"""
+        store = SQLiteSessionStore(path=self.path, ttl=60, max_entries=2, prune_every=3)
+        store.put("a", STATE)
+        store.put("b", STATE)
+        store.put("c", STATE)  # third write prunes down to the two most recent
+        self.assertEqual(store.get_stats()["entries"], 2)
+        self.assertIsNone(store.get("a"))
+
+        store.ttl = -1
+        store.put("d", STATE)
+        self.assertIsNone(store.get("d"))
+        self.assertEqual(store.get_stats()["expired"], 1)
+
+
+class TestRedisSessionStore(unittest.TestCase):
+    """Test cases for the Redis backend"""
+
+    def test_ttl_is_set_and_renewed(self):
+        """Test that writes set a TTL and reads renew it"""
+        client = MagicMock()
+        client.pipeline.return_value.execute.return_value = [encode_state(STATE), True]
+        store = RedisSessionStore(ttl=120, client=client)
+
+        store.put("a", STATE)
+        client.set.assert_called_once_with("rag:session:a", encode_state(STATE), ex=120)
+        self.assertEqual(store.get("a"), STATE)
+        client.pipeline.return_value.expire.assert_called_once_with("rag:session:a", 120)
+
+    def test_errors_are_contained(self):
+        """Test that an unreachable server reads as a miss instead of failing the request"""
+        client = MagicMock()
+        client.pipeline.return_value.execute.side_effect = ConnectionError("refused")
+        store = RedisSessionStore(client=client)
+        self.assertIsNone(store.get("a"))
+        self.assertEqual(store.get_stats()["errors"], 1)
+
+
+def take_turn(store, session_id, turn, pause=0.05):
+    """Load, slowly extend and save a session the way one request does"""
+    with store.lock(session_id):
+        state = store.get(session_id) or {"turns": []}
+        time.sleep(pause)
+        state["turns"].append(turn)
+        store.put(session_id, state)
+
+
+class TestSessionLocks(unittest.TestCase):
+    """Test cases for serializing concurrent turns of one session"""
+
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp(suffix=".db")
+        os.close(fd)
+        self.addCleanup(os.remove, self.path)
+
+    def test_concurrent_turns_are_not_lost(self):
+        """Test that two threads answering one session both keep their turn"""
+        store = MemorySessionStore(ttl=60, max_entries=10, max_bytes=10**6)
+        threads = [threading.Thread(target=take_turn, args=(store, "a", n)) for n in range(2)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(sorted(store.get("a")["turns"]), [0, 1])
+        self.assertEqual(store.get_stats()["lock_waits"], 1)
+
+    def test_lock_timeout(self):
+        """Test that a turn gives up with SessionBusy when the session stays held"""
+        store = MemorySessionStore(ttl=60, max_entries=10, max_bytes=10**6)
+        with store.lock("a"):
+            with self.assertRaises(SessionBusy):
+                with store.lock("a", timeout=0.05):
+                    pass
+            with store.lock("b", timeout=0.05):
+                pass
+        self.assertEqual(store.get_stats()["lock_timeouts"], 1)
+
+    def test_sqlite_lease_is_shared_between_workers(self):
+        """Test that two stores on one file (two workers) cannot hold a session at once"""
+        first = SQLiteSessionStore(path=self.path, ttl=60)
+        second = SQLiteSessionStore(path=self.path, ttl=60)
+        with first.lock("a"):
+            with self.assertRaises(SessionBusy):
+                second.acquire_lease("a", timeout=0.1)
+        token = second.acquire_lease("a", timeout=0)
+        self.assertIsNotNone(token)
+        second.release_lease("a", token)
+
+    def test_sqlite_expired_lease_is_taken_over(self):
+        """Test that a lease left by a dead worker expires and its late release is ignored"""
+        dead = SQLiteSessionStore(path=self.path, ttl=60)
+        dead.lease_ttl = -1
+        stale = dead.acquire_lease("a", timeout=0)
+        live = SQLiteSessionStore(path=self.path, ttl=60)
+        token = live.acquire_lease("a", timeout=0)
+        dead.release_lease("a", stale)
+        with self.assertRaises(SessionBusy):
+            dead.acquire_lease("a", timeout=0)
+        live.release_lease("a", token)
+
+    def test_redis_lease_uses_set_nx_and_compare_and_delete(self):
+        """Test that the Redis lease is taken with SET NX and released only by its holder"""
+        client = MagicMock()
+        client.set.side_effect = [None, True]
+        store = RedisSessionStore(client=client)
+        with store.lock("a", timeout=1):
+            pass
+        key = "rag:session:a:lease"
+        token = client.set.call_args.args[1]
+        self.assertEqual(client.set.call_args.kwargs, {"nx": True, "ex": store.lease_ttl})
+        self.assertEqual(client.eval.call_args.args[1:], (1, key, token))
+        self.assertEqual(store.get_stats()["lock_waits"], 1)
+
+
+class _TurnRecordingAssistant:
+    """Stand-in assistant whose answer appends the query to the stored turns"""
+
+    deployment_name, temperature, max_tokens, top_p = "gpt", 0.1, 100, 1.0
+    last_response_cached = False
+
+    def __init__(self):
+        self.turns = []
+
+    def load_state(self, state):
+        self.turns = list(state["turns"])
+
+    def export_state(self):
+        return {"turns": self.turns}
+
+    def generate_rag_response(self, query, is_enhanced=False):
+        time.sleep(0.05)
+        self.turns.append(query)
+        return "answer", [], None, None, ""
+
+    def stream_rag_response(self, query):
+        time.sleep(0.05)
+        self.turns.append(query)
+        yield "answer"
+
+
+class TestFlaskSessionTurns(unittest.TestCase):
+    """Test cases for session serialization in the Flask query routes"""
+
+    def test_concurrent_requests_keep_both_turns(self):
+        """Test that overlapping /api/query and /api/stream_query calls for one session both persist"""
+        import main
+        store = MemorySessionStore(ttl=60, max_entries=10, max_bytes=10**6)
+        responses = []
+
+        def post(path, query):
+            with main.app.test_client() as client:
+                with client.session_transaction() as sess:
+                    sess["session_id"] = "shared"
+                response = client.post(path, json={"query": query})
+                responses.append((response.status_code, response.get_data(as_text=True)))
+
+        with patch("main.get_session_store", return_value=store), \
+                patch("main.FlaskRAGAssistantWithHistory", _TurnRecordingAssistant):
+            threads = [threading.Thread(target=post, args=("/api/query", "first")),
+                       threading.Thread(target=post, args=("/api/stream_query", "second"))]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+
+        self.assertEqual([status for status, _ in responses], [200, 200])
+        self.assertEqual(sorted(store.get("shared")["turns"]), ["first", "second"])
+
+
+class TestAssistantSessionState(unittest.TestCase):
+    """Test cases for exporting and restoring assistant conversation state"""
+
+    @patch('rag_assistant_with_history_copy.get_openai_client', return_value=MagicMock())
+    def test_state_round_trip(self, _client):
+        """Test that a fresh assistant resumes the stored conversation and settings"""
+        first = FlaskRAGAssistantWithHistory()
+        first.temperature = 0.9
+        first.deployment_name = "custom-deployment"
+        first.conversation_manager.add_user_message("hello")
+        first.conversation_manager.add_assistant_message("hi there")
+
+        store = MemorySessionStore(ttl=60, max_entries=10, max_bytes=10**6)
+        store.put("s", first.export_state())
+
+        second = FlaskRAGAssistantWithHistory()
+        second.load_state(store.get("s"))
+        self.assertEqual(second.temperature, 0.9)
+        self.assertEqual(second.openai_service.deployment_name, "custom-deployment")
+        self.assertEqual(second.conversation_manager.get_history(), first.conversation_manager.get_history())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,56 @@
+"""
+Unit tests for the similarity module
+"""
+import unittest
+import numpy as np
+import similarity
+
+class TestSimilarity(unittest.TestCase):
+    """Test cases for the vectorized cosine similarity helpers"""
+
+    def test_cosine_similarity_matches_reference(self):
+        """Test that the NumPy version matches the original pure-Python formula"""
+        a = [0.3, -1.2, 4.0, 0.0]
+        b = [1.5, 0.2, 3.3, -0.7]
+        dot = sum(x * y for x, y in zip(a, b))
+        mag = (sum(x * x for x in a) ** 0.5) * (sum(y * y for y in b) ** 0.5)
+        self.assertAlmostEqual(similarity.cosine_similarity(a, b), dot / mag, places=5)
+
+    def test_cosine_similarity_zero_vector(self):
+        """Test that a zero-magnitude vector scores 0.0"""
+        self.assertEqual(similarity.cosine_similarity([0.0, 0.0], [1.0, 2.0]), 0.0)
+
+    def test_cosine_similarities_batch(self):
+        """Test scoring one query against a matrix in one call"""
+        matrix = [[1.0, 0.0], [0.0, 2.0], [-3.0, 0.0], [0.0, 0.0]]
+        scores = similarity.cosine_similarities([1.0, 0.0], matrix)
+        np.testing.assert_allclose(scores, [1.0, 0.0, -1.0, 0.0], atol=1e-6)
+
+    def test_top_k(self):
+        """Test that top_k returns the best rows in descending order"""
+        rng = np.random.default_rng(42)
+        matrix = rng.normal(size=(50, 16))
+        query = matrix[7] + 0.01 * rng.normal(size=16)
+
+        indices, scores = similarity.top_k(query, matrix, 5)
+        self.assertEqual(len(indices), 5)
+        self.assertEqual(indices[0], 7)
+        self.assertTrue(np.all(np.diff(scores) <= 0))
+
+        expected = np.argsort(-similarity.cosine_similarities(query, matrix))[:5]
+        np.testing.assert_array_equal(indices, expected)
+
+    def test_top_k_clamps_k(self):
+        """Test that k larger than N returns every row"""
+        indices, scores = similarity.top_k([1.0, 0.0], [[0.0, 1.0], [1.0, 0.0]], 10)
+        np.testing.assert_array_equal(indices, [1, 0])
+        self.assertEqual(len(scores), 2)
+
+    def test_top_k_empty(self):
+        """Test that an empty matrix yields no results"""
+        indices, scores = similarity.top_k([1.0, 0.0], np.zeros((0, 2)), 3)
+        self.assertEqual(len(indices), 0)
+        self.assertEqual(len(scores), 0)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,81 @@
+"""
+Unit tests for speculative retrieval
+"""
+import unittest
+from unittest.mock import MagicMock, patch
+import logging
+import speculative_retrieval
+from rag_assistant_with_history_copy import FlaskRAGAssistantWithHistory
+
+# Configure logging for tests
+logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+
+class TestSpeculativeHelpers(unittest.TestCase):
+    """Test cases for the query comparison and merge helpers"""
+
+    def test_queries_differ(self):
+        """Test the term-overlap comparison"""
+        self.assertFalse(speculative_retrieval.queries_differ("How do I reset the pump?", "how do I reset the pump"))
+        self.assertTrue(speculative_retrieval.queries_differ(
+            "reset it", "OpenLab CDS pump reset procedure after pressure error"
+        ))
+        self.assertFalse(speculative_retrieval.queries_differ("", ""))
+
+    def test_merge_results(self):
+        """Test that merging keeps primary order and drops duplicates"""
+        a = {"chunk": "a", "parent_id": "1"}
+        b = {"chunk": "b", "parent_id": "1"}
+        c = {"chunk": "c", "parent_id": "2"}
+        merged = speculative_retrieval.merge_results([b, a], [a, c], limit=10)
+        self.assertEqual(merged, [b, a, c])
+        self.assertEqual(speculative_retrieval.merge_results([a, b], [c], limit=2), [a, b])
+
+
+class TestSpeculativeRetrieve(unittest.TestCase):
+    """Test cases for FlaskRAGAssistantWithHistory._retrieve"""
+
+    def setUp(self):
+        patcher = patch('rag_assistant_with_history_copy.get_openai_client', return_value=MagicMock())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.assistant = FlaskRAGAssistantWithHistory(settings={"speculative_retrieval": True})
+        self.searched = []
+
+        def fake_search(query):
+            self.searched.append(query)
+            return [{"chunk": query, "parent_id": ""}]
+
+        self.assistant.search_knowledge_base = fake_search
+
+    def test_reuses_raw_results_when_queries_match(self):
+        """Test that only one search runs when enhancement changes nothing material"""
+        self.assistant._get_enhanced_query = lambda q: q.upper()
+        results = self.assistant._retrieve("reset the pump")
+        self.assertEqual(self.searched, ["reset the pump"])
+        self.assertEqual(results, [{"chunk": "reset the pump", "parent_id": ""}])
+
+    def test_reissues_and_merges_when_queries_differ(self):
+        """Test that a materially different enhanced query is searched and ranked first"""
+        self.assistant._get_enhanced_query = lambda q: "OpenLab CDS pump reset procedure"
+        results = self.assistant._retrieve("reset it")
+        self.assertCountEqual(self.searched, ["reset it", "OpenLab CDS pump reset procedure"])
+        self.assertEqual([r["chunk"] for r in results], ["OpenLab CDS pump reset procedure", "reset it"])
+
+    def test_disabled_mode_searches_enhanced_only(self):
+        """Test that the sequential path is kept when the mode is off"""
+        self.assistant.settings["speculative_retrieval"] = False
+        self.assistant._get_enhanced_query = lambda q: "enhanced"
+        self.assistant._retrieve("raw")
+        self.assertEqual(self.searched, ["enhanced"])
+
+    def test_already_enhanced_query(self):
+        """Test that an already enhanced query skips enhancement entirely"""
+        self.assistant._get_enhanced_query = MagicMock()
+        self.assistant._retrieve("raw", is_enhanced=True)
+        self.assistant._get_enhanced_query.assert_not_called()
+        self.assertEqual(self.searched, ["raw"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,131 @@
+"""
+Unit tests for token counting and token-budget history trimming
+"""
+import unittest
+from unittest.mock import MagicMock, patch
+import logging
+import token_counter
+from token_counter import count_tokens, count_message_tokens, encoding_name, MESSAGE_OVERHEAD
+from conversation_state import Message, CONTEXT_MESSAGE_TEMPLATE, render_context, encode_messages, decode_messages
+from rag_assistant_with_history_copy import FlaskRAGAssistantWithHistory
+
+# Configure logging for tests
+logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+CHUNKS = [f"Chunk {i}: " + "Reset the VPN profile from the portal and sign in again. " * 20 for i in range(3)]
+
+
+def context_message(query):
+    return CONTEXT_MESSAGE_TEMPLATE.format(context=render_context(CHUNKS), query=query)
+
+
+class TestTokenCounter(unittest.TestCase):
+    """Test cases for token counting"""
+
+    def test_encoding_selection(self):
+        """Test that deployment names map to the right tokenizer family"""
+        self.assertEqual(encoding_name("gpt-4o-mini"), "o200k_base")
+        self.assertEqual(encoding_name("o3-mini"), "o200k_base")
+        self.assertEqual(encoding_name("gpt-35-turbo"), "cl100k_base")
+        self.assertEqual(encoding_name(None), "cl100k_base")
+
+    def test_counts(self):
+        """Test that counts are positive, grow with text and include message framing"""
+        self.assertEqual(count_tokens(""), 0)
+        short, long = count_tokens("hello"), count_tokens("hello " * 100)
+        self.assertGreater(short, 0)
+        self.assertGreater(long, short)
+        self.assertGreaterEqual(count_message_tokens("user", "hello"), MESSAGE_OVERHEAD + short)
+
+    def test_fallback_without_tiktoken(self):
+        """Test the character-based estimate used when tiktoken is not installed"""
+        with patch.object(token_counter, "tiktoken", None):
+            self.assertEqual(count_tokens("x" * 10), 3)
+
+
+class TestMessageTokenCache(unittest.TestCase):
+    """Test cases for the per-message token cache"""
+
+    def test_counted_once(self):
+        """Test that a message is tokenized only the first time"""
+        message = Message("user", "hello there")
+        with patch("conversation_state.count_message_tokens", return_value=7) as counter:
+            self.assertEqual(message.token_count(), 7)
+            self.assertEqual(message.token_count(), 7)
+        counter.assert_called_once()
+
+    def test_cache_survives_serialization(self):
+        """Test that cached counts are stored with the conversation"""
+        message = Message("user", "hello there")
+        message.token_count()
+        decoded = decode_messages(encode_messages([message, Message("assistant", "hi")]))
+        self.assertEqual(decoded[0].tokens, message.tokens)
+        self.assertIsNone(decoded[1].tokens)
+
+
+class TestTokenBudgetTrimming(unittest.TestCase):
+    """Test cases for FlaskRAGAssistantWithHistory token-budget trimming"""
+
+    def setUp(self):
+        patcher = patch('rag_assistant_with_history_copy.get_openai_client', return_value=MagicMock())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.assistant = FlaskRAGAssistantWithHistory()
+        self.assistant.history_trim_strategy = "tokens"
+        # Exercise the budget stage on its own; compaction is covered in test_history_compaction
+        self.assistant.history_compaction = False
+        self.assistant.summarize_history = MagicMock(
+            return_value={"role": "system", "content": "Previous conversation summary: ..."})
+        manager = self.assistant.conversation_manager
+        for i in range(4):
+            manager.add_user_message(context_message(f"question {i}"))
+            manager.add_assistant_message(f"answer {i}")
+        self.history = manager.get_history()
+        self.full = sum(m.token_count(self.assistant.deployment_name) for m in manager.get_messages())
+
+    def test_under_budget_is_untouched(self):
+        """Test that history within the budget is passed through as-is"""
+        self.assistant.history_token_budget = self.full + 100
+        trimmed, was_trimmed = self.assistant._trim_history(self.history)
+        self.assertFalse(was_trimmed)
+        self.assertIs(trimmed, self.history)
+        self.assistant.summarize_history.assert_not_called()
+
+    def test_context_is_stripped_before_dropping(self):
+        """Test that older turns lose their context first and no message is dropped if that suffices"""
+        self.assistant.history_token_budget = self.full - 100
+        trimmed, was_trimmed = self.assistant._trim_history(self.history)
+        self.assertTrue(was_trimmed)
+        self.assertEqual(len(trimmed), len(self.history))
+        self.assertEqual(trimmed[1], {"role": "user", "content": "question 0"})
+        self.assertEqual(trimmed[-2], self.history[-2])  # current turn keeps its context
+        self.assistant.summarize_history.assert_not_called()
+        # The stored conversation is not modified
+        self.assertEqual(self.assistant.conversation_manager.get_history(), self.history)
+
+    def test_oldest_messages_are_summarized(self):
+        """Test that messages dropped to fit the budget are summarized"""
+        model = self.assistant.deployment_name
+        messages = self.assistant.conversation_manager.get_messages()
+        self.assistant.summarization_settings["max_summary_tokens"] = 10
+        self.assistant.history_token_budget = sum(m.token_count(model) for m in messages[:1] + messages[-2:]) + 25
+        trimmed, was_trimmed = self.assistant._trim_history(self.history)
+        self.assertTrue(was_trimmed)
+        self.assertEqual(trimmed[0], self.history[0])
+        self.assertEqual(trimmed[1]["content"], "Previous conversation summary: ...")
+        self.assertEqual(trimmed[-1], self.history[-1])
+        self.assertLess(len(trimmed), len(self.history))
+        self.assertNotEqual(trimmed[2]["role"], "assistant")
+        self.assistant.summarize_history.assert_called_once()
+
+    def test_turn_strategy_still_available(self):
+        """Test that the turn-count strategy keeps its behavior"""
+        self.assistant.history_trim_strategy = "turns"
+        self.assistant.max_history_turns = 10
+        trimmed, was_trimmed = self.assistant._trim_history(self.history)
+        self.assertFalse(was_trimmed)
+        self.assertEqual(self.assistant._trim_notice()["content"], "[History trimmed to last 10 turns]")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,79 @@
+"""
+Token counting for chat messages, backed by tiktoken when it is installed
+"""
+import logging
+import math
+import threading
+from typing import Dict, Optional
+
+try:
+    import tiktoken
+except ImportError:  # pragma: no cover - optional dependency
+    tiktoken = None
+
+logger = logging.getLogger(__name__)
+
+# Per-message framing tokens (role, separators) and the tokens priming the reply,
+# as documented for the chat completions format
+MESSAGE_OVERHEAD = 4
+REPLY_OVERHEAD = 3
+
+# Used when tiktoken is unavailable: English text averages about four characters per token
+CHARS_PER_TOKEN = 4
+
+_encodings: Dict[str, object] = {}
+_lock = threading.Lock()
+
+
+def encoding_name(model: Optional[str]) -> str:
+    """
+    Pick the tokenizer for a model or Azure deployment name.
+
+    Deployment names are free-form, so this matches on the model family they usually contain.
+    """
+    name = (model or "").lower()
+    if "4o" in name or "4.1" in name or "gpt-5" in name or name.startswith(("o1", "o3", "o4")):
+        return "o200k_base"
+    return "cl100k_base"
+
+
+def _get_encoding(model: Optional[str]):
+    if tiktoken is None:
+        return None
+    name = encoding_name(model)
+    encoding = _encodings.get(name)
+    if encoding is None:
+        with _lock:
+            encoding = _encodings.get(name)
+            if encoding is None:
+                try:
+                    encoding = tiktoken.get_encoding(name)
+                except Exception as e:
+                    logger.warning(f"Could not load tokenizer {name}, estimating token counts: {e}")
+                    encoding = False
+                _encodings[name] = encoding
+    return encoding or None
+
+
+def count_tokens(text: str, model: Optional[str] = None) -> int:
+    """
+    Count the tokens in a piece of text.
+
+    Args:
+        text: The text to count
+        model: Model or deployment name used to pick the tokenizer
+
+    Returns:
+        The exact count with tiktoken, otherwise a character-based estimate
+    """
+    if not text:
+        return 0
+    encoding = _get_encoding(model)
+    if encoding is None:
+        return math.ceil(len(text) / CHARS_PER_TOKEN)
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def count_message_tokens(role: str, content: str, model: Optional[str] = None) -> int:
+    """Count the tokens one chat message adds to a prompt, including its framing."""
+    return MESSAGE_OVERHEAD + count_tokens(role, model) + count_tokens(content, model)